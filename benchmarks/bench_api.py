@@ -0,0 +1,641 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks da API HTTP e da escrita na BD: latência p50/p99 de /status e
+/api/info com clientes concorrentes, e débito do gravar_contagem contra a
+BD simulada.
+"""
+
+import gzip
+import http.client
+import json
+import struct
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+from .simulacao import TempoSemEspera, percentis, preparar_ordem_ativa
+
+
+def _carga(porta, caminho, clientes, pedidos_por_cliente):
+    latencias = []
+    erros = [0]
+    lock = threading.Lock()
+
+    def cliente():
+        locais = []
+        for _ in range(pedidos_por_cliente):
+            t0 = time.perf_counter()
+            try:
+                conn = http.client.HTTPConnection("127.0.0.1", porta, timeout=30)
+                conn.request("GET", caminho)
+                resposta = conn.getresponse()
+                resposta.read()
+                conn.close()
+                if resposta.status != 200:
+                    with lock:
+                        erros[0] += 1
+            except Exception:
+                with lock:
+                    erros[0] += 1
+            locais.append(time.perf_counter() - t0)
+        with lock:
+            latencias.extend(locais)
+
+    threads = [threading.Thread(target=cliente) for _ in range(clientes)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    total = time.perf_counter() - t0
+
+    resultado = percentis(latencias)
+    resultado["pedidos"] = len(latencias)
+    resultado["erros"] = erros[0]
+    resultado["pedidos_por_s"] = round(len(latencias) / total, 1) if total else None
+    return resultado
+
+
+def bench_api(main, gpio, bd, rapido=False):
+    """Latência de /status e /api/info com N clientes concorrentes"""
+    pontos = 1000
+    contador = preparar_ordem_ativa(main, pontos=pontos)
+    bd.preencher_historico(contador.Ordem, 180)
+
+    servidor = make_server("127.0.0.1", 0, main.app, threaded=True)
+    porta = servidor.server_port
+    thread = threading.Thread(target=servidor.serve_forever, daemon=True)
+    thread.start()
+
+    pedidos = 10 if rapido else 50
+    resultados = {}
+    try:
+        for clientes in (1, 4, 16):
+            resultados[f"status_c{clientes}"] = _carga(porta, "/status", clientes, pedidos)
+            resultados[f"api_info_c{clientes}"] = _carga(porta, "/api/info", clientes, pedidos)
+    finally:
+        servidor.shutdown()
+        main.reset_counter()
+
+    return {"pontos_em_memoria": pontos, "pontos_historico": 180, "resultados": resultados}
+
+
+def bench_gravar_contagem(main, gpio, bd, rapido=False):
+    """Débito do gravar_contagem sem latência e com latência simulada de rede"""
+    contador = preparar_ordem_ativa(main, pontos=100)
+    contador.IdBDOrdemProducao = 1
+    resultados = {}
+    latencia_original = bd.latencia
+
+    try:
+        for latencia_ms in (0, 2):
+            bd.latencia = latencia_ms / 1000.0
+            n = 50 if rapido else 500
+            if latencia_ms:
+                n = max(10, n // 10)
+            inseridos_inicio = bd.inseridos
+            t0 = time.perf_counter()
+            for i in range(n):
+                main.gravar_contagem(contador.IdBDOrdemProducao, contador.ContagemAtual + i)
+            total = time.perf_counter() - t0
+            resultados[f"latencia_{latencia_ms}ms"] = {
+                "chamadas": n,
+                "insercoes": bd.inseridos - inseridos_inicio,
+                "gravacoes_por_s": round(n / total, 1),
+                "ms_por_gravacao": round(total / n * 1000, 3),
+            }
+    finally:
+        bd.latencia = latencia_original
+        main.reset_counter()
+
+    return resultados
+
+
+def descodificar_colunar(corpo):
+    """Descodifica o formato binário 'colunar' (usado para validar o codificador)"""
+    assert corpo[:4] == b"KRC2"
+    (tamanho,) = struct.unpack_from("<I", corpo, 4)
+    pos = 8 + tamanho
+    escalares = json.loads(corpo[8:pos])
+    n, t0 = struct.unpack_from("<Iq", corpo, pos)
+    pos += 12
+    dt, tempo = [], t0
+    for _ in range(max(n - 1, 0)):
+        (delta,) = struct.unpack_from("<H", corpo, pos)
+        pos += 2
+        if delta == 0xFFFF:  # Escape: segue-se o epoch do ponto
+            (absoluto,) = struct.unpack_from("<q", corpo, pos)
+            pos += 8
+            delta = absoluto - tempo
+        tempo += delta
+        dt.append(delta)
+    colunas = {}
+    for chave in ("Nominal", "Media", "Cadencia"):
+        colunas[chave] = struct.unpack_from(f"<{n}f", corpo, pos)
+        pos += 4 * n
+    mascara = corpo[pos:pos + (n + 7) // 8]
+    return escalares, n, t0, dt, colunas, mascara
+
+
+def bench_formatos(main, gpio, bd, rapido=False):
+    """Tamanho e custo de codificação de /status e /api/info por formato e compressão"""
+    pontos = 1000
+    contador = preparar_ordem_ativa(main, pontos=pontos)
+    bd.preencher_historico(contador.Ordem, pontos)
+    cliente = main.app.test_client()
+    repeticoes = 5 if rapido else 30
+
+    formatos = ["json", "colunar"] + (["msgpack"] if main.msgpack is not None else [])
+    compressoes = [None, "gzip"] + (["br"] if main.brotli is not None else [])
+    resultados = {}
+
+    try:
+        for caminho in ("/status", f"/api/info/{pontos}/{contador.Ordem}"):
+            por_caminho = {}
+            for formato in formatos:
+                for compressao in compressoes:
+                    cabecalhos = {"Accept": main.MIME_FORMATOS[formato]}
+                    if compressao:
+                        cabecalhos["Accept-Encoding"] = compressao
+                    codificacao = []
+                    total = []
+                    resposta = None
+                    for _ in range(repeticoes):
+                        t0 = time.perf_counter()
+                        resposta = cliente.get(caminho, headers=cabecalhos)
+                        total.append(time.perf_counter() - t0)
+                        codificacao.append(float(resposta.headers["X-Codificacao-ms"]) / 1000)
+                    corpo = resposta.get_data()
+                    if formato == "colunar":
+                        if compressao == "gzip":
+                            corpo_bruto = gzip.decompress(corpo)
+                        elif compressao == "br":
+                            corpo_bruto = main.brotli.decompress(corpo)
+                        else:
+                            corpo_bruto = corpo
+                        assert descodificar_colunar(corpo_bruto)[1] > 0
+                    por_caminho[f"{formato}+{compressao or 'sem'}"] = {
+                        "bytes": len(corpo),
+                        "bytes_antes_compressao": int(resposta.headers["X-Tamanho-Bruto"]),
+                        "codificacao_ms": percentis(codificacao),
+                        "pedido_ms": percentis(total),
+                    }
+            base = por_caminho["json+sem"]["bytes"]
+            for valores in por_caminho.values():
+                valores["razao_vs_json"] = round(valores["bytes"] / base, 4)
+            resultados[caminho.split("/")[1] if caminho == "/status" else "api_info"] = por_caminho
+    finally:
+        main.reset_counter()
+
+    return {"pontos": pontos, "repeticoes": repeticoes, "resultados": resultados}
+
+
+def bench_delta(main, gpio, bd, rapido=False):
+    """Tamanho e tempo de /status completo versus incremental (?since=) com séries cheias"""
+    pontos = 1000
+    contador = preparar_ordem_ativa(main, pontos=pontos)
+    cliente = main.app.test_client()
+    repeticoes = 20 if rapido else 200
+
+    tempo_original = main.time
+    main.time = TempoSemEspera()
+    try:
+        completo, incremental = [], []
+        bytes_completo = bytes_incremental = 0
+        contador._tempo_ultimo_ciclo = None
+        contador.update_stats()  # Primeiro ciclo só fixa a referência do GFA
+        seq = cliente.get("/status").get_json()["data"]["Seq"]
+        for _ in range(repeticoes):
+            # Uma amostra nova entre sondagens, como no ciclo de estatísticas
+            contador.ContagemAtual += 8
+            contador.update_stats()
+
+            t0 = time.perf_counter()
+            resposta = cliente.get("/status")
+            completo.append(time.perf_counter() - t0)
+            bytes_completo = len(resposta.get_data())
+
+            t0 = time.perf_counter()
+            resposta = cliente.get(f"/status?since={seq}")
+            incremental.append(time.perf_counter() - t0)
+            bytes_incremental = len(resposta.get_data())
+            dados = resposta.get_json()["data"]
+            assert not dados["Completo"] and len(dados["Tempo"]) == 1
+            seq = dados["Seq"]
+    finally:
+        main.time = tempo_original
+        main.reset_counter()
+
+    return {
+        "pontos": pontos,
+        "repeticoes": repeticoes,
+        "completo": {"bytes": bytes_completo, "pedido_ms": percentis(completo)},
+        "incremental": {"bytes": bytes_incremental, "pedido_ms": percentis(incremental)},
+        "razao_bytes": round(bytes_incremental / bytes_completo, 4) if bytes_completo else None,
+    }
+
+
+def bench_disjuntor(main, gpio, bd, rapido=False):
+    """
+    Pedidos da API com a BD em baixo, com e sem disjuntor: latência de /api/info
+    (com e sem resultado em cache), /setup e /reset-contador, e tempo até o disjuntor
+    voltar a fechar depois de a BD regressar, também depois de uma ligação de ensaio
+    que falha com um erro que não é do pymssql (OSError do socket).
+    """
+    pedidos = 5 if rapido else 20
+    atraso_falha = 0.3  # Timeout de login simulado (3 s no Pi, por omissão)
+    contador = preparar_ordem_ativa(main, pontos=100)
+    bd.preencher_historico(contador.Ordem, 180)
+    cliente = main.app.test_client()
+    caminhos = {
+        "api_info_em_cache": "/api/info",
+        "api_info_sem_cache": "/api/info/180/OP-SEM-CACHE",
+        "setup": "/setup/OP-NOVA/1000",
+        "reset_contador": "/reset-contador",
+    }
+    disjuntor = main.disjuntor_bd(contador.DB_Server, contador.DB_DB)
+    tempo_aberto_original = disjuntor.tempo_aberto
+    resultados = {}
+
+    try:
+        assert cliente.get("/api/info").status_code == 200  # Preenche a cache
+        main.reset_counter(contador)
+        bd.indisponivel = True
+        bd.atraso_falha = atraso_falha
+
+        for modo, falhas_abrir in (("disjuntor_desligado", 10 ** 9), ("com_disjuntor", main.CONFIG["bd_disjuntor_falhas"])):
+            disjuntor.sucesso()
+            disjuntor.falhas_abrir = falhas_abrir
+            disjuntor.tempo_aberto = 60
+            por_caminho = {}
+            for nome, caminho in caminhos.items():
+                if nome == "api_info_em_cache":
+                    contador.Ordem = "OP-BENCH"  # /api/info sem ordem usa a ordem da linha
+                latencias, codigos, desatualizadas = [], set(), 0
+                for _ in range(pedidos):
+                    t0 = time.perf_counter()
+                    resposta = cliente.get(caminho)
+                    latencias.append(time.perf_counter() - t0)
+                    codigos.add(resposta.status_code)
+                    desatualizadas += resposta.headers.get("X-BD-Desatualizada") == "1"
+                    if nome == "api_info_em_cache":
+                        contador.Ordem = "OP-BENCH"
+                main.reset_counter(contador)
+                por_caminho[nome] = {
+                    "latencia_ms": percentis(latencias),
+                    "codigos_http": sorted(codigos),
+                    "respostas_desatualizadas": desatualizadas,
+                }
+            por_caminho["disjuntor"] = disjuntor.estado()
+            resultados[modo] = por_caminho
+
+        # BD de volta: o primeiro pedido depois de tempo_aberto é o ensaio que fecha o disjuntor
+        disjuntor.tempo_aberto = 0.2
+        bd.indisponivel = False
+        t0 = time.perf_counter()
+        while disjuntor.posicao != main.DisjuntorBD.FECHADO and time.perf_counter() - t0 < 5:
+            cliente.get("/api/info/180/OP-SEM-CACHE")
+            time.sleep(0.01)
+        resultados["fecho_apos_recuperacao_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        fechou = disjuntor.posicao == main.DisjuntorBD.FECHADO
+
+        # Ensaio com OSError: o disjuntor volta a abrir (em vez de ficar com o ensaio em
+        # curso para sempre) e fecha no ensaio seguinte, quando a BD responde
+        def ligar():
+            # Sem conexões inativas no pool: cada chamada tenta uma ligação nova
+            credenciais = (contador.DB_Server, contador.DB_User, contador.DB_Password, contador.DB_DB)
+            main.pool_bd.descartar(credenciais)
+            try:
+                main.get_db_connection(*credenciais).close()
+            except Exception:
+                pass
+
+        bd.erro_ligacao = OSError("Ligação recusada (socket simulado)")
+        t0 = time.perf_counter()
+        while disjuntor.posicao != main.DisjuntorBD.ABERTO and time.perf_counter() - t0 < 5:
+            ligar()
+        time.sleep(disjuntor.tempo_aberto)
+        ligar()  # Ensaio que falha com OSError
+        reaberto = disjuntor.posicao == main.DisjuntorBD.ABERTO
+        bd.erro_ligacao = None
+        t0 = time.perf_counter()
+        while disjuntor.posicao != main.DisjuntorBD.FECHADO and time.perf_counter() - t0 < 5:
+            ligar()
+            time.sleep(0.01)
+        resultados["fecho_apos_ensaio_oserror_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        recuperou = reaberto and disjuntor.posicao == main.DisjuntorBD.FECHADO
+        resultados["estado_bd"] = cliente.get("/bd").get_json()["data"]
+    finally:
+        bd.erro_ligacao = None
+        bd.indisponivel = False
+        disjuntor.sucesso()
+        disjuntor.falhas_abrir = main.CONFIG["bd_disjuntor_falhas"]
+        disjuntor.tempo_aberto = tempo_aberto_original
+        main.reset_counter()
+
+    return {
+        "pedidos": pedidos,
+        "atraso_falha_login_s": atraso_falha,
+        # Antes: 3 tentativas com timeout de login e 2 s entre elas, em cada pedido
+        "latencia_anterior_por_ligacao_s": round(3 * atraso_falha + 2 * 2, 1),
+        "resultados": resultados,
+        "ok": fechou and recuperou,
+    }
+
+
+def bench_historico_local(main, gpio, bd, rapido=False):
+    """
+    /api/info de uma ordem de 24 h (17280 amostras de 5 s) lida do histórico local
+    (SQLite) versus do SQL Server simulado, com a mesma resposta; custo da gravação
+    de cada amostra, tamanho do ficheiro e retenção. O SQL Server simulado só tem a
+    latência por consulta, sem o custo de transferir as linhas pela rede.
+    """
+    import os
+    import tempfile
+
+    pontos = 17280
+    repeticoes = 5 if rapido else 20
+    ordem = "OP-24H"
+    contador = main.contador
+    cliente = main.app.test_client()
+    historico_original = main.historico_local
+    latencia_original = bd.latencia
+
+    bd.preencher_historico(ordem, pontos)
+    ficheiro = os.path.join(tempfile.mkdtemp(prefix="krones_historico_"), "historico_local.db")
+    historico = main.HistoricoLocal(ficheiro, dias=30, max_mb=200)
+    historico._conexao()
+    historico._criado = 0  # Como se o ficheiro já existisse antes do início da ordem
+
+    try:
+        # Gravar as mesmas amostras que estão no SQL Server simulado
+        gravar = []
+        for linha in bd.historico[ordem]:
+            t0 = time.perf_counter()
+            historico.registar(contador.linha_id, linha["DataDados"], linha)
+            gravar.append(time.perf_counter() - t0)
+
+        caminho = f"/api/info/{pontos}/{ordem}"
+        resultados = {}
+        respostas = {}
+        for origem, local in (("sql_server", None), ("local", historico)):
+            main.historico_local = local
+            bd.latencia = 0.005
+            for n in (180, pontos):
+                tempos = []
+                for _ in range(repeticoes):
+                    t0 = time.perf_counter()
+                    resposta = cliente.get(f"/api/info/{n}/{ordem}")
+                    tempos.append(time.perf_counter() - t0)
+                resultados[f"{origem}_{n}_pontos"] = {"pedido_ms": percentis(tempos), "codigo_http": resposta.status_code}
+            respostas[origem] = resposta.get_json()
+
+        # Com o SQL Server em baixo a ordem local continua disponível
+        bd.indisponivel = True
+        resultados["local_sql_server_em_baixo"] = {"codigo_http": cliente.get(caminho).status_code}
+        bd.indisponivel = False
+
+        for resposta in respostas.values():
+            resposta.pop("DataDados", None)
+        iguais = respostas["local"] == respostas["sql_server"]
+
+        # Retenção: uma ordem sem amostras há mais de `dias` é apagada
+        antiga = dict(bd.historico[ordem][0], Ordem="OP-ANTIGA")
+        historico.registar(contador.linha_id, antiga["DataDados"] - main.timedelta(days=40), antiga)
+        historico.limpar()
+        estado = historico.estado()
+    finally:
+        bd.indisponivel = False
+        bd.latencia = latencia_original
+        main.historico_local = historico_original
+
+    return {
+        "pontos": pontos,
+        "repeticoes": repeticoes,
+        "latencia_sql_simulada_ms": 5,
+        "gravar_amostra_ms": percentis(gravar),
+        "resultados": resultados,
+        "respostas_iguais": iguais,
+        "tamanho_mb": estado["TamanhoMB"],
+        "bytes_por_amostra": round(estado["TamanhoMB"] * 1e6 / max(estado["Amostras"], 1), 1),
+        "ordem_antiga_apagada": estado["Ordens"] == 1 and estado["OrdensApagadas"] == 1,
+    }
+
+
+def bench_exportacao(main, gpio, bd, rapido=False):
+    """
+    /export/<Ordem> em streaming (CSV e, com pyarrow, Parquet) versus o /api/info com
+    todas as amostras: pico de memória (tracemalloc) para ordens de 24 h e de 4 dias,
+    linhas e colunas exportadas do SQL Server simulado e do histórico local, intervalo
+    de tempo e escolha de colunas.
+    """
+    import csv
+    import io
+    import os
+    import tempfile
+    import tracemalloc
+
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        pq = None
+
+    tamanhos = (17280, 4 * 17280)
+    cliente = main.app.test_client()
+    contador = main.contador
+    historico_original = main.historico_local
+
+    def consumir(caminho):
+        """Lê a resposta parte a parte (sem a guardar) e mede o pico de memória"""
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        t0 = time.perf_counter()
+        resposta = cliente.get(caminho)
+        total = 0
+        for parte in resposta.response:
+            total += len(parte)
+        resposta.close()
+        duracao = time.perf_counter() - t0
+        pico = tracemalloc.get_traced_memory()[1] - base
+        tracemalloc.stop()
+        return {"codigo_http": resposta.status_code, "bytes": total,
+                "pico_memoria_mb": round(pico / 1e6, 2), "duracao_ms": round(duracao * 1000, 1)}
+
+    def obter(caminho):
+        resposta = cliente.get(caminho)
+        return resposta.status_code, resposta.get_data()
+
+    resultados = {}
+    try:
+        main.historico_local = None
+        for pontos in tamanhos:
+            ordem = f"OP-EXP-{pontos}"
+            bd.preencher_historico(ordem, pontos)
+            medicoes = {
+                "export_csv": consumir(f"/export/{ordem}"),
+                "api_info": consumir(f"/api/info/{pontos}/{ordem}"),
+            }
+            if pq is not None:
+                medicoes["export_parquet"] = consumir(f"/export/{ordem}?formato=parquet")
+            resultados[f"{pontos}_linhas"] = medicoes
+            if pontos != tamanhos[0]:
+                del bd.historico[ordem]
+
+        # Mesma exportação a partir do histórico local
+        ordem = f"OP-EXP-{tamanhos[0]}"
+        linhas = bd.historico[ordem]
+        _, csv_sql = obter(f"/export/{ordem}")
+        ficheiro = os.path.join(tempfile.mkdtemp(prefix="krones_exportacao_"), "historico_local.db")
+        historico = main.HistoricoLocal(ficheiro, dias=30, max_mb=200)
+        historico._conexao()
+        historico._criado = 0  # Como se o ficheiro já existisse antes do início da ordem
+        for linha in linhas:
+            historico.registar(contador.linha_id, linha["DataDados"], linha)
+        main.historico_local = historico
+        codigo_local, csv_local = obter(f"/export/{ordem}")
+        resultados["local_csv"] = consumir(f"/export/{ordem}")
+
+        # Intervalo de tempo e colunas escolhidas
+        inicio, fim = linhas[100]["DataDados"], linhas[199]["DataDados"]
+        _, parcial = obter(f"/export/{ordem}?colunas=DataDados,ContagemAtual&inicio={inicio.isoformat()}&fim={fim.isoformat()}")
+        parcial = list(csv.reader(io.StringIO(parcial.decode())))
+        verificacao = {
+            "linhas_csv": csv_sql.count(b"\n") - 1,
+            "local_igual_sql_server": codigo_local == 200 and csv_local == csv_sql,
+            "intervalo_cabecalho": parcial[0],
+            "intervalo_linhas": len(parcial) - 1,
+            "intervalo_primeira": parcial[1] if len(parcial) > 1 else None,
+            "coluna_invalida_http": cliente.get(f"/export/{ordem}?colunas=Ordem;DROP").status_code,
+            "formato_invalido_http": cliente.get(f"/export/{ordem}?formato=xlsx").status_code,
+            "ordem_inexistente_http": cliente.get("/export/OP-NAO-EXISTE").status_code,
+        }
+        if pq is not None:
+            for origem, local in (("sql_server", None), ("local", historico)):
+                main.historico_local = local
+                _, dados = obter(f"/export/{ordem}?formato=parquet&colunas=DataDados,ContagemAtual,MediaProducao")
+                tabela = pq.read_table(io.BytesIO(dados))
+                verificacao[f"parquet_{origem}"] = {
+                    "linhas": tabela.num_rows,
+                    "colunas": tabela.column_names,
+                    "grupos_linhas": pq.ParquetFile(io.BytesIO(dados)).num_row_groups,
+                    "ultima_contagem": tabela.column("ContagemAtual")[-1].as_py(),
+                }
+    finally:
+        main.historico_local = historico_original
+        for pontos in tamanhos:
+            bd.historico.pop(f"OP-EXP-{pontos}", None)
+
+    return {
+        "pyarrow": pq is not None,
+        "linhas_por_bloco": main.LINHAS_BLOCO_EXPORTACAO,
+        "resultados": resultados,
+        "verificacao": verificacao,
+    }
+
+
+def bench_ordem_ativa(main, gpio, bd, rapido=False):
+    """
+    /api/info da ordem ativa servido das séries em memória versus da BD simulada (5 ms
+    por consulta), com 1 e 4 clientes: ordem inteira em memória (pedido completo e
+    incremental) e ordem mais longa do que a janela em memória (amostras antigas da
+    BD). Em cada caso confirma que as duas respostas são iguais.
+    """
+    pedidos = 10 if rapido else 50
+    contador = main.contador
+    historico_original = main.historico_local
+    latencia_original = bd.latencia
+    memoria_original = main.CONFIG["api_info_memoria"]
+
+    def linhas_bd(ordem, datas, inicio):
+        """Linhas da BD iguais às amostras em memória (campos da ordem atuais na última)"""
+        estatisticas = contador.estatisticas
+        campos = {
+            "Ordem": ordem, "Artigo": contador.ArtigoEmContagem, "DescricaoArtigo": contador.DescricaoArtigoEmContagem,
+            "CadenciaArtigo": contador.CadenciaArtigoEmContagem, "Inicio": inicio, "Fim": None,
+            "ContagemAtual": contador.ContagemAtual, "ContagemTotal": contador.ContagemTotal,
+            "MediaProducao": main.media_producao(contador), "Quebras": contador.Quebras,
+            "EstadoPorta": contador.EstadoPorta, "EstadoContador": contador.EstadoContador,
+            "EstadoConfiguracao": int(contador.ContadorConfigurado),
+        }
+        return [
+            dict(campos, DataDados=main.datetime_de_ns(data), Tempo=main.formatar_ns(data, main.FORMATO_HORA),
+                 Paragens=paragem, Nominal=nominal, Media=media, Cadencia=cadencia)
+            for data, paragem, nominal, media, cadencia in zip(
+                datas, estatisticas.Paragens, estatisticas.EstatisticaGFA,
+                estatisticas.EstatisticaGFAMedia, estatisticas.EstatisticaCadenciaArtigo,
+            )
+        ]
+
+    def comparar(servidor, casos):
+        porta = servidor.server_port
+        cliente = main.app.test_client()
+        resultados = {}
+        iguais = {}
+        for nome, caminho in casos.items():
+            respostas = {}
+            for origem, memoria in (("bd", False), ("memoria", True)):
+                main.CONFIG["api_info_memoria"] = memoria
+                consultas = bd.consultas
+                resposta = cliente.get(caminho).get_json()
+                consultas = bd.consultas - consultas
+                resposta.pop("DataDados", None)
+                respostas[origem] = resposta
+                for clientes in (1, 4):
+                    resultados[f"{nome}_{origem}_c{clientes}"] = _carga(porta, caminho, clientes, pedidos)
+                resultados[f"{nome}_{origem}_c1"]["consultas_bd_por_pedido"] = consultas
+            iguais[nome] = respostas["bd"] == respostas["memoria"] and "error" not in respostas["bd"]
+            for clientes in (1, 4):
+                resultados[f"{nome}_p99_memoria_sobre_bd_c{clientes}"] = round(
+                    resultados[f"{nome}_memoria_c{clientes}"]["p99"] / resultados[f"{nome}_bd_c{clientes}"]["p99"], 3)
+        return resultados, iguais
+
+    servidor = make_server("127.0.0.1", 0, main.app, threaded=True)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    try:
+        main.historico_local = None
+        bd.latencia = 0.005
+
+        # Ordem de 1 h, toda em memória
+        contador = preparar_ordem_ativa(main, contador, pontos=720, ordem="OP-ATIVA")
+        datas = list(contador.EstatisticaNs)
+        inicio = main.datetime_de_ns(contador.metadados.InicioNs)
+        bd.historico["OP-ATIVA"] = linhas_bd("OP-ATIVA", datas, inicio)
+        desde_ms = datas[-13] // 1_000_000
+        resultados, iguais = comparar(servidor, {
+            "completa_180": "/api/info",
+            "completa_720": "/api/info/720/OP-ATIVA",
+            "incremental": f"/api/info/720/OP-ATIVA?desde_ms={desde_ms}",
+        })
+
+        # Ordem de 4 h: só as últimas 1000 amostras em memória, as anteriores na BD
+        contador = preparar_ordem_ativa(main, contador, pontos=2880, ordem="OP-LONGA")
+        estatisticas = contador.estatisticas
+        with estatisticas.lock:
+            datas = list(estatisticas.EstatisticaNs)
+            inicio = main.datetime_de_ns(contador.metadados.InicioNs)
+            bd.historico["OP-LONGA"] = linhas_bd("OP-LONGA", datas, inicio)
+            for serie in ("EstatisticaGFA", "EstatisticaGFAMedia", "EstatisticaCadenciaArtigo",
+                          "Paragens", "EstatisticaNs"):
+                setattr(estatisticas, serie, getattr(estatisticas, serie)[-1000:])
+            estatisticas.completo_desde = estatisticas.EstatisticaNs[0]
+        longa, iguais_longa = comparar(servidor, {"janela_e_bd": "/api/info/2880/OP-LONGA"})
+        resultados.update(longa)
+        iguais.update(iguais_longa)
+    finally:
+        servidor.shutdown()
+        main.CONFIG["api_info_memoria"] = memoria_original
+        main.historico_local = historico_original
+        bd.latencia = latencia_original
+        for ordem in ("OP-ATIVA", "OP-LONGA"):
+            bd.historico.pop(ordem, None)
+        main.reset_counter()
+
+    return {
+        "pedidos_por_cliente": pedidos,
+        "latencia_sql_simulada_ms": 5,
+        "resultados": resultados,
+        "respostas_iguais": iguais,
+    }
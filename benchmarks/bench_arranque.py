@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark de arranque: tempo até à primeira contagem com uma ordem ativa a
+recuperar, medido em processos novos (importações incluídas) com GPIO e BD
+simulados.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from .simulacao import RAIZ_REPO, percentis
+
+CODIGO_PREPARAR = """
+import sys
+sys.path.insert(0, {raiz!r})
+from benchmarks.simulacao import carregar_main
+main, gpio, bd = carregar_main(diretorio={diretorio!r})
+c = main.linhas.todas()[0]
+c.Ordem, c.IdBDOrdemProducao, c.ContagemTotal, c.estado = "OP-ARRANQUE", 7, 10 ** 6, main.ESTADO_EM_CONTAGEM
+c.EstadoPorta = 1
+c.ContagemAtual = 120
+c._save_state()
+"""
+
+CODIGO_ARRANQUE = """
+import json, sys, threading, time, urllib.request
+sys.path.insert(0, {raiz!r})
+from benchmarks.simulacao import carregar_main
+from werkzeug.serving import make_server
+main, gpio, bd = carregar_main(diretorio={diretorio!r})
+contador = main.linhas.todas()[0]
+gpio.onda_quadrada(contador.SENSOR_PIN, {frequencia})
+
+# O mesmo caminho do executar(): sistema primeiro, servidor HTTP a seguir
+main.init_main()
+main.marcar_arranque("servidor_http")
+servidor = make_server("127.0.0.1", 0, main.app, threaded=True)
+threading.Thread(target=servidor.serve_forever, daemon=True).start()
+
+limite = time.perf_counter() + 5
+while time.perf_counter() < limite and not {{"primeira_contagem", "bd_pronta"}} <= set(main.relatorio_arranque):
+    time.sleep(0.005)
+with urllib.request.urlopen(f"http://127.0.0.1:{{servidor.server_port}}/arranque", timeout=5) as resposta:
+    relatorio = json.loads(resposta.read())["data"]
+relatorio["Porta"] = gpio.valores.get(contador.DOOR_PIN)
+relatorio["EstadoContador"] = contador.EstadoContador
+relatorio["Contagem"] = contador.ContagemAtual
+print(json.dumps(relatorio), flush=True)
+main.thread_running = False
+servidor.shutdown()
+"""
+
+
+def _executar(codigo, diretorio, **parametros):
+    saida = subprocess.run(
+        [sys.executable, "-c", codigo.format(raiz=RAIZ_REPO, diretorio=diretorio, **parametros)],
+        capture_output=True, text=True, timeout=60, cwd=RAIZ_REPO,
+    )
+    if saida.returncode != 0:
+        raise RuntimeError(saida.stderr.strip().splitlines()[-1] if saida.stderr else "falha no subprocesso")
+    return saida.stdout
+
+
+def bench_arranque(main, gpio, bd, rapido=False):
+    """Tempo até à primeira contagem, à BD e ao HTTP num processo novo (objetivo < 500 ms)"""
+    repeticoes = 3 if rapido else 10
+    frequencia = 50
+    fases = {}
+    interpretador = []
+    ultimo = None
+
+    for _ in range(repeticoes):
+        diretorio = tempfile.mkdtemp(prefix="krones_arranque_")
+        _executar(CODIGO_PREPARAR, diretorio)
+        ultimo = json.loads(_executar(CODIGO_ARRANQUE, diretorio, frequencia=frequencia).splitlines()[-1])
+        for fase, ms in ultimo["Fases"].items():
+            fases.setdefault(fase, []).append(ms / 1000)
+        if ultimo["InterpretadorMs"] is not None:
+            interpretador.append(ultimo["InterpretadorMs"] / 1000)
+
+    primeira = fases.get("primeira_contagem", [])
+    return {
+        "repeticoes": repeticoes,
+        "frequencia_hz": frequencia,
+        "fases_ms": {fase: percentis(valores) for fase, valores in fases.items()},
+        "interpretador_e_harness_ms": percentis(interpretador) if interpretador else None,
+        "importacoes_preguicosas_ms": ultimo["Importacoes"],
+        "contagem_retomada": ultimo["EstadoContador"] == 1 and ultimo["Contagem"] > 120,
+        "porta_recuperada_aberta": ultimo["Porta"] == 1,
+        "primeira_contagem_abaixo_500ms": bool(primeira) and max(primeira) < 0.5,
+    }
@@ -0,0 +1,808 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks de captura: taxa máxima de impulsos contados sem perdas pelo
+ciclo Flop (count_thread) e pelo increment_count, e CPU por 1000 garrafas.
+"""
+
+import threading
+import time
+
+from .simulacao import percentis, preparar_ordem_ativa
+
+
+def _executar_flop(main, gpio, frequencia, duracao, duty):
+    """Corre a count_thread contra uma onda quadrada e devolve (esperado, contado, cpu_s)"""
+    contador = preparar_ordem_ativa(main)
+    contador.sensor_initialized = True
+    contador.Flop = False
+
+    impulsos = gpio.onda_quadrada(contador.SENSOR_PIN, frequencia, duty)
+    main.thread_running = True
+    thread = threading.Thread(target=main.count_thread, daemon=True)
+
+    cpu_inicio = time.process_time()
+    thread.start()
+    time.sleep(duracao)
+    main.thread_running = False
+    fim = time.perf_counter()
+    thread.join()
+    cpu = time.process_time() - cpu_inicio
+
+    gpio.geradores.pop(contador.SENSOR_PIN, None)
+    return impulsos(fim), contador.ContagemAtual, cpu
+
+
+def bench_flop(main, gpio, bd, rapido=False):
+    """Varrimento de frequências para o ciclo Flop da count_thread"""
+    duracao = 1.5 if rapido else 5.0
+    frequencias = [5, 10, 20, 30, 40, 50, 60, 80, 100]
+    resultados = []
+    max_sem_perdas = 0
+
+    for freq in frequencias:
+        esperado, contado, cpu = _executar_flop(main, gpio, freq, duracao, duty=0.5)
+        # Tolerância de um impulso na fronteira da janela de medição
+        perdidos = max(0, esperado - contado - 1)
+        resultados.append({
+            "frequencia_hz": freq,
+            "esperado": esperado,
+            "contado": contado,
+            "perdidos": perdidos,
+            "cpu_s": round(cpu, 4),
+            "cpu_s_por_1000": round(cpu * 1000 / contado, 4) if contado else None,
+        })
+        if perdidos == 0:
+            max_sem_perdas = freq
+        else:
+            break
+
+    # CPU em repouso (contador parado) durante o mesmo período
+    main.reset_counter()
+    main.thread_running = True
+    thread = threading.Thread(target=main.count_thread, daemon=True)
+    cpu_inicio = time.process_time()
+    thread.start()
+    time.sleep(duracao)
+    main.thread_running = False
+    thread.join()
+    cpu_repouso = time.process_time() - cpu_inicio
+
+    referencia = next((r for r in resultados if r["frequencia_hz"] == 10), resultados[0])
+    return {
+        "duracao_s": duracao,
+        "varrimento": resultados,
+        "max_frequencia_sem_perdas_hz": max_sem_perdas,
+        "cpu_s_por_1000_garrafas": referencia["cpu_s_por_1000"],
+        "cpu_repouso_pct": round(cpu_repouso / duracao * 100, 3),
+    }
+
+
+def bench_increment_count(main, gpio, bd, rapido=False):
+    """Taxa máxima de chamadas ao increment_count sem rejeições pelo limiar"""
+    duracao = 1.0 if rapido else 3.0
+    frequencias = [5, 10, 15, 19, 25, 40, 100]
+    resultados = []
+    max_sem_perdas = 0
+
+    for freq in frequencias:
+        contador = preparar_ordem_ativa(main)
+        contador.last_count_time = 0
+        periodo = 1.0 / freq
+        chamadas = int(duracao * freq)
+        aceites = 0
+        inicio = time.perf_counter()
+        cpu_inicio = time.process_time()
+        for i in range(chamadas):
+            alvo = inicio + i * periodo
+            espera = alvo - time.perf_counter()
+            if espera > 0:
+                time.sleep(espera)
+            if contador.increment_count():
+                aceites += 1
+        cpu = time.process_time() - cpu_inicio
+
+        resultados.append({
+            "frequencia_hz": freq,
+            "chamadas": chamadas,
+            "aceites": aceites,
+            "rejeitadas": chamadas - aceites,
+            "cpu_us_por_chamada": round(cpu / chamadas * 1e6, 2) if chamadas else None,
+        })
+        if aceites == chamadas and max_sem_perdas < freq:
+            max_sem_perdas = freq
+
+    # Custo puro da chamada sem espera (limiar desligado)
+    contador = preparar_ordem_ativa(main)
+    contador.count_threshold_ms = -1
+    n = 2000 if rapido else 20000
+    t0 = time.perf_counter()
+    for _ in range(n):
+        contador.increment_count()
+    custo = (time.perf_counter() - t0) / n
+    contador.count_threshold_ms = 50
+
+    return {
+        "duracao_s": duracao,
+        "varrimento": resultados,
+        "max_frequencia_sem_perdas_hz": max_sem_perdas,
+        "custo_us_por_chamada": round(custo * 1e6, 3),
+    }
+
+
+def bench_multilinha(main, gpio, bd, rapido=False):
+    """
+    CPU do motor de captura partilhado com 1 e 8 linhas a contar em simultâneo.
+
+    Compara o custo de 8 linhas num só motor com 8 vezes o custo de uma linha
+    (aproximação de 8 processos independentes, sem contar o interpretador extra).
+    """
+    duracao = 1.5 if rapido else 5.0
+    frequencia = 10
+    registo_original = main.linhas
+    resultados = {}
+
+    try:
+        for n in (1, 8):
+            registo = main.RegistoLinhas()
+            impulsos = []
+            for i in range(n):
+                contador = main.Contador(
+                    linha_id=f"B{i}", sensor_pin=100 + i, door_pin=200 + i,
+                    ficheiro_estado=f"contador_state_B{i}.backup",
+                )
+                registo.adicionar(contador)
+                preparar_ordem_ativa(main, contador)
+                contador.sensor_initialized = True
+                impulsos.append(gpio.onda_quadrada(contador.SENSOR_PIN, frequencia))
+            main.linhas = registo
+
+            main.thread_running = True
+            thread = threading.Thread(target=main.count_thread, daemon=True)
+            cpu_inicio = time.process_time()
+            thread.start()
+            time.sleep(duracao)
+            main.thread_running = False
+            fim = time.perf_counter()
+            thread.join()
+            cpu = time.process_time() - cpu_inicio
+
+            esperado = sum(f(fim) for f in impulsos)
+            contado = sum(c.ContagemAtual for c in registo.todas())
+            resultados[f"linhas_{n}"] = {
+                "esperado": esperado,
+                "contado": contado,
+                "cpu_pct": round(cpu / duracao * 100, 3),
+            }
+            for c in registo.todas():
+                gpio.geradores.pop(c.SENSOR_PIN, None)
+    finally:
+        main.linhas = registo_original
+
+    cpu_1 = resultados["linhas_1"]["cpu_pct"]
+    cpu_8 = resultados["linhas_8"]["cpu_pct"]
+    return {
+        "duracao_s": duracao,
+        "frequencia_hz": frequencia,
+        "resultados": resultados,
+        "cpu_8_processos_estimado_pct": round(cpu_1 * 8, 3),
+        "razao_partilhado_vs_8_processos": round(cpu_8 / (cpu_1 * 8), 3) if cpu_1 else None,
+    }
+
+
+def bench_supervisor(main, gpio, bd, rapido=False):
+    """
+    Recuperação da captura pelo supervisor: a ContadorThread morre uma vez e fica
+    bloqueada outra; mede o tempo até voltar a contar, as garrafas perdidas e os
+    pings recebidos por um watchdog do systemd simulado.
+    """
+    import os
+    import socket
+    import tempfile
+
+    frequencia = 20
+    caminho = os.path.join(tempfile.mkdtemp(prefix="krones_notify_"), "notify")
+    receptor = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    receptor.bind(caminho)
+    receptor.settimeout(0.01)
+    ambiente = {"NOTIFY_SOCKET": caminho, "WATCHDOG_USEC": "1000000"}
+    os.environ.update(ambiente)
+
+    supervisor_original = main.supervisor
+    capturar_original = main.capturar_linha
+    sup = main.supervisor = main.Supervisor(backoff_inicial=0.05)
+    contador = preparar_ordem_ativa(main)
+    contador.sensor_initialized = True
+    contador.Flop = False
+    impulsos = gpio.onda_quadrada(contador.SENSOR_PIN, frequencia)
+    resultados = {}
+
+    def falhar_uma_vez(excecao=None, espera=0):
+        def capturar(c, t):
+            main.capturar_linha = capturar_original
+            if espera:
+                time.sleep(espera)
+            if excecao is not None:
+                raise excecao
+            return capturar_original(c, t)
+        return capturar
+
+    def esperar_reinicio(reinicios):
+        t0 = time.perf_counter()
+        while sup.estado()["Threads"][0]["Reinicios"] < reinicios and time.perf_counter() - t0 < 10:
+            time.sleep(0.005)
+        return time.perf_counter() - t0
+
+    try:
+        main.thread_running = True
+        main.evento_encerrar.clear()
+        sup.registar("ContadorThread", main.count_thread, limite_batimento=0.5, critica=True)
+        sup.arrancar()
+        time.sleep(0.5)
+
+        # 1) A thread morre (exceção que escapa ao log_exceptions)
+        main.capturar_linha = falhar_uma_vez(SystemExit())
+        resultados["morte_ms"] = round(esperar_reinicio(1) * 1000, 1)
+        time.sleep(0.5)
+
+        # 2) A thread fica bloqueada: é substituída e a antiga sai ao acordar
+        main.capturar_linha = falhar_uma_vez(espera=2.0)
+        resultados["bloqueio_ms"] = round(esperar_reinicio(2) * 1000, 1)
+        time.sleep(2.5 if rapido else 5.0)
+        vivas = [t for t in main.threading.enumerate() if t.name == "ContadorThread"]
+
+        main.thread_running = False
+        main.evento_encerrar.set()
+        fim = time.perf_counter()
+        time.sleep(0.1)
+        esperado = impulsos(fim)
+
+        pings = 0
+        while True:
+            try:
+                pings += receptor.recv(64) == b"WATCHDOG=1"
+            except socket.timeout:
+                break
+        estado = sup.estado()
+        resultados.update({
+            "frequencia_hz": frequencia,
+            "esperado": esperado,
+            "contado": contador.ContagemAtual,
+            "garrafas_perdidas": max(0, esperado - contador.ContagemAtual - 1),
+            "contagens_duplicadas": max(0, contador.ContagemAtual - esperado),
+            "threads_contador_vivas": len(vivas),
+            "reinicios": estado["Threads"][0]["Reinicios"],
+            "pings_watchdog": pings,
+        })
+    finally:
+        main.thread_running = False
+        main.capturar_linha = capturar_original
+        main.supervisor = supervisor_original
+        main.evento_encerrar.clear()
+        gpio.geradores.pop(contador.SENSOR_PIN, None)
+        for chave in ambiente:
+            os.environ.pop(chave, None)
+        receptor.close()
+        main.reset_counter()
+
+    return resultados
+
+
+class LockCronometrado:
+    """RLock que acumula, por thread, o tempo passado à espera de o adquirir"""
+
+    def __init__(self, lock, esperas):
+        self._lock = lock
+        self._esperas = esperas
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(False):
+            espera = 0.0
+            obtido = True
+        else:
+            t0 = time.perf_counter()
+            obtido = self._lock.acquire(blocking, timeout)
+            espera = time.perf_counter() - t0
+        registo = self._esperas.setdefault(threading.current_thread().name, [0, 0, 0.0, 0.0])
+        registo[0] += 1
+        if espera:
+            registo[1] += 1
+            registo[2] += espera
+            registo[3] = max(registo[3], espera)
+        return obtido
+
+    def release(self):
+        self._lock.release()
+
+    __enter__ = acquire
+
+    def __exit__(self, *excecao):
+        self.release()
+
+
+def bench_contencao(main, gpio, bd, rapido=False):
+    """
+    Tempo de espera por locks na captura com /status e o ciclo de estatísticas em carga.
+
+    A captura chama processar_leitura a ~1000 garrafas/s enquanto 4 clientes pedem
+    /status (1000 pontos nas séries) e update_stats corre a cada 50 ms. Todos os
+    locks do contador são substituídos por versões cronometradas.
+    """
+    duracao = 2.0 if rapido else 10.0
+    contador = preparar_ordem_ativa(main, pontos=1000)
+    contador.IdBDOrdemProducao = 0  # Sem gravação na BD
+
+    esperas = {}
+    originais = [(contador, "_state_lock"), (contador, "_contagem_lock")]
+    if hasattr(contador, "estatisticas"):
+        originais.append((contador.estatisticas, "lock"))
+    guardados = [(objeto, nome, getattr(objeto, nome)) for objeto, nome in originais]
+    for objeto, nome, lock in guardados:
+        setattr(objeto, nome, LockCronometrado(lock, esperas))
+
+    parar = threading.Event()
+    latencias = []
+    pedidos = [0]
+
+    def captura():
+        while not parar.is_set():
+            contador.processar_leitura(1)
+            t0 = time.perf_counter()
+            contador.processar_leitura(0)
+            latencias.append(time.perf_counter() - t0)
+            time.sleep(0.001)
+
+    def cliente():
+        http = main.app.test_client()
+        while not parar.is_set():
+            http.get("/status")
+            pedidos[0] += 1
+
+    def estatisticas():
+        while not parar.is_set():
+            contador.update_stats()
+            time.sleep(0.05)
+
+    threads = [threading.Thread(target=captura, name="Captura")]
+    threads += [threading.Thread(target=cliente, name=f"API-{i}") for i in range(4)]
+    threads.append(threading.Thread(target=estatisticas, name="Estatisticas"))
+    try:
+        for t in threads:
+            t.start()
+        time.sleep(duracao)
+        parar.set()
+        for t in threads:
+            t.join()
+    finally:
+        for objeto, nome, lock in guardados:
+            setattr(objeto, nome, lock)
+        main.reset_counter()
+
+    def resumo(nome):
+        aquisicoes, contendidas, total, maximo = esperas.get(nome, [0, 0, 0.0, 0.0])
+        return {
+            "aquisicoes": aquisicoes,
+            "contendidas": contendidas,
+            "espera_total_ms": round(total * 1000, 3),
+            "espera_max_ms": round(maximo * 1000, 3),
+        }
+
+    captura_resumo = resumo("Captura")
+    return {
+        "duracao_s": duracao,
+        "garrafas": len(latencias),
+        "pedidos_status": pedidos[0],
+        "modelo_separado": hasattr(contador, "estatisticas"),
+        "captura": captura_resumo,
+        "captura_espera_por_garrafa_us": round(captura_resumo["espera_total_ms"] * 1000 / max(len(latencias), 1), 3),
+        "latencia_garrafa_ms": percentis(latencias),
+        "estatisticas": resumo("Estatisticas"),
+        "api": resumo("API-0"),
+    }
+
+
+class Enchedora:
+    """
+    Gerador do sensor de uma linha simulada: garrafas ao ritmo nominal, ao ritmo lento
+    com a saída de aviso ligada, e ainda durante `atraso` segundos depois de a porta
+    fechar (garrafas que já tinham passado a porta)
+    """
+
+    def __init__(self, gpio, porta, aviso, ritmo, ritmo_lento, atraso):
+        self.gpio = gpio
+        self.porta = porta
+        self.aviso = aviso
+        self.ritmo = ritmo
+        self.ritmo_lento = ritmo_lento
+        self.atraso = atraso
+        self.fase = 0.0
+        self.instante = time.perf_counter()
+        self.fecho = None
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            agora = time.perf_counter()
+            decorrido = agora - self.instante
+            self.instante = agora
+            if self.gpio.valores.get(self.porta) == 1:
+                self.fecho = None
+            elif self.fecho is None:
+                self.fecho = agora
+            if self.fecho is None or agora - self.fecho < self.atraso:
+                lento = self.gpio.valores.get(self.aviso) == 1
+                self.fase += (self.ritmo_lento if lento else self.ritmo) * decorrido
+            return 1 if self.fase % 1 < 0.5 else 0
+
+    def garrafas(self):
+        """Impulsos completos (descidas) gerados até agora"""
+        return int(self.fase - 0.5) + 1 if self.fase >= 0.5 else 0
+
+
+def bench_aproximacao(main, gpio, bd, rapido=False):
+    """
+    Excesso de garrafas por ordem fechada no objetivo, com e sem saída de aviso.
+
+    A count_thread conta uma enchedora simulada (25 garrafas/s, 5/s com o aviso ligado,
+    e mais 0,3 s de garrafas depois de a porta fechar). Compara o excesso real com o
+    medido pelo contador e mede a latência entre a garrafa do objetivo e o fecho da porta.
+    """
+    ordens = 2 if rapido else 10
+    objetivo = 40
+    ritmo, ritmo_lento, atraso = 25, 5, 0.3
+    pino_aviso = 90
+    contador = main.contador
+    modos = {"sem_aviso": (0, 0), "com_aviso": (10, 0.2)}
+    resultados = {}
+
+    main.thread_running = True
+    thread = threading.Thread(target=main.count_thread, daemon=True)
+    thread.start()
+    try:
+        contador.AVISO_PIN = pino_aviso
+        contador.sensor_initialized = True
+        contador.sobrecontagem_janela = atraso + 0.5
+        for modo, (garrafas_aviso, segundos_aviso) in modos.items():
+            contador.aproximacao_garrafas = garrafas_aviso
+            contador.aproximacao_segundos = segundos_aviso
+            reais, medidos, latencias, duracoes = [], [], [], []
+            for i in range(ordens):
+                main.reset_counter(contador)
+                contador.atualizar_ordem(Ordem=f"OP-APROX-{i}", ContagemTotal=objetivo)
+                enchedora = Enchedora(gpio, contador.DOOR_PIN, pino_aviso, ritmo, ritmo_lento, atraso)
+                registos = len(contador.sobrecontagens)
+                contador.transicao("configurar")
+                gpio.definir_gerador(contador.SENSOR_PIN, enchedora)
+                t0 = time.perf_counter()
+                contador.transicao("iniciar")
+                limite = t0 + 30
+                while len(contador.sobrecontagens) == registos and time.perf_counter() < limite:
+                    time.sleep(0.01)
+                duracoes.append(time.perf_counter() - t0)
+                registo = contador.sobrecontagens[-1]
+                reais.append(enchedora.garrafas() - objetivo)
+                medidos.append(registo["Excesso"])
+                latencias.append(registo["LatenciaFechoMs"] / 1000)
+            resultados[modo] = {
+                "excesso_real": reais,
+                "excesso_medido": medidos,
+                "excesso_real_medio": round(sum(reais) / len(reais), 2),
+                "latencia_fecho_porta_ms": percentis(latencias),
+                "duracao_ordem_s": round(sum(duracoes) / len(duracoes), 2),
+            }
+    finally:
+        main.thread_running = False
+        thread.join()
+        gpio.geradores.pop(contador.SENSOR_PIN, None)
+        contador.AVISO_PIN = None
+        contador.aproximacao_garrafas = main.CONFIG["aproximacao_garrafas"]
+        contador.aproximacao_segundos = main.CONFIG["aproximacao_segundos"]
+        contador.sobrecontagem_janela = main.CONFIG["sobrecontagem_janela"]
+        main.reset_counter(contador)
+
+    return {
+        "ordens_por_modo": ordens,
+        "objetivo": objetivo,
+        "ritmo_garrafas_s": ritmo,
+        "ritmo_lento_garrafas_s": ritmo_lento,
+        "atraso_porta_s": atraso,
+        "resultados": resultados,
+        "medicao_exata": all(r["excesso_real"] == r["excesso_medido"] for r in resultados.values()),
+    }
+
+
+def bench_aproximacao_processo(main, gpio, bd, rapido=False):
+    """
+    Excesso de garrafas no objetivo: count_thread versus processo de captura, que fecha
+    a porta no limite escrito no anel, sozinho e com o GIL do processo principal ocupado.
+
+    A enchedora simulada (25 garrafas/s, mais 0,2 s depois de a porta fechar) reage à
+    porta do processo que a lê: no modo processo corre no processo de captura, com a
+    sua cópia dos pinos, e só pára se for ele a fechar a porta. O excesso real é a
+    contagem acumulada do processo (ou da enchedora, no modo thread) menos o objetivo.
+    """
+    ordens = 2 if rapido else 8
+    objetivo = 40
+    ritmo, atraso = 25, 0.2
+    contador = main.contador
+    resultados = {}
+    ocupado = threading.Event()
+
+    def ocupar_gil():
+        # Trabalho em Python puro que não liberta o GIL (como serializar um pedido grande)
+        dados = list(range(200000, 0, -1))
+        while ocupado.is_set():
+            sorted(dados)
+
+    try:
+        contador.sensor_initialized = True
+        contador.sobrecontagem_janela = atraso + 0.4
+        for modo in ("thread", "processo"):
+            for carga in (False, True):
+                reais, medidos, latencias, pelo_processo = [], [], [], []
+                for i in range(ordens):
+                    main.reset_counter(contador)
+                    contador.atualizar_ordem(Ordem=f"OP-EXC-{i}", ContagemTotal=objetivo)
+                    registos = len(contador.sobrecontagens)
+                    contador.transicao("configurar")
+                    # A porta abre antes do fork: o processo de captura herda-a aberta
+                    contador.transicao("iniciar")
+                    enchedora = Enchedora(gpio, contador.DOOR_PIN, None, ritmo, ritmo, atraso)
+                    gpio.definir_gerador(contador.SENSOR_PIN, enchedora)
+                    captura = None
+                    main.thread_running = True
+                    if modo == "processo":
+                        captura = main.CapturaProcesso(main.linhas, intervalo_ms=1)
+                        captura.iniciar()
+                        alvo = captura.thread_consumo
+                    else:
+                        alvo = main.count_thread
+                    thread = threading.Thread(target=alvo, daemon=True)
+                    hog = threading.Thread(target=ocupar_gil, daemon=True)
+                    if carga:
+                        ocupado.set()
+                        hog.start()
+                    thread.start()
+                    limite = time.perf_counter() + 30
+                    while len(contador.sobrecontagens) == registos and time.perf_counter() < limite:
+                        time.sleep(0.01)
+                    ocupado.clear()
+                    if carga:
+                        hog.join()
+                    if captura is not None:
+                        time.sleep(atraso)
+                        captura.parar_processo()
+                        real = captura.anel.contagem(0) - objetivo
+                    else:
+                        real = enchedora.garrafas() - objetivo
+                    main.thread_running = False
+                    thread.join()
+                    if captura is not None:
+                        captura.libertar()
+                    gpio.geradores.pop(contador.SENSOR_PIN, None)
+                    registo = contador.sobrecontagens[-1]
+                    reais.append(real)
+                    medidos.append(registo["Excesso"])
+                    latencias.append(registo["LatenciaFechoMs"] / 1000)
+                    pelo_processo.append(registo.get("PortaPeloProcesso", False))
+                resultados[f"{modo}_{'com' if carga else 'sem'}_gil_ocupado"] = {
+                    "excesso_real": reais,
+                    "excesso_medido": medidos,
+                    "excesso_real_medio": round(sum(reais) / len(reais), 2),
+                    "latencia_fecho_porta_ms": percentis(latencias),
+                    "porta_pelo_processo": all(pelo_processo),
+                }
+    finally:
+        ocupado.clear()
+        main.thread_running = False
+        gpio.geradores.pop(contador.SENSOR_PIN, None)
+        contador.sobrecontagem_janela = main.CONFIG["sobrecontagem_janela"]
+        main.reset_counter(contador)
+
+    processo = [r for modo, r in resultados.items() if modo.startswith("processo")]
+    return {
+        "ordens_por_modo": ordens,
+        "objetivo": objetivo,
+        "ritmo_garrafas_s": ritmo,
+        "atraso_porta_s": atraso,
+        "resultados": resultados,
+        "porta_pelo_processo": all(r["porta_pelo_processo"] for r in processo),
+    }
+
+
+def bench_captura(main, gpio, bd, rapido=False):
+    """
+    Jitter da captura com e sem carga na API: count_thread versus processo de captura.
+
+    Uma onda quadrada de 10 Hz com instantes de descida conhecidos alimenta o sensor.
+    Mede o atraso entre a descida e a deteção (no processo, o instante publicado no
+    anel) e entre a descida e a contagem no processo principal, sozinho e com 4
+    clientes a pedir /api/info (1000 pontos) em paralelo. Verifica que não há perdas.
+    """
+    from werkzeug.serving import make_server
+
+    from .bench_api import _carga
+
+    duracao = 2.0 if rapido else 10.0
+    frequencia, duty = 10, 0.5
+    periodo = 1.0 / frequencia
+    contador = main.contador
+    resultados = {}
+
+    servidor = make_server("127.0.0.1", 0, main.app, threaded=True)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    contar_original = contador._contar_garrafa
+    try:
+        for modo in ("thread", "processo"):
+            for carga in (False, True):
+                preparar_ordem_ativa(main, contador, pontos=1000)
+                bd.preencher_historico(contador.Ordem, 1000)
+                contador.sensor_initialized = True
+                contador.Flop = False
+                inicio = time.perf_counter() + 0.2  # Depois de o processo de captura arrancar
+
+                def descida_anterior(instante):
+                    # Instante da última descida da onda antes de `instante`
+                    k = (instante - inicio - periodo * duty) // periodo
+                    return inicio + k * periodo + periodo * duty
+
+                def gerador():
+                    decorrido = time.perf_counter() - inicio
+                    return 1 if decorrido >= 0 and decorrido % periodo < periodo * duty else 0
+
+                contagens = []
+
+                def contar():
+                    contagens.append(time.perf_counter())
+                    contar_original()
+
+                contador._contar_garrafa = contar
+                # Antes do fork: o processo de captura herda o gerador do pino
+                gpio.definir_gerador(contador.SENSOR_PIN, gerador)
+                captura = None
+                main.thread_running = True
+                if modo == "processo":
+                    captura = main.CapturaProcesso(main.linhas, intervalo_ms=1)
+                    captura.iniciar()
+                    alvo = captura.thread_consumo
+                else:
+                    alvo = main.count_thread
+                thread = threading.Thread(target=alvo, daemon=True)
+                thread.start()
+
+                clientes = []
+                if carga:
+                    fim_carga = time.perf_counter() + duracao
+
+                    def cliente():
+                        while time.perf_counter() < fim_carga:
+                            _carga(servidor.server_port, "/api/info", 1, 5)
+
+                    clientes = [threading.Thread(target=cliente, daemon=True) for _ in range(4)]
+                    for t in clientes:
+                        t.start()
+                time.sleep(duracao)
+                fim = time.perf_counter()
+                if captura is not None:
+                    captura.parar_processo()
+                    deteccoes = [captura.anel.registo(i)[0] / 1e9 for i in range(captura.anel.cabecalho()[0])]
+                    estado = captura.estado()
+                main.thread_running = False
+                thread.join()
+                for t in clientes:
+                    t.join()
+                if captura is not None:
+                    captura.libertar()
+                else:
+                    deteccoes = contagens
+                    estado = None
+
+                esperado = int((fim - inicio - periodo * duty) // periodo) + 1
+                resultado = {
+                    "esperado": esperado,
+                    "contado": contador.ContagemAtual,
+                    "perdidos": max(0, esperado - contador.ContagemAtual - 1),
+                    "atraso_detecao_ms": percentis([t - descida_anterior(t) for t in deteccoes]),
+                    "atraso_contagem_ms": percentis([t - descida_anterior(t) for t in contagens]),
+                }
+                if estado is not None:
+                    resultado["maior_intervalo_leitura_ms"] = estado["MaiorIntervaloLeituraMs"]
+                    resultado["registos_perdidos"] = estado["RegistosPerdidos"]
+                resultados[f"{modo}_{'com' if carga else 'sem'}_carga"] = resultado
+                contador._contar_garrafa = contar_original
+                gpio.geradores.pop(contador.SENSOR_PIN, None)
+    finally:
+        contador._contar_garrafa = contar_original
+        main.thread_running = False
+        servidor.shutdown()
+        main.reset_counter()
+
+    return {
+        "duracao_s": duracao,
+        "frequencia_hz": frequencia,
+        "clientes_carga": 4,
+        "resultados": resultados,
+        "sem_perdas": all(r["perdidos"] == 0 for r in resultados.values()),
+    }
+
+
+def bench_repouso(main, gpio, bd, rapido=False):
+    """
+    Motor de captura em repouso e a contar: despertares por segundo e CPU do processo,
+    latência entre a passagem a em_contagem e a primeira leitura do sensor, e perdas
+    com o intervalo de leitura adaptado à cadência do artigo.
+    """
+    import random
+
+    duracao = 2.0 if rapido else 10.0
+    tentativas = 5 if rapido else 20
+    contador = main.contador
+    capturar_original = main.capturar_linha
+    ciclos = [0]
+    leituras = []
+
+    def capturar(c, t):
+        ciclos[0] += 1
+        return capturar_original(c, t)
+
+    def medir(duracao):
+        ciclos[0] = 0
+        cpu_inicio = time.process_time()
+        time.sleep(duracao)
+        return ciclos[0] / duracao, (time.process_time() - cpu_inicio) / duracao * 100
+
+    main.capturar_linha = capturar
+    main.reset_counter(contador)
+    contador.sensor_initialized = True
+    main.thread_running = True
+    thread = threading.Thread(target=main.count_thread, daemon=True)
+    thread.start()
+    resultados = {}
+    try:
+        time.sleep(0.2)
+        despertares, cpu = medir(duracao)
+        resultados["repouso"] = {"despertares_por_s": round(despertares, 2), "cpu_pct": round(cpu, 3)}
+
+        # Transição para em_contagem com a thread a dormir
+        gpio.definir_gerador(contador.SENSOR_PIN, lambda: leituras.append(time.perf_counter()) or 0)
+        rnd = random.Random(1)
+        latencias = []
+        for _ in range(tentativas):
+            main.reset_counter(contador)
+            time.sleep(rnd.uniform(0.1, 0.5))
+            leituras.clear()
+            t0 = time.perf_counter()
+            with contador._state_lock:
+                contador.estado = main.ESTADO_EM_CONTAGEM
+            while not [t for t in leituras if t >= t0] and time.perf_counter() - t0 < 5:
+                time.sleep(0.0005)
+            latencias.append(min(t for t in leituras if t >= t0) - t0)
+        resultados["latencia_primeira_leitura_ms"] = percentis(latencias)
+
+        for cadencia in (6000, 36000):
+            preparar_ordem_ativa(main, contador)
+            contador.CadenciaArtigoEmContagem = cadencia
+            impulsos = gpio.onda_quadrada(contador.SENSOR_PIN, cadencia / 3600.0)
+            despertares, cpu = medir(duracao)
+            esperado = impulsos()
+            resultados[f"contagem_{cadencia}_gh"] = {
+                "intervalo_ms": main.metricas_captura.estado()["IntervaloMs"],
+                "despertares_por_s": round(despertares, 2),
+                "cpu_pct": round(cpu, 3),
+                "esperado": esperado,
+                "contado": contador.ContagemAtual,
+                "perdidos": max(0, esperado - contador.ContagemAtual - 1),
+            }
+    finally:
+        main.thread_running = False
+        main.evento_captura.set()
+        thread.join()
+        main.capturar_linha = capturar_original
+        gpio.geradores.pop(contador.SENSOR_PIN, None)
+        main.reset_counter(contador)
+
+    return {
+        "duracao_s": duracao,
+        "despertares_anterior_por_s": 100,  # Ciclo fixo de 10 ms em qualquer estado
+        "resultados": resultados,
+    }
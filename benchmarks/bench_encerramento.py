@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""
+Harness de encerramento: SIGTERM repetido com a linha a contar e escritas de BD
+em fila. Em cada ciclo arranca um processo novo sobre os mesmos ficheiros, envia
+SIGTERM (por vezes duas vezes seguidas) e confirma que a contagem final chegou ao
+checkpoint, à BD simulada e ao processo seguinte.
+"""
+
+import json
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from .bench_arranque import CODIGO_PREPARAR
+from .simulacao import RAIZ_REPO, percentis
+
+ID_ORDEM = 7  # IdBDOrdemProducao usado pelo CODIGO_PREPARAR
+
+CODIGO_CICLO = """
+import atexit, json, sys, threading, time
+sys.path.insert(0, {raiz!r})
+from benchmarks.simulacao import carregar_main
+main, gpio, bd = carregar_main(diretorio={diretorio!r})
+bd.latencia = {latencia}
+contador = main.linhas.todas()[0]
+gpio.onda_quadrada(contador.SENSOR_PIN, {frequencia})
+
+def relatorio():
+    print(json.dumps({{
+        "final": contador.ContagemAtual,
+        "bd": bd.contagens.get({id_ordem}),
+        "fases": main.relatorio_encerramento,
+    }}), flush=True)
+atexit.register(relatorio)
+
+def carga():
+    # Mantém a fila do escritor ocupada, como uma BD lenta em produção
+    while main.thread_running:
+        if contador.escritor.pendentes() < {fila}:
+            contador.escritor.submeter(main.gravar_contagem, {id_ordem}, contador.ContagemAtual, contador)
+        time.sleep(0.01)
+
+main.init_main()
+threading.Thread(target=carga, daemon=True).start()
+print(json.dumps({{"recuperada": contador.relatorio_recuperacao.get("Recuperada")}}), flush=True)
+while True:
+    time.sleep(0.05)
+"""
+
+
+def bench_encerramento(main, gpio, bd, rapido=False):
+    """Perda de contagens e duração das fases do encerramento com SIGTERM repetido sob carga"""
+    ciclos = 5 if rapido else 30
+    rnd = random.Random(3)
+    diretorio = tempfile.mkdtemp(prefix="krones_encerramento_")
+    subprocess.run(
+        [sys.executable, "-c", CODIGO_PREPARAR.format(raiz=RAIZ_REPO, diretorio=diretorio)],
+        check=True, capture_output=True, cwd=RAIZ_REPO,
+    )
+
+    anterior = None
+    perdidas_recuperacao = 0
+    perdidas_bd = 0
+    saidas_erro = 0
+    repetidos = 0
+    fases = {}
+    encerramento = []
+
+    for _ in range(ciclos):
+        processo = subprocess.Popen(
+            [sys.executable, "-c", CODIGO_CICLO.format(
+                raiz=RAIZ_REPO, diretorio=diretorio, latencia=0.02, frequencia=50, id_ordem=ID_ORDEM, fila=20,
+            )],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, cwd=RAIZ_REPO,
+        )
+        recuperada = json.loads(processo.stdout.readline())["recuperada"]
+        if anterior is not None:
+            perdidas_recuperacao += max(0, anterior - recuperada)
+
+        time.sleep(rnd.uniform(0.3, 1.5))
+        t0 = time.perf_counter()
+        processo.send_signal(signal.SIGTERM)
+        if rnd.random() < 0.5:
+            time.sleep(0.05)
+            processo.send_signal(signal.SIGTERM)
+            repetidos += 1
+        saida, _ = processo.communicate(timeout=60)
+        encerramento.append(time.perf_counter() - t0)
+        saidas_erro += processo.returncode != 0
+
+        resultado = json.loads(saida.strip().splitlines()[-1])
+        anterior = resultado["final"]
+        perdidas_bd += max(0, resultado["final"] - (resultado["bd"] or 0))
+        for fase, ms in resultado["fases"].items():
+            if fase != "escritas_por_gravar":
+                fases.setdefault(fase, []).append(ms / 1000)
+
+    return {
+        "ciclos": ciclos,
+        "sigterm_repetidos": repetidos,
+        "saidas_com_erro": saidas_erro,
+        "garrafas_perdidas_recuperacao": perdidas_recuperacao,
+        "garrafas_por_gravar_na_bd": perdidas_bd,
+        "contagem_final": anterior,
+        "encerramento_ms": percentis(encerramento),
+        "fases_ms": {fase: percentis(valores) for fase, valores in fases.items()},
+    }
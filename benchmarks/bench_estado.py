@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks de estado e estatísticas: latência de _save_state/recover_state
+e custo de update_stats/media_producao em função do comprimento das séries.
+"""
+
+import time
+
+from .simulacao import TempoSemEspera, percentis, preparar_ordem_ativa
+
+
+def bench_persistencia(main, gpio, bd, rapido=False):
+    """Latência de gravação e recuperação do ficheiro de estado"""
+    n = 200 if rapido else 2000
+    contador = preparar_ordem_ativa(main)
+    contador.ContagemAtual = 12345
+
+    gravar = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        contador._save_state()
+        gravar.append(time.perf_counter() - t0)
+
+    recuperar = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        contador.recover_state()
+        recuperar.append(time.perf_counter() - t0)
+
+    return {
+        "iteracoes": n,
+        "save_state_ms": percentis(gravar),
+        "recover_state_ms": percentis(recuperar),
+    }
+
+
+def bench_estatisticas(main, gpio, bd, rapido=False):
+    """Custo de update_stats e media_producao versus comprimento das séries"""
+    comprimentos = [10, 100, 1000, 10000]
+    repeticoes = 20 if rapido else 200
+    resultados = []
+
+    tempo_original = main.time
+    main.time = TempoSemEspera()
+    try:
+        for comprimento in comprimentos:
+            update = []
+            media = []
+            for _ in range(repeticoes):
+                contador = preparar_ordem_ativa(main, pontos=comprimento)
+                contador.IdBDOrdemProducao = 0  # Sem gravação na BD
+
+                t0 = time.perf_counter()
+                contador.update_stats()
+                update.append(time.perf_counter() - t0)
+
+                t0 = time.perf_counter()
+                main.media_producao()
+                media.append(time.perf_counter() - t0)
+
+            resultados.append({
+                "comprimento": comprimento,
+                "update_stats_ms": percentis(update),
+                "media_producao_ms": percentis(media),
+            })
+    finally:
+        main.time = tempo_original
+        main.reset_counter()
+
+    return {"repeticoes": repeticoes, "series": resultados}
+
+
+def bench_recuperacao(main, gpio, bd, rapido=False):
+    """
+    Perda de contagens e tempo de recuperação após uma falha abrupta.
+
+    Em cada tentativa conta um número aleatório de garrafas, abandona o contador
+    sem encerramento (como um crash) e recupera com um contador novo sobre os mesmos
+    ficheiros. Compara com o que se recuperaria só com o checkpoint.
+    """
+    import random
+
+    rnd = random.Random(1)
+    tentativas = 20 if rapido else 200
+    perdidas = 0
+    perdidas_so_checkpoint = 0
+    tempos = []
+
+    for i in range(tentativas):
+        ficheiro = f"recuperacao_{i}.backup"
+        original = main.Contador(linha_id=f"R{i}", sensor_pin=300, door_pin=301, ficheiro_estado=ficheiro)
+        original.Ordem = "OP-REC"
+        original.IdBDOrdemProducao = 42
+        original.ContagemTotal = 10 ** 6
+        original.estado = main.ESTADO_EM_CONTAGEM
+        original._save_state()
+        garrafas = rnd.randint(1, 500)
+        with original._contagem_lock:
+            for _ in range(garrafas):
+                original._contar_garrafa()
+        checkpoint = int(original.last_saved_state["ContagemAtual"])
+
+        t0 = time.perf_counter()
+        recuperado = main.Contador(linha_id=f"R{i}", sensor_pin=300, door_pin=301, ficheiro_estado=ficheiro)
+        recuperado.recover_state()
+        tempos.append(time.perf_counter() - t0)
+
+        perdidas += garrafas - recuperado.ContagemAtual
+        perdidas_so_checkpoint += garrafas - checkpoint
+
+    # Ficheiros locais perdidos: a BD repõe a contagem em segundo plano
+    bd.contagens[43] = 250
+    ficheiro = "recuperacao_bd.backup"
+    c = main.Contador(linha_id="RBD", sensor_pin=300, door_pin=301, ficheiro_estado=ficheiro)
+    c.Ordem, c.IdBDOrdemProducao, c.ContagemTotal, c.estado = "OP-BD", 43, 1000, main.ESTADO_EM_CONTAGEM
+    c.ContagemAtual = 200  # Checkpoint desatualizado, sem diário
+    c._save_state()
+    main.os.remove(c.ficheiro_diario)
+    c = main.Contador(linha_id="RBD", sensor_pin=300, door_pin=301, ficheiro_estado=ficheiro)
+    c.recover_state()
+    c.escritor.fila.join()
+
+    return {
+        "tentativas": tentativas,
+        "garrafas_perdidas": perdidas,
+        "garrafas_perdidas_so_checkpoint": perdidas_so_checkpoint,
+        "tempo_ate_pronto_ms": percentis(tempos),
+        "correcao_bd": c.relatorio_recuperacao,
+    }
+
+
+def bench_ordem(main, gpio, bd, rapido=False):
+    """
+    Fecho da ordem: latência entre o fim da contagem (objetivo atingido ou
+    /parar-contagem) e o UPDATE na BD, e fecho único com pedidos simultâneos.
+    """
+    import threading
+
+    tentativas = 20 if rapido else 200
+    cliente = main.app.test_client()
+    contador = main.contador
+
+    def esperar_fecho(id_ordem, limite=5.0):
+        t0 = time.perf_counter()
+        while time.perf_counter() - t0 < limite:
+            for id_bd, _, instante in list(bd.finalizacoes):
+                if id_bd == id_ordem:
+                    return instante
+            time.sleep(0.0005)
+        return None
+
+    latencias = {"objetivo": [], "parar_contagem": []}
+    try:
+        for i in range(tentativas):
+            for origem in latencias:
+                id_ordem = 1000 + 2 * i + (origem == "parar_contagem")
+                preparar_ordem_ativa(main, contador)
+                contador.IdBDOrdemProducao = id_ordem
+                contador.ContagemTotal = 10
+                t0 = time.perf_counter()
+                if origem == "objetivo":
+                    with contador._contagem_lock:
+                        for _ in range(10):
+                            contador._contar_garrafa()
+                else:
+                    cliente.get("/parar-contagem")
+                instante = esperar_fecho(id_ordem)
+                if instante is not None:
+                    latencias[origem].append(instante - t0)
+                contador.escritor.fila.join()
+
+        # Corridas: objetivo atingido, /parar-contagem repetido, update_stats e encerramento ao mesmo tempo
+        duplicados = 0
+        sem_fecho = 0
+        nao_livres = 0
+        for i in range(tentativas):
+            id_ordem = 5000 + i
+            preparar_ordem_ativa(main, contador)
+            contador.IdBDOrdemProducao = id_ordem
+            contador.ContagemTotal = 5
+            barreira = threading.Barrier(6)
+
+            def objetivo():
+                barreira.wait()
+                with contador._contagem_lock:
+                    for _ in range(5):
+                        contador._contar_garrafa()
+
+            def parar():
+                barreira.wait()
+                main.app.test_client().get("/parar-contagem")
+
+            def estatisticas():
+                barreira.wait()
+                contador.update_stats()
+                with contador._state_lock:
+                    if contador.estado == main.ESTADO_A_FINALIZAR:
+                        contador._agendar_finalizacao()
+
+            threads = [threading.Thread(target=f) for f in (objetivo, parar, parar, parar, estatisticas, estatisticas)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            contador.escritor.fila.join()
+            fechos = sum(1 for id_bd, _, _ in bd.finalizacoes if id_bd == id_ordem)
+            duplicados += max(0, fechos - 1)
+            sem_fecho += fechos == 0
+            nao_livres += contador.estado != main.ESTADO_LIVRE
+
+        # Transições inválidas numa linha livre têm de ser recusadas sem efeitos
+        main.reset_counter()
+        invalidas = {caminho: cliente.get(caminho).status_code
+                     for caminho in ("/parar-contagem", "/iniciar-contagem", "/pausa", "/retomar")}
+        eventos = cliente.get("/eventos-ordem").get_json()["data"]
+    finally:
+        main.reset_counter()
+
+    return {
+        "tentativas": tentativas,
+        "latencia_fecho_ms": {origem: percentis(valores) for origem, valores in latencias.items()},
+        "latencia_anterior_max_ms": 5000,  # Fecho só no ciclo seguinte da thread de estatísticas
+        "corridas": {
+            "fechos_duplicados": duplicados,
+            "ordens_sem_fecho": sem_fecho,
+            "linhas_nao_livres": nao_livres,
+        },
+        "transicoes_invalidas_http": invalidas,
+        "estado_final": eventos["Estado"],
+    }
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+"""
+Teste de longa duração da memória: a linha simulada corre dias de tempo virtual
+(RelogioVirtual) com ordens sucessivas, pausas do calendário e gravações na BD,
+e a memória Python alocada pelo main.py (tracemalloc) tem de ficar estável.
+
+Uso (a partir da raiz do repositório):
+    python -m benchmarks.bench_memoria --dias 7
+"""
+
+import argparse
+import gc
+import inspect
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import deque
+from datetime import datetime
+
+from .simulacao import RAIZ_REPO, carregar_main, simular_producao
+
+
+def _heap_main(main):
+    """
+    Bytes alocados e ainda vivos cuja origem é o main.py, sem as amostras do próprio
+    MonitorMemoria (o do teste guarda todas, não só as últimas 24 h)
+    """
+    linhas, primeira = inspect.getsourcelines(main.MonitorMemoria)
+    monitor = range(primeira, primeira + len(linhas))
+    snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(True, main.__file__),))
+    return sum(e.size for e in snapshot.statistics("lineno") if e.traceback[0].lineno not in monitor)
+
+
+def soak_memoria(main, bd, dias, garrafas_por_hora=6000, horas_ordem=2, aquecimento_h=8):
+    """
+    Corre `dias` dias virtuais em passos de 15 minutos: quando a linha fica livre configura
+    a ordem seguinte (`horas_ordem` horas de produção). Em cada hora esvazia as listas da BD
+    simulada (não são do main.py) e regista uma amostra do MonitorMemoria e os bytes do
+    main.py. Entre ordens (linha livre) recolhe o lixo e mede de novo: depois do
+    aquecimento esta medida não pode crescer de ordem para ordem.
+    
+    O que é limitado por desenho (séries de 1000 pontos, cache de datas, diário de eventos,
+    ordens conhecidas do histórico local até à retenção) tem de encher durante o
+    aquecimento: o diário de eventos fica com 10 eventos e a retenção com 6 horas.
+    """
+    contador = main.contador
+    relogio_original = main.relogio
+    historico_original = main.historico_local
+    relogio = main.RelogioVirtual(datetime(2026, 1, 5, 6, 0))  # Segunda-feira
+    ficheiro = os.path.join(tempfile.mkdtemp(prefix="krones_memoria_"), "historico_local.db")
+    historico = main.HistoricoLocal(ficheiro, dias=0.25, max_mb=50)
+    horas = int(dias * 24)
+    monitor = main.MonitorMemoria({}, pontos=horas + 1)
+    ligado = not tracemalloc.is_tracing()
+    if ligado:
+        tracemalloc.start(1)
+
+    eventos_original = contador.eventos_ordem
+    ordens = garrafas = 0
+    por_hora = []  # Bytes do main.py no fim de cada hora
+    entre_ordens = []  # (hora, bytes do main.py com a linha livre)
+    threads = []
+    try:
+        main.relogio = relogio
+        main.historico_local = historico
+        historico._conexao()
+        main.reset_counter(contador)
+        contador.eventos_ordem = deque(eventos_original, maxlen=10)
+        t0 = time.perf_counter()
+        for passo in range(horas * 4):
+            if contador.estado == main.ESTADO_LIVRE:
+                if ordens:
+                    gc.collect()
+                    entre_ordens.append((passo / 4, _heap_main(main)))
+                ordens += 1
+                contador.transicao("configurar")
+                with contador._contagem_lock, contador._state_lock:
+                    contador.atualizar_ordem(
+                        Ordem=f"OP-SOAK-{ordens}", IdBDOrdemProducao=10000 + ordens,
+                        ContagemTotal=garrafas_por_hora * horas_ordem, Quebras=0,
+                    )
+                    contador.ContagemAtual = 0
+                contador.transicao("iniciar")
+            garrafas += simular_producao(main, relogio, 900, garrafas_por_hora)["garrafas"]
+            if passo % 4 != 3:
+                continue
+
+            with bd._lock:
+                bd.rollups.clear()
+                bd.oee_horario.clear()
+                bd.finalizacoes.clear()
+                bd.contagens.clear()
+            threads.append(monitor.amostrar()["Threads"])
+            por_hora.append(_heap_main(main))
+        duracao = time.perf_counter() - t0
+        tracemalloc_mb = tracemalloc.get_tracemalloc_memory() / 1048576
+    finally:
+        main.relogio = relogio_original
+        main.historico_local = historico_original
+        main.reset_counter(contador)
+        contador.eventos_ordem = eventos_original
+        if ligado:
+            tracemalloc.stop()
+
+    # A medida entre ordens oscila uns KB com a hora do fim da ordem: compara-se o máximo
+    # da segunda metade com o da primeira
+    estavel = [b for hora, b in entre_ordens if hora >= aquecimento_h]
+    metade = len(estavel) // 2
+    crescimento_kb = (max(estavel[metade:]) - max(estavel[:metade])) / 1024 if metade else None
+    primeira, ultima = monitor.amostras[0], monitor.amostras[-1]
+    relatorio = {
+        "dias_simulados": dias,
+        "duracao_real_s": round(duracao, 1),
+        "ordens": ordens,
+        "garrafas": garrafas,
+        "heap_main_kb_por_hora": {
+            "inicio": round(por_hora[0] / 1024, 1),
+            "fim": round(por_hora[-1] / 1024, 1),
+            "max": round(max(por_hora) / 1024, 1),
+        },
+        "heap_main_kb_entre_ordens": [round(b / 1024, 1) for b in estavel],
+        "crescimento_entre_ordens_kb": round(crescimento_kb, 1) if crescimento_kb is not None else None,
+        "tendencia_heap_total_mb_por_hora": monitor.tendencia("HeapMb", ultimas=horas - aquecimento_h),
+        # O RSS inclui as tabelas do próprio tracemalloc e os snapshots do teste
+        "tendencia_rss_mb_por_hora": monitor.tendencia("RssMb", ultimas=horas - aquecimento_h),
+        "tracemalloc_mb": round(tracemalloc_mb, 2),
+        "heap_total_mb": [primeira["HeapMb"], ultima["HeapMb"]],
+        "rss_mb": [primeira["RssMb"], ultima["RssMb"]],
+        "blocos_alocados": [primeira["BlocosAlocados"], ultima["BlocosAlocados"]],
+        "threads": [min(threads), max(threads)],
+        "log_mb": ultima["LogMb"],
+        "relogio_final": main.formatar_ns(relogio.tempo_ns()),
+    }
+    relatorio["ok"] = (
+        crescimento_kb is not None and crescimento_kb < 16
+        and len(set(threads[aquecimento_h:])) == 1
+    )
+    return relatorio
+
+
+def bench_memoria(main, gpio, bd, rapido=False):
+    """
+    Memória do main.py estável ao longo de dias de produção simulada (18 h com --rapido,
+    3 dias sem), num processo novo: as threads e os objetos dos outros benchmarks
+    não entram na medida.
+    """
+    dias = 0.75 if rapido else 3
+    saida = subprocess.run(
+        [sys.executable, "-m", "benchmarks.bench_memoria", "--dias", str(dias)],
+        capture_output=True, text=True, timeout=3600, cwd=RAIZ_REPO,
+    )
+    if not saida.stdout.strip():
+        raise RuntimeError(saida.stderr.strip().splitlines()[-1] if saida.stderr else "falha no subprocesso")
+    return json.loads(saida.stdout)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Teste de longa duração da memória")
+    parser.add_argument("--dias", type=float, default=7, help="dias de tempo virtual")
+    parser.add_argument("--garrafas-hora", type=int, default=6000)
+    args = parser.parse_args(argv)
+
+    main_mod, gpio, bd = carregar_main()
+    resultado = soak_memoria(main_mod, bd, args.dias, args.garrafas_hora)
+    print(json.dumps(resultado, indent=2, ensure_ascii=False))
+    return 0 if resultado["ok"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks de simulação de turnos com o relógio virtual: garrafas, ciclos de
+estatísticas, pausas do calendário e gravações na BD de horas de produção,
+corridos em segundos.
+"""
+
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from .bench_api import descodificar_colunar
+from .simulacao import ordem_simulada, percentis, simular_producao
+
+
+def bench_turno(main, gpio, bd, rapido=False):
+    """
+    Turno das 08:00 às 16:00 (a pausa das 12:00 às 13:00 fica pelo meio) numa linha
+    a 6000 garrafas/hora, com o RelogioVirtual: duração real, garrafas contadas,
+    amostras gravadas (com datas virtuais no histórico local), pausas e horas de OEE.
+    """
+    horas = 2 if rapido else 8
+    garrafas_por_hora = 6000
+    inicio = datetime(2026, 1, 5, 8, 0)  # Segunda-feira
+    contador = main.contador
+    relogio_original = main.relogio
+    historico_original = main.historico_local
+    relogio = main.RelogioVirtual(inicio)
+
+    ficheiro = os.path.join(tempfile.mkdtemp(prefix="krones_turno_"), "historico_local.db")
+    historico = main.HistoricoLocal(ficheiro, dias=30, max_mb=200)
+    inseridos = bd.inseridos
+    try:
+        main.relogio = relogio
+        main.historico_local = historico
+        main.reset_counter(contador)
+        contador.transicao("configurar")
+        with contador._contagem_lock, contador._state_lock:
+            contador.atualizar_ordem(Ordem="OP-TURNO", IdBDOrdemProducao=77, ContagemTotal=garrafas_por_hora * 10, Quebras=0)
+            contador.ContagemAtual = 0
+        contador.transicao("iniciar")
+
+        t0 = time.perf_counter()
+        cpu0 = time.process_time()
+        resultado = simular_producao(main, relogio, horas * 3600, garrafas_por_hora)
+        duracao = time.perf_counter() - t0
+        cpu = time.process_time() - cpu0
+
+        amostras = historico.ler(10 ** 6, "OP-TURNO")
+        pausas = [(e["Data"][11:16], e["Evento"], e["Origem"]) for e in contador.eventos_ordem
+                  if e["Evento"] in ("pausar", "retomar")]
+        esperadas = garrafas_por_hora * (horas - (1 if horas > 4 else 0))
+        relatorio = {
+            "duracao_real_s": round(duracao, 2),
+            "cpu_s": round(cpu, 2),
+            "aceleracao": round(horas * 3600 / duracao) if duracao else None,
+            "garrafas_simuladas": resultado["garrafas"],
+            "contagem": contador.ContagemAtual,
+            "contagem_esperada": esperadas,
+            "ciclos_estatisticas": resultado["ciclos"],
+            "insercoes_bd": bd.inseridos - inseridos,
+            "amostras_historico_local": len(amostras),
+            "primeira_amostra": amostras[0]["DataDados"].strftime("%Y-%m-%d %H:%M:%S") if amostras else None,
+            "ultima_amostra": amostras[-1]["DataDados"].strftime("%Y-%m-%d %H:%M:%S") if amostras else None,
+            "pausas": pausas,
+            "horas_oee_fechadas": len(contador.oee.horas_ordem),
+            "relogio_final": relogio.agora().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+    finally:
+        main.relogio = relogio_original
+        main.historico_local = historico_original
+        main.reset_counter(contador)
+
+    return dict(relatorio, horas_simuladas=horas, garrafas_por_hora=garrafas_por_hora)
+
+
+def bench_turno_noite(main, gpio, bd, rapido=False):
+    """
+    Turno da noite das 23:30 às 02:30 de 24 para 25/10/2026 em Europe/Lisbon: passa a
+    meia-noite e a mudança da hora (02:00 de verão volta a 01:00), por isso a hora
+    01:00-02:00 repete-se. Confirma que /status e /api/info devolvem todas as amostras
+    da ordem, com intervalos de 5 s no formato colunar (4 a 6 s, com as datas ao
+    segundo; uma hora repetida daria -3595 s), e mede o custo de formatar as
+    horas de 1000 amostras com e sem a cache por segundo.
+    """
+    horas = 4  # 23:30 -> 02:30 de inverno
+    garrafas_por_hora = 6000
+    contador = main.contador
+    relogio_original = main.relogio
+    historico_original = main.historico_local
+    tz_original = os.environ.get("TZ")
+    cliente = main.app.test_client()
+    colunar = {"Accept": main.MIME_FORMATOS["colunar"]}
+
+    def intervalos(caminho):
+        """Pontos e intervalos mínimo/máximo (s) da resposta no formato colunar"""
+        _, n, _, dt, _, _ = descodificar_colunar(cliente.get(caminho, headers=colunar).get_data())
+        return n, [min(dt), max(dt)]
+
+    os.environ["TZ"] = "Europe/Lisbon"
+    time.tzset()
+    main.formatar_epoch.cache_clear()  # A cache é da hora local: muda com o fuso
+    try:
+        relogio = main.RelogioVirtual(datetime(2026, 10, 24, 23, 30))
+        ficheiro = os.path.join(tempfile.mkdtemp(prefix="krones_noite_"), "historico_local.db")
+        historico = main.HistoricoLocal(ficheiro, dias=30, max_mb=200)
+        main.relogio = relogio
+        main.historico_local = historico
+        historico._conexao()  # Criado antes da ordem: fica completa localmente
+        main.reset_counter(contador)
+        contador.transicao("configurar")
+        with contador._contagem_lock, contador._state_lock:
+            contador.atualizar_ordem(Ordem="OP-NOITE", IdBDOrdemProducao=78, ContagemTotal=garrafas_por_hora * 10, Quebras=0)
+            contador.ContagemAtual = 0
+        contador.transicao("iniciar")
+
+        t0 = time.perf_counter()
+        resultado = simular_producao(main, relogio, horas * 3600, garrafas_por_hora)
+        duracao = time.perf_counter() - t0
+        amostras = len(historico.ler(10 ** 6, "OP-NOITE"))  # Todas as amostras gravadas da ordem
+
+        status = cliente.get("/status").get_json()["data"]
+        info = cliente.get(f"/api/info/{amostras + 100}/OP-NOITE").get_json()
+        depois_meia_noite = sum(1 for t in info["Tempo"] if t < "23:30:00")
+        n_status, dt_status = intervalos("/status")
+        n_info, dt_info = intervalos(f"/api/info/{amostras + 100}/OP-NOITE")
+
+        # Horas de 1000 amostras: formatar_ns (cache por segundo) versus strftime em cada uma
+        instantes = list(contador.EstatisticaNs)
+        repeticoes = 20 if rapido else 200
+        com_cache, sem_cache = [], []
+        for _ in range(repeticoes):
+            t = time.perf_counter()
+            [main.formatar_ns(ns, main.FORMATO_HORA) for ns in instantes]
+            com_cache.append(time.perf_counter() - t)
+            t = time.perf_counter()
+            [datetime.fromtimestamp(ns / 1e9).strftime("%H:%M:%S") for ns in instantes]
+            sem_cache.append(time.perf_counter() - t)
+
+        relatorio = {
+            "duracao_real_s": round(duracao, 2),
+            "amostras": amostras,
+            "inicio": status["Inicio"],
+            "relogio_final": main.formatar_ns(relogio.tempo_ns()),
+            "status_pontos": len(status["Tempo"]),
+            "status_pontos_esperados": min(amostras, 1000),
+            "status_intervalos_colunar_min_max_s": dt_status,
+            "api_info_pontos": len(info["Tempo"]),
+            "api_info_pontos_depois_meia_noite": depois_meia_noite,
+            "api_info_intervalos_colunar_min_max_s": dt_info,
+            "colunar_pontos": {"status": n_status, "api_info": n_info},
+            "formatar_1000_horas_ms": {"cache": percentis(com_cache), "strftime": percentis(sem_cache)},
+        }
+        relatorio["ok"] = (
+            relatorio["status_pontos"] == relatorio["status_pontos_esperados"]
+            and relatorio["api_info_pontos"] == amostras
+            and depois_meia_noite > 0
+            and 4 <= dt_status[0] and dt_status[1] <= 6 and 4 <= dt_info[0] and dt_info[1] <= 6
+        )
+    finally:
+        main.relogio = relogio_original
+        main.historico_local = historico_original
+        main.reset_counter(contador)
+        if tz_original is None:
+            os.environ.pop("TZ", None)
+        else:
+            os.environ["TZ"] = tz_original
+        time.tzset()
+        main.formatar_epoch.cache_clear()
+
+    return dict(relatorio, horas_simuladas=horas, garrafas_por_hora=garrafas_por_hora)
+
+
+def bench_previsao(main, gpio, bd, rapido=False):
+    """
+    Verificações determinísticas da previsão de fecho, com pausa das 12:00 às 13:00.
+
+    Com séries de GFA sintéticas: ritmo constante (intervalo nulo), ciclos alternados
+    0/12000 (ritmo de cada minuto constante: intervalo nulo) e minutos alternados
+    parado/12000 (desvio de 6000 nos ritmos de um minuto: intervalo conhecido). Numa
+    ordem simulada com o RelogioVirtual, a previsão das 10:30 tem de acertar no fecho
+    real (depois da pausa), dentro do intervalo de 90%.
+    """
+    formato = "%Y-%m-%d %H:%M:%S"
+    calendario = main.Calendario({"pausas": [{"inicio": "12:00", "fim": "13:00"}]})
+    agora = datetime(2026, 1, 5, 10, 30)
+
+    def prever(gfa, restantes=15000):
+        previsao = main.PrevisaoFecho(calendario, janela=120).atualizar(agora, restantes, gfa)
+        return {chave: previsao[chave] for chave in ("EstimativaFecho", "EstimativaFechoMin", "EstimativaFechoMax")}
+
+    def fim(ritmo, restantes=15000):
+        return calendario.fim_producao(agora, restantes * 3600 / ritmo).strftime(formato)
+
+    # 15000 garrafas a 6000/h: 2,5 h de produção, 1,5 h antes da pausa e 1 h depois
+    esperado = {"EstimativaFecho": "2026-01-05 14:00:00", "EstimativaFechoMin": "2026-01-05 14:00:00",
+                "EstimativaFechoMax": "2026-01-05 14:00:00"}
+    constante = prever([6000.0] * 120)
+    alternado = prever([0.0, 12000.0] * 60)
+    erro = main.PrevisaoFecho.Z_90 * 6000 / (150 ** 0.5)  # 150 minutos de produção em falta
+    minutos = prever(([0.0] * 12 + [12000.0] * 12) * 5)
+    minutos_esperado = {"EstimativaFecho": fim(6000), "EstimativaFechoMin": fim(6000 + erro),
+                        "EstimativaFechoMax": fim(6000 - erro)}
+
+    # Ordem simulada: começa às 10:00, previsão às 10:30, fecho real depois da pausa
+    garrafas_por_hora = 6000
+    with ordem_simulada(
+        main, datetime(2026, 1, 5, 10, 0), calendario=calendario,  # Segunda-feira
+        Ordem="OP-PREVISAO", IdBDOrdemProducao=79, ContagemTotal=garrafas_por_hora * 3,
+    ) as (contador, relogio):
+        simular_producao(main, relogio, 1800, garrafas_por_hora)
+        prevista = dict(contador.previsao.atual)
+        while contador.estado in (main.ESTADO_EM_CONTAGEM, main.ESTADO_PAUSADA) and relogio.agora() < agora + timedelta(hours=6):
+            simular_producao(main, relogio, 300, garrafas_por_hora)
+        fechos = [e["Data"] for e in contador.eventos_ordem if e["Evento"] == "terminar" and e["Ordem"] == "OP-PREVISAO"]
+
+    real = fechos[-1][:19] if fechos else None
+    diferenca = None
+    if real and prevista["EstimativaFecho"]:
+        diferenca = (datetime.strptime(real, formato) - datetime.strptime(prevista["EstimativaFecho"], formato)).total_seconds()
+    verificacoes = {
+        "ritmo_constante": constante == esperado,
+        "ciclos_alternados_sem_intervalo": alternado == esperado,
+        "minutos_alternados_intervalo": minutos == minutos_esperado,
+        # O ciclo de estatísticas retoma a linha até 5 s depois do fim da pausa
+        "ordem_simulada_fecho": diferenca is not None and abs(diferenca) <= 15,
+        "ordem_simulada_no_intervalo": (
+            real is not None
+            and prevista["EstimativaFechoMin"] <= real <= (prevista["EstimativaFechoMax"] or real)
+        ),
+    }
+    return {
+        "sinteticas": {"constante": constante, "ciclos_alternados": alternado, "minutos_alternados": minutos,
+                       "minutos_alternados_esperado": minutos_esperado},
+        "ordem_simulada": {"previsao_10h30": prevista, "fecho_real": real, "diferenca_s": diferenca},
+        "verificacoes": verificacoes,
+        "ok": all(verificacoes.values()),
+    }
+
+
+def bench_oee(main, gpio, bd, rapido=False):
+    """
+    Verificações determinísticas do OEE com o RelogioVirtual: ordem das 13:30 às 15:30
+    a 6000 garrafas/hora num artigo de 7200/hora (desempenho 5/6), com uma pausa do
+    operador fora do calendário (13:40-13:50, paragem), 60 quebras às 14:10 e uma pausa
+    do calendário (14:30-14:45, fora do tempo planeado). Passa a mudança de turno
+    (Manhã -> Tarde às 14:00) e duas mudanças de hora; compara disponibilidade,
+    desempenho e qualidade de cada hora, do turno e da ordem com os valores esperados.
+    """
+    cadencia, garrafas_por_hora = 7200, 6000
+    cliente = main.app.test_client()
+    with ordem_simulada(
+        main, datetime(2026, 1, 5, 13, 30),  # Segunda-feira
+        calendario=main.Calendario({"pausas": [{"inicio": "14:30", "fim": "14:45"}]}),
+        turnos=[{"nome": "Manhã", "inicio": "06:00"}, {"nome": "Tarde", "inicio": "14:00"}],
+        Ordem="OP-OEE", IdBDOrdemProducao=80, ContagemTotal=10 ** 6, CadenciaArtigoEmContagem=cadencia,
+    ) as (contador, relogio):
+        simular_producao(main, relogio, 600, garrafas_por_hora)    # 13:30 -> 13:40
+        contador.pause_count(origem="operador")
+        simular_producao(main, relogio, 600, garrafas_por_hora)    # 13:40 -> 13:50, parada
+        contador.resume_count(origem="operador")
+        simular_producao(main, relogio, 1200, garrafas_por_hora)   # 13:50 -> 14:10
+        cliente.get("/quebra/60")
+        simular_producao(main, relogio, 4800, garrafas_por_hora)   # 14:10 -> 15:30
+        horas = {h[2][11:16]: dict(zip(("Disponibilidade", "Desempenho", "Qualidade", "OEE"), h[9:13]),
+                                   TempoPlaneado=h[4], TempoFuncionamento=h[5], Contagem=h[6], Quebras=h[7], Turno=h[3])
+                 for h in contador.oee.horas_ordem}
+        resumo = contador.oee.resumo()
+
+    desempenho = garrafas_por_hora / cadencia
+    esperado = {
+        # Hora 13: 30 min planeados, 10 min parada pelo operador (conta como paragem)
+        "hora_13": {"Disponibilidade": 20 / 30, "Desempenho": desempenho, "Qualidade": 1.0},
+        # Hora 14: a pausa do calendário não é tempo planeado; 60 quebras em 4500 garrafas
+        "hora_14": {"Disponibilidade": 1.0, "Desempenho": desempenho, "Qualidade": 4440 / 4500},
+        "hora_15": {"Disponibilidade": 1.0, "Desempenho": desempenho, "Qualidade": 1.0},
+        # Turno da Tarde (14:00-15:30): 75 min em marcha, 7500 garrafas
+        "turno_tarde": {"Disponibilidade": 1.0, "Desempenho": desempenho, "Qualidade": 7440 / 7500},
+        # Ordem: 105 min planeados, 95 em marcha, 9500 garrafas
+        "ordem": {"Disponibilidade": 95 / 105, "Desempenho": desempenho, "Qualidade": 9440 / 9500},
+    }
+    medido = {
+        "hora_13": horas.get("13:00", {}),
+        "hora_14": horas.get("14:00", {}),
+        "hora_15": resumo["Hora"],
+        "turno_tarde": resumo["Turno"],
+        "ordem": resumo["Ordem"],
+    }
+    # Tolerância de um ciclo de estatísticas (5 s) nas transições de pausa e nos limites
+    tolerancia = {"Disponibilidade": 0.01, "Desempenho": 0.01, "Qualidade": 0.001}
+    verificacoes = {
+        periodo: all(abs(medido[periodo].get(chave, -1) - valor) <= tolerancia[chave] for chave, valor in valores.items())
+        for periodo, valores in esperado.items()
+    }
+    verificacoes["turnos"] = (horas.get("13:00", {}).get("Turno") == "Manhã" and horas.get("14:00", {}).get("Turno") == "Tarde"
+                              and resumo["Turno"]["Nome"] == "Tarde")
+    verificacoes["horas_fechadas"] = sorted(horas) == ["13:00", "14:00"]
+    return {
+        "esperado": {p: {k: round(v, 4) for k, v in valores.items()} for p, valores in esperado.items()},
+        "medido": medido,
+        "verificacoes": verificacoes,
+        "ok": all(verificacoes.values()),
+    }
+
+
+def bench_rollups(main, gpio, bd, rapido=False):
+    """
+    Verificações determinísticas dos rollups: ordem das 13:55 às 15:05 a 6000 garrafas/hora
+    com o RelogioVirtual (mudança de turno às 14:00 e de hora às 15:00). O /api/info por
+    minuto, hora e turno (gravados na BD simulada mais os em memória) tem de somar a
+    contagem da linha menos as garrafas do primeiro ciclo de estatísticas (de
+    referência), com 100 garrafas em cada minuto completo (um ciclo pode cair no minuto
+    vizinho com o arredondamento do instante), e ler os períodos em memória
+    não pode alterar as linhas pendentes.
+    """
+    garrafas_por_hora = 6000
+    cliente = main.app.test_client()
+    respostas = {}
+    bd.rollups.clear()
+    with ordem_simulada(
+        main, datetime(2026, 1, 5, 13, 55),  # Segunda-feira
+        turnos=[{"nome": "Manhã", "inicio": "06:00"}, {"nome": "Tarde", "inicio": "14:00"}],
+        Ordem="OP-ROLLUP", IdBDOrdemProducao=81, ContagemTotal=10 ** 6,
+    ) as (contador, relogio):
+        simular_producao(main, relogio, 70 * 60, garrafas_por_hora)
+        contagem = contador.ContagemAtual
+
+        pendentes = list(contador.rollups.pendentes)
+        for resolucao in main.Rollups.RESOLUCOES:
+            contador.rollups.em_memoria(resolucao, "OP-ROLLUP")
+        pendentes_intactos = contador.rollups.pendentes == pendentes
+
+        for resolucao in main.Rollups.RESOLUCOES:
+            respostas[resolucao] = cliente.get(
+                "/api/info/1000/OP-ROLLUP",
+                query_string={"inicio": "2026-01-05 13:55:00", "fim": "2026-01-05 15:05:00", "resolucao": resolucao},
+            ).get_json()
+
+    # 70 minutos e o das 15:05, onde cai o último ciclo (garrafas das 15:04:55 às 15:05:00)
+    minutos = respostas["minuto"]["Contagens"]
+    primeiro_ciclo = garrafas_por_hora * main.INTERVALO_ESTATISTICAS / 3600
+    verificacoes = {
+        "pendentes_intactos": pendentes_intactos,
+        "minutos": (
+            len(minutos) == 71
+            and all(abs(c - 100) <= primeiro_ciclo + 1 for c in minutos[1:-1])
+            and abs(sum(minutos[1:-1]) - 100 * 69) <= primeiro_ciclo + 1
+        ),
+        "horas": [t[11:16] for t in respostas["hora"]["Tempo"]] == ["13:00", "14:00", "15:00"],
+        "turnos": [t[11:16] for t in respostas["turno"]["Tempo"]] == ["06:00", "14:00"],
+        "somas": all(0 <= contagem - r["ContagemAtual"] <= primeiro_ciclo + 1 for r in respostas.values()),
+    }
+    return {
+        "contagem": contagem,
+        "contagem_por_resolucao": {r: dados["ContagemAtual"] for r, dados in respostas.items()},
+        "pontos_por_resolucao": {r: len(dados["Tempo"]) for r, dados in respostas.items()},
+        "contagem_por_hora": respostas["hora"]["Contagens"],
+        "contagem_por_minuto": minutos,
+        "verificacoes": verificacoes,
+        "ok": all(verificacoes.values()),
+    }
+
+
+def bench_calendario(main, gpio, bd, rapido=False):
+    """
+    Verificações determinísticas do calendário de pausas: janela de dias úteis das
+    12:00 às 13:00 com retoma automática, janela de sexta das 22:00 às 06:00 (passa a
+    meia-noite) e um feriado. Confere em_pausa, proxima_transicao e fim_producao, e numa
+    linha simulada com o RelogioVirtual a pausa e a retoma pelo calendário e uma retoma
+    do operador dentro da janela que não volta a ser pausada.
+    """
+    dia = datetime(2026, 1, 5)  # Segunda-feira; terça 06/01 é feriado
+    calendario = main.Calendario({
+        "pausas": [
+            {"dias": [0, 1, 2, 3, 4], "inicio": "12:00", "fim": "13:00", "retomar": True},
+            {"dias": [4], "inicio": "22:00", "fim": "06:00"},
+        ],
+        "feriados": ["2026-01-06"],
+    })
+
+    def transicao(momento):
+        proxima = calendario.proxima_transicao(momento)
+        return (proxima[0], proxima[1]) if proxima else None
+
+    verificacoes = {
+        "pausa_dia_util": calendario.em_pausa(dia.replace(hour=12, minute=30)) is not None,
+        "feriado_sem_pausa": calendario.em_pausa(datetime(2026, 1, 6, 12, 30)) is None,
+        "sabado_sem_pausa": calendario.em_pausa(datetime(2026, 1, 10, 12, 30)) is None,
+        "pausa_passa_meia_noite": calendario.em_pausa(datetime(2026, 1, 10, 2, 0)) is not None,
+        "proxima_pausa": transicao(dia.replace(hour=11)) == (dia.replace(hour=12), "pausa"),
+        "proxima_retoma": transicao(dia.replace(hour=12, minute=30)) == (dia.replace(hour=13), "retoma"),
+        "proxima_salta_feriado": transicao(dia.replace(hour=13, minute=30)) == (datetime(2026, 1, 7, 12, 0), "pausa"),
+        "fim_producao_salta_pausa": calendario.fim_producao(dia.replace(hour=11, minute=30), 3600) == dia.replace(hour=13, minute=30),
+    }
+
+    with ordem_simulada(
+        main, dia.replace(hour=11, minute=50), calendario=calendario,
+        Ordem="OP-CALENDARIO", IdBDOrdemProducao=82, ContagemTotal=10 ** 6,
+    ) as (contador, relogio):
+        # Só o calendário retoma a linha (sem a retoma do operador da simulação)
+        simular_producao(main, relogio, 80 * 60, retomar_pausas=False)  # 11:50 -> 13:10
+        eventos = [(e["Data"][11:16], e["Evento"], e["Origem"]) for e in contador.eventos_ordem
+                   if e["Evento"] in ("pausar", "retomar") and e["Ordem"] == "OP-CALENDARIO"]
+        em_contagem_depois = contador.estado == main.ESTADO_EM_CONTAGEM
+
+        # Retoma do operador dentro da janela: o calendário não volta a pausar a linha
+        janela = main.aplicar_calendario(datetime(2026, 1, 7, 12, 0))
+        pausada = contador.estado == main.ESTADO_PAUSADA
+        contador.resume_count(origem="operador")
+        main.aplicar_calendario(datetime(2026, 1, 7, 12, 10), janela)
+        retoma_operador_mantida = pausada and contador.estado == main.ESTADO_EM_CONTAGEM
+
+    verificacoes["pausa_e_retoma_pelo_calendario"] = (
+        eventos == [("12:00", "pausar", "calendario"), ("13:00", "retomar", "calendario")] and em_contagem_depois
+    )
+    verificacoes["retoma_operador_mantida"] = retoma_operador_mantida
+    return {
+        "eventos": eventos,
+        "verificacoes": verificacoes,
+        "ok": all(verificacoes.values()),
+    }
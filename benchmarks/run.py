@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+"""
+Executa a suite de benchmarks do contador com GPIO e BD simulados.
+
+Uso (a partir da raiz do repositório):
+    python -m benchmarks.run                      # todos, resultados em bench_resultados.json
+    python -m benchmarks.run --rapido             # durações curtas, para verificação rápida
+    python -m benchmarks.run -b flop -b api       # apenas os benchmarks indicados
+    python -m benchmarks.run --saida v1.2.json    # ficheiro de saída
+
+Termina com código 1 se algum benchmark der erro ou tiver "ok" falso.
+O ficheiro JSON inclui a versão (commit git), a plataforma e os parâmetros,
+para que resultados de versões diferentes possam ser comparados.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import traceback
+from datetime import datetime
+
+from . import bench_api, bench_arranque, bench_contagem, bench_encerramento, bench_estado, bench_memoria, bench_turno
+from .simulacao import RAIZ_REPO, carregar_main
+
+BENCHMARKS = {
+    "flop": bench_contagem.bench_flop,
+    "increment_count": bench_contagem.bench_increment_count,
+    "multilinha": bench_contagem.bench_multilinha,
+    "supervisor": bench_contagem.bench_supervisor,
+    "contencao": bench_contagem.bench_contencao,
+    "aproximacao": bench_contagem.bench_aproximacao,
+    "aproximacao_processo": bench_contagem.bench_aproximacao_processo,
+    "captura": bench_contagem.bench_captura,
+    "repouso": bench_contagem.bench_repouso,
+    "persistencia": bench_estado.bench_persistencia,
+    "estatisticas": bench_estado.bench_estatisticas,
+    "recuperacao": bench_estado.bench_recuperacao,
+    "ordem": bench_estado.bench_ordem,
+    "arranque": bench_arranque.bench_arranque,
+    "encerramento": bench_encerramento.bench_encerramento,
+    "api": bench_api.bench_api,
+    "formatos": bench_api.bench_formatos,
+    "delta": bench_api.bench_delta,
+    "gravar_contagem": bench_api.bench_gravar_contagem,
+    "disjuntor": bench_api.bench_disjuntor,
+    "historico_local": bench_api.bench_historico_local,
+    "exportacao": bench_api.bench_exportacao,
+    "ordem_ativa": bench_api.bench_ordem_ativa,
+    "turno": bench_turno.bench_turno,
+    "turno_noite": bench_turno.bench_turno_noite,
+    "previsao": bench_turno.bench_previsao,
+    "oee": bench_turno.bench_oee,
+    "rollups": bench_turno.bench_rollups,
+    "calendario": bench_turno.bench_calendario,
+    "memoria": bench_memoria.bench_memoria,
+}
+
+
+def _versao():
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"], cwd=RAIZ_REPO, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return "desconhecida"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks do contador de garrafas")
+    parser.add_argument("-b", "--benchmark", action="append", choices=sorted(BENCHMARKS),
+                        help="benchmark a executar (pode repetir; por omissão todos)")
+    parser.add_argument("--rapido", action="store_true", help="durações curtas")
+    parser.add_argument("--saida", default="bench_resultados.json", help="ficheiro JSON de saída")
+    args = parser.parse_args(argv)
+
+    saida = os.path.abspath(args.saida)
+    nomes = args.benchmark or list(BENCHMARKS)
+
+    main_mod, gpio, bd = carregar_main()
+
+    relatorio = {
+        "versao": _versao(),
+        "data": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "python": sys.version.split()[0],
+        "plataforma": platform.platform(),
+        "maquina": platform.machine(),
+        "cpus": os.cpu_count(),
+        "rapido": args.rapido,
+        "resultados": {},
+    }
+
+    for nome in nomes:
+        print(f"[bench] {nome} ...", flush=True)
+        t0 = time.perf_counter()
+        try:
+            resultado = BENCHMARKS[nome](main_mod, gpio, bd, rapido=args.rapido)
+        except Exception as e:
+            resultado = {"erro": str(e), "traceback": traceback.format_exc()}
+        resultado["duracao_benchmark_s"] = round(time.perf_counter() - t0, 2)
+        relatorio["resultados"][nome] = resultado
+
+    with open(saida, "w") as f:
+        json.dump(relatorio, f, indent=2, ensure_ascii=False)
+    print(f"[bench] resultados gravados em {saida}")
+
+    # Código de saída 1 se algum benchmark falhou (erro) ou não passou as verificações (ok)
+    falhados = [nome for nome, resultado in relatorio["resultados"].items()
+                if "erro" in resultado or resultado.get("ok") is False]
+    if falhados:
+        print(f"[bench] falharam: {', '.join(falhados)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,477 @@
+# -*- coding: utf-8 -*-
+
+"""
+Ambiente simulado para executar o main.py fora do Raspberry Pi.
+
+Fornece um módulo RPi.GPIO falso (com pinos cujo estado pode ser gerado em
+função do tempo) e um pymssql de substituição que responde às consultas
+usadas pelo contador sem precisar de SQL Server.
+"""
+
+import importlib.util
+import itertools
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+RAIZ_REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class GPIOSimulado(types.ModuleType):
+    """Substituto do módulo RPi.GPIO com pinos controlados pelo benchmark"""
+
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    HIGH = 1
+    LOW = 0
+    PUD_UP = 22
+    PUD_DOWN = 21
+    PUD_OFF = 20
+
+    def __init__(self):
+        super().__init__("RPi.GPIO")
+        self._lock = threading.Lock()
+        self.geradores = {}  # pino -> função sem argumentos que devolve 0/1
+        self.valores = {}    # pino -> último valor escrito/definido
+        self.leituras = 0
+        self.escritas = 0
+
+    def setwarnings(self, flag):
+        pass
+
+    def setmode(self, modo):
+        pass
+
+    def setup(self, pino, direcao, pull_up_down=None, initial=None):
+        with self._lock:
+            self.valores.setdefault(pino, 0 if initial is None else initial)
+
+    def input(self, pino):
+        self.leituras += 1
+        gerador = self.geradores.get(pino)
+        if gerador is not None:
+            return gerador()
+        return self.valores.get(pino, 0)
+
+    def output(self, pino, valor):
+        self.escritas += 1
+        with self._lock:
+            self.valores[pino] = valor
+
+    def cleanup(self, pinos=None):
+        pass
+
+    def definir_gerador(self, pino, gerador):
+        """Associa ao pino uma função que devolve o estado atual (0/1)"""
+        self.geradores[pino] = gerador
+
+    def onda_quadrada(self, pino, frequencia_hz, duty=0.5):
+        """
+        Gera no pino uma onda quadrada a começar agora.
+
+        Returns:
+            Função que devolve o número de impulsos completos (descidas) desde o início
+        """
+        periodo = 1.0 / frequencia_hz
+        inicio = time.perf_counter()
+
+        def gerador():
+            fase = (time.perf_counter() - inicio) % periodo
+            return 1 if fase < periodo * duty else 0
+
+        def impulsos_completos(ate=None):
+            decorrido = (ate if ate is not None else time.perf_counter()) - inicio
+            return int((decorrido - periodo * duty) // periodo) + 1 if decorrido >= periodo * duty else 0
+
+        self.definir_gerador(pino, gerador)
+        return impulsos_completos
+
+
+class BDSimulada:
+    """
+    Estado partilhado das conexões pymssql simuladas.
+
+    Guarda as linhas inseridas e responde às consultas de leitura do main.py
+    com dados sintéticos. A latência simula a ida e volta à rede da fábrica.
+    """
+
+    def __init__(self, latencia=0.0):
+        self.latencia = latencia
+        self.indisponivel = False  # Servidor em baixo: ligações e consultas falham
+        self.atraso_falha = 0.0  # Tempo até uma ligação falhar (timeout de login)
+        self.erro_ligacao = None  # Exceção (não pymssql) levantada pelas ligações, ex.: OSError
+        self._lock = threading.Lock()
+        self.historico = {}  # Ordem -> lista de dicionários
+        self.oee_horario = []  # Rollups horários de OEE inseridos
+        self.rollups = []  # Rollups de minuto/hora/turno inseridos
+        self.contagens = {}  # IdContagem -> última ContagemAtual inserida
+        self.finalizacoes = []  # (Id, QuantidadeFinal, perf_counter) de cada UPDATE de fecho de ordem
+        self.inseridos = 0
+        self.conexoes = 0
+        self.consultas = 0
+
+    def preencher_historico(self, ordem, pontos, inicio=None, intervalo=5):
+        """Gera `pontos` linhas de histórico para a ordem"""
+        inicio = inicio or datetime.now().replace(microsecond=0) - timedelta(seconds=pontos * intervalo)
+        linhas = []
+        for i in range(pontos):
+            data = inicio + timedelta(seconds=i * intervalo)
+            linhas.append({
+                "DataDados": data,
+                "Ordem": ordem,
+                "Artigo": "ART001",
+                "DescricaoArtigo": "Artigo simulado",
+                "CadenciaArtigo": 6000,
+                "Inicio": inicio,
+                "Fim": None,
+                "ContagemAtual": i * 8,
+                "ContagemTotal": pontos * 10,
+                "MediaProducao": 5760.0,
+                "Paragens": None,
+                "Quebras": 0,
+                "EstadoPorta": 1,
+                "EstadoContador": 1,
+                "EstadoConfiguracao": 1,
+                "Nominal": 5760.0,
+                "Media": 5760.0,
+                "Cadencia": 6000.0,
+                "Tempo": data.strftime("%H:%M:%S"),
+            })
+        with self._lock:
+            self.historico[ordem] = linhas
+
+    def executar(self, sql, params, as_dict):
+        if self.indisponivel:
+            raise self.Error("Servidor simulado indisponível")
+        if self.latencia:
+            time.sleep(self.latencia)
+        with self._lock:
+            self.consultas += 1
+        texto = " ".join(sql.split())
+
+        if texto.startswith("INSERT"):
+            with self._lock:
+                self.inseridos += 1
+                if "krones_oee_horario" in texto:
+                    self.oee_horario.append(dict(zip(
+                        ("Linha", "Ordem", "IdContagem", "Hora", "Turno", "TempoPlaneado",
+                         "TempoFuncionamento", "Contagem", "Quebras", "ContagemTeorica"), params)))
+                elif "krones_contadoreslinhacontagem" in texto:
+                    self.contagens[params[0]] = params[1]
+                elif "krones_rollup_contagens" in texto:
+                    self.rollups.append(dict(zip(
+                        ("Linha", "Ordem", "IdContagem", "Resolucao", "Inicio", "Turno", "Contagem",
+                         "GFAMin", "GFAMax", "GFAMedia", "TempoParagem", "Quebras"), params)))
+            return []
+
+        if texto.startswith("UPDATE krones_contadoreslinha") and "QuantidadeFinal" in texto:
+            with self._lock:
+                self.finalizacoes.append((params[-1], params[0], time.perf_counter()))
+            return []
+
+        if "SELECT TOP 1 ContagemAtual" in texto and "krones_contadoreslinhacontagem" in texto:
+            contagem = self.contagens.get(params[0])
+            linhas = [{"ContagemAtual": contagem}] if contagem is not None else []
+            return linhas if as_dict else [tuple(l.values()) for l in linhas]
+
+        if "FROM krones_rollup_contagens" in texto:
+            n, ordem, resolucao, inicio, fim = params
+            linhas = [
+                {k: l[k] for k in ("Inicio", "Turno", "Contagem", "GFAMin", "GFAMax", "GFAMedia", "TempoParagem", "Quebras")}
+                for l in self.rollups
+                if l["Ordem"] == ordem and l["Resolucao"] == resolucao
+                and inicio <= datetime.strptime(l["Inicio"], "%Y-%m-%d %H:%M:%S") <= fim
+            ][:n]
+            return linhas if as_dict else [tuple(l.values()) for l in linhas]
+
+        if "FROM krones_oee_horario" in texto:
+            linhas = [l for l in self.oee_horario if l["Ordem"] == params[0]]
+            return [dict(l) for l in linhas] if as_dict else [tuple(l.values()) for l in linhas]
+
+        if "FROM krones_historico_contagens" in texto and "SELECT TOP" not in texto:
+            # Exportação: colunas escolhidas, sem TOP, lida pelo cursor em blocos
+            colunas = [c.strip() for c in texto[len("SELECT "):texto.index(" FROM")].split(",")]
+            linhas = self.historico.get(params[0], [])
+            desde = params[1] if len(params) > 1 and "DataDados > %s" in texto else None
+            ate = params[-1] if len(params) > 1 and "DataDados <= %s" in texto else None
+            return (
+                tuple(l[c] for c in colunas) for l in linhas
+                if (desde is None or l["DataDados"] > desde) and (ate is None or l["DataDados"] <= ate)
+            )
+
+        if "FROM krones_historico_contagens" in texto and "SELECT TOP (%s)" in texto:
+            n, ordem = params[0], params[1]
+            linhas = self.historico.get(ordem, [])
+            if "DataDados > %s" in texto:
+                linhas = [l for l in linhas if l["DataDados"] > params[2]]
+            if "DataDados <= %s" in texto:
+                linhas = [l for l in linhas if l["DataDados"] <= params[-1]]
+            linhas = linhas[:n]
+        elif "SELECT Abertura" in texto:
+            linhas = self.historico.get(params[0], [])[:1]
+            linhas = [{"Abertura": linhas[0]["Inicio"]}] if linhas else []
+        elif "SELECT TOP 1 Inicio" in texto:
+            linhas = self.historico.get(params[0], [])[:1]
+        elif "krones_contadoreslinha" in texto and "COUNT(Id)" in texto:
+            linhas = [{"Id": "-1"}]
+        elif "SELECT" in texto and "Id" in texto and "krones_contadoreslinha" in texto:
+            linhas = [{"Id": 1}]
+        elif "ArtigoGCP" in texto:
+            linhas = [{"ArtigoGCP": "ART001", "DescricaoGCP": "Artigo simulado", "CDU_Cadencia": 6000}]
+        else:
+            linhas = []
+
+        if as_dict:
+            return [dict(l) for l in linhas]
+        return [tuple(l.values()) for l in linhas]
+
+
+class _CursorSimulado:
+    def __init__(self, bd, as_dict):
+        self._bd = bd
+        self._as_dict = as_dict
+        self._resultado = []
+
+    def execute(self, sql, params=None):
+        self._resultado = self._bd.executar(sql, params, self._as_dict)
+
+    def executemany(self, sql, seq_params):
+        for params in seq_params:
+            self._resultado = self._bd.executar(sql, params, self._as_dict)
+
+    def fetchone(self):
+        return self._resultado.pop(0) if self._resultado else None
+
+    def fetchall(self):
+        resultado, self._resultado = self._resultado, []
+        return resultado
+
+    def fetchmany(self, size=1):
+        if not isinstance(self._resultado, list):
+            return list(itertools.islice(self._resultado, size))  # Resultado lido à medida
+        resultado, self._resultado = self._resultado[:size], self._resultado[size:]
+        return resultado
+
+    def close(self):
+        pass
+
+
+class _ConexaoSimulada:
+    def __init__(self, bd):
+        self._bd = bd
+
+    def cursor(self, as_dict=False):
+        return _CursorSimulado(self._bd, as_dict)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def criar_pymssql(bd):
+    """Cria um módulo pymssql falso ligado à BDSimulada indicada"""
+    modulo = types.ModuleType("pymssql")
+
+    class Error(Exception):
+        pass
+
+    def connect(*args, **kwargs):
+        if bd.erro_ligacao is not None:
+            raise bd.erro_ligacao
+        if bd.indisponivel:
+            time.sleep(bd.atraso_falha)
+            raise Error("Servidor simulado indisponível")
+        with bd._lock:
+            bd.conexoes += 1
+        return _ConexaoSimulada(bd)
+
+    modulo.Error = bd.Error = Error
+    modulo.connect = connect
+    return modulo
+
+
+def carregar_main(bd=None, diretorio=None, silencioso=True):
+    """
+    Importa o main.py com GPIO e BD simulados.
+
+    O diretório de trabalho muda para uma pasta temporária para que o app.log
+    e o contador_state.backup do benchmark não se misturem com os reais.
+
+    Returns:
+        Tuplo (modulo_main, gpio_simulado, bd_simulada)
+    """
+    bd = bd or BDSimulada()
+    gpio = GPIOSimulado()
+    rpi = types.ModuleType("RPi")
+    rpi.GPIO = gpio
+    sys.modules["RPi"] = rpi
+    sys.modules["RPi.GPIO"] = gpio
+    sys.modules["pymssql"] = criar_pymssql(bd)
+
+    os.chdir(diretorio or tempfile.mkdtemp(prefix="krones_bench_"))
+
+    sys.modules.pop("main", None)
+    spec = importlib.util.spec_from_file_location("main", os.path.join(RAIZ_REPO, "main.py"))
+    main = importlib.util.module_from_spec(spec)
+    sys.modules["main"] = main
+    spec.loader.exec_module(main)
+
+    if silencioso:
+        # Manter o log em ficheiro (faz parte do custo real) mas sem consola
+        raiz = logging.getLogger("")
+        for handler in list(raiz.handlers):
+            if type(handler) is logging.StreamHandler:
+                raiz.removeHandler(handler)
+
+    return main, gpio, bd
+
+
+class TempoSemEspera:
+    """Substitui o módulo time do main.py com sleep instantâneo"""
+
+    def __init__(self):
+        self._real = time
+
+    def sleep(self, segundos):
+        pass
+
+    def __getattr__(self, nome):
+        return getattr(self._real, nome)
+
+
+def percentis(amostras, pontos=(50, 90, 99)):
+    """Devolve dicionário {"p50": ..., ...} em milissegundos a partir de segundos"""
+    if not amostras:
+        return {f"p{p}": None for p in pontos}
+    ordenadas = sorted(amostras)
+    resultado = {}
+    for p in pontos:
+        idx = min(len(ordenadas) - 1, int(round(p / 100.0 * (len(ordenadas) - 1))))
+        resultado[f"p{p}"] = round(ordenadas[idx] * 1000, 4)
+    resultado["media"] = round(sum(ordenadas) / len(ordenadas) * 1000, 4)
+    resultado["max"] = round(ordenadas[-1] * 1000, 4)
+    return resultado
+
+
+def preparar_ordem_ativa(main, contador=None, pontos=0, ordem="OP-BENCH"):
+    """Coloca o contador em contagem com `pontos` amostras nas estatísticas"""
+    contador = contador or main.contador
+    main.reset_counter(contador)
+    agora = datetime.now().replace(microsecond=0)
+    with contador._state_lock, contador.estatisticas.lock:
+        contador.Ordem = ordem
+        contador.ContagemTotal = 10 ** 9
+        inicio = agora - timedelta(seconds=pontos * 5 + 5)
+        contador.TempoInicio = inicio
+        contador.estatisticas.completo_desde = main.ns_de_data(inicio)  # Ordem inteira em memória
+        for i in range(pontos):
+            tempo = agora - timedelta(seconds=(pontos - i) * 5)
+            contador.EstatisticaGFA.append(5760.0)
+            contador.EstatisticaGFAMedia.append(5760.0)
+            contador.EstatisticaNs.append(main.ns_de_data(tempo))
+            contador.EstatisticaCadenciaArtigo.append(6000.0)
+            contador.Paragens.append("null")
+        contador.estado = main.ESTADO_EM_CONTAGEM
+    return contador
+
+
+def simular_producao(main, relogio, duracao, garrafas_por_hora=6000, retomar_pausas=True):
+    """
+    Avança `duracao` segundos do RelogioVirtual com o trabalho das threads, numa só thread:
+    uma garrafa (ciclo Flop) a cada 3600/garrafas_por_hora segundos em cada linha em
+    contagem, um ciclo de estatísticas a cada 5 s (com as gravações na BD concluídas
+    antes do ciclo seguinte) e o calendário de pausas. Com `retomar_pausas`, as linhas
+    pausadas pelo calendário são retomadas (como pelo operador) no fim da janela.
+
+    Devolve {"garrafas": ..., "ciclos": ...}.
+    """
+    # Instantes em nanossegundos inteiros, como no RelogioVirtual: em segundos de vírgula
+    # flutuante (época) os ciclos e as garrafas caem umas centenas de ns antes do segundo
+    ns = main.NS_POR_SEGUNDO
+    inicio = relogio.tempo_ns()
+    fim = inicio + round(duracao * ns)
+    n_garrafa = 1
+    proxima_garrafa = inicio + 3600 * ns // garrafas_por_hora
+    proximo_ciclo = inicio + round(main.INTERVALO_ESTATISTICAS * ns)
+    janela = None
+    garrafas = ciclos = 0
+
+    def avancar_ate(instante):
+        relogio.avancar((instante - relogio.tempo_ns()) / ns)
+
+    while min(proxima_garrafa, proximo_ciclo) <= fim:
+        # Uma garrafa no instante do ciclo já entra nesse ciclo
+        if proxima_garrafa <= proximo_ciclo:
+            avancar_ate(proxima_garrafa)
+            for contador in main.linhas.todas():
+                if contador.estado == main.ESTADO_EM_CONTAGEM:
+                    contador.processar_leitura(1)
+                    contador.processar_leitura(0)
+                    garrafas += 1
+            # Instante calculado do índice, não acumulado: os arredondamentos não se somam
+            n_garrafa += 1
+            proxima_garrafa = inicio + n_garrafa * 3600 * ns // garrafas_por_hora
+            continue
+
+        avancar_ate(proximo_ciclo)
+        main.ciclo_estatisticas()
+        for contador in main.linhas.todas():
+            contador.escritor.fila.join()
+        anterior, janela = janela, main.aplicar_calendario(relogio.agora(), janela)
+        if retomar_pausas and anterior is not None and janela is None:
+            for contador in main.linhas.todas():
+                contador.resume_count(origem="operador")
+        ciclos += 1
+        proximo_ciclo += round(main.INTERVALO_ESTATISTICAS * ns)
+
+    avancar_ate(fim)
+    return {"garrafas": garrafas, "ciclos": ciclos}
+
+
+@contextmanager
+def ordem_simulada(main, inicio, calendario=None, turnos=None, **ordem):
+    """
+    Linha principal com o RelogioVirtual a partir de `inicio`, sem histórico local, e uma
+    ordem (os campos de atualizar_ordem em `ordem`) configurada e iniciada. Com
+    `calendario` substitui o calendário de pausas (também o da previsão) e com `turnos`
+    (lista de {"nome", "inicio"}) os turnos do OEE e dos rollups. À saída repõe o
+    relógio, o histórico, o calendário e os turnos, e a linha.
+
+    Devolve (contador, relogio).
+    """
+    ordem.setdefault("Quebras", 0)
+    contador = main.contador
+    originais = (main.relogio, main.historico_local, main.calendario,
+                 contador.previsao.calendario, contador.oee.turnos, contador.rollups.turnos)
+    relogio = main.RelogioVirtual(inicio)
+    try:
+        main.relogio = relogio
+        main.historico_local = None
+        if calendario is not None:
+            main.calendario = contador.previsao.calendario = calendario
+        if turnos is not None:
+            contador.oee.turnos = contador.rollups.turnos = main.ler_turnos(turnos)
+        main.reset_counter(contador)
+        contador.transicao("configurar")
+        with contador._contagem_lock, contador._state_lock:
+            contador.atualizar_ordem(**ordem)
+            contador.ContagemAtual = 0
+        contador.transicao("iniciar")
+        yield contador, relogio
+    finally:
+        (main.relogio, main.historico_local, main.calendario,
+         contador.previsao.calendario, contador.oee.turnos, contador.rollups.turnos) = originais
+        main.reset_counter(contador)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+"""
+Simulação de uma frota de contadores a enviar amostras para o agregador.
+
+Arranca o main.py em modo agregador num subprocesso (BD simulada, porta local)
+e simula N contadores, cada um com várias linhas, a enviar lotes pelo
+ClienteAgregador real. No fim verifica que o /status da frota bate certo com o
+que foi contado, que todas as amostras chegaram à BD e que um lote reenviado
+é reconhecido como duplicado.
+
+Uso (a partir da raiz do repositório):
+    python -m benchmarks.simular_frota --contadores 5 --linhas 2 --ciclos 60
+"""
+
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+from .simulacao import RAIZ_REPO, carregar_main
+
+CODIGO_SERVIDOR = """
+import os, sys, threading
+sys.path.insert(0, {raiz!r})
+from benchmarks.simulacao import carregar_main
+from werkzeug.serving import make_server
+main, gpio, bd = carregar_main()
+main.agregador.intervalo_gravacao = 0.5
+main.init_agregador()
+servidor = make_server("127.0.0.1", {porta}, main.app, threaded=True)
+print("pronto", flush=True)
+servidor.serve_forever()
+"""
+
+
+def _porta_livre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _obter(url):
+    with urllib.request.urlopen(url, timeout=10) as resposta:
+        return json.loads(resposta.read())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulação de frota com agregador")
+    parser.add_argument("--contadores", type=int, default=5)
+    parser.add_argument("--linhas", type=int, default=2)
+    parser.add_argument("--ciclos", type=int, default=60, help="ciclos de estatísticas simulados")
+    parser.add_argument("--envio-cada", type=int, default=3, help="ciclos entre envios")
+    args = parser.parse_args(argv)
+
+    porta = _porta_livre()
+    ambiente = dict(os.environ, KRONES_MODO="agregador")
+    servidor = subprocess.Popen(
+        [sys.executable, "-c", CODIGO_SERVIDOR.format(raiz=RAIZ_REPO, porta=porta)],
+        env=ambiente, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+    )
+    try:
+        servidor.stdout.readline()
+        url = f"http://127.0.0.1:{porta}"
+
+        main_mod, gpio, bd = carregar_main()
+        rnd = random.Random(42)
+
+        # Cada contador simulado tem o seu registo de linhas e o seu cliente
+        frota = []
+        for i in range(args.contadores):
+            registo = main_mod.RegistoLinhas()
+            for j in range(args.linhas):
+                c = main_mod.Contador(
+                    linha_id=str(j + 1), sensor_pin=100 + j, door_pin=200 + j,
+                    ficheiro_estado=f"estado_{i}_{j}.backup",
+                )
+                c.Ordem = f"OP-{i}-{j}"
+                c.IdBDOrdemProducao = 1000 + i * 10 + j
+                c.ContagemTotal = 10 ** 6
+                c.estado = main_mod.ESTADO_EM_CONTAGEM
+                registo.adicionar(c)
+            cliente = main_mod.ClienteAgregador(url, f"pi-{i:02d}", registo, intervalo=0)
+            frota.append((cliente, registo))
+
+        amostras = 0
+        t0 = time.perf_counter()
+        for ciclo in range(args.ciclos):
+            for cliente, registo in frota:
+                for c in registo.todas():
+                    delta = rnd.randint(5, 10)
+                    c.ContagemAtual += delta
+                    cliente.registar_amostra(c, c.ContagemAtual, delta, float(delta * 720))
+                    amostras += 1
+                if (ciclo + 1) % args.envio_cada == 0:
+                    cliente.enviar()
+        for cliente, _ in frota:
+            cliente.enviar()
+        duracao_envio = time.perf_counter() - t0
+
+        # Reenviar o último lote de um contador, como se a resposta se tivesse perdido
+        cliente, _ = frota[0]
+        cliente._pendente = {"lote": cliente._lote, "amostras": [], "eventos": []}
+        cliente.enviar()
+
+        # Esperar que o agregador grave tudo na BD simulada
+        estado = {}
+        for _ in range(50):
+            estado = _obter(url + "/status")["data"]
+            if estado["AmostrasGravadas"] >= amostras and not estado["AmostrasPendentesBD"]:
+                break
+            time.sleep(0.2)
+
+        contagem_real = sum(c.ContagemAtual for _, registo in frota for c in registo.todas())
+        resultado = {
+            "contadores": args.contadores,
+            "linhas_por_contador": args.linhas,
+            "amostras_enviadas": amostras,
+            "amostras_gravadas": estado.get("AmostrasGravadas"),
+            "contagem_real": contagem_real,
+            "contagem_frota": estado.get("ContagemTotalFrota"),
+            "linhas_na_frota": estado.get("TotalLinhas"),
+            "lotes_recebidos": estado.get("LotesRecebidos"),
+            "lotes_duplicados": estado.get("LotesDuplicados"),
+            "lotes_enviados": sum(c.enviados for c, _ in frota),
+            "duracao_envio_s": round(duracao_envio, 3),
+        }
+        resultado["ok"] = (
+            resultado["amostras_gravadas"] == amostras
+            and resultado["contagem_frota"] == contagem_real
+            and resultado["linhas_na_frota"] == args.contadores * args.linhas
+            and resultado["lotes_duplicados"] == 1
+        )
+        print(json.dumps(resultado, indent=2))
+        return 0 if resultado["ok"] else 1
+    finally:
+        servidor.terminate()
+        servidor.wait()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
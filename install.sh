@@ -25,6 +25,11 @@ cp -f CERT.crt $INSTALL_DIR/
 cp -f CERT.key $INSTALL_DIR/
 cp -f README.md $INSTALL_DIR/
 
+# Copia a configuração apenas se fornecida (senão mantém a existente)
+if [ -f "config.json" ]; then
+  cp -f config.json $INSTALL_DIR/
+fi
+
 # Ativa ambiente virtual e instala dependências
 echo "A instalar dependências no ambiente virtual..."
 source $INSTALL_DIR/venv/bin/activate
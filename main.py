@@ -14,24 +14,214 @@ Veja o README.md para mais informações sobre a configuração.
 import sys
 import os
 import time
+
+# Referência para o relatório de arranque (tempos medidos a partir daqui)
+ARRANQUE_T0 = time.perf_counter()
+
 import logging
+import logging.handlers
 import signal
 import threading
 import traceback
+import tracemalloc
 import atexit
-import numpy as np
+import importlib
 from datetime import datetime, timedelta
-from functools import wraps
+from functools import wraps, lru_cache
 import ssl
-import pymssql
 import math
-import RPi.GPIO as GPIO  # Usar apenas RPi.GPIO
-from flask import Flask, jsonify, request, make_response
-from queue import Queue
+import json
+import gzip
+import socket
+import uuid
+import urllib.request
+import struct
+import bisect
+import select
+import weakref
+import itertools
+import csv
+import io
+from array import array
+from collections import OrderedDict, deque, namedtuple
+from flask import Flask, Blueprint, jsonify, request, make_response, g, has_request_context, Response, stream_with_context
+from queue import Queue, Empty
+
+class ModuloPreguicoso:
+    """
+    Importa um módulo só no primeiro acesso a um atributo.
+    
+    No primeiro acesso substitui-se a si próprio na variável global `nome_global`,
+    para que as chamadas seguintes (ex.: GPIO.input no motor de captura) vão
+    diretamente ao módulo, sem passar por aqui.
+    """
+    def __init__(self, nome, nome_global, ao_carregar=None):
+        self._nome = nome
+        self._nome_global = nome_global
+        self._ao_carregar = ao_carregar
+        self._lock = threading.Lock()
+        self._modulo = None
+    
+    def __getattr__(self, atributo):
+        with self._lock:
+            if self._modulo is None:
+                inicio = time.perf_counter()
+                modulo = importlib.import_module(self._nome)
+                if self._ao_carregar is not None:
+                    self._ao_carregar(modulo)
+                globals()[self._nome_global] = modulo
+                self._modulo = modulo
+                importacoes_preguicosas[self._nome] = round((time.perf_counter() - inicio) * 1000, 3)
+                logging.info(f"Módulo {self._nome} importado em {(time.perf_counter() - inicio) * 1000:.1f} ms")
+        return getattr(self._modulo, atributo)
+
+# Tempo de importação (ms) de cada módulo carregado por ModuloPreguicoso
+importacoes_preguicosas = {}
+
+def _configurar_gpio(modulo):
+    """Configuração do GPIO feita ao importar o RPi.GPIO"""
+    modulo.setwarnings(False)  # Desativa avisos
+    modulo.setmode(modulo.BCM)   # Usar numeração BCM
+
+# Módulos pesados ou dependentes do hardware, importados só quando são precisos
+np = ModuloPreguicoso("numpy", "np")
+pymssql = ModuloPreguicoso("pymssql", "pymssql")
+sqlite3 = ModuloPreguicoso("sqlite3", "sqlite3")
+pa = ModuloPreguicoso("pyarrow", "pa")  # Opcional: só para a exportação em Parquet
+pq = ModuloPreguicoso("pyarrow.parquet", "pq")
+GPIO = ModuloPreguicoso("RPi.GPIO", "GPIO", ao_carregar=_configurar_gpio)  # Usar apenas RPi.GPIO
+
+# Dependências opcionais para formatos de resposta compactos
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Instantes internos em epoch nanossegundos (inteiros): comparar, ordenar e filtrar são
+# operações sobre inteiros, sem depender do dia nem da hora de verão. Só a API, a BD e o
+# ficheiro de estado veem texto, formatado por formatar_ns (com cache por segundo)
+NS_POR_SEGUNDO = 1_000_000_000
+FORMATO_DATA = "%Y-%m-%d %H:%M:%S"
+FORMATO_HORA = "%H:%M:%S"
+
+@lru_cache(maxsize=4096)
+def formatar_epoch(segundo, formato=FORMATO_DATA):
+    """Texto (hora local) de um epoch em segundos inteiros; os resultados ficam em cache"""
+    return time.strftime(formato, time.localtime(segundo))
+
+def formatar_ns(ns, formato=FORMATO_DATA):
+    """Texto de um instante em epoch ns; "" se o instante não está definido (0)"""
+    if not ns:
+        return ""
+    return formatar_epoch(ns // NS_POR_SEGUNDO, formato)
+
+def truncar_segundo(ns):
+    """Instante em epoch ns sem a fração de segundo"""
+    return ns - ns % NS_POR_SEGUNDO
+
+def ns_de_data(valor):
+    """
+    Converte uma data vinda de fora (epoch ns, datetime ou texto YYYY-MM-DD HH:MM:SS /
+    ISO 8601) em epoch ns; 0 se vazia ou inválida.
+    """
+    if not valor:
+        return 0
+    if isinstance(valor, int):
+        return valor
+    if not isinstance(valor, datetime):
+        try:
+            valor = datetime.fromisoformat(str(valor))
+        except ValueError:
+            logging.warning(f"Data inválida: {valor}")
+            return 0
+    return int(valor.replace(microsecond=0).timestamp()) * NS_POR_SEGUNDO + valor.microsecond * 1000
+
+def datetime_de_ns(ns):
+    """datetime local (sem fuso) de um instante em epoch ns, para a BD e o calendário"""
+    segundos, resto = divmod(ns, NS_POR_SEGUNDO)
+    return datetime.fromtimestamp(segundos).replace(microsecond=resto // 1000)
+
+class Relogio:
+    """
+    Fonte de tempo da lógica do contador: relógio de parede (epoch e datetime),
+    relógio monotónico e esperas.
+    
+    A captura de hardware, a rede (pool, disjuntor, agregador) e a supervisão das
+    threads continuam no relógio real; contagens, estatísticas, pausas do calendário,
+    ordens e datas gravadas na BD usam o `relogio` global, que pode ser substituído
+    por um RelogioVirtual.
+    """
+    def tempo(self):
+        """Epoch em segundos"""
+        return time.time()
+    
+    def tempo_ns(self):
+        """Epoch em nanossegundos (inteiro)"""
+        return time.time_ns()
+    
+    def agora(self):
+        return datetime.now()
+    
+    def monotonico(self):
+        """Segundos de um relógio que nunca recua (intervalos e limiares)"""
+        return time.monotonic()
+    
+    def dormir(self, segundos):
+        time.sleep(segundos)
+    
+    def esperar(self, evento, segundos):
+        """Espera pelo evento no máximo `segundos`; True se foi assinalado"""
+        return evento.wait(segundos)
+
+class RelogioVirtual(Relogio):
+    """
+    Relógio simulado para correr horas de produção em segundos: o tempo só avança
+    com avancar(), ou quando alguém dorme ou espera (a espera termina logo, com o
+    tempo avançado). Pensado para uma simulação conduzida por uma única thread,
+    que chama os passos de cada componente pela ordem certa.
+    """
+    def __init__(self, inicio=None):
+        self._lock = threading.Lock()
+        self._ns = ns_de_data(inicio or datetime.now())  # Inteiro: avanços de 5 s não acumulam erros
+    
+    def tempo(self):
+        return self._ns / NS_POR_SEGUNDO
+    
+    def tempo_ns(self):
+        return self._ns
+    
+    def agora(self):
+        return datetime_de_ns(self._ns)
+    
+    def monotonico(self):
+        return self._ns / NS_POR_SEGUNDO
+    
+    def avancar(self, segundos):
+        with self._lock:
+            self._ns += round(max(0.0, segundos) * NS_POR_SEGUNDO)
+            return self._ns / NS_POR_SEGUNDO
+    
+    def dormir(self, segundos):
+        self.avancar(segundos)
+    
+    def esperar(self, evento, segundos):
+        if not evento.is_set() and segundos is not None:
+            self.avancar(segundos)
+        return evento.is_set()
 
-# Configuração robusta do logging primeiro, antes de qualquer uso
+relogio = Relogio()
+
+# Configuração robusta do logging primeiro, antes de qualquer uso. O app.log roda ao
+# chegar a LOG_MAX_BYTES (ficam LOG_COPIAS ficheiros antigos), para não encher o cartão
+LOG_FICHEIRO = "app.log"
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_COPIAS = 5
 logging.basicConfig(
-    filename="app.log",
+    handlers=[logging.handlers.RotatingFileHandler(LOG_FICHEIRO, maxBytes=LOG_MAX_BYTES, backupCount=LOG_COPIAS)],
     level=logging.INFO,
     format="%(asctime)s;%(levelname)s;%(message)s",
     datefmt="%Y-%m-%d %H:%M:%S",
@@ -44,12 +234,141 @@ formatter = logging.Formatter("%(asctime)s;%(levelname)s;%(message)s")
 console.setFormatter(formatter)
 logging.getLogger("").addHandler(console)
 
-# Configuração do GPIO
-GPIO.setwarnings(False)  # Desativa avisos
-GPIO.setmode(GPIO.BCM)   # Usar numeração BCM
+# Relatório de arranque: milissegundos desde ARRANQUE_T0 em que cada fase terminou
+relatorio_arranque = {}
+
+def marcar_arranque(fase):
+    """Regista o fim de uma fase do arranque (só a primeira vez)"""
+    if fase not in relatorio_arranque:
+        relatorio_arranque[fase] = round((time.perf_counter() - ARRANQUE_T0) * 1000, 3)
+
+marcar_arranque("imports")
+
+# Configuração opcional em ficheiro JSON (por omissão: uma única linha nos pinos 22/23)
+CONFIG_FICHEIRO = os.environ.get("KRONES_CONFIG", "config.json")
+CONFIG_PADRAO = {
+    # Cada linha de enchimento tem o seu sensor e a sua porta
+    "linhas": [
+        {"id": "1", "sensor_pin": 22, "door_pin": 23},
+    ],
+    # Número máximo de conexões inativas guardadas por servidor de BD
+    "pool_bd_max_inativas": 4,
+    # Disjuntor da BD (por servidor/BD): falhas de ligação seguidas até abrir, segundos
+    # aberto antes de uma ligação de ensaio, e timeout de login (mais curto nos pedidos HTTP)
+    "bd_disjuntor_falhas": 3,
+    "bd_disjuntor_aberto_s": 30,
+    "bd_login_timeout": 10,
+    "bd_login_timeout_pedido": 3,
+    # Histórico local (SQLite) para o /api/info não depender do SQL Server: ficheiro,
+    # dias de retenção depois da última amostra de cada ordem e tamanho máximo
+    "historico_local": True,
+    "historico_local_ficheiro": "historico_local.db",
+    "historico_local_dias": 30,
+    "historico_local_max_mb": 200,
+    # /api/info da ordem ativa servido das séries em memória (a BD só para amostras mais antigas)
+    "api_info_memoria": True,
+    # Porta HTTP fixa (por omissão: 443 com SSL, 8080 sem SSL)
+    "porta_http": None,
+    # Modo do processo: "contador" (Raspberry Pi) ou "agregador" (servidor central)
+    "modo": "contador",
+    # Contador: URL do agregador para onde enviar as amostras (None = gravar diretamente na BD)
+    "agregador_url": None,
+    "agregador_intervalo": 15,        # Segundos entre envios
+    "agregador_max_amostras": 20000,  # Amostras guardadas enquanto o agregador não responde
+    "agregador_token": None,          # Partilhado entre contadores e agregador (opcional)
+    "agregador_verificar_ssl": True,  # False para aceitar o certificado auto-assinado do agregador
+    "origem": socket.gethostname(),   # Identificação deste contador no agregador
+    # Agregador: BD onde gravar as amostras recebidas e intervalo de gravação
+    "agregador_bd": {
+        "server": "your_db_server",
+        "user": "your_db_user",
+        "password": "your_db_password",
+        "database": "your_db_name",
+    },
+    "agregador_intervalo_gravacao": 5,
+    # Turnos (hora de início de cada um), usados nos indicadores OEE por turno
+    "turnos": [
+        {"nome": "Manhã", "inicio": "06:00"},
+        {"nome": "Tarde", "inicio": "14:00"},
+        {"nome": "Noite", "inicio": "22:00"},
+    ],
+    # Número de rollups (minuto/hora/turno) fechados acumulados antes de cada gravação na BD
+    "rollup_lote": 10,
+    # Calendário de pausas: janelas por dia da semana (0 = segunda ... 6 = domingo),
+    # com retoma automática opcional, e feriados (datas sem pausas programadas)
+    "calendario": {
+        "pausas": [
+            {"dias": [0, 1, 2, 3, 4, 5, 6], "inicio": "12:00", "fim": "13:00", "retomar": False},
+            {"dias": [0, 1, 2, 3, 4, 5, 6], "inicio": "17:00", "fim": "17:15", "retomar": False},
+        ],
+        "feriados": [],
+    },
+    # Número de ciclos de estatísticas (5 s) usados para estimar o ritmo na previsão de fecho
+    "previsao_janela": 120,
+    # Após recuperação, continuar a contar se a linha estava em contagem (False = pausar por segurança)
+    "recuperacao_retomar": True,
+    # Supervisor das threads: espera máxima entre reinícios (backoff exponencial), falhas
+    # seguidas de uma thread crítica até deixar de enviar pings ao watchdog do systemd,
+    # e segundos numa só operação de BD até o escritor ser considerado bloqueado
+    "supervisor_backoff_maximo": 60,
+    "supervisor_max_falhas": 5,
+    "escritor_limite_bloqueio": 120,
+    # Encerramento: segundos à espera que as escritas pendentes cheguem à BD (ou ao agregador)
+    "encerramento_prazo_bd": 10,
+    # Aproximação ao objetivo: a saída de aviso (aviso_pin da linha, para abrandar a enchedora)
+    # liga quando faltam até `aproximacao_garrafas` garrafas, ou menos de `aproximacao_segundos`
+    # ao ritmo atual; depois do fecho da porta no objetivo, as garrafas que ainda passam no
+    # sensor durante `sobrecontagem_janela` segundos contam como excesso da ordem
+    "aproximacao_garrafas": 50,
+    "aproximacao_segundos": 10,
+    "sobrecontagem_janela": 5,
+    # Captura num processo dedicado, fora do GIL do processo principal: intervalo entre
+    # leituras, núcleo onde fixar o processo (None = qualquer) e prioridade SCHED_FIFO
+    # (None = escalonamento normal; requer CAP_SYS_NICE)
+    "captura_processo": False,
+    "captura_intervalo_ms": 1,
+    "captura_cpu": None,
+    "captura_prioridade_fifo": None,
+    # Captura na thread: intervalo entre leituras adaptado ao ritmo da linha (período da
+    # garrafa a dividir por captura_amostras_por_garrafa, entre o mínimo e o máximo) e
+    # espera máxima em repouso, inferior ao limite de batimento da ContadorThread (5 s).
+    # O máximo tem de ser menor que o impulso mais curto do sensor: acima dos 10 ms do
+    # ciclo fixo anterior perdem-se garrafas de impulso curto em linhas lentas
+    "captura_amostras_por_garrafa": 10,
+    "captura_intervalo_min_ms": 2,
+    "captura_intervalo_max_ms": 10,
+    "captura_repouso_s": 2,
+    # Monitor de memória: segundos entre amostras (RSS, heap, threads, app.log), amostras
+    # guardadas (1440 = 24 h) e orçamentos que geram alertas (0 = sem limite; heap_mb só
+    # com o tracemalloc ativo). O tracemalloc pode ficar ligado desde o arranque (custa
+    # CPU e memória) ou ser ligado a pedido em /memoria/alocacoes, com `memoria_quadros`
+    # quadros da pilha por alocação
+    "memoria_intervalo": 60,
+    "memoria_amostras": 1440,
+    "memoria_orcamentos": {"rss_mb": 200, "heap_mb": 64, "threads": 32, "log_mb": 60},
+    "memoria_tracemalloc": False,
+    "memoria_quadros": 10,
+}
+
+def carregar_configuracao(caminho=CONFIG_FICHEIRO):
+    """Carrega a configuração do ficheiro JSON, completando com os valores por omissão"""
+    config = json.loads(json.dumps(CONFIG_PADRAO))
+    try:
+        if os.path.exists(caminho):
+            with open(caminho, "r") as f:
+                config.update(json.load(f))
+            logging.info(f"Configuração carregada de {caminho}")
+    except Exception as e:
+        logging.error(f"Erro ao ler configuração {caminho}, a usar valores por omissão: {e}")
+    return config
+
+CONFIG = carregar_configuracao()
 
-# Cria uma fila para operações de BD para evitar bloqueios
-db_queue = Queue()
+# Modo agregador: pela configuração, variável KRONES_MODO ou argumento --agregador
+MODO_AGREGADOR = (
+    "--agregador" in sys.argv
+    or os.environ.get("KRONES_MODO", CONFIG["modo"]) == "agregador"
+)
 
 # Decorador para capturar e registar exceções
 def log_exceptions(func):
@@ -60,25 +379,300 @@ def log_exceptions(func):
         except Exception as e:
             logging.error(f"Exceção em {func.__name__}: {str(e)}")
             logging.error(traceback.format_exc())
-            if isinstance(e, pymssql.Error):
+            if erro_bd(e):
                 logging.error(f"Erro de BD em {func.__name__}: {str(e)}")
             return None
     return wrapper
 
+def erro_bd(e):
+    """
+    Indica se a exceção é um erro do pymssql sem o importar: se o módulo ainda não foi
+    carregado nenhuma exceção pode vir dele (e, sem pymssql instalado, a importação
+    levantaria ImportError dentro do tratamento da exceção original)
+    """
+    modulo = sys.modules.get("pymssql")
+    return modulo is not None and isinstance(e, modulo.Error)
+
+class ConexaoPool:
+    """
+    Conexão emprestada pelo PoolBD.
+    
+    Comporta-se como a conexão pymssql, mas close() devolve-a ao pool em vez
+    de a fechar, evitando um novo login ao SQL Server em cada operação.
+    """
+    def __init__(self, pool, chave, conn):
+        self._pool = pool
+        self._chave = chave
+        self._conn = conn
+        self._devolvida = False
+    
+    def __getattr__(self, nome):
+        return getattr(self._conn, nome)
+    
+    def close(self):
+        if not self._devolvida:
+            self._devolvida = True
+            self._pool.devolver(self._chave, self._conn)
+
+class PoolBD:
+    """Pool de conexões partilhado por todas as linhas, uma fila por servidor/BD"""
+    def __init__(self, max_inativas=4, idade_maxima=300):
+        self.max_inativas = max_inativas
+        self.idade_maxima = idade_maxima  # Segundos até descartar uma conexão inativa
+        self._lock = threading.Lock()
+        self._inativas = {}  # chave -> lista de (conn, instante_devolucao)
+    
+    def obter(self, chave):
+        """Devolve uma conexão inativa ainda válida, ou None se não houver"""
+        agora = time.time()
+        with self._lock:
+            fila = self._inativas.get(chave, [])
+            while fila:
+                conn, instante = fila.pop()
+                if agora - instante < self.idade_maxima:
+                    return conn
+                self._fechar(conn)
+        return None
+    
+    def devolver(self, chave, conn):
+        """Devolve a conexão ao pool; conexões com erro pendente são descartadas"""
+        try:
+            conn.rollback()
+        except Exception:
+            self._fechar(conn)
+            return
+        with self._lock:
+            fila = self._inativas.setdefault(chave, [])
+            if len(fila) < self.max_inativas:
+                fila.append((conn, time.time()))
+                return
+        self._fechar(conn)
+    
+    def descartar(self, chave):
+        """Fecha todas as conexões inativas de um servidor/BD"""
+        with self._lock:
+            fila = self._inativas.pop(chave, [])
+        for conn, _ in fila:
+            self._fechar(conn)
+    
+    @staticmethod
+    def _fechar(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+pool_bd = PoolBD(max_inativas=CONFIG["pool_bd_max_inativas"])
+
+class BDIndisponivel(Exception):
+    """Disjuntor da BD aberto: a operação falha logo, sem tentar ligar ao servidor"""
+
+class DisjuntorBD:
+    """
+    Disjuntor das ligações a um servidor/BD, partilhado por todas as linhas e threads.
+    
+    Fechado: as ligações são tentadas normalmente. Depois de `falhas_abrir` falhas de
+    ligação seguidas abre e, durante `tempo_aberto` segundos, get_db_connection falha
+    logo com BDIndisponivel em vez de esperar pelo timeout de login. Passado esse
+    tempo fica meio aberto: uma única ligação de ensaio é tentada e, conforme o
+    resultado, o disjuntor fecha ou volta a abrir.
+    """
+    FECHADO, ABERTO, MEIO_ABERTO = "fechado", "aberto", "meio_aberto"
+    
+    def __init__(self, nome, falhas_abrir=3, tempo_aberto=30):
+        self.nome = nome
+        self.falhas_abrir = falhas_abrir
+        self.tempo_aberto = tempo_aberto
+        self._lock = threading.Lock()
+        self.posicao = self.FECHADO
+        self.falhas = 0  # Falhas de ligação seguidas
+        self.aberto_em = None
+        self._ensaio = False  # Ligação de ensaio em curso (meio aberto)
+        self.aberturas = 0
+        self.rejeitadas = 0
+        self.ultimo_erro = None
+    
+    def _atualizar(self):
+        """Aberto há mais de `tempo_aberto`: passa a meio aberto; chamado com _lock adquirido"""
+        if self.posicao == self.ABERTO and time.time() - self.aberto_em >= self.tempo_aberto:
+            self.posicao = self.MEIO_ABERTO
+            self._ensaio = False
+    
+    def disponivel(self):
+        """True se uma ligação seria tentada agora (fechado, ou ensaio ainda por fazer)"""
+        with self._lock:
+            self._atualizar()
+            return self.posicao == self.FECHADO or (self.posicao == self.MEIO_ABERTO and not self._ensaio)
+    
+    def permitir(self):
+        """
+        Autoriza uma tentativa de ligação.
+        
+        Returns:
+            True se é a ligação de ensaio do disjuntor meio aberto
+        
+        Raises:
+            BDIndisponivel: disjuntor aberto, ou ensaio já em curso
+        """
+        with self._lock:
+            self._atualizar()
+            if self.posicao == self.FECHADO:
+                return False
+            if self.posicao == self.MEIO_ABERTO and not self._ensaio:
+                self._ensaio = True
+                logging.info(f"Disjuntor BD {self.nome}: a tentar ligação de ensaio")
+                return True
+            self.rejeitadas += 1
+            restante = max(0, self.tempo_aberto - (time.time() - self.aberto_em))
+            raise BDIndisponivel(f"BD {self.nome} indisponível (disjuntor {self.posicao}, nova tentativa em {restante:.0f} s)")
+    
+    def sucesso(self):
+        with self._lock:
+            if self.posicao != self.FECHADO:
+                logging.info(f"Disjuntor BD {self.nome}: ligação restabelecida, disjuntor fechado")
+            self.posicao = self.FECHADO
+            self.falhas = 0
+            self._ensaio = False
+    
+    def falha(self, erro):
+        """
+        Regista uma falha de ligação.
+        
+        Returns:
+            True se o disjuntor abriu com esta falha
+        """
+        with self._lock:
+            self.falhas += 1
+            self.ultimo_erro = str(erro)
+            if self.posicao == self.MEIO_ABERTO or self.falhas >= self.falhas_abrir:
+                abriu = self.posicao != self.ABERTO
+                self.posicao = self.ABERTO
+                self.aberto_em = time.time()
+                self._ensaio = False
+                if abriu:
+                    self.aberturas += 1
+                    logging.warning(f"Disjuntor BD {self.nome} aberto após {self.falhas} falha(s): {erro}")
+                return abriu
+            return False
+    
+    def estado(self):
+        with self._lock:
+            self._atualizar()
+            return {
+                "Nome": self.nome,
+                "Posicao": self.posicao,
+                "FalhasSeguidas": self.falhas,
+                "AbertoHaS": round(time.time() - self.aberto_em, 1) if self.posicao != self.FECHADO else None,
+                "Aberturas": self.aberturas,
+                "Rejeitadas": self.rejeitadas,
+                "UltimoErro": self.ultimo_erro,
+            }
+
+disjuntores_bd = {}  # (servidor, BD) -> DisjuntorBD
+_disjuntores_lock = threading.Lock()
+
+def disjuntor_bd(db_server, db_name):
+    """Disjuntor do servidor/BD indicado (criado no primeiro uso)"""
+    chave = (db_server, db_name)
+    with _disjuntores_lock:
+        disjuntor = disjuntores_bd.get(chave)
+        if disjuntor is None:
+            disjuntor = disjuntores_bd[chave] = DisjuntorBD(
+                f"{db_server}/{db_name}", CONFIG["bd_disjuntor_falhas"], CONFIG["bd_disjuntor_aberto_s"],
+            )
+        return disjuntor
+
+class CacheLeiturasBD:
+    """
+    Últimos resultados de consultas de leitura usadas pela API.
+    
+    Com a BD em falha, a API responde com o último resultado conhecido, marcado como
+    desatualizado (cabeçalho X-BD-Desatualizada), em vez de um erro.
+    """
+    def __init__(self, maximo=64):
+        self.maximo = maximo
+        self._lock = threading.Lock()
+        self._valores = OrderedDict()
+    
+    def guardar(self, chave, valor):
+        with self._lock:
+            self._valores[chave] = valor
+            self._valores.move_to_end(chave)
+            while len(self._valores) > self.maximo:
+                self._valores.popitem(last=False)
+    
+    def obter(self, chave, erro):
+        """Último resultado guardado para a chave, depois de uma leitura falhada com `erro`"""
+        with self._lock:
+            valor = self._valores.get(chave)
+        if has_request_context():
+            g.erro_bd = str(erro)
+            if valor is not None:
+                g.bd_desatualizada = True
+        return valor
+
+cache_leituras_bd = CacheLeiturasBD()
+
+def resposta_bd_indisponivel(contador):
+    """Resposta 503 imediata se o disjuntor da BD da linha está aberto; None se disponível"""
+    disjuntor = disjuntor_bd(contador.DB_Server, contador.DB_DB)
+    if disjuntor.disponivel():
+        return None
+    return jsonify({
+        "message": "BD indisponível, tente novamente mais tarde",
+        "Disjuntor": disjuntor.estado(),
+    }), 503
+
 # Função segura para conexão à BD
 def get_db_connection(db_server, db_user, db_password, db_name, max_retries=3):
+    """
+    Conexão à BD (do pool, se houver), protegida pelo disjuntor do servidor.
+    
+    Num pedido HTTP, ou na ligação de ensaio do disjuntor, há uma única tentativa com
+    timeout de login curto, para não prender a thread do servidor.
+    
+    Raises:
+        BDIndisponivel: disjuntor aberto
+        pymssql.Error: falha na ligação
+        Exception: outro erro da ligação (ex.: OSError do socket), também registado
+            no disjuntor e sem novas tentativas
+    """
+    disjuntor = disjuntor_bd(db_server, db_name)
+    ensaio = disjuntor.permitir()
+    chave = (db_server, db_user, db_password, db_name)
+    if not ensaio:
+        conn = pool_bd.obter(chave)
+        if conn is not None:
+            return ConexaoPool(pool_bd, chave, conn)
+    
+    pedido = has_request_context()
+    if pedido or ensaio:
+        max_retries = 1
+    login_timeout = CONFIG["bd_login_timeout_pedido"] if pedido else CONFIG["bd_login_timeout"]
+    
     retries = 0
     while retries < max_retries:
         try:
-            conn = pymssql.connect(db_server, db_user, db_password, db_name, timeout=10)
-            return conn
+            conn = pymssql.connect(db_server, db_user, db_password, db_name, timeout=10, login_timeout=login_timeout)
+            disjuntor.sucesso()
+            return ConexaoPool(pool_bd, chave, conn)
         except pymssql.Error as e:
             retries += 1
             logging.error(f"Falha na conexão BD (tentativa {retries}): {str(e)}")
+            if disjuntor.falha(e):
+                pool_bd.descartar(chave)  # Conexões inativas de um servidor em falha
+                raise
             if retries >= max_retries:
                 logging.error("Excedido número máximo de tentativas de conexão à BD")
                 raise
             time.sleep(2)  # Espera antes de tentar novamente
+        except Exception as e:
+            # Qualquer outro erro também conta como falha: a ligação de ensaio do disjuntor
+            # meio aberto tem de terminar em sucesso() ou falha(), senão fica presa em curso
+            logging.error(f"Erro inesperado na conexão BD: {e}")
+            if disjuntor.falha(e):
+                pool_bd.descartar(chave)
+            raise
 
 app = Flask(__name__)
 
@@ -112,29 +706,693 @@ def handle_options(path):
     
     return response
 
-class Contador:
+class EscritorBD:
+    """
+    Fila de operações de BD executadas por uma thread dedicada.
+    
+    Evita criar uma thread nova por cada gravação e garante que as escritas
+    de uma linha são feitas pela ordem em que foram pedidas.
+    """
+    # Todos os escritores criados, para o supervisor verificar
+    instancias = weakref.WeakSet()
+    
+    def __init__(self, nome):
+        self.nome = nome
+        self.fila = Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.inicio_operacao = None  # time.monotonic() do início da operação em curso
+        self.reinicios = 0
+        EscritorBD.instancias.add(self)
+    
+    def submeter(self, func, *args):
+        """Coloca uma operação na fila, arrancando a thread se necessário"""
+        self.fila.put((func, args))
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._arrancar()
+    
+    def _arrancar(self):
+        """Cria a thread do escritor; chamado com _lock adquirido"""
+        self._thread = threading.Thread(target=self._executar, daemon=True, name=self.nome)
+        self._thread.start()
+    
+    def pendentes(self):
+        return self.fila.qsize()
+    
+    def bloqueado_ha(self):
+        """Segundos desde o início da operação em curso (0 se parado)"""
+        inicio = self.inicio_operacao
+        return time.monotonic() - inicio if inicio is not None else 0
+    
+    def verificar(self, limite_bloqueio):
+        """
+        Chamado pelo supervisor: repõe a thread se morreu com operações na fila, ou
+        se está presa há mais de `limite_bloqueio` segundos numa única operação.
+        
+        A thread presa não pode ser interrompida; quando a operação terminar ela
+        repara que foi substituída e sai. As operações seguintes continuam pela
+        ordem da fila na thread nova.
+        """
+        with self._lock:
+            viva = self._thread is not None and self._thread.is_alive()
+            if viva and self.bloqueado_ha() <= limite_bloqueio:
+                return False
+            if not viva and self.fila.empty():
+                return False
+            logging.error(f"Escritor {self.nome} {'bloqueado há ' + str(int(self.bloqueado_ha())) + ' s' if viva else 'terminou'} "
+                          f"com {self.pendentes()} operação(ões) pendente(s) - a reiniciar")
+            self.inicio_operacao = None
+            self.reinicios += 1
+            self._arrancar()
+            return True
+    
+    def _executar(self):
+        while self._thread is threading.current_thread():
+            try:
+                func, args = self.fila.get(timeout=60)
+            except Empty:
+                # Sem trabalho há um minuto: terminar e libertar a thread
+                with self._lock:
+                    if self.fila.empty() and self._thread is threading.current_thread():
+                        self._thread = None
+                        return
+                continue
+            self.inicio_operacao = time.monotonic()
+            try:
+                func(*args)
+            except Exception as e:
+                logging.error(f"Erro em operação de BD ({self.nome}): {e}")
+                logging.error(traceback.format_exc())
+            finally:
+                if self._thread is threading.current_thread():
+                    self.inicio_operacao = None
+                self.fila.task_done()
+
+def ler_turnos(turnos):
+    """Converte a configuração dos turnos numa lista ordenada de (minuto do dia de início, nome)"""
+    return sorted(
+        (int(t["inicio"][:2]) * 60 + int(t["inicio"][3:5]), t["nome"]) for t in turnos
+    ) or [(0, "Dia")]
+
+def turno_de(momento, turnos):
+    """Devolve (início, nome) do turno a que pertence o momento"""
+    minuto = momento.hour * 60 + momento.minute
+    dia = momento.replace(hour=0, minute=0, second=0, microsecond=0)
+    if minuto < turnos[0][0]:
+        # Antes do primeiro turno: último turno do dia anterior
+        inicio, nome = turnos[-1]
+        return (dia - timedelta(days=1) + timedelta(minutes=inicio), nome)
+    inicio, nome = turnos[0]
+    for inicio_turno, nome_turno in turnos:
+        if inicio_turno <= minuto:
+            inicio, nome = inicio_turno, nome_turno
+    return (dia + timedelta(minutes=inicio), nome)
+
+class AcumuladorOEE:
+    """Totais de um período (ordem, turno ou hora) a partir dos quais se calcula o OEE"""
+    __slots__ = ("tempo_planeado", "tempo_funcionamento", "contagem", "quebras", "contagem_teorica")
+    
+    def __init__(self, tempo_planeado=0.0, tempo_funcionamento=0.0, contagem=0, quebras=0, contagem_teorica=0.0):
+        self.tempo_planeado = tempo_planeado
+        self.tempo_funcionamento = tempo_funcionamento
+        self.contagem = contagem
+        self.quebras = quebras
+        self.contagem_teorica = contagem_teorica
+    
+    def adicionar(self, intervalo, contagem, cadencia, quebras):
+        """Acumula um ciclo de estatísticas; sem garrafas no ciclo conta como paragem"""
+        self.tempo_planeado += intervalo
+        if contagem > 0:
+            self.tempo_funcionamento += intervalo
+            self.contagem_teorica += cadencia * intervalo / 3600
+        self.contagem += contagem
+        self.quebras += quebras
+    
+    def indicadores(self):
+        """Disponibilidade, desempenho, qualidade e OEE (frações entre 0 e 1)"""
+        disponibilidade = self.tempo_funcionamento / self.tempo_planeado if self.tempo_planeado > 0 else 0.0
+        desempenho = self.contagem / self.contagem_teorica if self.contagem_teorica > 0 else 0.0
+        qualidade = max(0, self.contagem - self.quebras) / self.contagem if self.contagem > 0 else 0.0
+        return {
+            "Disponibilidade": round(disponibilidade, 4),
+            "Desempenho": round(desempenho, 4),
+            "Qualidade": round(qualidade, 4),
+            "OEE": round(disponibilidade * desempenho * qualidade, 4),
+            "TempoPlaneado": round(self.tempo_planeado),
+            "TempoFuncionamento": round(self.tempo_funcionamento),
+            "Contagem": self.contagem,
+            "Quebras": self.quebras,
+        }
+
+class MotorOEE:
+    """
+    Cálculo incremental do OEE de uma linha por ordem, turno e hora.
+    
+    Cada ciclo de estatísticas atualiza três acumuladores de tamanho fixo; quando
+    a hora muda, o acumulador horário fechado fica pendente para ser gravado na BD
+    num único lote. As pausas do calendário não contam como tempo planeado; as pausas
+    fora do calendário contam como paragem.
+    """
+    def __init__(self, turnos):
+        self.turnos = ler_turnos(turnos)
+        self._lock = threading.Lock()
+        self.ordem = AcumuladorOEE()
+        self.turno = AcumuladorOEE()
+        self.hora = AcumuladorOEE()
+        self._chave_turno = None   # (início do turno, nome)
+        self._chave_hora = None    # (Ordem, IdBDOrdemProducao, hora)
+        self._quebras_anteriores = 0
+        self.pendentes = []        # Rollups horários fechados, por gravar
+        self.horas_ordem = []      # Rollups horários fechados da ordem atual (também os já gravados)
+        self.horas_completas = False  # True se a ordem atual começou depois do arranque do processo
+    
+    def registar(self, momento, intervalo, contagem, cadencia, quebras_total, ordem, id_ordem):
+        """Acumula um ciclo de estatísticas em contagem"""
+        with self._lock:
+            quebras = max(0, quebras_total - self._quebras_anteriores)
+            self._quebras_anteriores = quebras_total
+            
+            chave_hora = (ordem, id_ordem, momento.replace(minute=0, second=0, microsecond=0))
+            if chave_hora != self._chave_hora:
+                self._fechar_hora()
+                self._chave_hora = chave_hora
+            
+            chave_turno = turno_de(momento, self.turnos)
+            if chave_turno != self._chave_turno:
+                self.turno = AcumuladorOEE()
+                self._chave_turno = chave_turno
+            
+            for acumulador in (self.ordem, self.turno, self.hora):
+                acumulador.adicionar(intervalo, contagem, cadencia, quebras)
+    
+    def _fechar_hora(self):
+        """Passa o acumulador horário para os pendentes; chamado com _lock adquirido"""
+        if self._chave_hora is not None and self.hora.tempo_planeado > 0:
+            ordem, id_ordem, hora = self._chave_hora
+            indicadores = self.hora.indicadores()
+            rollup = (
+                ordem, id_ordem, hora.strftime("%Y-%m-%d %H:%M:%S"), turno_de(hora, self.turnos)[1],
+                float(self.hora.tempo_planeado), float(self.hora.tempo_funcionamento),
+                int(self.hora.contagem), int(self.hora.quebras), float(self.hora.contagem_teorica),
+                indicadores["Disponibilidade"], indicadores["Desempenho"],
+                indicadores["Qualidade"], indicadores["OEE"],
+            )
+            self.pendentes.append(rollup)
+            self.horas_ordem.append(rollup)
+        self.hora = AcumuladorOEE()
+        self._chave_hora = None
+    
+    def nova_ordem(self):
+        """Fecha a hora em curso e começa os totais de uma nova ordem"""
+        with self._lock:
+            self._fechar_hora()
+            self.ordem = AcumuladorOEE()
+            self._quebras_anteriores = 0
+            self.horas_ordem = []
+            self.horas_completas = True
+    
+    def fechar(self):
+        """Fecha a hora em curso (fim da ordem), deixando-a pendente para gravação"""
+        with self._lock:
+            self._fechar_hora()
+    
+    def retirar_pendentes(self):
+        with self._lock:
+            pendentes, self.pendentes = self.pendentes, []
+            return pendentes
+    
+    def devolver_pendentes(self, pendentes):
+        """Repõe rollups que não foi possível gravar, para nova tentativa"""
+        with self._lock:
+            self.pendentes[:0] = pendentes
+    
+    def resumo(self):
+        with self._lock:
+            turno = self.turno.indicadores()
+            turno["Nome"] = self._chave_turno[1] if self._chave_turno else None
+            hora = self.hora.indicadores()
+            hora["Hora"] = self._chave_hora[2].strftime("%Y-%m-%d %H:%M:%S") if self._chave_hora else None
+            return {"Ordem": self.ordem.indicadores(), "Turno": turno, "Hora": hora}
+
+class AcumuladorRollup:
+    """Agregado de um período: garrafas, GFA mínimo/máximo/médio, segundos parado e quebras"""
+    __slots__ = ("contagem", "gfa_min", "gfa_max", "gfa_soma", "amostras", "tempo_paragem", "quebras")
+    
+    def __init__(self):
+        self.contagem = 0
+        self.gfa_min = None
+        self.gfa_max = None
+        self.gfa_soma = 0.0
+        self.amostras = 0
+        self.tempo_paragem = 0.0
+        self.quebras = 0
+    
+    def adicionar(self, intervalo, contagem, gfa, quebras):
+        self.contagem += contagem
+        self.gfa_min = gfa if self.gfa_min is None else min(self.gfa_min, gfa)
+        self.gfa_max = gfa if self.gfa_max is None else max(self.gfa_max, gfa)
+        self.gfa_soma += gfa
+        self.amostras += 1
+        if contagem == 0:
+            self.tempo_paragem += intervalo
+        self.quebras += quebras
+
+class Rollups:
+    """
+    Rollups de contagem por minuto, hora e turno mantidos em memória.
+    
+    Cada período fechado passa a uma linha pendente; as linhas são gravadas em
+    krones_rollup_contagens em lotes de `lote`, para relatórios longos não terem
+    de percorrer o histórico de 5 em 5 segundos.
+    """
+    RESOLUCOES = ("minuto", "hora", "turno")
+    
+    def __init__(self, turnos, lote=10):
+        self.turnos = ler_turnos(turnos)
+        self.lote = lote
+        self._lock = threading.Lock()
+        self._abertos = {}  # resolução -> (chave, acumulador)
+        self._quebras_anteriores = 0
+        self.pendentes = []
+    
+    def inicio_periodo(self, resolucao, momento):
+        """Início do período (minuto, hora ou turno) que contém o momento"""
+        if resolucao == "minuto":
+            return momento.replace(second=0, microsecond=0)
+        if resolucao == "hora":
+            return momento.replace(minute=0, second=0, microsecond=0)
+        return turno_de(momento, self.turnos)[0]
+    
+    def registar(self, momento, intervalo, contagem, gfa, quebras_total, ordem, id_ordem):
+        """Acumula um ciclo de estatísticas em todas as resoluções"""
+        with self._lock:
+            quebras = max(0, quebras_total - self._quebras_anteriores)
+            self._quebras_anteriores = quebras_total
+            for resolucao in self.RESOLUCOES:
+                chave = (ordem, id_ordem, self.inicio_periodo(resolucao, momento))
+                aberto = self._abertos.get(resolucao)
+                if aberto is None or aberto[0] != chave:
+                    if aberto is not None:
+                        self._fechar(resolucao, *aberto)
+                    aberto = (chave, AcumuladorRollup())
+                    self._abertos[resolucao] = aberto
+                aberto[1].adicionar(intervalo, contagem, gfa, quebras)
+    
+    def _linha(self, resolucao, chave, acumulador):
+        """Linha da tabela krones_rollup_contagens de um período (sem alterar o estado)"""
+        ordem, id_ordem, inicio = chave
+        return (
+            ordem, id_ordem, resolucao[0].upper(), inicio.strftime("%Y-%m-%d %H:%M:%S"),
+            turno_de(inicio, self.turnos)[1], int(acumulador.contagem),
+            float(acumulador.gfa_min or 0), float(acumulador.gfa_max or 0),
+            float(round(acumulador.gfa_soma / acumulador.amostras, 0)) if acumulador.amostras else 0.0,
+            float(acumulador.tempo_paragem), int(acumulador.quebras),
+        )
+    
+    def _fechar(self, resolucao, chave, acumulador):
+        """Passa um período para os pendentes; chamado com _lock adquirido"""
+        self.pendentes.append(self._linha(resolucao, chave, acumulador))
+    
+    def fechar(self):
+        """Fecha todos os períodos em curso (fim ou mudança de ordem)"""
+        with self._lock:
+            for resolucao, aberto in self._abertos.items():
+                self._fechar(resolucao, *aberto)
+            self._abertos = {}
+            self._quebras_anteriores = 0
+    
+    def lote_pronto(self):
+        return len(self.pendentes) >= self.lote
+    
+    def em_memoria(self, resolucao, ordem):
+        """Períodos da ordem ainda não gravados (pendentes e em curso), como linhas da tabela"""
+        letra = resolucao[0].upper()
+        with self._lock:
+            linhas = [l for l in self.pendentes if l[2] == letra and l[0] == ordem]
+            aberto = self._abertos.get(resolucao)
+            if aberto is not None and aberto[0][0] == ordem:
+                linhas.append(self._linha(resolucao, *aberto))
+        campos = ("Inicio", "Turno", "Contagem", "GFAMin", "GFAMax", "GFAMedia", "TempoParagem", "Quebras")
+        return [dict(zip(campos, l[3:])) for l in linhas]
+    
+    def retirar_pendentes(self):
+        with self._lock:
+            pendentes, self.pendentes = self.pendentes, []
+            return pendentes
+    
+    def devolver_pendentes(self, pendentes):
+        """Repõe linhas que não foi possível gravar, para nova tentativa"""
+        with self._lock:
+            self.pendentes[:0] = pendentes
+
+class Calendario:
+    """
+    Calendário de pausas programadas da fábrica.
+    
+    Cada janela tem dias da semana, hora de início e de fim (pode passar a meia-noite)
+    e se a contagem é retomada automaticamente no fim. Nos feriados não há pausas
+    programadas. Usado pela thread de pausas, pela previsão de fecho e pelo OEE.
+    """
+    def __init__(self, config):
+        self.janelas = []
+        for janela in config.get("pausas", []):
+            inicio = int(janela["inicio"][:2]) * 60 + int(janela["inicio"][3:5])
+            fim = int(janela["fim"][:2]) * 60 + int(janela["fim"][3:5])
+            if fim <= inicio:
+                fim += 24 * 60  # Janela que passa a meia-noite
+            dias = frozenset(int(d) for d in janela.get("dias", range(7)))
+            self.janelas.append((dias, inicio, fim, bool(janela.get("retomar", False))))
+        self.feriados = frozenset(
+            datetime.strptime(d, "%Y-%m-%d").date() for d in config.get("feriados", [])
+        )
+    
+    def janelas_do_dia(self, dia):
+        """Lista ordenada de (início, fim, retomar) das pausas que começam no dia indicado"""
+        dia = dia.replace(hour=0, minute=0, second=0, microsecond=0)
+        if dia.date() in self.feriados:
+            return []
+        return sorted(
+            (dia + timedelta(minutes=inicio), dia + timedelta(minutes=fim), retomar)
+            for dias, inicio, fim, retomar in self.janelas if dia.weekday() in dias
+        )
+    
+    def em_pausa(self, momento):
+        """Janela (início, fim, retomar) em curso no momento, ou None"""
+        for dia in (momento - timedelta(days=1), momento):
+            for janela in self.janelas_do_dia(dia):
+                if janela[0] <= momento < janela[1]:
+                    return janela
+        return None
+    
+    def janelas_a_partir(self, momento, dias=400):
+        """Gera as janelas que terminam depois do momento, por ordem cronológica"""
+        dia = momento - timedelta(days=1)
+        for _ in range(dias + 1):
+            for janela in self.janelas_do_dia(dia):
+                if janela[1] > momento:
+                    yield janela
+            dia += timedelta(days=1)
+    
+    def proxima_transicao(self, momento):
+        """
+        Próxima mudança de estado depois do momento.
+        
+        Returns:
+            (momento da transição, "pausa" ou "retoma", janela), ou None sem pausas programadas
+        """
+        for janela in self.janelas_a_partir(momento):
+            if janela[0] > momento:
+                return (janela[0], "pausa", janela)
+            return (janela[1], "retoma", janela)
+        return None
+    
+    def fim_producao(self, momento, segundos_producao):
+        """Momento em que se completam `segundos_producao` de produção, saltando as pausas"""
+        restante = segundos_producao
+        for inicio, fim, _ in self.janelas_a_partir(momento, dias=30):
+            if inicio > momento:
+                disponivel = (inicio - momento).total_seconds()
+                if restante <= disponivel:
+                    break
+                restante -= disponivel
+            momento = max(momento, fim)  # Pausa em curso ou atingida antes de terminar
+        return momento + timedelta(seconds=restante)
+
+calendario = Calendario(CONFIG["calendario"])
+
+class PrevisaoFecho:
+    """
+    Previsão da hora de fecho da ordem, recalculada uma vez por ciclo de estatísticas.
+    
+    O ritmo é a média do GFA nos últimos `janela` ciclos, com as paragens (GFA 0)
+    incluídas; os limites correspondem a um intervalo de 90% do ritmo médio ao longo
+    do tempo que falta, considerando os ritmos de cada minuto (média dos seus 12
+    ciclos) como independentes. As pausas do calendário que caem dentro do tempo
+    previsto são somadas à estimativa.
+    """
+    CICLOS_POR_BLOCO = 12  # Ciclos de 5 s num minuto
+    Z_90 = 1.645
+    
+    def __init__(self, calendario, janela=120):
+        self.calendario = calendario
+        self.janela = janela
+        self.atual = self.vazia()
+    
+    @staticmethod
+    def vazia():
+        return {"EstimativaFecho": "", "EstimativaFechoMin": "", "EstimativaFechoMax": "", "RitmoPrevisto": 0.0}
+    
+    def atualizar(self, agora, restantes, gfa):
+        """Recalcula a previsão; `gfa` é a série de GFA da ordem (garrafas/hora)"""
+        recentes = np.asarray(gfa[-self.janela:], dtype=float)
+        if restantes <= 0 or len(recentes) == 0 or recentes.mean() <= 0:
+            self.atual = self.vazia()
+            return self.atual
+        
+        ritmo = float(recentes.mean())
+        segundos = restantes * 3600 / ritmo
+        
+        # Incerteza do ritmo médio ao longo do tempo que falta: desvio padrão dos ritmos
+        # de um minuto (os minutos completos mais recentes), a dividir pela raiz do número
+        # de minutos que faltam; com menos de dois minutos, o dos ciclos de 5 s, sem redução
+        minutos = len(recentes) // self.CICLOS_POR_BLOCO
+        if minutos >= 2:
+            ritmos_minuto = recentes[len(recentes) - minutos * self.CICLOS_POR_BLOCO:]
+            desvio = float(ritmos_minuto.reshape(minutos, self.CICLOS_POR_BLOCO).mean(axis=1).std())
+            erro = self.Z_90 * desvio / math.sqrt(max(1.0, segundos / 60))
+        else:
+            erro = self.Z_90 * float(recentes.std())
+        ritmo_max = ritmo + erro
+        ritmo_min = ritmo - erro
+        
+        formato = "%Y-%m-%d %H:%M:%S"
+        self.atual = {
+            "EstimativaFecho": self.calendario.fim_producao(agora, segundos).strftime(formato),
+            "EstimativaFechoMin": self.calendario.fim_producao(agora, restantes * 3600 / ritmo_max).strftime(formato),
+            "EstimativaFechoMax": (
+                self.calendario.fim_producao(agora, restantes * 3600 / ritmo_min).strftime(formato) if ritmo_min > 0 else ""
+            ),
+            "RitmoPrevisto": round(ritmo, 0),
+        }
+        return self.atual
+
+# Rotas do contador; registadas na raiz (linha por omissão) e em /linha/<linha_id>
+bp = Blueprint("contador", __name__)
+
+# Ciclo de vida da ordem de produção
+ESTADO_LIVRE = "livre"              # Sem ordem (ou ordem anterior já finalizada na BD)
+ESTADO_CONFIGURADA = "configurada"  # Ordem registada, contagem ainda não iniciada
+ESTADO_EM_CONTAGEM = "em_contagem"
+ESTADO_PAUSADA = "pausada"
+ESTADO_A_FINALIZAR = "a_finalizar"  # Contagem terminada, fecho na BD pendente
+
+# (estado, evento) -> próximo estado; "repor" (reset do contador) leva qualquer estado a livre
+TRANSICOES_ORDEM = {
+    (ESTADO_LIVRE, "configurar"): ESTADO_CONFIGURADA,
+    (ESTADO_CONFIGURADA, "cancelar"): ESTADO_LIVRE,
+    (ESTADO_CONFIGURADA, "iniciar"): ESTADO_EM_CONTAGEM,
+    (ESTADO_EM_CONTAGEM, "pausar"): ESTADO_PAUSADA,
+    (ESTADO_PAUSADA, "retomar"): ESTADO_EM_CONTAGEM,
+    (ESTADO_CONFIGURADA, "terminar"): ESTADO_A_FINALIZAR,
+    (ESTADO_EM_CONTAGEM, "terminar"): ESTADO_A_FINALIZAR,
+    (ESTADO_PAUSADA, "terminar"): ESTADO_A_FINALIZAR,
+    (ESTADO_A_FINALIZAR, "finalizada"): ESTADO_LIVRE,
+}
+DESTINO_EVENTO = {evento: destino for (_, evento), destino in TRANSICOES_ORDEM.items()}
+
+# Valores dos campos antigos (EstadoContador, EstadoPausa, ContadorConfigurado, GravarDados)
+# em cada estado, mantidos na API, no checkpoint e no envio ao agregador
+ESTADOS_LEGADOS = {
+    ESTADO_LIVRE: (0, False, 0, 0),
+    ESTADO_CONFIGURADA: (0, False, 1, 0),
+    ESTADO_EM_CONTAGEM: (1, False, 1, 0),
+    ESTADO_PAUSADA: (2, True, 1, 0),
+    ESTADO_A_FINALIZAR: (0, False, 1, 1),
+}
+
+class EstadoCaptura:
+    """
+    Estado quente da linha, alterado a cada leitura do sensor.
+    
+    Pertence ao motor de captura: o Flop e a leitura anterior só são alterados pela
+    thread de captura (e na reposição da linha, fora de contagem); a contagem muda
+    com _contagem_lock adquirido. As restantes threads leem os campos sem lock.
+    """
+    __slots__ = (
+        "contagem", "flop", "ultima_contagem_ms", "estado_anterior", "contou",
+        "ultima_garrafa", "intervalo_medio", "aviso_ativo", "fecho", "fecho_em", "excesso",
+        "terminar_pendente",
+    )
+    
+    def __init__(self):
+        self.contagem = 0
+        self.flop = False
+        self.ultima_contagem_ms = 0  # Mecanismo de proteção contra falsos positivos
+        self.estado_anterior = None
+        self.contou = False  # Primeira garrafa deste processo (relatório de arranque)
+        
+        # Aproximação ao objetivo: ritmo atual (média móvel do intervalo entre garrafas),
+        # saída de aviso e observação do excesso depois do fecho da porta no objetivo
+        self.ultima_garrafa = 0.0
+        self.intervalo_medio = 0.0
+        self.aviso_ativo = False
+        self.fecho = None  # Dados do fecho no objetivo, enquanto o excesso é observado
+        self.fecho_em = None
+        self.excesso = 0
+        # Snapshot da ordem fechada no objetivo enquanto a transição "terminar" corre fora
+        # da captura: as garrafas seguintes já são excesso
+        self.terminar_pendente = None
+
+class MetadadosOrdem(namedtuple("MetadadosOrdem", (
+    "Ordem", "IdBDOrdemProducao", "ContagemTotal", "Quebras",
+    "ArtigoEmContagem", "DescricaoArtigoEmContagem", "CadenciaArtigoEmContagem",
+    "InicioNs", "FimNs",
+))):
+    """
+    Metadados da ordem em contagem. Imutáveis: cada alteração cria um snapshot novo que
+    substitui o anterior numa única atribuição, por isso quem os lê (captura, API,
+    escritores de BD) vê sempre um conjunto coerente sem adquirir locks.
+    
+    Início e fim em epoch ns (0 se não definidos); TempoInicio/TempoFim são o texto
+    YYYY-MM-DD HH:MM:SS usado na API, na BD e no ficheiro de estado.
+    """
+    __slots__ = ()
+    
+    @property
+    def TempoInicio(self):
+        return formatar_ns(self.InicioNs)
+    
+    @property
+    def TempoFim(self):
+        return formatar_ns(self.FimNs)
+
+METADADOS_VAZIOS = MetadadosOrdem("NA", 0, 0, 0, "NA", "NA", 6000, 0, 0)
+
+class EstatisticasLinha:
+    """
+    Séries de estatísticas da linha e cursor de sequência dos pedidos incrementais.
+    
+    Têm lock próprio, usado pelo ciclo de estatísticas e pela API (/status,
+    media_producao), para que uma resposta longa não atrase a captura nem as
+    transições da ordem.
+    """
     def __init__(self):
+        self.lock = threading.RLock()
+        self.EstatisticaGFA = []
+        self.EstatisticaGFAMedia = []
+        self.EstatisticaGFANominal = 0
+        self.EstatisticaNs = []  # Instante (epoch ns) de cada amostra; a hora só é formatada na API
+        self.EstatisticaCadenciaArtigo = []
+        self.RegistoParagem = 0
+        self.Paragens = []
+        
+        # Todas as amostras a partir deste instante (epoch ns) estão nas séries: as anteriores
+        # ao arranque do processo ou já removidas só existem na BD
+        self.completo_desde = relogio.tempo_ns()
+        
+        # Cursor para pedidos incrementais (?since=). Começa no epoch em ms do arranque,
+        # para continuar a crescer entre reinícios do processo
+        self.seq = int(relogio.tempo() * 1000)
+        self.seq_removido = self.seq  # Seq mais alto já removido das séries
+        self.EstatisticaSeq = []
+        self._escalares_versao = {}  # campo -> (valor, seq da última alteração)
+    
+    def limpar(self):
+        """Esvazia as séries (nova ordem); os cursores anteriores deixam de ser válidos"""
+        with self.lock:
+            self.EstatisticaGFANominal = 0
+            self.EstatisticaGFA = []
+            self.EstatisticaGFAMedia = []
+            self.EstatisticaNs = []
+            self.EstatisticaCadenciaArtigo = []
+            self.RegistoParagem = 0
+            self.Paragens = []
+            self.EstatisticaSeq = []
+            self.completo_desde = relogio.tempo_ns()
+            self.seq_removido = self.proximo_seq()
+    
+    def proximo_seq(self):
+        """Avança o cursor de sequência; chamado com o lock adquirido"""
+        self.seq += 1
+        return self.seq
+    
+    def registar_escalares(self, escalares):
+        """Regista os valores atuais dos campos escalares, avançando o cursor nos que mudaram"""
+        with self.lock:
+            for chave, valor in escalares.items():
+                anterior = self._escalares_versao.get(chave)
+                if anterior is None or anterior[0] != valor:
+                    self._escalares_versao[chave] = (valor, self.proximo_seq())
+    
+    def escalares_desde(self, since):
+        """Nomes dos campos escalares alterados depois do cursor indicado"""
+        with self.lock:
+            return [chave for chave, (_, seq) in self._escalares_versao.items() if seq > since]
+    
+    def cursor_valido(self, since):
+        """True se nenhuma amostra posterior ao cursor foi já removida das séries"""
+        return since is not None and self.seq_removido <= since <= self.seq
+
+def _delegar(componente, campo):
+    """Atributo do Contador guardado num dos seus componentes (estado quente ou estatísticas)"""
+    return property(
+        lambda self: getattr(getattr(self, componente), campo),
+        lambda self, valor: setattr(getattr(self, componente), campo, valor),
+    )
+
+def _campo_ordem(campo):
+    """Atributo do Contador lido do snapshot dos metadados; escrever cria um snapshot novo"""
+    return property(
+        lambda self: getattr(self.metadados, campo),
+        lambda self, valor: self.atualizar_ordem(**{campo: valor}),
+    )
+
+def _data_ordem(campo, campo_ns):
+    """Data da ordem em texto, guardada no snapshot em epoch ns (aceita texto, datetime ou ns)"""
+    return property(
+        lambda self: getattr(self.metadados, campo),
+        lambda self, valor: self.atualizar_ordem(**{campo_ns: ns_de_data(valor)}),
+    )
+
+# Acorda o motor de captura quando o estado de uma linha muda (dorme se nenhuma conta)
+evento_captura = threading.Event()
+
+class Contador:
+    def __init__(self, linha_id="1", sensor_pin=22, door_pin=23, ficheiro_estado="contador_state.backup", aviso_pin=None):
+        # Identificação da linha de enchimento
+        self.linha_id = str(linha_id)
+        self.ficheiro_estado = ficheiro_estado
+        
         # Configuração de pinos GPIO com proteção
-        self.SENSOR_PIN = 22  # Pino do sensor de contagem
-        self.DOOR_PIN = 23    # Pino de controlo da porta
+        self.SENSOR_PIN = sensor_pin  # Pino do sensor de contagem
+        self.DOOR_PIN = door_pin      # Pino de controlo da porta
+        self.AVISO_PIN = aviso_pin    # Saída de aviso de aproximação ao objetivo (opcional)
 
         # Estado do pino de entrada - uso do pull-up interno
         self.pullup = True
         self.invert_logic = False  # Se True, inverte a lógica de deteção do sensor
         
+        # Modelo da linha em três partes: estado quente (captura), snapshot imutável dos
+        # metadados da ordem e séries de estatísticas, cada uma com a sua disciplina de acesso
+        self.quente = EstadoCaptura()
+        self.metadados = METADADOS_VAZIOS
+        self.estatisticas = EstatisticasLinha()
+        
         # Variáveis para controlo da leitura do sensor
-        self.previous_sensor_state = None
         self.using_polling_only = True  # Flag para indicar uso exclusivo de polling
         self.sensor_initialized = False
         self.door_initialized = False
         self.last_transition_time = 0  # Timestamp da última transição
         self.debug_counter = 0  # Contador para logs de depuração limitados
         
-        # Variáveis para controlo de erros e recuperação
+        # _state_lock: ciclo de vida da ordem, alterações dos metadados, porta e checkpoint;
+        # _contagem_lock: a contagem (uma garrafa de cada vez). Ordem de aquisição:
+        # _contagem_lock, _state_lock, lock das estatísticas
         self._state_lock = threading.RLock()
         self._contagem_lock = threading.RLock()
         
-        self.sensor_last_reset = time.time()
+        self.sensor_last_reset = relogio.monotonico()
         self.sensor_reset_attempts = 0
         self.max_reset_attempts = 5  # Máximo de tentativas de reset
         self.reset_cooldown = 60  # Tempo de espera entre resets (segundos)
@@ -145,64 +1403,223 @@ class Contador:
         self.DB_Password = "your_db_password"
         self.DB_DB = "your_db_name"
         
-        # Estados:
-        # 0: Parado
-        # 1: Contagem
-        # 2: Pausa
-        self.EstadoContador = 0
-        self.EstadoPausa = False
-        self.Flop = False
+        # Estado da ordem (ver TRANSICOES_ORDEM); só muda através de transicao()
+        self.estado = ESTADO_LIVRE
+        self.eventos_ordem = deque(maxlen=200)  # Últimos eventos do ciclo de vida (também em ficheiro)
+        self._finalizacao_agendada = None  # IdBDOrdemProducao com o fecho já na fila do escritor
+        self.pausa_calendario = None  # Janela do calendário que pausou a contagem, se foi automática
+        self._tempo_ultima_pausa = None  # Referência para o tempo de paragem não planeada no OEE
         
-        # Mecanismo de proteção para deteção de falsos positivos
-        self.last_count_time = 0
         self.count_threshold_ms = 50  # Intervalo mínimo entre contagens (ms)
         
-        self.ContadorConfigurado = 0
-        self.Quebras = 0
+        # Aproximação ao objetivo (ver CONFIG_PADRAO) e excesso medido em cada ordem
+        self.aproximacao_garrafas = CONFIG["aproximacao_garrafas"]
+        self.aproximacao_segundos = CONFIG["aproximacao_segundos"]
+        self.sobrecontagem_janela = CONFIG["sobrecontagem_janela"]
+        self.sobrecontagens = deque(maxlen=50)
         
         # Proteção de leitura dos sensores
         self.read_error_count = 0
         self.max_read_errors = 10  # Máximo de erros antes de reiniciar leitura
         
-        # Estatísticas com backup periódico
-        self.TempoInicio = ""
-        self.TempoFim = ""
-        self.EstatisticaGFA = []
-        self.EstatisticaGFAMedia = []
-        self.EstatisticaGFANominal = 0
-        self.EstatisticaTempo = []
-        self.EstatisticaCadenciaArtigo = []
-        self.RegistoParagem = 0
-        self.GravarDados = 0
-        self.Paragens = []
-        
-        self.ArtigoEmContagem = "NA"
-        self.DescricaoArtigoEmContagem = "NA"
-        self.CadenciaArtigoEmContagem = 6000
-        
-        self.ContagemAtual = 0
-        self.ContagemTotal = 0
         self.EstadoPorta = 0
-        self.Ordem = "NA"
         self.input_state = 0
-        self.IdBDOrdemProducao = 0
         
-        # Backup de estado para recuperação
-        self.last_saved_state = {}
-        self._save_state()
-    
-    def inicializar_sensor(self):
+        # Referência para o cálculo do GFA entre ciclos de estatísticas
+        self._contagem_ultimo_ciclo = None
+        self._tempo_ultimo_ciclo = None
+        
+        # Controlo de leitura pelo motor de captura partilhado
+        self.ultimo_relatorio_estado = 0
+        self.proxima_tentativa_sensor = 0
+        self.reinicio_sensor_pendente = False  # Reinício do sensor a correr fora da captura
+        
+        # Escritor de BD próprio da linha (fila + thread dedicada)
+        self.escritor = EscritorBD(f"EscritorBD-{self.linha_id}")
+        
+        # Indicadores OEE calculados a cada ciclo de estatísticas
+        self.oee = MotorOEE(CONFIG["turnos"])
+        self.rollups = Rollups(CONFIG["turnos"], CONFIG["rollup_lote"])
+        
+        # Previsão de fecho, calculada uma vez por ciclo e lida pela API e pela gravação
+        self.previsao = PrevisaoFecho(calendario, CONFIG["previsao_janela"])
+        
+        # Backup de estado para recuperação. O ficheiro não é escrito aqui, para não
+        # substituir o estado anterior antes de recover_state o ler
+        self.last_saved_state = {}
+        
+        # Diário de contagens (registo por garrafa) usado para repor as contagens
+        # feitas depois do último checkpoint
+        self.ficheiro_diario = os.path.splitext(ficheiro_estado)[0] + ".diario"
+        self.ficheiro_eventos = os.path.splitext(ficheiro_estado)[0] + ".eventos"
+        self._fd_diario = None
+        self.relatorio_recuperacao = {}
+    
+    # Estado quente, metadados da ordem e estatísticas, acessíveis como antes pelo resto do código
+    ContagemAtual = _delegar("quente", "contagem")
+    Flop = _delegar("quente", "flop")
+    last_count_time = _delegar("quente", "ultima_contagem_ms")
+    previous_sensor_state = _delegar("quente", "estado_anterior")
+    
+    Ordem = _campo_ordem("Ordem")
+    IdBDOrdemProducao = _campo_ordem("IdBDOrdemProducao")
+    ContagemTotal = _campo_ordem("ContagemTotal")
+    Quebras = _campo_ordem("Quebras")
+    ArtigoEmContagem = _campo_ordem("ArtigoEmContagem")
+    DescricaoArtigoEmContagem = _campo_ordem("DescricaoArtigoEmContagem")
+    CadenciaArtigoEmContagem = _campo_ordem("CadenciaArtigoEmContagem")
+    TempoInicio = _data_ordem("TempoInicio", "InicioNs")
+    TempoFim = _data_ordem("TempoFim", "FimNs")
+    
+    EstatisticaGFA = _delegar("estatisticas", "EstatisticaGFA")
+    EstatisticaGFAMedia = _delegar("estatisticas", "EstatisticaGFAMedia")
+    EstatisticaGFANominal = _delegar("estatisticas", "EstatisticaGFANominal")
+    EstatisticaNs = _delegar("estatisticas", "EstatisticaNs")
+    EstatisticaCadenciaArtigo = _delegar("estatisticas", "EstatisticaCadenciaArtigo")
+    RegistoParagem = _delegar("estatisticas", "RegistoParagem")
+    Paragens = _delegar("estatisticas", "Paragens")
+    
+    @property
+    def estado(self):
+        return self._estado
+    
+    @estado.setter
+    def estado(self, valor):
+        self._estado = valor
+        evento_captura.set()
+    
+    def atualizar_ordem(self, **campos):
+        """Substitui o snapshot dos metadados da ordem por um novo com os campos indicados"""
+        with self._state_lock:
+            self.metadados = self.metadados._replace(**campos)
+    
+    # Campos antigos, derivados do estado da ordem
+    @property
+    def EstadoContador(self):
+        """0: Parado, 1: Contagem, 2: Pausa"""
+        return ESTADOS_LEGADOS[self.estado][0]
+    
+    @property
+    def EstadoPausa(self):
+        return ESTADOS_LEGADOS[self.estado][1]
+    
+    @property
+    def ContadorConfigurado(self):
+        return ESTADOS_LEGADOS[self.estado][2]
+    
+    @property
+    def GravarDados(self):
+        return ESTADOS_LEGADOS[self.estado][3]
+    
+    def transicao(self, evento, origem="api", repetido_ok=True):
+        """
+        Aplica um evento ao ciclo de vida da ordem, com os respetivos efeitos.
+        
+        A validação, a mudança de estado, os efeitos (porta, tempos, fecho na BD) e o
+        checkpoint acontecem sob o mesmo lock, por isso dois pedidos simultâneos não
+        podem aplicar a mesma transição duas vezes.
+        
+        Returns:
+            True se a transição foi aplicada ou se a linha já estava no estado de destino
+            (pedido repetido, sem efeitos, se `repetido_ok`); False se não é válida
+        """
+        with self._state_lock:
+            anterior = self.estado
+            destino = ESTADO_LIVRE if evento == "repor" else TRANSICOES_ORDEM.get((anterior, evento))
+            if destino is None:
+                if repetido_ok and DESTINO_EVENTO.get(evento) == anterior:
+                    return True
+                logging.info(f"Linha {self.linha_id}: transição '{evento}' inválida no estado {anterior}")
+                return False
+            
+            self.estado = destino
+            self._registar_evento_ordem(evento, anterior, destino, origem)
+            agora = truncar_segundo(relogio.tempo_ns())  # Datas da ordem ao segundo
+            
+            if evento == "iniciar":
+                reset_stats(self)
+                self.atualizar_ordem(InicioNs=agora)
+                open_door(self)
+            elif evento == "pausar":
+                close_door(self)  # Fechar a porta quando pausar
+            elif evento == "retomar":
+                self.pausa_calendario = None
+                if self.quente.terminar_pendente is None:  # Objetivo atingido: a porta fica fechada
+                    open_door(self)
+            elif evento == "terminar":
+                self.atualizar_ordem(FimNs=agora)
+                close_door(self)  # Já fechada pela captura se o objetivo foi atingido
+                if self.quente.fecho is None:
+                    # No objetivo o aviso (abrandar) fica ligado até ao fim da janela do excesso
+                    self.definir_aviso(False)
+                self.oee.fechar()
+                self.rollups.fechar()
+                if cliente_agregador is None:
+                    self.escritor.submeter(gravar_oee_horario, self)
+                    self.escritor.submeter(gravar_rollups, self)
+                self._agendar_finalizacao()
+            elif evento in ("repor", "cancelar"):
+                self._finalizacao_agendada = None
+                self.definir_aviso(False)
+            
+            self._save_state()
+        return True
+    
+    def _registar_evento_ordem(self, evento, anterior, destino, origem):
+        """Acrescenta o evento ao diário de eventos da ordem; chamado com _state_lock adquirido"""
+        instante = relogio.tempo_ns()
+        registo = {
+            "Data": f"{formatar_ns(instante)}.{instante // 1_000_000 % 1000:03d}",
+            "Evento": evento,
+            "De": anterior,
+            "Para": destino,
+            "Origem": origem,
+            "Ordem": self.Ordem,
+            "IdBDOrdemProducao": self.IdBDOrdemProducao,
+            "Contagem": self.ContagemAtual,
+        }
+        self.eventos_ordem.append(registo)
+        logging.info(f"Linha {self.linha_id}: {anterior} -> {destino} ({evento}, {origem})")
+        try:
+            with open(self.ficheiro_eventos, "a") as f:
+                f.write(json.dumps(registo, ensure_ascii=False) + "\n")
+        except OSError as e:
+            logging.error(f"Erro ao escrever no diário de eventos da ordem: {e}")
+    
+    def _agendar_finalizacao(self):
+        """
+        Coloca o fecho da ordem na fila do escritor, uma única vez por ordem.
+        
+        Os valores do fecho são fixados agora; se a gravação falhar, a chave é
+        libertada e a update_stats volta a agendá-lo no ciclo seguinte.
+        Chamado com _state_lock adquirido.
+        """
+        ordem = self.metadados
+        chave = ordem.IdBDOrdemProducao
+        if self._finalizacao_agendada is not None and self._finalizacao_agendada == chave:
+            return False
+        self._finalizacao_agendada = chave
+        fecho = {
+            "Id": chave,
+            "Ordem": ordem.Ordem,
+            "Contagem": self.quente.contagem,
+            "Quebras": ordem.Quebras,
+            "Media": media_producao(self),
+            "Inicio": ordem.TempoInicio,
+            "Fim": ordem.TempoFim,
+        }
+        self.escritor.submeter(self.finalizar_registo_bd, fecho)
+        return True
+    
+    def inicializar_sensor(self):
         """Inicializa o sensor de contagem com tratamento de erros"""
         try:
-            # Limpar qualquer configuração anterior
-            self._safe_gpio_cleanup()
-            
-            # Configurar GPIO para o sensor
+            # Configurar GPIO para o sensor (a limpeza e a pausa de estabilização ficam
+            # para o reiniciar_sensor, para não atrasar a primeira contagem no arranque;
+            # o ciclo Flop só conta numa transição completa, por isso um estado inicial
+            # ainda instável não gera contagens falsas)
             GPIO.setup(self.SENSOR_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP if self.pullup else GPIO.PUD_DOWN)
             
-            # Pausa para estabilização antes de ler o estado
-            time.sleep(0.2)
-            
             # Ler o estado inicial do sensor e garantir que Flop começa como False
             self.previous_sensor_state = GPIO.input(self.SENSOR_PIN)
             self.Flop = False
@@ -218,12 +1635,12 @@ class Contador:
     def inicializar_porta(self):
         """Inicializa o controle da porta com tratamento de erros"""
         try:
-            # Configurar GPIO para a porta
-            GPIO.setup(self.DOOR_PIN, GPIO.OUT)
-            GPIO.output(self.DOOR_PIN, GPIO.LOW)  # Garantir que começa fechado
-            self.EstadoPorta = 0
+            # Configurar GPIO para a porta já no estado recuperado (fechada sem ordem ativa)
+            GPIO.setup(self.DOOR_PIN, GPIO.OUT, initial=GPIO.HIGH if self.EstadoPorta == 1 else GPIO.LOW)
+            if self.AVISO_PIN is not None:
+                GPIO.setup(self.AVISO_PIN, GPIO.OUT, initial=GPIO.LOW)
             
-            logging.info(f"Porta inicializada no pino {self.DOOR_PIN}")
+            logging.info(f"Porta inicializada no pino {self.DOOR_PIN} ({'ABERTA' if self.EstadoPorta == 1 else 'FECHADA'})")
             self.door_initialized = True
             return True
         except Exception as e:
@@ -233,7 +1650,7 @@ class Contador:
     
     def reiniciar_sensor(self):
         """Reinicia o sensor com controle de frequência para evitar loops infinitos"""
-        current_time = time.time()
+        current_time = relogio.monotonico()
         
         # Verificar se não estamos tentando reiniciar com muita frequência
         if current_time - self.sensor_last_reset < self.reset_cooldown:
@@ -254,7 +1671,7 @@ class Contador:
             self._safe_gpio_cleanup()
             
             # Pequena pausa para estabilização
-            time.sleep(0.2)
+            relogio.dormir(0.2)
             
             # Reinicializar o sensor
             success = self.inicializar_sensor()
@@ -269,11 +1686,34 @@ class Contador:
             logging.error(f"Erro ao reiniciar sensor: {str(e)}")
             return False
     
+    def pedir_reinicio_sensor(self):
+        """
+        Reinicia o sensor numa thread própria: a limpeza do pino e a pausa de estabilização
+        não podem parar o motor de captura partilhado, que salta esta linha até ao fim
+        """
+        if self.reinicio_sensor_pendente:
+            return
+        self.reinicio_sensor_pendente = True
+        threading.Thread(
+            target=self._reiniciar_sensor_pendente, daemon=True, name=f"ReinicioSensor-{self.linha_id}"
+        ).start()
+    
+    def _reiniciar_sensor_pendente(self):
+        try:
+            if self.reiniciar_sensor():
+                logging.info(f"Linha {self.linha_id}: sensor reinicializado fora da thread de contagem")
+            else:
+                logging.error(f"Linha {self.linha_id}: falha ao reinicializar sensor")
+                self.proxima_tentativa_sensor = time.time() + 5  # Esperar antes de tentar novamente
+        finally:
+            self.reinicio_sensor_pendente = False
+    
     def _safe_gpio_cleanup(self):
         """Método seguro para limpar os pinos GPIO"""
         try:
-            # Limpar apenas os pinos que estamos usando
-            GPIO.cleanup([self.SENSOR_PIN, self.DOOR_PIN])
+            # Limpar apenas o pino do sensor: a porta e o aviso são saídas e continuam
+            # configuradas (e no estado atual) depois de o sensor ser reiniciado
+            GPIO.cleanup([self.SENSOR_PIN])
             logging.info("Limpeza de GPIO executada")
         except Exception as e:
             logging.warning(f"Erro durante limpeza de GPIO: {str(e)}")
@@ -281,188 +1721,478 @@ class Contador:
     def _save_state(self):
         """Guarda o estado atual para recuperação em caso de falha"""
         with self._state_lock:
+            ordem = self.metadados
             self.last_saved_state = {
+                'Estado': self.estado,
                 'EstadoContador': self.EstadoContador,
-                'ContagemAtual': self.ContagemAtual,
-                'ContagemTotal': self.ContagemTotal,
-                'Quebras': self.Quebras,
-                'Ordem': self.Ordem,
-                'IdBDOrdemProducao': self.IdBDOrdemProducao,
-                'ArtigoEmContagem': self.ArtigoEmContagem,
-                'TempoInicio': self.TempoInicio,
-                'TempoFim': self.TempoFim,
+                'ContagemAtual': self.quente.contagem,
+                'ContagemTotal': ordem.ContagemTotal,
+                'Quebras': ordem.Quebras,
+                'Ordem': ordem.Ordem,
+                'IdBDOrdemProducao': ordem.IdBDOrdemProducao,
+                'ArtigoEmContagem': ordem.ArtigoEmContagem,
+                'TempoInicio': ordem.TempoInicio,
+                'TempoFim': ordem.TempoFim,
                 "EstadoPorta": self.EstadoPorta
             }
             
-            # Guardar em ficheiro para persistência
+            # Guardar em ficheiro para persistência (escrita num temporário e rename atómico)
             try:
-                with open('contador_state.backup', 'w') as f:
+                temporario = self.ficheiro_estado + ".tmp"
+                with open(temporario, 'w') as f:
                     for key, value in self.last_saved_state.items():
                         f.write(f"{key}={value}\n")
+                os.replace(temporario, self.ficheiro_estado)
             except Exception as e:
                 logging.error(f"Erro ao guardar estado em ficheiro: {str(e)}")
+            
+            # Marca no diário; com o checkpoint gravado, o diário pode ser compactado
+            self._registar_diario(compactar=True)
+    
+    # Registo do diário: epoch em ms, IdBDOrdemProducao, ContagemAtual
+    REGISTO_DIARIO = struct.Struct("<qiI")
+    TAMANHO_MAXIMO_DIARIO = 64 * 1024
+    
+    def _registar_diario(self, compactar=False):
+        """Acrescenta a contagem atual ao diário; chamado com _contagem_lock ou _state_lock adquirido"""
+        try:
+            if self._fd_diario is None:
+                self._fd_diario = os.open(self.ficheiro_diario, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            if compactar and os.fstat(self._fd_diario).st_size > self.TAMANHO_MAXIMO_DIARIO:
+                os.ftruncate(self._fd_diario, 0)
+            os.write(self._fd_diario, self.REGISTO_DIARIO.pack(
+                int(relogio.tempo() * 1000), int(self.metadados.IdBDOrdemProducao), int(self.quente.contagem)
+            ))
+        except Exception as e:
+            logging.error(f"Erro ao escrever no diário de contagens: {e}")
+            self._fd_diario = None
+    
+    def fechar_diario(self):
+        """Força o diário para o disco e fecha-o (no encerramento); chamado com _contagem_lock adquirido"""
+        if self._fd_diario is None:
+            return
+        try:
+            os.fsync(self._fd_diario)
+            os.close(self._fd_diario)
+        except OSError as e:
+            logging.error(f"Erro ao fechar o diário de contagens: {e}")
+        self._fd_diario = None
+    
+    def ler_diario(self, registos_finais=16):
+        """
+        Estado final do diário: (epoch ms, IdBDOrdemProducao, ContagemAtual) ou None.
+        
+        Lê só os últimos registos completos e usa a maior contagem da ordem do último
+        registo (uma marca de checkpoint pode ser escrita ao mesmo tempo que uma garrafa).
+        """
+        tamanho_registo = self.REGISTO_DIARIO.size
+        try:
+            with open(self.ficheiro_diario, "rb") as f:
+                completos = os.fstat(f.fileno()).st_size // tamanho_registo  # Ignora um registo truncado no fim
+                if completos == 0:
+                    return None
+                primeiro = max(0, completos - registos_finais)
+                f.seek(primeiro * tamanho_registo)
+                dados = f.read((completos - primeiro) * tamanho_registo)
+            registos = [r for r in self.REGISTO_DIARIO.iter_unpack(dados)]
+            ultimo = registos[-1]
+            contagem = max(r[2] for r in registos if r[1] == ultimo[1])
+            return (ultimo[0], ultimo[1], contagem)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.error(f"Erro ao ler diário de contagens: {e}")
+            return None
     
     def recover_state(self):
-        """Recupera estado guardado em caso de reinicialização inesperada"""
+        """
+        Recupera o estado após reinicialização, conciliando o checkpoint com o diário.
+        
+        O checkpoint (gravado a cada 10 garrafas) dá a ordem e a configuração; o último
+        registo do diário, se for da mesma ordem, dá as garrafas contadas depois dele.
+        A comparação com o último registo de krones_contadoreslinhacontagem é feita em
+        segundo plano (verificar_contagem_bd), para não atrasar o arranque.
+        """
+        inicio = time.perf_counter()
         try:
-            if os.path.exists('contador_state.backup'):
-                with open('contador_state.backup', 'r') as f:
-                    state = {}
+            state = {}
+            if os.path.exists(self.ficheiro_estado):
+                with open(self.ficheiro_estado, 'r') as f:
                     for line in f:
                         if '=' in line:
                             key, value = line.strip().split('=', 1)
                             state[key] = value
-                            
-                with self._state_lock:
-                    # Recuperar apenas se houver ordem ativa
-                    if state.get('Ordem', 'NA') != 'NA':
-                        self.EstadoContador = int(state.get('EstadoContador', 0))
-                        self.ContagemAtual = int(state.get('ContagemAtual', 0))
-                        self.ContagemTotal = int(state.get('ContagemTotal', 0))
-                        self.Quebras = int(state.get('Quebras', 0))
-                        self.Ordem = state.get('Ordem', 'NA')
-                        self.IdBDOrdemProducao = int(state.get('IdBDOrdemProducao', 0))
-                        self.ArtigoEmContagem = state.get('ArtigoEmContagem', 'NA')
-                        self.TempoInicio = state.get('TempoInicio', '')
-                        self.TempoFim = state.get('TempoFim', '')
-                        self.EstadoPorta = int(state.get('EstadoPorta', 0))
-                        
-                        # Sincronizar o estado real da porta
-                        if self.EstadoPorta == 1:
-                            GPIO.output(self.DOOR_PIN, GPIO.HIGH)
-                        else:
-                            GPIO.output(self.DOOR_PIN, GPIO.LOW)
-                        
-                        # Se estava em contagem, pausar por segurança
-                        if self.EstadoContador == 1:
-                            self.EstadoContador = 2  # Pausa
-                            logging.info("Recuperado de estado anterior - pausado por segurança")
-                            # Definir como configurado
-                            self.ContadorConfigurado = 1
-                        
-                        logging.info(f"Estado recuperado: Ordem={self.Ordem}, Contagem={self.ContagemAtual}/{self.ContagemTotal}")
+            
+            # Recuperar apenas se houver ordem ativa
+            if state.get('Ordem', 'NA') == 'NA':
+                return
+            
+            with self._state_lock:
+                estado = state.get('Estado')
+                if estado not in ESTADOS_LEGADOS:
+                    # Checkpoint anterior ao ciclo de vida explícito
+                    estado = {1: ESTADO_EM_CONTAGEM, 2: ESTADO_PAUSADA}.get(int(state.get('EstadoContador', 0)), ESTADO_LIVRE)
+                self.estado = estado
+                self.ContagemAtual = int(state.get('ContagemAtual', 0))
+                self.atualizar_ordem(
+                    ContagemTotal=int(state.get('ContagemTotal', 0)),
+                    Quebras=int(state.get('Quebras', 0)),
+                    Ordem=state.get('Ordem', 'NA'),
+                    IdBDOrdemProducao=int(state.get('IdBDOrdemProducao', 0)),
+                    ArtigoEmContagem=state.get('ArtigoEmContagem', 'NA'),
+                    InicioNs=ns_de_data(state.get('TempoInicio')),
+                    FimNs=ns_de_data(state.get('TempoFim')),
+                )
+                self.EstadoPorta = int(state.get('EstadoPorta', 0))
+                
+                # Repor as garrafas contadas depois do checkpoint
+                contagem_checkpoint = self.ContagemAtual
+                registo = self.ler_diario()
+                contagem_diario = None
+                if registo is not None and registo[1] == self.IdBDOrdemProducao:
+                    contagem_diario = registo[2]
+                    self.ContagemAtual = max(contagem_checkpoint, contagem_diario)
+                
+                self.relatorio_recuperacao = {
+                    "Ordem": self.Ordem,
+                    "Checkpoint": contagem_checkpoint,
+                    "Diario": contagem_diario,
+                    "BD": None,
+                    "Recuperada": self.ContagemAtual,
+                    "RepostasDoDiario": self.ContagemAtual - contagem_checkpoint,
+                    "DiscrepanciaBD": None,
+                    "TempoMs": None,
+                }
+                
+                # O estado da porta é aplicado ao pino em inicializar_porta
+                # Sem diário da mesma ordem a contagem pode estar atrasada: pausar por segurança
+                if self.estado == ESTADO_EM_CONTAGEM and (contagem_diario is None or not CONFIG["recuperacao_retomar"]):
+                    self.estado = ESTADO_PAUSADA
+                    self._registar_evento_ordem("pausar", ESTADO_EM_CONTAGEM, ESTADO_PAUSADA, "recuperacao")
+                    self.EstadoPorta = 0  # Porta fechada enquanto pausado
+                    logging.info("Recuperado de estado anterior - pausado por segurança")
+                
+                # Fecho na BD interrompido pela reinicialização: voltar a agendar
+                if self.estado == ESTADO_A_FINALIZAR:
+                    self._agendar_finalizacao()
+                
+                self._save_state()
+                
+                self.relatorio_recuperacao["TempoMs"] = round((time.perf_counter() - inicio) * 1000, 3)
+                logging.info(
+                    f"Linha {self.linha_id}: estado recuperado: Ordem={self.Ordem}, "
+                    f"Contagem={self.ContagemAtual}/{self.ContagemTotal} "
+                    f"(checkpoint {contagem_checkpoint}, diário {contagem_diario})"
+                )
+            
+            # Confirmar com a BD em segundo plano
+            if self.IdBDOrdemProducao > 0 and cliente_agregador is None:
+                self.escritor.submeter(verificar_contagem_bd, self)
         except Exception as e:
             logging.error(f"Erro ao recuperar estado: {str(e)}")
     
     def increment_count(self):
         """Incrementa a contagem com proteção contra falsas leituras"""
-        current_time = time.time() * 1000  # Tempo atual em ms
+        current_time = relogio.monotonico() * 1000  # Tempo atual em ms
+        quente = self.quente
         
         with self._contagem_lock:
             # Verifica se o tempo desde a última contagem é maior que o limiar
-            if current_time - self.last_count_time > self.count_threshold_ms:
-                self.ContagemAtual += 1
-                self.last_count_time = current_time
-                
-                # Log para diagnóstico
-                if self.ContagemAtual % 10 == 0:
-                    logging.info(f"Contagem atual: {self.ContagemAtual}")
-                
-                # Verificar se atingiu o total
-                if self.ContagemAtual >= (self.ContagemTotal + self.Quebras):
-                    # Usar threading para não bloquear a contagem
-                    threading.Thread(target=self._stop_counting_thread).start()
-                
-                # Guardar estado a cada 10 contagens
-                if self.ContagemAtual % 10 == 0:
-                    self._save_state()
-                
+            if current_time - quente.ultima_contagem_ms > self.count_threshold_ms:
+                quente.ultima_contagem_ms = current_time
+                self._contar_garrafa()
                 return True
             else:
                 # Regista falsas leituras para diagnóstico
-                logging.debug(f"Leitura ignorada: intervalo muito curto ({int(current_time - self.last_count_time)} ms)")
+                logging.debug(f"Leitura ignorada: intervalo muito curto ({int(current_time - quente.ultima_contagem_ms)} ms)")
                 return False
     
-    def _stop_counting_thread(self):
-        """Thread segura para parar contagem"""
+    def _contar_garrafa(self):
+        """Regista uma garrafa; chamado com _contagem_lock adquirido"""
+        agora = time.perf_counter()  # Latência do fecho da porta (tempo real)
+        instante = relogio.monotonico()
+        quente = self.quente
+        if quente.terminar_pendente is not None:
+            quente.excesso += 1  # Porta já fechada no objetivo, à espera da transição
+            return
+        quente.contagem += 1
+        contagem = quente.contagem
+        
+        # Ritmo atual; intervalos longos (pausa, nova ordem) não entram na média
+        intervalo = instante - quente.ultima_garrafa
+        if quente.ultima_garrafa and intervalo < 30:
+            quente.intervalo_medio = intervalo if not quente.intervalo_medio else 0.8 * quente.intervalo_medio + 0.2 * intervalo
+        quente.ultima_garrafa = instante
+        
+        # O snapshot dá o objetivo e as quebras coerentes entre si, sem adquirir _state_lock
+        ordem = self.metadados
+        objetivo = ordem.ContagemTotal + ordem.Quebras
+        restantes = objetivo - contagem
+        if restantes <= 0:
+            # Objetivo atingido: fechar a porta já, nesta mesma leitura, antes do lock, do
+            # checkpoint e do diário de eventos da transição
+            try:
+                GPIO.output(self.DOOR_PIN, GPIO.LOW)
+            except Exception as e:
+                logging.error(f"Erro ao fechar porta no objetivo: {e}")  # A transição volta a tentar
+            quente.fecho_em = instante
+            quente.excesso = 0
+            quente.terminar_pendente = ordem
+            quente.fecho = {
+                "Ordem": ordem.Ordem,
+                "IdBDOrdemProducao": ordem.IdBDOrdemProducao,
+                "Objetivo": objetivo,
+                "ContagemFecho": contagem,
+                "LatenciaFechoMs": round((time.perf_counter() - agora) * 1000, 3),
+                "AvisoAtivo": quente.aviso_ativo,
+            }
+        elif not quente.aviso_ativo and (
+            restantes <= self.aproximacao_garrafas
+            or (quente.intervalo_medio and restantes * quente.intervalo_medio <= self.aproximacao_segundos)
+        ):
+            self.definir_aviso(True, restantes)
+        
+        self._registar_diario()
+        if not quente.contou:
+            quente.contou = True
+            marcar_arranque("primeira_contagem")
+        
+        # Log para diagnóstico
+        if contagem % 10 == 0:
+            logging.info(f"Linha {self.linha_id}: contagem atual: {contagem}")
+        
+        # Terminar numa thread própria: a transição (diário de eventos, checkpoint, média, OEE
+        # e rollups) não pode parar a captura, que serve todas as linhas, nem esperar pelas
+        # gravações na fila do escritor de BD (só o fecho na BD vai para essa fila)
+        if restantes <= 0:
+            threading.Thread(
+                target=self._terminar_no_objetivo, args=(ordem,), daemon=True,
+                name=f"TerminarObjetivo-{self.linha_id}",
+            ).start()
+        
+        # Guardar estado a cada 10 contagens
+        if contagem % 10 == 0:
+            self._save_state()
+    
+    def _terminar_no_objetivo(self, ordem):
+        """
+        Transição "terminar" do objetivo atingido, fora da thread de captura e sem I/O de BD:
+        o fecho na BD é agendado no escritor da linha, como no fim manual
+        """
+        quente = self.quente
+        if quente.terminar_pendente is not ordem:
+            return  # Linha reposta ou nova ordem iniciada entretanto
         try:
-            with self._state_lock:
-                self.EstadoContador = 0
-                self.TempoFim = datetime.now().replace(microsecond=0).strftime("%Y-%m-%d %H:%M:%S")
-                self.GravarDados = 1
-                self._save_state()
-            
-            # Fechar porta
-            GPIO.output(self.DOOR_PIN, GPIO.LOW)
-            self.EstadoPorta = 0
+            if self.transicao("terminar", origem="objetivo"):
+                logging.info("Contagem finalizada automaticamente")
+        finally:
+            quente.terminar_pendente = None
+    
+    def definir_aviso(self, ativo, restantes=None):
+        """Liga ou desliga a saída de aviso de aproximação ao objetivo"""
+        quente = self.quente
+        if quente.aviso_ativo == ativo:
+            return
+        quente.aviso_ativo = ativo
+        if ativo:
+            logging.info(f"Linha {self.linha_id}: aproximação ao objetivo, faltam {restantes} garrafas")
+        if self.AVISO_PIN is not None:
+            try:
+                GPIO.output(self.AVISO_PIN, GPIO.HIGH if ativo else GPIO.LOW)
+            except Exception as e:
+                logging.error(f"Erro na saída de aviso da linha {self.linha_id}: {e}")
+    
+    def observar_excesso(self, estado_entrada):
+        """
+        Depois do fecho no objetivo, conta (pelo mesmo ciclo Flop, sem alterar a contagem)
+        as garrafas que ainda passam no sensor; no fim da janela regista o excesso da ordem.
+        Chamado pelo motor de captura enquanto a linha não está em contagem.
+        """
+        quente = self.quente
+        if estado_entrada == 1 and quente.flop is False:
+            quente.flop = True
+        elif estado_entrada == 0 and quente.flop is True:
+            quente.excesso += 1
+            quente.flop = False
+        if relogio.monotonico() - quente.fecho_em >= self.sobrecontagem_janela:
+            self.registar_sobrecontagem()
+    
+    def registar_sobrecontagem(self):
+        """Regista o excesso medido na última ordem fechada no objetivo e termina a observação"""
+        quente = self.quente
+        fecho = quente.fecho
+        if fecho is None:
+            return
+        fecho["Excesso"] = quente.excesso
+        fecho["Data"] = formatar_ns(relogio.tempo_ns())
+        self.sobrecontagens.append(fecho)
+        quente.fecho = quente.fecho_em = None
+        quente.flop = False
+        self.definir_aviso(False)
+        logging.info(
+            f"Linha {self.linha_id}: ordem {fecho['Ordem']} fechada no objetivo em "
+            f"{fecho['LatenciaFechoMs']} ms, excesso de {fecho['Excesso']} garrafas"
+        )
+    
+    def aplicar_garrafas(self, garrafas):
+        """
+        Aplica garrafas detetadas pelo processo de captura (o ciclo Flop já foi feito lá):
+        contam se a linha está em contagem, ou como excesso depois do fecho no objetivo.
+        """
+        quente = self.quente
+        if quente.fecho is not None and quente.terminar_pendente is None and self.estado == ESTADO_EM_CONTAGEM:
+            self.registar_sobrecontagem()  # Nova ordem iniciada antes do fim da janela
+        for _ in range(garrafas):
+            if self.estado == ESTADO_EM_CONTAGEM:
+                with self._contagem_lock:
+                    self._contar_garrafa()
+            elif quente.fecho is not None:
+                quente.excesso += 1
+        if quente.fecho is not None and relogio.monotonico() - quente.fecho_em >= self.sobrecontagem_janela:
+            self.registar_sobrecontagem()
+    
+    def processar_leitura(self, estado_entrada):
+        """
+        Sistema Flop: conta uma garrafa quando o sensor é ativado e volta ao estado normal.
+        Chamado pelo motor de captura em cada leitura do sensor desta linha.
+        """
+        quente = self.quente
+        
+        # Sistema Flop - primeira parte (deteta quando o sensor é ativado)
+        if estado_entrada == 1 and quente.flop is False:
+            # Levantar FLOP - sensor ativado
+            quente.flop = True
+        
+        # Sistema Flop - segunda parte (deteta quando o sensor volta ao estado normal)
+        elif estado_entrada == 0 and quente.flop is True:
+            # Contagem completa - incrementar contador
+            with self._contagem_lock:
+                self._contar_garrafa()
             
-            logging.info("Contagem finalizada automaticamente")
-        except Exception as e:
-            logging.error(f"Erro ao parar contagem: {str(e)}")
-
+            # Reset no FLOP - pronto para próxima contagem
+            quente.flop = False
+    
     def update_stats(self):
-        """Atualiza as estatísticas do contador"""
+        """
+        Atualiza as estatísticas do contador.
+        
+        Chamado a cada ciclo da thread de estatísticas; o GFA é calculado a partir
+        da diferença de contagem desde o ciclo anterior, sem bloquear a thread.
+        """
         try:
             # Só atualiza estatísticas se contador ativo
             if self.EstadoContador == 1:
-                with self._contagem_lock:
-                    contagem_inicial = self.ContagemAtual
+                agora = relogio.monotonico()
+                # Leitura atómica da contagem, sem esperar pela captura
+                contagem_final = self.quente.contagem
+                ordem = self.metadados
                 
-                # Aguardar período para cálculo
-                time.sleep(5)
+                # Primeiro ciclo em contagem: apenas guardar a referência
+                self._tempo_ultima_pausa = None
+                if self._tempo_ultimo_ciclo is None:
+                    self._contagem_ultimo_ciclo = contagem_final
+                    self._tempo_ultimo_ciclo = agora
+                    return
+                
+                diff = contagem_final - self._contagem_ultimo_ciclo
+                intervalo = agora - self._tempo_ultimo_ciclo
+                self._contagem_ultimo_ciclo = contagem_final
+                self._tempo_ultimo_ciclo = agora
                 
-                # Calcular estatísticas com proteção de thread
-                with self._contagem_lock:
-                    contagem_final = self.ContagemAtual
-                    diff = contagem_final - contagem_inicial
-                    
                 # Calcular valor GFA (garrafas por hora)
-                gfa = float(diff * 720)  # (diff / 5s) * 3600s = diff * 720
+                gfa = float(round(diff * 3600 / intervalo, 0)) if intervalo > 0 else 0.0
                 
-                with self._state_lock:
-                    self.EstatisticaGFA.append(gfa)
-                    self.EstatisticaGFANominal = gfa
+                estatisticas = self.estatisticas
+                with estatisticas.lock:
+                    estatisticas.EstatisticaGFA.append(gfa)
+                    estatisticas.EstatisticaGFANominal = gfa
                     
                     # Calcular média com proteção
                     try:
-                        valid_values = [float(x) for x in self.EstatisticaGFA if isinstance(x, (int, float, np.float64, np.int64)) and x >= 0]
+                        valid_values = [float(x) for x in estatisticas.EstatisticaGFA if isinstance(x, (int, float, np.float64, np.int64)) and x >= 0]
                         if valid_values:
                             media = float(round(np.mean(valid_values), 0))
-                            self.EstatisticaGFAMedia.append(media)
+                            estatisticas.EstatisticaGFAMedia.append(media)
                         else:
-                            self.EstatisticaGFAMedia.append(0.0)
+                            estatisticas.EstatisticaGFAMedia.append(0.0)
                     except Exception as media_e:
                         logging.error(f"Erro ao calcular média: {media_e}")
-                        self.EstatisticaGFAMedia.append(0.0)
+                        estatisticas.EstatisticaGFAMedia.append(0.0)
                     
-                    # Registar tempo
-                    self.EstatisticaTempo.append(datetime.now().strftime("%H:%M:%S"))
+                    # Registar o instante e o número de sequência da amostra
+                    instante = relogio.tempo_ns()
+                    estatisticas.EstatisticaNs.append(instante)
+                    estatisticas.EstatisticaSeq.append(estatisticas.proximo_seq())
                     
                     # Atualizar cadência do artigo se disponível
-                    if hasattr(self, 'CadenciaArtigoEmContagem'):
-                        cadencia_valor = float(self.CadenciaArtigoEmContagem) if hasattr(self.CadenciaArtigoEmContagem, "__float__") else self.CadenciaArtigoEmContagem
-                        self.EstatisticaCadenciaArtigo.append(cadencia_valor)
+                    cadencia_valor = float(ordem.CadenciaArtigoEmContagem) if hasattr(ordem.CadenciaArtigoEmContagem, "__float__") else ordem.CadenciaArtigoEmContagem
+                    estatisticas.EstatisticaCadenciaArtigo.append(cadencia_valor)
                     
                     # Registar ocorrência de paragens
-                    if self.RegistoParagem == 1:
-                        self.Paragens.append("0")
-                        self.RegistoParagem = 0
+                    if estatisticas.RegistoParagem == 1:
+                        estatisticas.Paragens.append("0")
+                        estatisticas.RegistoParagem = 0
                     else:
-                        self.Paragens.append("null")
+                        estatisticas.Paragens.append("null")
                     
-                    # Limitar tamanho das listas para evitar uso excessivo de memória
+                    # Limitar tamanho das listas para evitar uso excessivo de memória. As
+                    # amostras antigas saem da própria lista (sem copiar as restantes para uma
+                    # lista nova em cada ciclo); quem lê as séries fá-lo com o lock adquirido
                     max_list_size = 1000
-                    if len(self.EstatisticaGFA) > max_list_size:
-                        self.EstatisticaGFA = self.EstatisticaGFA[-max_list_size:]
-                    if len(self.EstatisticaGFAMedia) > max_list_size:
-                        self.EstatisticaGFAMedia = self.EstatisticaGFAMedia[-max_list_size:]
-                    if len(self.EstatisticaTempo) > max_list_size:
-                        self.EstatisticaTempo = self.EstatisticaTempo[-max_list_size:]
-                    if len(self.EstatisticaCadenciaArtigo) > max_list_size:
-                        self.EstatisticaCadenciaArtigo = self.EstatisticaCadenciaArtigo[-max_list_size:]
-                    if len(self.Paragens) > max_list_size:
-                        self.Paragens = self.Paragens[-max_list_size:]
+                    if len(estatisticas.EstatisticaSeq) > max_list_size:
+                        estatisticas.seq_removido = estatisticas.EstatisticaSeq[-max_list_size - 1]
+                    if len(estatisticas.EstatisticaNs) > max_list_size:
+                        estatisticas.completo_desde = estatisticas.EstatisticaNs[-max_list_size]
+                    for serie in (estatisticas.EstatisticaGFA, estatisticas.EstatisticaGFAMedia, estatisticas.EstatisticaNs,
+                                  estatisticas.EstatisticaCadenciaArtigo, estatisticas.Paragens, estatisticas.EstatisticaSeq):
+                        if len(serie) > max_list_size:
+                            del serie[:-max_list_size]
+                    serie_gfa = list(estatisticas.EstatisticaGFA)
+                
+                # Atualizar OEE e rollups da ordem, turno e hora (agrupados por hora e turno do calendário)
+                momento = datetime_de_ns(instante)
+                self.oee.registar(
+                    momento, intervalo, diff, float(ordem.CadenciaArtigoEmContagem or 0),
+                    ordem.Quebras, ordem.Ordem, ordem.IdBDOrdemProducao,
+                )
+                self.rollups.registar(momento, intervalo, diff, gfa, ordem.Quebras, ordem.Ordem, ordem.IdBDOrdemProducao)
+                
+                # Previsão de fecho: o objetivo inclui as quebras, como em _contar_garrafa
+                self.previsao.atualizar(momento, ordem.ContagemTotal + ordem.Quebras - contagem_final, serie_gfa)
                 
-                # Gravar na BD se necessário
-                if self.IdBDOrdemProducao > 0:
-                    threading.Thread(
-                        target=gravar_contagem,
-                        args=(self.IdBDOrdemProducao, contagem_final)
-                    ).start()
+                # Enviar ao agregador, ou gravar na BD se necessário (na thread de escrita da linha)
+                if cliente_agregador is not None:
+                    cliente_agregador.registar_amostra(self, contagem_final, diff, gfa, ordem)
+                elif ordem.IdBDOrdemProducao > 0:
+                    self.escritor.submeter(gravar_contagem, ordem.IdBDOrdemProducao, contagem_final, self)
+                    if self.oee.pendentes:
+                        self.escritor.submeter(gravar_oee_horario, self)
+                    if self.rollups.lote_pronto():
+                        self.escritor.submeter(gravar_rollups, self)
             
-            # Verificar se precisa finalizar registo na BD
-            elif self.EstadoContador == 0 and self.GravarDados == 1:
-                self.finalizar_registo_bd()
+            else:
+                # Fora de contagem: o próximo ciclo volta a ser de referência e não há previsão
+                self._tempo_ultimo_ciclo = None
+                self.previsao.atual = PrevisaoFecho.vazia()
+                
+                # Pausa fora das janelas do calendário: paragem não planeada no OEE
+                agora = relogio.monotonico()
+                if self.EstadoContador == 2:
+                    momento = relogio.agora()
+                    if self._tempo_ultima_pausa is not None and calendario.em_pausa(momento) is None:
+                        ordem = self.metadados
+                        self.oee.registar(
+                            momento, agora - self._tempo_ultima_pausa, 0, float(ordem.CadenciaArtigoEmContagem or 0),
+                            ordem.Quebras, ordem.Ordem, ordem.IdBDOrdemProducao,
+                        )
+                    self._tempo_ultima_pausa = agora
+                else:
+                    self._tempo_ultima_pausa = None
+                
+                # Fecho na BD que falhou: voltar a tentar
+                if self.estado == ESTADO_A_FINALIZAR:
+                    with self._state_lock:
+                        self._agendar_finalizacao()
                 
         except Exception as e:
             logging.error(f"Erro ao atualizar estatísticas: {e}")
@@ -472,327 +2202,739 @@ class Contador:
             with self._state_lock:
                 self._save_state()
     
-    def finalizar_registo_bd(self):
-        """Finaliza o registo na base de dados quando a contagem termina"""
+    def finalizar_registo_bd(self, fecho=None):
+        """
+        Finaliza o registo na base de dados quando a contagem termina.
+        
+        Idempotente: o UPDATE só altera a ordem enquanto está ativa, por isso repetir
+        o mesmo fecho (ex.: nova tentativa depois de um erro de rede em que o commit
+        chegou a ser feito) não altera nada. Com sucesso, a linha passa a livre.
+        """
+        if fecho is None:
+            with self._state_lock:
+                fecho = {
+                    "Id": self.IdBDOrdemProducao, "Ordem": self.Ordem, "Contagem": self.ContagemAtual,
+                    "Quebras": self.Quebras, "Media": media_producao(self),
+                    "Inicio": self.TempoInicio, "Fim": self.TempoFim,
+                }
         try:
-            self.GravarDados = 0
-            
-            conn = get_db_connection(self.DB_Server, self.DB_User, self.DB_Password, self.DB_DB)
-            cursor = conn.cursor()
-            
-            # Garantir que os valores são tipos básicos do Python antes de enviar à base de dados
-            media_valor = float(media_producao()) if hasattr(media_producao(), "__float__") else 0
-            
-            cursor.execute(
-                """
-                UPDATE krones_contadoreslinha
-                SET
-                    Ativo = 0,
-                    QuantidadeFinal = %s,
-                    Quebras = %s,
-                    MediaProducao = %s,
-                    Abertura = %s,
-                    Fecho = %s
-                WHERE
-                    Ativo = 1 AND
-                    Ordem = %s AND
-                    Id = %s
-                """,
-                (
-                    int(self.ContagemAtual),
-                    int(self.Quebras),
-                    int(media_valor),
-                    self.TempoInicio,
-                    self.TempoFim,
-                    self.Ordem,
-                    int(self.IdBDOrdemProducao),
+            if int(fecho["Id"]) > 0:
+                conn = get_db_connection(self.DB_Server, self.DB_User, self.DB_Password, self.DB_DB)
+                cursor = conn.cursor()
+                
+                # Garantir que os valores são tipos básicos do Python antes de enviar à base de dados
+                media = fecho["Media"]
+                media_valor = float(media) if hasattr(media, "__float__") else 0
+                
+                cursor.execute(
+                    """
+                    UPDATE krones_contadoreslinha
+                    SET
+                        Ativo = 0,
+                        QuantidadeFinal = %s,
+                        Quebras = %s,
+                        MediaProducao = %s,
+                        Abertura = %s,
+                        Fecho = %s
+                    WHERE
+                        Ativo = 1 AND
+                        Ordem = %s AND
+                        Id = %s
+                    """,
+                    (
+                        int(fecho["Contagem"]),
+                        int(fecho["Quebras"]),
+                        int(media_valor),
+                        fecho["Inicio"],
+                        fecho["Fim"],
+                        fecho["Ordem"],
+                        int(fecho["Id"]),
+                    )
                 )
-            )
-            
-            conn.commit()
-            conn.close()
+                
+                conn.commit()
+                conn.close()
             
-            # Retirar configuração
+            # Retirar configuração, se a linha ainda está à espera deste fecho
             with self._state_lock:
-                self.ContadorConfigurado = 0
-                self._save_state()
+                if self.estado == ESTADO_A_FINALIZAR and self.IdBDOrdemProducao == fecho["Id"]:
+                    self.transicao("finalizada", origem="bd")
             
-            logging.info(f"Finalizada ordem {self.Ordem} na BD")
+            logging.info(f"Linha {self.linha_id}: finalizada ordem {fecho['Ordem']} na BD")
             
         except Exception as e:
             logging.error(f"Erro ao finalizar ordem na BD: {e}")
+            # Libertar a chave para a update_stats voltar a tentar
+            with self._state_lock:
+                if self._finalizacao_agendada == fecho["Id"]:
+                    self._finalizacao_agendada = None
     
-    def pause_count(self):
-        """Pausa a contagem com proteção de estado"""
-        with self._state_lock:
-            if self.EstadoContador == 1: 
-                self.EstadoContador = 2  # Pausa
-                self.EstadoPausa = True
-                logging.info("Contagem pausada com sucesso")
-                self._save_state()  # Salvar o estado atual
-                
-                # Fechar a porta quando pausar
-                try:
-                    GPIO.output(self.DOOR_PIN, GPIO.LOW)
-                    self.EstadoPorta = 0
-                    logging.info("Porta fechada durante pausa")
-                except Exception as e:
-                    logging.error(f"Erro ao fechar porta durante pausa: {e}")
-                    # Tentar recuperar
-                    try:
-                        GPIO.setup(self.DOOR_PIN, GPIO.OUT)
-                        GPIO.output(self.DOOR_PIN, GPIO.LOW)
-                        self.EstadoPorta = 0
-                        logging.info("Recuperação de porta durante pausa bem-sucedida")
-                    except Exception as e2:
-                        logging.error(f"Falha na recuperação de porta durante pausa: {e2}")
-                
-                return True
-            else:
-                logging.info("Não é possível pausar: contador não está em modo de contagem")
-                return False
-
-    def resume_count(self):
-        """Retoma a contagem que foi pausada"""
-        with self._state_lock:
-            if self.EstadoContador == 2:  # Só retoma se estiver pausado
-                self.EstadoContador = 1  # Contagem
-                self.EstadoPausa = False
-                logging.info("Contagem retomada com sucesso")
-                self._save_state()  # Salvar o estado atual
-                
-                # Abrir a porta
-                try:
-                    GPIO.output(self.DOOR_PIN, GPIO.HIGH)
-                    self.EstadoPorta = 1
-                except Exception as e:
-                    logging.error(f"Erro ao abrir porta durante retomada: {e}")
-                    # Tentar recuperar
-                    try:
-                        GPIO.setup(self.DOOR_PIN, GPIO.OUT)
-                        GPIO.output(self.DOOR_PIN, GPIO.HIGH)
-                        self.EstadoPorta = 1
-                    except Exception as e2:
-                        logging.error(f"Falha na recuperação de porta: {e2}")
-                
-                return True
-            else:
-                logging.info("Não é possível retomar: contador não está pausado")
-                return False
-
-# Instância do contador
-contador = Contador()
+    def pause_count(self, origem="api"):
+        """Pausa a contagem (e fecha a porta); False se não está em contagem"""
+        if self.estado != ESTADO_EM_CONTAGEM or not self.transicao("pausar", origem):
+            logging.info("Não é possível pausar: contador não está em modo de contagem")
+            return False
+        logging.info("Contagem pausada com sucesso")
+        return True
 
-# Variável global para controle de threads
-thread_running = True  # Flag para controle de threads
+    def resume_count(self, origem="api"):
+        """Retoma a contagem que foi pausada (e abre a porta); False se não está pausada"""
+        if self.estado != ESTADO_PAUSADA or not self.transicao("retomar", origem):
+            logging.info("Não é possível retomar: contador não está pausado")
+            return False
+        logging.info("Contagem retomada com sucesso")
+        return True
 
-# Tratamento de sinais para encerramento gracioso
-def signal_handler(sig, frame):
-    """Manipulador de sinais para encerramento seguro"""
-    global contador, thread_running
+class RegistoLinhas:
+    """Registo das linhas de enchimento geridas por este processo"""
+    def __init__(self):
+        self._linhas = {}
+        self._todas = ()  # Tuplo imutável lido pelo motor de captura sem lock
+        self._lock = threading.Lock()
     
-    logging.info(f"Sinal {sig} recebido, preparando para desligar...")
+    def adicionar(self, contador):
+        with self._lock:
+            if contador.linha_id in self._linhas:
+                raise ValueError(f"Linha duplicada: {contador.linha_id}")
+            self._linhas[contador.linha_id] = contador
+            self._todas = tuple(self._linhas.values())
+        logging.info(f"Linha {contador.linha_id} registada (sensor={contador.SENSOR_PIN}, porta={contador.DOOR_PIN})")
     
-    # Parar threads
-    thread_running = False
-    time.sleep(1)  # Dar tempo para as threads terminarem
+    def obter(self, linha_id):
+        return self._linhas.get(str(linha_id))
     
-    # Garantir que portas estão em estado seguro
-    try:
-        GPIO.output(contador.DOOR_PIN, GPIO.LOW)
-        GPIO.output(contador.SENSOR_PIN, GPIO.LOW)
-    except Exception as e:
-        logging.error(f"Erro ao definir pinos como LOW: {e}")
+    def padrao(self):
+        """A primeira linha configurada, usada pelas rotas sem prefixo /linha/<id>"""
+        return self._todas[0]
     
-    # Salvar estado atual
-    try:
-        contador._save_state()
-        logging.info("Estado salvo com sucesso")
-    except Exception as e:
-        logging.error(f"Erro ao salvar estado: {e}")
+    def todas(self):
+        return self._todas
     
-    # Limpar GPIO
-    try:
-        GPIO.cleanup()
-        logging.info("GPIO limpo com sucesso")
-    except Exception as e:
-        logging.error(f"Erro ao limpar GPIO: {e}")
+    def __len__(self):
+        return len(self._todas)
     
-    # Encerrar programa
-    logging.info("Programa encerrado de forma limpa")
-    sys.exit(0)
+    @classmethod
+    def a_partir_config(cls, config):
+        registo = cls()
+        for i, linha in enumerate(config["linhas"]):
+            linha_id = str(linha["id"])
+            # A primeira linha mantém o ficheiro de estado original (compatível com o update.sh)
+            ficheiro = "contador_state.backup" if i == 0 else f"contador_state_{linha_id}.backup"
+            registo.adicionar(Contador(
+                linha_id=linha_id,
+                sensor_pin=int(linha["sensor_pin"]),
+                door_pin=int(linha["door_pin"]),
+                ficheiro_estado=linha.get("ficheiro_estado", ficheiro),
+                aviso_pin=int(linha["aviso_pin"]) if linha.get("aviso_pin") is not None else None,
+            ))
+        return registo
 
-signal.signal(signal.SIGINT, signal_handler)
-signal.signal(signal.SIGTERM, signal_handler)
+# Linhas de enchimento geridas por este processo (nenhuma em modo agregador)
+linhas = RegistoLinhas() if MODO_AGREGADOR else RegistoLinhas.a_partir_config(CONFIG)
 
-# Funções de controle da porta com proteção de exceções
-@log_exceptions
-def open_door():
-    """Abre a porta com proteção contra falhas"""
-    try:
-        if contador.EstadoPorta == 0:
-            GPIO.output(contador.DOOR_PIN, GPIO.HIGH)
-            contador.EstadoPorta = 1
-            logging.info("Porta aberta")
-            return True
-        return False
-    except Exception as e:
-        logging.error(f"Erro ao abrir porta: {str(e)}")
-        # Tentativa de recuperação
-        try:
-            GPIO.setup(contador.DOOR_PIN, GPIO.OUT)
-            GPIO.output(contador.DOOR_PIN, GPIO.HIGH)
-            contador.EstadoPorta = 1
-            logging.info("Recuperação de porta bem-sucedida")
-            return True
-        except Exception as e2:
-            logging.error(f"Falha na recuperação de porta: {str(e2)}")
-            return False
+# Instância do contador da linha por omissão (rotas sem prefixo)
+contador = linhas.padrao() if len(linhas) else None
 
-@log_exceptions
-def close_door():
-    """Fecha a porta com proteção contra falhas"""
+def contador_pedido():
+    """Devolve o contador da linha do pedido HTTP atual, ou o da linha por omissão"""
+    if has_request_context():
+        contador_linha = g.get("contador")
+        if contador_linha is not None:
+            return contador_linha
+    return linhas.padrao()
+
+@bp.url_value_preprocessor
+def extrair_linha(endpoint, values):
+    """Resolve o prefixo /linha/<linha_id> para o contador correspondente"""
+    if values and "linha_id" in values:
+        linha_id = values.pop("linha_id")
+        g.linha_id = linha_id
+        g.contador = linhas.obter(linha_id)
+
+@bp.after_request
+def marcar_bd_desatualizada(resposta):
+    """Respostas construídas com leituras em cache por a BD estar em falha"""
+    if g.get("bd_desatualizada"):
+        resposta.headers["X-BD-Desatualizada"] = "1"
+    return resposta
+
+@bp.before_request
+def validar_linha():
+    if "linha_id" in g and g.get("contador") is None:
+        return jsonify({"status": "Erro", "mensagem": f"Linha desconhecida: {g.linha_id}"}), 404
+
+# Variável global para controle de threads
+thread_running = True  # Flag para controle de threads
+evento_encerrar = threading.Event()  # Acorda as threads que dormem até uma hora marcada
+
+def sd_notify(mensagem):
+    """
+    Envia uma notificação ao systemd (protocolo sd_notify), sem dependências externas.
+    
+    Sem NOTIFY_SOCKET (fora do systemd ou com Type=simple) não faz nada.
+    """
+    endereco = os.environ.get("NOTIFY_SOCKET")
+    if not endereco:
+        return False
+    if endereco.startswith("@"):
+        endereco = "\0" + endereco[1:]  # Socket no espaço de nomes abstrato
     try:
-        if contador.EstadoPorta == 1:
-            GPIO.output(contador.DOOR_PIN, GPIO.LOW)
-            contador.EstadoPorta = 0
-            logging.info("Porta fechada")
-            return True
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as s:
+            s.connect(endereco)
+            s.sendall(mensagem.encode())
+        return True
+    except OSError as e:
+        logging.warning(f"Falha ao notificar o systemd ({mensagem.split('=')[0]}): {e}")
         return False
-    except Exception as e:
-        logging.error(f"Erro ao fechar porta: {str(e)}")
-        # Tentativa de recuperação
-        try:
-            GPIO.setup(contador.DOOR_PIN, GPIO.OUT)
-            GPIO.output(contador.DOOR_PIN, GPIO.LOW)
-            contador.EstadoPorta = 0
-            logging.info("Recuperação de porta bem-sucedida")
-            return True
-        except Exception as e2:
-            logging.error(f"Falha na recuperação de porta: {str(e2)}")
-            return False
 
-@log_exceptions
-def reset_stats():
-    """Reset aos dados estatísticos com proteção de thread"""
-    with contador._state_lock:
-        contador.TempoInicio = ""
-        contador.TempoFim = ""
-        contador.EstatisticaGFANominal = 0
-        contador.EstatisticaGFA = []
-        contador.EstatisticaGFAMedia = []
-        contador.EstatisticaTempo = []
-        contador.EstatisticaCadenciaArtigo = []
-        contador.RegistoParagem = 0
-        contador.Paragens = []
+class Supervisor:
+    """
+    Supervisor das threads de trabalho.
     
-    logging.info("Estatísticas repostas")
-
-@log_exceptions
-def reset_counter():
-    """Reset completo do contador com proteção de thread"""
-    with contador._state_lock:
-        contador.ArtigoEmContagem = "NA"
-        contador.DescricaoArtigoEmContagem = "NA"
-        contador.CadenciaArtigoEmContagem = 6000
-        contador.ContagemAtual = 0
-        contador.ContagemTotal = 0
-        contador.Quebras = 0
-        contador.EstadoContador = 0
-        contador.EstadoPorta = 0
-        contador.Ordem = "NA"
-        contador.input_state = 0
-        contador.IdBDOrdemProducao = 0
-        contador.ContadorConfigurado = 0
-        contador.Flop = False
+    Cada thread registada dá sinal de vida com batimento(nome) em cada iteração do
+    seu ciclo. A thread de supervisão verifica, a cada segundo, se alguma terminou
+    ou deixou de dar sinal de vida e volta a arrancá-la com backoff exponencial.
+    Verifica também os escritores de BD e envia os pings ao watchdog do systemd
+    enquanto as threads críticas estiverem a funcionar.
+    """
+    def __init__(self, backoff_inicial=1, backoff_maximo=60, max_falhas=5, periodo_estavel=60):
+        self.backoff_inicial = backoff_inicial
+        self.backoff_maximo = backoff_maximo
+        self.max_falhas = max_falhas            # Falhas seguidas até desistir do watchdog
+        self.periodo_estavel = periodo_estavel  # Segundos a funcionar até esquecer as falhas
+        self._lock = threading.Lock()
+        self._trabalhadores = {}
+        self._thread = None
+        self._acordar = threading.Event()  # Uma thread terminou: verificar já
         
-        reset_stats()
-        contador._save_state()
+        # Watchdog do systemd (WatchdogSec= no serviço): ping a metade do intervalo
+        watchdog_usec = os.environ.get("WATCHDOG_USEC")
+        watchdog_pid = os.environ.get("WATCHDOG_PID")
+        self.watchdog_intervalo = None
+        if watchdog_usec and (not watchdog_pid or int(watchdog_pid) == os.getpid()):
+            self.watchdog_intervalo = int(watchdog_usec) / 1e6 / 2
+        self._ultimo_ping = 0
+        self.pings = 0
     
-    # Garantir porta fechada
-    close_door()
-    logging.info("Contador completamente reposto")
-
-# Endpoints da API com proteção de exceções
-@app.route("/abrir-porta", methods=["GET"])
-@log_exceptions
-def abrir_porta():
+    def registar(self, nome, alvo, limite_batimento=None, critica=False):
+        """
+        Regista uma thread de trabalho (ainda sem a arrancar).
+        
+        Args:
+            limite_batimento: segundos sem batimento até a thread ser considerada
+                bloqueada (None: verifica-se apenas se está viva)
+            critica: sem ela o processo não serve para nada; se falhar seguidamente
+                o watchdog deixa de receber pings e o systemd reinicia o serviço
+        """
+        with self._lock:
+            self._trabalhadores[nome] = {
+                "alvo": alvo,
+                "limite": limite_batimento,
+                "critica": critica,
+                "thread": None,
+                "batimento": None,
+                "inicio": None,
+                "reinicios": 0,
+                "falhas_seguidas": 0,
+                "ultima_falha": None,
+                "erro": None,
+                "proxima_tentativa": None,
+            }
+    
+    def iniciar(self, nome):
+        """Arranca (ou volta a arrancar) a thread registada com este nome"""
+        with self._lock:
+            trabalhador = self._trabalhadores[nome]
+            thread = threading.Thread(target=self._executar, args=(nome, trabalhador), daemon=True, name=nome)
+            trabalhador["thread"] = thread
+            trabalhador["erro"] = None
+            trabalhador["batimento"] = trabalhador["inicio"] = time.monotonic()
+            trabalhador["proxima_tentativa"] = None
+        thread.start()
+        logging.info(f"Thread {nome} iniciada")
+    
+    def _executar(self, nome, trabalhador):
+        """Corre a thread registada, guardando a exceção que a terminar"""
+        try:
+            trabalhador["alvo"]()
+        except BaseException as e:
+            trabalhador["erro"] = repr(e)
+            logging.error(f"Exceção não tratada na thread {nome}: {e!r}")
+            logging.error(traceback.format_exc())
+        finally:
+            self._acordar.set()
+    
+    def batimento(self, nome):
+        """
+        Sinal de vida da thread `nome`.
+        
+        Devolve False se a thread que chama já foi substituída (depois de ter ficado
+        bloqueada), para que termine o seu ciclo. Threads não registadas (ex.: nos
+        benchmarks) devolvem sempre True.
+        """
+        trabalhador = self._trabalhadores.get(nome)
+        if trabalhador is None:
+            return True
+        if trabalhador["thread"] is not threading.current_thread():
+            return trabalhador["thread"] is None
+        trabalhador["batimento"] = time.monotonic()
+        return True
+    
+    def verificar(self):
+        """
+        Deteta threads terminadas ou bloqueadas e reinicia-as quando o backoff o permitir.
+        
+        Returns:
+            Segundos até ao próximo reinício agendado (None se não houver nenhum)
+        """
+        if not thread_running:
+            return None
+        agora = time.monotonic()
+        reiniciar = []
+        proximo = None
+        with self._lock:
+            for nome, t in self._trabalhadores.items():
+                if t["thread"] is None:
+                    continue
+                if t["proxima_tentativa"] is None:
+                    if not t["thread"].is_alive():
+                        motivo = f"terminou ({t['erro']})" if t["erro"] else "terminou"
+                    elif t["limite"] is not None and agora - t["batimento"] > t["limite"]:
+                        motivo = f"sem sinal de vida há {agora - t['batimento']:.0f} s"
+                    else:
+                        if t["falhas_seguidas"] and agora - t["inicio"] > self.periodo_estavel:
+                            t["falhas_seguidas"] = 0
+                        continue
+                    
+                    espera = min(self.backoff_inicial * 2 ** t["falhas_seguidas"], self.backoff_maximo)
+                    t["falhas_seguidas"] += 1
+                    t["ultima_falha"] = {"Motivo": motivo, "Data": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+                    t["proxima_tentativa"] = agora + espera
+                    logging.error(f"Thread {nome} {motivo} - a reiniciar dentro de {espera:.1f} s "
+                                  f"(falha seguida n.º {t['falhas_seguidas']})")
+                if agora >= t["proxima_tentativa"]:
+                    t["reinicios"] += 1
+                    reiniciar.append(nome)
+                elif proximo is None or t["proxima_tentativa"] - agora < proximo:
+                    proximo = t["proxima_tentativa"] - agora
+        
+        for nome in reiniciar:
+            self.iniciar(nome)
+        
+        for escritor in list(EscritorBD.instancias):
+            escritor.verificar(CONFIG["escritor_limite_bloqueio"])
+        return proximo
+    
+    def aguardar(self, nome, timeout):
+        """Espera que a thread registada com este nome termine; True se terminou"""
+        trabalhador = self._trabalhadores.get(nome)
+        thread = trabalhador["thread"] if trabalhador else None
+        if thread is None or thread is threading.current_thread():
+            return True
+        thread.join(timeout)
+        return not thread.is_alive()
+    
+    def saudavel(self):
+        """False se alguma thread crítica falhou seguidamente max_falhas vezes"""
+        with self._lock:
+            return all(
+                t["falhas_seguidas"] < self.max_falhas
+                for t in self._trabalhadores.values() if t["critica"]
+            )
+    
+    def notificar_watchdog(self):
+        """Ping ao watchdog do systemd, só enquanto o processo estiver saudável"""
+        if self.watchdog_intervalo is None:
+            return
+        agora = time.monotonic()
+        if agora - self._ultimo_ping < self.watchdog_intervalo:
+            return
+        if not self.saudavel():
+            logging.critical("Thread crítica a falhar repetidamente - a suspender os pings ao watchdog")
+            return
+        if sd_notify("WATCHDOG=1"):
+            self._ultimo_ping = agora
+            self.pings += 1
+    
+    def thread_supervisao(self):
+        """Ciclo da thread de supervisão"""
+        logging.info(f"Supervisor iniciado ({len(self._trabalhadores)} thread(s), "
+                     f"watchdog {'a cada %.1f s' % self.watchdog_intervalo if self.watchdog_intervalo else 'desligado'})")
+        while thread_running:
+            proximo = None
+            try:
+                proximo = self.verificar()
+                self.notificar_watchdog()
+            except Exception as e:
+                logging.error(f"Erro no supervisor: {e}")
+                logging.error(traceback.format_exc())
+            # Acordar ao fim de um segundo, no próximo reinício agendado ou quando uma thread terminar
+            self._acordar.wait(1 if proximo is None else min(1, proximo))
+            self._acordar.clear()
+        logging.info("Supervisor finalizado")
+    
+    def arrancar(self):
+        """Arranca as threads registadas ainda não iniciadas e a thread de supervisão"""
+        for nome, trabalhador in list(self._trabalhadores.items()):
+            if trabalhador["thread"] is None:
+                self.iniciar(nome)
+        self._thread = threading.Thread(target=self.thread_supervisao, daemon=True, name="SupervisorThread")
+        self._thread.start()
+    
+    def estado(self):
+        """Saúde e contagem de reinícios de cada thread e escritor, para a API"""
+        agora = time.monotonic()
+        threads = []
+        with self._lock:
+            for nome, t in self._trabalhadores.items():
+                viva = t["thread"] is not None and t["thread"].is_alive()
+                if t["proxima_tentativa"] is not None:
+                    estado = "a aguardar reinício"
+                elif not viva:
+                    estado = "parada"
+                elif t["limite"] is not None and agora - t["batimento"] > t["limite"]:
+                    estado = "bloqueada"
+                else:
+                    estado = "ativa"
+                threads.append({
+                    "Nome": nome,
+                    "Estado": estado,
+                    "Critica": t["critica"],
+                    "UltimoBatimentoS": round(agora - t["batimento"], 3) if t["batimento"] is not None else None,
+                    "LimiteBatimentoS": t["limite"],
+                    "Reinicios": t["reinicios"],
+                    "FalhasSeguidas": t["falhas_seguidas"],
+                    "UltimaFalha": t["ultima_falha"],
+                    "ProximaTentativaS": round(t["proxima_tentativa"] - agora, 1) if t["proxima_tentativa"] is not None else None,
+                })
+        escritores = [{
+            "Nome": e.nome,
+            "Pendentes": e.pendentes(),
+            "OperacaoEmCursoS": round(e.bloqueado_ha(), 3),
+            "Reinicios": e.reinicios,
+        } for e in list(EscritorBD.instancias)]
+        return {
+            "Saudavel": self.saudavel(),
+            "Threads": threads,
+            "Escritores": escritores,
+            "Watchdog": {
+                "IntervaloPingS": self.watchdog_intervalo,
+                "Pings": self.pings,
+                "Supervisor": self._thread is not None and self._thread.is_alive(),
+            },
+        }
+
+supervisor = Supervisor(
+    backoff_maximo=CONFIG["supervisor_backoff_maximo"],
+    max_falhas=CONFIG["supervisor_max_falhas"],
+)
+
+# Tratamento de sinais para encerramento gracioso
+encerramento_em_curso = threading.Event()
+relatorio_encerramento = {}  # Duração (ms) de cada fase do último encerramento
+
+def encerrar(motivo, prazo_bd=None):
+    """
+    Encerramento coordenado e com prazo.
+    
+    Fases, cada uma cronometrada no log:
+      1. parar_threads: deixa de aceitar impulsos (a captura termina o ciclo em curso)
+         e para as estatísticas, as pausas e o supervisor
+      2. porta_segura: fecha fisicamente as portas (o EstadoPorta gravado fica igual,
+         para a recuperação reabrir a porta se a linha estava a contar)
+      3. checkpoint: grava a contagem final no checkpoint e força o diário para o disco
+      4. submeter_bd: agenda a última contagem e o fecho pendente de cada ordem
+      5. drenar_bd: espera pelos escritores de BD (e pelo último envio ao agregador)
+         até `prazo_bd` segundos; o que ficar por gravar é registado no log
+      6. gpio: liberta os pinos
+    
+    Returns:
+        False se já havia um encerramento em curso (ex.: SIGTERM repetido)
+    """
+    if encerramento_em_curso.is_set():
+        logging.warning(f"Encerramento já em curso - {motivo} ignorado")
+        return False
+    encerramento_em_curso.set()
+    prazo_bd = CONFIG["encerramento_prazo_bd"] if prazo_bd is None else prazo_bd
+    inicio = time.perf_counter()
+    fases = relatorio_encerramento
+    
+    def fase(nome, func):
+        t0 = time.perf_counter()
+        try:
+            func()
+        except Exception as e:
+            logging.error(f"Encerramento: erro na fase {nome}: {e}")
+            logging.error(traceback.format_exc())
+        fases[nome] = round((time.perf_counter() - t0) * 1000, 1)
+        logging.info(f"Encerramento: {nome} em {fases[nome]} ms")
+    
+    def parar_threads():
+        global thread_running
+        sd_notify("STOPPING=1")
+        # Com captura em processo, parar primeiro o processo: a ContadorThread aplica
+        # as últimas garrafas publicadas antes de terminar
+        if captura_processo is not None:
+            captura_processo.parar_processo()
+        thread_running = False
+        evento_encerrar.set()
+        evento_captura.set()
+        supervisor._acordar.set()
+        for nome in ("ContadorThread", "EstatísticasThread"):
+            if not supervisor.aguardar(nome, 1.0):
+                logging.warning(f"Encerramento: {nome} não terminou a tempo")
+    
+    def porta_segura():
+        for contador_linha in linhas.todas():
+            if contador_linha.door_initialized:
+                GPIO.output(contador_linha.DOOR_PIN, GPIO.LOW)
+    
+    def checkpoint():
+        for contador_linha in linhas.todas():
+            with contador_linha._contagem_lock:
+                contador_linha._save_state()
+                contador_linha.fechar_diario()
+            logging.info(f"Linha {contador_linha.linha_id}: contagem final {contador_linha.ContagemAtual} "
+                         f"gravada no checkpoint (ordem {contador_linha.Ordem})")
+    
+    def submeter_bd():
+        if cliente_agregador is not None:
+            return
+        for contador_linha in linhas.todas():
+            if contador_linha.estado == ESTADO_A_FINALIZAR:
+                with contador_linha._state_lock:
+                    contador_linha._agendar_finalizacao()  # Sem efeito se já está na fila
+            elif contador_linha.EstadoContador in (1, 2) and contador_linha.IdBDOrdemProducao > 0:
+                contador_linha.escritor.submeter(
+                    gravar_contagem, contador_linha.IdBDOrdemProducao, contador_linha.ContagemAtual, contador_linha
+                )
+                if contador_linha.oee.pendentes:
+                    contador_linha.escritor.submeter(gravar_oee_horario, contador_linha)
+                if contador_linha.rollups.pendentes:
+                    contador_linha.escritor.submeter(gravar_rollups, contador_linha)
+    
+    def drenar_bd():
+        limite = time.perf_counter() + prazo_bd
+        # Último envio ao agregador (cliente) ou última gravação das amostras recebidas (agregador)
+        final = None
+        if cliente_agregador is not None:
+            final = threading.Thread(target=cliente_agregador.enviar, daemon=True, name="EnvioFinalThread")
+        elif agregador is not None:
+            final = threading.Thread(target=agregador.gravar_pendentes, daemon=True, name="GravacaoFinalThread")
+        if final is not None:
+            final.start()
+            final.join(max(0, limite - time.perf_counter()))
+        
+        escritores = list(EscritorBD.instancias)
+        while time.perf_counter() < limite and any(e.fila.unfinished_tasks for e in escritores):
+            time.sleep(0.02)
+        por_gravar = sum(e.fila.unfinished_tasks for e in escritores)
+        fases["escritas_por_gravar"] = por_gravar
+        if por_gravar or (final is not None and final.is_alive()):
+            logging.error(f"Encerramento: prazo de {prazo_bd} s esgotado com {por_gravar} escrita(s) de BD por concluir "
+                          f"(as contagens ficam no checkpoint e no diário)")
+    
+    def libertar_gpio():
+        if captura_processo is not None:
+            captura_processo.libertar()
+        GPIO.cleanup()
+    
+    logging.info(f"Encerramento iniciado ({motivo})")
+    fase("parar_threads", parar_threads)
+    if not MODO_AGREGADOR:
+        fase("porta_segura", porta_segura)
+        fase("checkpoint", checkpoint)
+    fase("submeter_bd", submeter_bd)
+    fase("drenar_bd", drenar_bd)
+    if not MODO_AGREGADOR:
+        fase("gpio", libertar_gpio)
+    
+    fases["total"] = round((time.perf_counter() - inicio) * 1000, 1)
+    logging.info(f"Encerramento concluído em {fases['total']} ms: {json.dumps(fases)}")
+    return True
+
+def signal_handler(sig, frame):
+    """Manipulador de sinais para encerramento seguro"""
+    logging.info(f"Sinal {sig} recebido, preparando para desligar...")
+    if not encerrar(f"sinal {sig}"):
+        return  # Sinal repetido: o encerramento em curso continua
+    
+    # Encerrar programa
+    logging.info("Programa encerrado de forma limpa")
+    sys.exit(0)
+
+signal.signal(signal.SIGINT, signal_handler)
+signal.signal(signal.SIGTERM, signal_handler)
+
+# Funções de controle da porta com proteção de exceções
+@log_exceptions
+def open_door(contador=None):
+    """Abre a porta com proteção contra falhas"""
+    contador = contador or contador_pedido()
+    # O pino e EstadoPorta mudam juntos, sob o mesmo lock das transições da ordem
+    with contador._state_lock:
+        try:
+            if contador.EstadoPorta == 0:
+                GPIO.output(contador.DOOR_PIN, GPIO.HIGH)
+                contador.EstadoPorta = 1
+                logging.info("Porta aberta")
+                return True
+            return False
+        except Exception as e:
+            logging.error(f"Erro ao abrir porta: {str(e)}")
+            # Tentativa de recuperação
+            try:
+                GPIO.setup(contador.DOOR_PIN, GPIO.OUT)
+                GPIO.output(contador.DOOR_PIN, GPIO.HIGH)
+                contador.EstadoPorta = 1
+                logging.info("Recuperação de porta bem-sucedida")
+                return True
+            except Exception as e2:
+                logging.error(f"Falha na recuperação de porta: {str(e2)}")
+                return False
+
+@log_exceptions
+def close_door(contador=None):
+    """Fecha a porta com proteção contra falhas"""
+    contador = contador or contador_pedido()
+    with contador._state_lock:
+        try:
+            if contador.EstadoPorta == 1:
+                GPIO.output(contador.DOOR_PIN, GPIO.LOW)
+                contador.EstadoPorta = 0
+                logging.info("Porta fechada")
+                return True
+            return False
+        except Exception as e:
+            logging.error(f"Erro ao fechar porta: {str(e)}")
+            # Tentativa de recuperação
+            try:
+                GPIO.setup(contador.DOOR_PIN, GPIO.OUT)
+                GPIO.output(contador.DOOR_PIN, GPIO.LOW)
+                contador.EstadoPorta = 0
+                logging.info("Recuperação de porta bem-sucedida")
+                return True
+            except Exception as e2:
+                logging.error(f"Falha na recuperação de porta: {str(e2)}")
+                return False
+
+@log_exceptions
+def reset_stats(contador=None):
+    """Reset aos dados estatísticos com proteção de thread"""
+    contador = contador or contador_pedido()
+    contador.atualizar_ordem(InicioNs=0, FimNs=0)
+    contador.quente.terminar_pendente = None  # Um "terminar" do objetivo ainda na fila já não se aplica
+    # O próximo ciclo de estatísticas volta a ser de referência: sem isto, uma ordem iniciada
+    # antes de um ciclo fora de contagem começava com a diferença para a contagem anterior
+    contador._tempo_ultimo_ciclo = None
+    # Cursores anteriores deixam de ser válidos: os clientes recebem um snapshot completo
+    contador.estatisticas.limpar()
+    
+    # Nova ordem: a hora em curso da ordem anterior fica pendente para gravação
+    contador.oee.nova_ordem()
+    contador.rollups.fechar()
+    if cliente_agregador is None:
+        if contador.oee.pendentes:
+            contador.escritor.submeter(gravar_oee_horario, contador)
+        if contador.rollups.pendentes:
+            contador.escritor.submeter(gravar_rollups, contador)
+    
+    logging.info("Estatísticas repostas")
+
+@log_exceptions
+def reset_counter(contador=None):
+    """Reset completo do contador com proteção de thread"""
+    contador = contador or contador_pedido()
+    with contador._contagem_lock, contador._state_lock:
+        contador.transicao("repor")
+        contador.metadados = METADADOS_VAZIOS
+        # Linha já fora de contagem: a captura deixou de mexer no estado quente
+        contador.quente.contagem = 0
+        contador.quente.flop = False
+        contador.EstadoPorta = 0
+        contador.input_state = 0
+        
+        reset_stats(contador)
+        contador._save_state()
+    
+    # Garantir porta fechada
+    close_door(contador)
+    logging.info("Contador completamente reposto")
+
+# Endpoints da API com proteção de exceções
+@bp.route("/abrir-porta", methods=["GET"])
+@log_exceptions
+def abrir_porta():
     open_door()
     return jsonify({"status": "OK"}), 200
 
-@app.route("/fechar-porta", methods=["GET"])
+@bp.route("/fechar-porta", methods=["GET"])
 @log_exceptions
 def fechar_porta():
     close_door()
     return jsonify({"status": "OK"}), 200
 
-@app.route("/iniciar-contagem", methods=["GET"])
+@bp.route("/iniciar-contagem", methods=["GET"])
 @log_exceptions
 def iniciar_contagem():
-    with contador._state_lock:
-        reset_stats()
-        contador.TempoInicio = datetime.now().replace(microsecond=0).strftime("%Y-%m-%d %H:%M:%S")
-        contador.EstadoContador = 1
-        contador._save_state()
+    contador = contador_pedido()
+    if not contador.transicao("iniciar"):
+        return jsonify({"status": "Erro", "mensagem": f"Não é possível iniciar a contagem no estado {contador.estado}"}), 400
     
-    open_door()
     logging.info("Contagem iniciada")
     return jsonify({"status": "OK"}), 200
 
-@app.route("/parar-contagem", methods=["GET"])
+@bp.route("/parar-contagem", methods=["GET"])
 @log_exceptions
 def parar_contagem():
-    close_door()
-    
-    with contador._state_lock:
-        contador.TempoFim = datetime.now().replace(microsecond=0).strftime("%Y-%m-%d %H:%M:%S")
-        contador.EstadoContador = 0
-        contador.ContadorConfigurado = 0
-        contador.GravarDados = 1
-        contador._save_state()
+    contador = contador_pedido()
+    # O fecho da ordem na BD é agendado já, na thread de escrita da linha
+    if not contador.transicao("terminar"):
+        return jsonify({"status": "Erro", "mensagem": f"Não é possível parar a contagem no estado {contador.estado}"}), 400
     
     logging.info("Contagem parada")
     return jsonify({"status": "OK"}), 200
 
-@app.route('/pausa', methods=['GET'])
+@bp.route('/pausa', methods=['GET'])
 def pausar_contagem():
     """
     Pausa a contagem atual
     """
+    contador = contador_pedido()
     logging.info("Solicitação para pausar contagem recebida")
     try:
-        with contador._state_lock:
-            if contador.pause_count():
-                # O método pause_count já se encarrega de fechar a porta
-                return jsonify({"status": "success", "message": "Contagem pausada com sucesso e porta fechada"}), 200
-            else:
-                return jsonify({"status": "error", "message": "Não foi possível pausar a contagem. Verifique se a contagem está em andamento."}), 400
+        if contador.pause_count():
+            # O método pause_count já se encarrega de fechar a porta
+            return jsonify({"status": "success", "message": "Contagem pausada com sucesso e porta fechada"}), 200
+        else:
+            return jsonify({"status": "error", "message": "Não foi possível pausar a contagem. Verifique se a contagem está em andamento."}), 400
     except Exception as e:
         logging.error(f"Erro ao pausar contagem: {str(e)}")
         return jsonify({"status": "error", "message": f"Erro ao pausar contagem: {str(e)}"}), 500
 
-@app.route("/retomar", methods=["GET"])
+@bp.route("/retomar", methods=["GET"])
 def retomar_contagem():
     """
     Retoma a contagem que foi pausada
     """
+    contador = contador_pedido()
     logging.info("Solicitação para retomar contagem recebida")
     try:
-        with contador._state_lock:
-            if contador.resume_count():
-                return jsonify({"status": "success", "message": "Contagem retomada com sucesso"}), 200
-            else:
-                return jsonify({"status": "error", "message": "Não foi possível retomar a contagem. Verifique se a contagem está pausada."}), 400
+        if contador.resume_count():
+            return jsonify({"status": "success", "message": "Contagem retomada com sucesso"}), 200
+        else:
+            return jsonify({"status": "error", "message": "Não foi possível retomar a contagem. Verifique se a contagem está pausada."}), 400
     except Exception as e:
         logging.error(f"Erro ao retomar contagem: {str(e)}")
         return jsonify({"status": "error", "message": f"Erro ao retomar contagem: {str(e)}"}), 500
 
-@app.route("/quebra/<int:valor>", methods=["GET"])
+@bp.route("/quebra/<int:valor>", methods=["GET"])
 @log_exceptions
 def quebra(valor):
+    contador = contador_pedido()
     try:
         if contador.EstadoContador == 1:
-            with contador._contagem_lock:
+            with contador._state_lock:
                 contador.Quebras += valor
                 contador._save_state()
             
@@ -805,20 +2947,33 @@ def quebra(valor):
         return jsonify({"status": "Erro", "mensagem": str(e)}), 500
 # Confirmar se na base de dados está OK para gravar. BETA
 @log_exceptions
-def validate_active_orders():
+def validate_active_orders(contador=None):
     """Confirma se na base de dados está OK para gravar"""
+    contador = contador or contador_pedido()
     try:
         conn = get_db_connection(contador.DB_Server, contador.DB_User, contador.DB_Password, contador.DB_DB)
         cursor = conn.cursor()
         
-        cursor.execute(
-            """
-            IF EXISTS (SELECT Id FROM krones_contadoreslinha WHERE Ativo = 1)
-                SELECT COUNT(Id) AS Id FROM krones_contadoreslinha WHERE Ativo = 1
-            ELSE
-                SELECT '-1' AS Id
-            """
-        )
+        if len(linhas) > 1:
+            # Com várias linhas na mesma BD, só interessa a última ordem desta linha
+            cursor.execute(
+                """
+                IF EXISTS (SELECT Id FROM krones_contadoreslinha WHERE Ativo = 1 AND Id = %s)
+                    SELECT COUNT(Id) AS Id FROM krones_contadoreslinha WHERE Ativo = 1 AND Id = %s
+                ELSE
+                    SELECT '-1' AS Id
+                """,
+                (int(contador.IdBDOrdemProducao), int(contador.IdBDOrdemProducao))
+            )
+        else:
+            cursor.execute(
+                """
+                IF EXISTS (SELECT Id FROM krones_contadoreslinha WHERE Ativo = 1)
+                    SELECT COUNT(Id) AS Id FROM krones_contadoreslinha WHERE Ativo = 1
+                ELSE
+                    SELECT '-1' AS Id
+                """
+            )
         
         row = cursor.fetchone()
         conn.close()
@@ -829,10 +2984,11 @@ def validate_active_orders():
         return -1
 
 @log_exceptions
-def media_producao():
+def media_producao(contador=None):
     """Calcula média de produção com proteção contra lista vazia"""
+    contador = contador or contador_pedido()
     try:
-        with contador._state_lock:
+        with contador.estatisticas.lock:
             if not contador.EstatisticaGFA or len(contador.EstatisticaGFA) == 0:
                 return 0
                 
@@ -851,22 +3007,28 @@ def media_producao():
         logging.error(f"Erro ao calcular média de produção: {e}")
         return 0
 
-@app.route("/setup/<string:ordem>/<int:cnt>", methods=["GET"])
+@bp.route("/setup/<string:ordem>/<int:cnt>", methods=["GET"])
 @log_exceptions
 def setup_contagem(ordem, cnt):
     """Configura uma nova contagem com validação robusta e proteção contra falhas"""
+    contador = contador_pedido()
     try:
         # Verificações iniciais
+        if contador.estado == ESTADO_A_FINALIZAR:
+            logging.info("O contador está a registar, por favor aguarde.")
+            return jsonify({"message": "O contador está a registar, por favor aguarde."}), 400
+        
         if contador.ContadorConfigurado == 1:
             logging.info("Contador já configurado")
             return jsonify({"message": "Contador já configurado"}), 400
-
-        if contador.EstadoContador != 0:
-            logging.info("O contador não está parado!")
-            return jsonify({"message": "Contador não está parado"}), 400
+        
+        # BD em falha (disjuntor aberto): responder já, sem reservar a linha
+        indisponivel = resposta_bd_indisponivel(contador)
+        if indisponivel is not None:
+            return indisponivel
 
         # Validar ordens ativas
-        active_orders = validate_active_orders()
+        active_orders = validate_active_orders(contador)
         if active_orders == 1:
             logging.info("O contador está a registar, por favor aguarde.")
             return jsonify({"message": "O contador está a registar, por favor aguarde."}), 400
@@ -874,17 +3036,15 @@ def setup_contagem(ordem, cnt):
             logging.error("Erro ao validar ordens ativas")
             return jsonify({"message": "Erro ao validar ordens ativas"}), 500
 
-        # Se passou nas verificações, pode configurar
-        if contador.EstadoContador == 0 and contador.ContadorConfigurado == 0:
+        # Se passou nas verificações, pode configurar (a transição reserva a linha,
+        # por isso um segundo pedido simultâneo já não passa daqui)
+        if contador.transicao("configurar", repetido_ok=False):
             # Reset às estatísticas
-            reset_stats()
+            reset_stats(contador)
             
-            with contador._state_lock:
-                contador.ContadorConfigurado = 1
-                contador.ContagemTotal = cnt
-                contador.Ordem = ordem
+            with contador._contagem_lock, contador._state_lock:
+                contador.atualizar_ordem(ContagemTotal=cnt, Ordem=ordem, IdBDOrdemProducao=0, Quebras=0)
                 contador.ContagemAtual = 0
-                contador.Quebras = 0
             
             # Obter informações do artigo na primeira BD
             try:
@@ -916,22 +3076,19 @@ def setup_contagem(ordem, cnt):
                 
                 # Atualizar dados do artigo
                 if row:
-                    with contador._state_lock:
-                        contador.ArtigoEmContagem = row[0]
-                        contador.DescricaoArtigoEmContagem = str(row[1])
-                        contador.CadenciaArtigoEmContagem = row[2]
+                    contador.atualizar_ordem(
+                        ArtigoEmContagem=row[0], DescricaoArtigoEmContagem=str(row[1]), CadenciaArtigoEmContagem=row[2],
+                    )
                 else:
                     logging.warning(f"Artigo não encontrado para ordem {ordem}")
-                    with contador._state_lock:
-                        contador.ArtigoEmContagem = "DESCONHECIDO"
-                        contador.DescricaoArtigoEmContagem = "Artigo não encontrado"
-                        contador.CadenciaArtigoEmContagem = 6000
+                    contador.atualizar_ordem(
+                        ArtigoEmContagem="DESCONHECIDO", DescricaoArtigoEmContagem="Artigo não encontrado", CadenciaArtigoEmContagem=6000,
+                    )
             except Exception as e:
                 logging.error(f"Erro ao obter dados do artigo: {e}")
-                with contador._state_lock:
-                    contador.ArtigoEmContagem = "ERRO"
-                    contador.DescricaoArtigoEmContagem = "Erro ao obter dados"
-                    contador.CadenciaArtigoEmContagem = 6000
+                contador.atualizar_ordem(
+                    ArtigoEmContagem="ERRO", DescricaoArtigoEmContagem="Erro ao obter dados", CadenciaArtigoEmContagem=6000,
+                )
             
             # Registar na BD SIP
             try:
@@ -947,7 +3104,7 @@ def setup_contagem(ordem, cnt):
                         (%s, %s, %s, %s, %s)
                     """,
                     (
-                        datetime.now().replace(microsecond=0).strftime("%Y-%m-%d %H:%M:%S"),
+                        formatar_ns(relogio.tempo_ns()),
                         1,
                         ordem,
                         cnt,
@@ -982,29 +3139,49 @@ def setup_contagem(ordem, cnt):
                 return jsonify({"message": f"Ordem {ordem} configurada com {cnt} garrafas totais"}), 200
             except Exception as e:
                 logging.error(f"Erro ao registar ordem na BD: {e}")
+                contador.transicao("cancelar")
                 return jsonify({"message": f"Erro ao registar ordem: {str(e)}"}), 500
+        else:
+            logging.info("Contador já configurado")
+            return jsonify({"message": "Contador já configurado"}), 400
     except Exception as e:
         logging.error(f"Erro ao configurar contagem: {e}")
         return jsonify({"message": f"Erro ao configurar contagem: {str(e)}"}), 500
 
-@app.route("/reset-contador", methods=["GET"])
+@bp.route("/reset-contador", methods=["GET"])
 @log_exceptions
 def reset_contador_endpoint():
     """Endpoint para repor o contador"""
+    contador = contador_pedido()
     try:
         if contador.EstadoContador == 0:
+            indisponivel = resposta_bd_indisponivel(contador)
+            if indisponivel is not None:
+                return indisponivel
+            
             # Marcar todas as ordens como inativas
             try:
                 conn = get_db_connection(contador.DB_Server, contador.DB_User, contador.DB_Password, contador.DB_DB)
                 cursor = conn.cursor()
                 
-                cursor.execute(
-                    """
-                    UPDATE krones_contadoreslinha
-                    SET Ativo = 0
-                    WHERE Ativo = 1
-                    """
-                )
+                if len(linhas) > 1:
+                    # Não desativar as ordens das outras linhas
+                    cursor.execute(
+                        """
+                        UPDATE krones_contadoreslinha
+                        SET Ativo = 0
+                        WHERE Ativo = 1 AND Id = %s
+                        """,
+                        (int(contador.IdBDOrdemProducao),)
+                    )
+                else:
+                    cursor.execute(
+                        """
+                        UPDATE krones_contadoreslinha
+                        SET Ativo = 0
+                        WHERE Ativo = 1
+                        """
+                    )
                 
                 conn.commit()
                 conn.close()
@@ -1021,135 +3198,808 @@ def reset_contador_endpoint():
         logging.error(f"Erro ao repor contador: {e}")
         return jsonify({"message": f"Erro ao repor contador: {str(e)}"}), 500
 
-@app.route("/status", methods=["GET"])
+# Formatos de resposta para /status e /api/info
+# - json (por omissão): séries como listas JSON, igual ao formato original
+# - msgpack: séries em colunas (tempos em delta de segundos, float32, máscara de paragens)
+# - colunar: o mesmo em binário próprio, sem dependências (ver README)
+SERIES_RESPOSTA = ("Nominal", "Media", "Cadencia")
+SERIES_STATUS = SERIES_RESPOSTA + ("Tempo", "Paragens")
+MIME_FORMATOS = {
+    "json": "application/json",
+    "msgpack": "application/x-msgpack",
+    "colunar": "application/vnd.krones.colunar",
+}
+TAMANHO_MINIMO_COMPRESSAO = 1024  # Bytes; abaixo disto não compensa comprimir
+
+def negociar_formato():
+    """Escolhe o formato pelo parâmetro ?formato= ou pelo cabeçalho Accept"""
+    formato = request.args.get("formato")
+    if formato in MIME_FORMATOS:
+        return formato if formato != "msgpack" or msgpack is not None else "json"
+    aceite = request.headers.get("Accept", "")
+    if MIME_FORMATOS["colunar"] in aceite:
+        return "colunar"
+    if MIME_FORMATOS["msgpack"] in aceite and msgpack is not None:
+        return "msgpack"
+    return "json"
+
+def negociar_compressao():
+    """Escolhe a compressão pelo cabeçalho Accept-Encoding (br se disponível, senão gzip)"""
+    aceite = request.headers.get("Accept-Encoding", "")
+    if "br" in aceite and brotli is not None:
+        return "br"
+    if "gzip" in aceite:
+        return "gzip"
+    return None
+
+def _segundos_tempos(dados):
+    """
+    Epoch (s) de cada ponto a partir dos textos da série Tempo, para respostas sem os
+    instantes originais (rollups, com a data completa, ou linhas antigas só com HH:MM:SS,
+    datadas a partir do início da ordem e contando as passagens da meia-noite)
+    """
+    tempos = dados.get("Tempo") or []
+    
+    # Data de referência para os tempos HH:MM:SS: o início da ordem, ou hoje
+    referencia = None
+    if dados.get("Inicio"):
+        try:
+            referencia = datetime.strptime(str(dados["Inicio"]), "%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            referencia = None
+    if referencia is None:
+        referencia = relogio.agora().replace(hour=0, minute=0, second=0, microsecond=0)
+    base_dia = int(referencia.replace(hour=0, minute=0, second=0).timestamp())
+    inicio_seg = referencia.hour * 3600 + referencia.minute * 60 + referencia.second
+    
+    segundos = []
+    dia = 0
+    anterior = None
+    for tempo_str in tempos:
+        try:
+            tempo_str = str(tempo_str)
+            if len(tempo_str) > 8:
+                # Data completa (rollups): não depende da data de referência
+                segundos.append(int(datetime.strptime(tempo_str, "%Y-%m-%d %H:%M:%S").timestamp()))
+                continue
+            hora, minuto, segundo = map(int, tempo_str.split(':'))
+            valor = hora * 3600 + minuto * 60 + segundo
+        except ValueError:
+            valor = anterior if anterior is not None else inicio_seg
+        if anterior is None and valor < inicio_seg:
+            dia = 1  # Primeiro ponto já depois da meia-noite
+        elif anterior is not None and valor < anterior:
+            dia += 1  # Passagem da meia-noite
+        anterior = valor
+        segundos.append(base_dia + dia * 86400 + valor)
+    return segundos
+
+def colunas_series(dados, tempos_ns=None):
+    """
+    Converte as séries da resposta em colunas compactas.
+    
+    `tempos_ns` são os instantes (epoch ns) dos pontos, quando a resposta vem de
+    amostras que os têm; sem eles os tempos são lidos dos textos da série Tempo.
+    
+    Returns:
+        Dicionário com n, t0 (epoch do primeiro ponto), dt (deltas em segundos),
+        colunas float32 em bytes e a máscara de paragens (bit i = paragem no ponto i)
+    """
+    if tempos_ns is not None:
+        segundos = [ns // NS_POR_SEGUNDO for ns in tempos_ns]
+    else:
+        segundos = _segundos_tempos(dados)
+    n = len(segundos)
+    
+    dt = [segundos[i] - segundos[i - 1] for i in range(1, n)]
+    
+    mascara = bytearray((n + 7) // 8)
+    for i, valor in enumerate((dados.get("Paragens") or [])[:n]):
+        if valor is not None and str(valor) != "null":
+            mascara[i >> 3] |= 1 << (i & 7)
+    
+    colunas = {}
+    for chave in SERIES_RESPOSTA:
+        valores = [float(v) if v is not None else 0.0 for v in (dados.get(chave) or [])[:n]]
+        valores += [0.0] * (n - len(valores))
+        colunas[chave] = array("f", valores).tobytes()
+    
+    return {
+        "n": n,
+        "t0": segundos[0] if segundos else 0,
+        "dt": dt,
+        "Paragens": bytes(mascara),
+        **colunas,
+    }
+
+def _escalares(dados):
+    """Campos da resposta que não são séries"""
+    return {k: v for k, v in dados.items() if k not in SERIES_STATUS}
+
+DELTA_ESCAPE = 0xFFFF  # Delta do formato colunar seguido do tempo absoluto do ponto
+
+def _codificar_deltas(t0, deltas):
+    """
+    Deltas de tempo do formato colunar: u16 se 0 <= delta < DELTA_ESCAPE; senão
+    (paragem longa, relógio acertado para trás) DELTA_ESCAPE seguido do epoch do
+    ponto em i64, para que nenhum tempo seja alterado
+    """
+    partes = bytearray()
+    tempo = t0
+    for delta in deltas:
+        tempo += delta
+        if 0 <= delta < DELTA_ESCAPE:
+            partes += struct.pack("<H", delta)
+        else:
+            partes += struct.pack("<Hq", DELTA_ESCAPE, tempo)
+    return bytes(partes)
+
+def codificar_colunar(escalares, colunas):
+    """
+    Formato binário próprio (little-endian):
+        "KRC2" | u32 tamanho + JSON dos campos escalares | u32 n | i64 t0 |
+        (n-1) deltas de tempo | n x f32 Nominal | n x f32 Media |
+        n x f32 Cadencia | ceil(n/8) bytes de máscara de paragens
+    
+    Cada delta é um u16 em segundos; um delta negativo ou >= 0xFFFF é escrito como
+    u16 0xFFFF seguido do epoch do ponto em i64 (ver _codificar_deltas).
+    """
+    json_escalares = json.dumps(escalares, separators=(",", ":"), default=str).encode("utf-8")
+    n = colunas["n"]
+    partes = [
+        b"KRC2",
+        struct.pack("<I", len(json_escalares)),
+        json_escalares,
+        struct.pack("<Iq", n, colunas["t0"]),
+        _codificar_deltas(colunas["t0"], colunas["dt"]),
+        colunas["Nominal"],
+        colunas["Media"],
+        colunas["Cadencia"],
+        colunas["Paragens"],
+    ]
+    return b"".join(partes)
+
+def responder(payload, dados, tempos_ns=None):
+    """
+    Serializa a resposta no formato negociado e comprime se o cliente aceitar.
+    
+    `dados` é o dicionário (dentro de `payload`) que contém as séries temporais, e
+    `tempos_ns` os instantes dos seus pontos, se conhecidos (ver colunas_series).
+    Os cabeçalhos X-Tamanho-Bruto e X-Codificacao-ms indicam o custo de cada formato.
+    """
+    t0 = time.perf_counter()
+    formato = negociar_formato()
+    
+    if formato == "json":
+        corpo = app.json.dumps(payload).encode("utf-8")
+    else:
+        colunas = colunas_series(dados, tempos_ns)
+        escalares = _escalares(dados)
+        if formato == "msgpack":
+            compacto_dados = {**escalares, "Series": colunas}
+            if dados is payload:
+                compacto = compacto_dados
+            else:
+                compacto = {k: (compacto_dados if v is dados else v) for k, v in payload.items()}
+            corpo = msgpack.packb(compacto, use_bin_type=True, default=str)
+        else:
+            extra = {} if dados is payload else {k: v for k, v in payload.items() if v is not dados}
+            corpo = codificar_colunar({**extra, **escalares}, colunas)
+    
+    tamanho_bruto = len(corpo)
+    compressao = negociar_compressao() if tamanho_bruto >= TAMANHO_MINIMO_COMPRESSAO else None
+    if compressao == "br":
+        corpo = brotli.compress(corpo, quality=4)
+    elif compressao == "gzip":
+        corpo = gzip.compress(corpo, compresslevel=6)
+    
+    resposta = make_response(corpo)
+    resposta.mimetype = MIME_FORMATOS[formato]
+    if compressao:
+        resposta.headers["Content-Encoding"] = compressao
+    resposta.headers["Vary"] = "Accept, Accept-Encoding"
+    resposta.headers["X-Tamanho-Bruto"] = str(tamanho_bruto)
+    resposta.headers["X-Codificacao-ms"] = f"{(time.perf_counter() - t0) * 1000:.3f}"
+    return resposta
+
+@bp.route("/status", methods=["GET"])
 @log_exceptions
 def status():
-    """Retorna o status atual do contador"""
+    """
+    Retorna o status atual do contador.
+    
+    Com ?since=<seq> devolve apenas as amostras e os campos escalares alterados
+    depois desse cursor; se o cursor já não estiver disponível (amostras removidas,
+    nova ordem ou reinício) devolve o snapshot completo com Completo=true. O cursor
+    CursorMs do /api/info (?desde_ms=) é de outro tipo e é rejeitado.
+    """
+    if "desde_ms" in request.args:
+        return jsonify({"error": "desde_ms é o cursor do /api/info; o /status usa ?since=<Seq>"}), 400
+    contador = contador_pedido()
+    since = request.args.get("since", type=int)
     try:
-        with contador._state_lock:
-            # Obter a hora de início da ordem atual
-            inicio_ordem = None
-            if contador.TempoInicio:
-                try:
-                    inicio_ordem = datetime.strptime(contador.TempoInicio, "%Y-%m-%d %H:%M:%S")
-                except ValueError:
-                    logging.warning(f"Formato de data de início inválido: {contador.TempoInicio}")
+        # Só o lock das estatísticas: a captura e as transições da ordem não esperam pela
+        # resposta, e os metadados vêm de um único snapshot coerente
+        estatisticas = contador.estatisticas
+        ordem = contador.metadados
+        with estatisticas.lock:
+            incremental = estatisticas.cursor_valido(since)
             
-            # Filtrar arrays de estatísticas para incluir apenas dados dentro do período válido
-            filtered_stats = {}
-            if inicio_ordem:
-                # Verificar quais índices dos arrays têm timestamps posteriores ao início da ordem
-                valid_indices = []
-                for i, tempo_str in enumerate(contador.EstatisticaTempo):
-                    try:
-                        # O formato no array é apenas hora:minuto:segundo
-                        # Precisamos combiná-lo com a data de início
-                        hora_parts = tempo_str.split(':')
-                        if len(hora_parts) == 3:
-                            hora, minuto, segundo = map(int, hora_parts)
-                            tempo_stat = inicio_ordem.replace(hour=hora, minute=minuto, second=segundo)
-                            
-                            # Se a hora for menor que a do início da ordem e for no mesmo dia,
-                            # provavelmente é do dia seguinte
-                            if tempo_stat < inicio_ordem:
-                                tempo_stat = tempo_stat + timedelta(days=1)
-                                
-                            if tempo_stat >= inicio_ordem:
-                                valid_indices.append(i)
-                    except Exception as e:
-                        logging.error(f"Erro ao processar tempo de estatística {tempo_str}: {e}")
-                
-                # Filtrar os arrays usando os índices válidos
-                filtered_stats["EstatisticaGFA"] = [contador.EstatisticaGFA[i] for i in valid_indices if i < len(contador.EstatisticaGFA)]
-                filtered_stats["EstatisticaGFAMedia"] = [contador.EstatisticaGFAMedia[i] for i in valid_indices if i < len(contador.EstatisticaGFAMedia)]
-                filtered_stats["EstatisticaTempo"] = [contador.EstatisticaTempo[i] for i in valid_indices if i < len(contador.EstatisticaTempo)]
-                filtered_stats["EstatisticaCadenciaArtigo"] = [contador.EstatisticaCadenciaArtigo[i] for i in valid_indices if i < len(contador.EstatisticaCadenciaArtigo)]
-                filtered_stats["Paragens"] = [contador.Paragens[i] for i in valid_indices if i < len(contador.Paragens)]
-            else:
-                # Se não tiver início, usar todos os dados (caso raro)
-                filtered_stats["EstatisticaGFA"] = contador.EstatisticaGFA
-                filtered_stats["EstatisticaGFAMedia"] = contador.EstatisticaGFAMedia
-                filtered_stats["EstatisticaTempo"] = contador.EstatisticaTempo
-                filtered_stats["EstatisticaCadenciaArtigo"] = contador.EstatisticaCadenciaArtigo
-                filtered_stats["Paragens"] = contador.Paragens
+            # Amostras a considerar: as posteriores ao cursor (ou todas) e ao início da
+            # ordem; os instantes são inteiros ordenados, por isso basta uma pesquisa binária
+            # (amostras sem seq, anteriores ao registo de sequências, contam como antigas)
+            instantes = estatisticas.EstatisticaNs
+            primeiro = 0
+            if incremental:
+                sem_seq = len(instantes) - len(estatisticas.EstatisticaSeq)
+                primeiro = sem_seq + bisect.bisect_right(estatisticas.EstatisticaSeq, since)
+            if ordem.InicioNs:
+                primeiro = max(primeiro, bisect.bisect_left(instantes, ordem.InicioNs))
+            tempos_ns = instantes[primeiro:]
+            filtered_stats = {
+                chave: getattr(estatisticas, chave)[primeiro:]
+                for chave in ("EstatisticaGFA", "EstatisticaGFAMedia", "EstatisticaCadenciaArtigo", "Paragens")
+            }
             
             # Criar objeto de resposta
             data = {
-                "Ordem": contador.Ordem,
-                "Artigo": contador.ArtigoEmContagem,
-                "DescricaoArtigo": contador.DescricaoArtigoEmContagem,
-                "CadenciaArtigo": contador.CadenciaArtigoEmContagem,
-                "Inicio": contador.TempoInicio,
-                "Fim": contador.TempoFim,
-                "ContagemAtual": contador.ContagemAtual,
-                "ContagemTotal": contador.ContagemTotal,
+                "Ordem": ordem.Ordem,
+                "Artigo": ordem.ArtigoEmContagem,
+                "DescricaoArtigo": ordem.DescricaoArtigoEmContagem,
+                "CadenciaArtigo": ordem.CadenciaArtigoEmContagem,
+                "Inicio": ordem.TempoInicio,
+                "Fim": ordem.TempoFim,
+                "ContagemAtual": contador.quente.contagem,
+                "ContagemTotal": ordem.ContagemTotal,
                 "MediaProducao": media_producao(),
                 "Nominal": filtered_stats["EstatisticaGFA"],
                 "Media": filtered_stats["EstatisticaGFAMedia"],
-                "Tempo": filtered_stats["EstatisticaTempo"],
+                "Tempo": [formatar_ns(ns, FORMATO_HORA) for ns in tempos_ns],
                 "Cadencia": filtered_stats["EstatisticaCadenciaArtigo"],
                 "Paragens": filtered_stats["Paragens"],
-                "Quebras": contador.Quebras,
+                "Quebras": ordem.Quebras,
                 "EstadoPorta": contador.EstadoPorta,
                 "EstadoContador": contador.EstadoContador,
                 "EstadoConfiguracao": contador.ContadorConfigurado,
-                "IdBDOrdemProducao": contador.IdBDOrdemProducao,
-                "DataDados": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                "EstadoOrdem": contador.estado,
+                "AvisoAproximacao": contador.quente.aviso_ativo,
+                "IdBDOrdemProducao": ordem.IdBDOrdemProducao,
+                "OEE": contador.oee.resumo(),
+                "DataDados": formatar_ns(relogio.tempo_ns())
             }
             
-            # Calcular estimativa de conclusão, se aplicável
-            if data["MediaProducao"] > 0 and contador.EstadoContador == 1:
-                try:
-                    minutos_restantes = math.ceil(
-                        (data["ContagemTotal"] - data["ContagemAtual"]) * 60 / 
-                        data["MediaProducao"]
-                    )
-                    data["EstimativaFecho"] = (
-                        datetime.now() + timedelta(minutes=minutos_restantes)
-                    ).strftime("%Y-%m-%d %H:%M:%S")
-                except Exception as e:
-                    logging.error(f"Erro ao calcular EstimativaFecho: {e}")
-                    data["EstimativaFecho"] = ""
-            else:
-                data["EstimativaFecho"] = ""
+            # Previsão de fecho calculada no último ciclo de estatísticas
+            data.update(contador.previsao.atual)
             
-        return jsonify({"data": data}), 200
+            # Atualizar versões dos campos escalares e preparar a resposta incremental
+            escalares = {k: v for k, v in data.items() if k not in SERIES_STATUS and k != "DataDados"}
+            estatisticas.registar_escalares(escalares)
+            if incremental:
+                alterados = estatisticas.escalares_desde(since)
+                data = {
+                    **{k: escalares[k] for k in alterados if k in escalares},
+                    **{k: data[k] for k in SERIES_STATUS},
+                    "DataDados": data["DataDados"],
+                }
+            data["Seq"] = estatisticas.seq
+            data["Completo"] = not incremental
+            
+        return responder({"data": data}, data, tempos_ns), 200
     except Exception as e:
         logging.error(f"Erro ao obter status: {e}")
         return jsonify({"data": {}, "error": str(e)}), 500
 
-@log_exceptions
-def obter_dados_historico(NumPontos, Ordem):
-    """Função para conectar à base de dados e obter os dados da tabela historico_contagens"""
-    try:
-        conn = get_db_connection(contador.DB_Server, contador.DB_User, contador.DB_Password, contador.DB_DB)
-        cursor = conn.cursor(as_dict=True)
-        
-        SQL = """
-            SELECT TOP (%s)
-                DataDados, Ordem, Artigo, DescricaoArtigo, CadenciaArtigo, 
-                Inicio, Fim, ContagemAtual, ContagemTotal, MediaProducao, 
-                Paragens, Quebras, EstadoPorta, EstadoContador, EstadoConfiguracao, 
-                Nominal, Media, Cadencia, Tempo
-            FROM krones_historico_contagens
-            WHERE Ordem = %s
-            ORDER BY DataDados ASC
+class HistoricoLocal:
+    """
+    Histórico das ordens guardado no próprio Raspberry Pi (SQLite), para o /api/info
+    não depender do SQL Server.
+    
+    Uma linha por ordem (artigo, início, fim, objetivo) e uma linha compacta por amostra
+    de 5 s: instante em segundos epoch, contagem, média, paragem, quebras, os três
+    estados num inteiro, GFA nominal/média/cadência e a hora da amostra em segundos do
+    dia. As amostras são gravadas pelo mesmo escritor que grava no SQL Server.
+    
+    Só as ordens iniciadas depois de o ficheiro ser criado estão completas localmente;
+    as restantes continuam a ser lidas do SQL Server. As ordens sem amostras há mais de
+    `dias` são apagadas, e as mais antigas também se o ficheiro passar de `max_mb`.
+    """
+    ESQUEMA = """
+        CREATE TABLE IF NOT EXISTS meta (chave TEXT PRIMARY KEY, valor TEXT);
+        CREATE TABLE IF NOT EXISTS ordens (
+            id INTEGER PRIMARY KEY, ordem TEXT UNIQUE NOT NULL, linha TEXT, artigo TEXT,
+            descricao TEXT, cadencia INTEGER, inicio INTEGER, fim INTEGER,
+            contagem_total INTEGER, completa INTEGER NOT NULL, ultima INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS amostras (
+            ordem_id INTEGER NOT NULL, t INTEGER NOT NULL, contagem INTEGER, media_producao REAL,
+            paragens TEXT, quebras INTEGER, estados INTEGER, nominal REAL, media REAL,
+            cadencia REAL, tempo INTEGER,
+            PRIMARY KEY (ordem_id, t)
+        ) WITHOUT ROWID;
+    """
+    INTERVALO_LIMPEZA = 3600  # Segundos entre verificações da retenção
+    CAMPOS_AMOSTRA = (
+        "DataDados", "ContagemAtual", "MediaProducao", "Paragens", "Quebras", "EstadoPorta",
+        "EstadoContador", "EstadoConfiguracao", "Nominal", "Media", "Cadencia", "Tempo",
+    )
+    
+    def __init__(self, ficheiro, dias=30, max_mb=200):
+        self.ficheiro = ficheiro
+        self.dias = dias
+        self.max_mb = max_mb
+        self._local = threading.local()  # Uma conexão por thread (WAL: leituras não bloqueiam a escrita)
+        self._escrita = threading.Lock()
+        self._ids = {}  # ordem -> (id, completa)
+        self._criado = None
+        self._ultima_limpeza = 0
+        self.amostras_gravadas = 0
+        self.ordens_apagadas = 0
+    
+    def _conexao(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.ficheiro, timeout=5, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if self._criado is None:
+                with self._escrita:
+                    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")  # Só tem efeito num ficheiro novo
+                    conn.executescript(self.ESQUEMA)
+                    conn.execute("INSERT OR IGNORE INTO meta VALUES ('criado', ?)", (str(int(relogio.tempo())),))
+                    conn.commit()
+                    self._criado = int(conn.execute("SELECT valor FROM meta WHERE chave = 'criado'").fetchone()[0])
+            self._local.conn = conn
+        return conn
+    
+    @staticmethod
+    def _epoch(valor):
+        """Data (epoch ns, datetime ou texto YYYY-MM-DD HH:MM:SS) em segundos epoch; None se vazia"""
+        return ns_de_data(valor) // NS_POR_SEGUNDO or None
+    
+    def registar(self, linha_id, agora, params, ordem_ns=None, amostra_ns=None):
         """
+        Grava uma amostra com os mesmos campos do INSERT em krones_historico_contagens.
         
-        cursor.execute(SQL, (NumPontos, Ordem))
-        result = cursor.fetchall()
-        conn.close()
-        
-        return result
-    except Exception as e:
-        logging.error(f"Erro ao obter dados históricos: {e}")
-        return []
-
-@app.route("/api/info", defaults={"NumPontos": 180, "Ordem": None})
-@app.route("/api/info/<int:NumPontos>/<string:Ordem>")
-@log_exceptions
-def ApiInfo(NumPontos, Ordem):
-    """API para obter informações históricas de uma ordem específica"""
+        `agora` é o instante da gravação (epoch ns ou datetime). Quem tem os instantes
+        originais passa `ordem_ns` (início, fim) e `amostra_ns`, para não os ler de
+        volta dos textos de `params`.
+        """
+        conn = self._conexao()
+        ordem = params["Ordem"]
+        t = ns_de_data(agora) // NS_POR_SEGUNDO
+        if ordem_ns is not None:
+            inicio, fim = (ns // NS_POR_SEGUNDO or None for ns in ordem_ns)
+        else:
+            inicio, fim = self._epoch(params["Inicio"]), self._epoch(params["Fim"])
+        with self._escrita:
+            conhecida = self._ids.get(ordem)
+            if conhecida is None:
+                linha = conn.execute("SELECT id, completa FROM ordens WHERE ordem = ?", (ordem,)).fetchone()
+                if linha is None:
+                    # Completa se começou depois de o histórico local existir
+                    completa = int(inicio is not None and inicio >= self._criado)
+                    cursor = conn.execute(
+                        "INSERT INTO ordens (ordem, linha, completa, ultima) VALUES (?, ?, ?, ?)",
+                        (ordem, linha_id, completa, t),
+                    )
+                    linha = (cursor.lastrowid, completa)
+                conhecida = self._ids[ordem] = linha
+            conn.execute(
+                """UPDATE ordens SET artigo = ?, descricao = ?, cadencia = ?, inicio = ?, fim = ?,
+                   contagem_total = ?, ultima = ? WHERE id = ?""",
+                (params["Artigo"], params["DescricaoArtigo"], params["CadenciaArtigo"], inicio,
+                 fim, params["ContagemTotal"], t, conhecida[0]),
+            )
+            if amostra_ns:
+                local = time.localtime(amostra_ns // NS_POR_SEGUNDO)
+                tempo = local.tm_hour * 3600 + local.tm_min * 60 + local.tm_sec
+            else:
+                tempo = params["Tempo"]
+                if tempo:
+                    h, m, s = tempo.split(":")
+                    tempo = int(h) * 3600 + int(m) * 60 + int(s)
+            conn.execute(
+                "INSERT OR REPLACE INTO amostras VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (conhecida[0], t, params["ContagemAtual"], params["MediaProducao"], params["Paragens"],
+                 params["Quebras"],
+                 params["EstadoPorta"] | params["EstadoContador"] << 1 | params["EstadoConfiguracao"] << 3,
+                 params["Nominal"], params["Media"], params["Cadencia"], tempo),
+            )
+            conn.commit()
+            self.amostras_gravadas += 1
+        if relogio.tempo() - self._ultima_limpeza >= self.INTERVALO_LIMPEZA:
+            self.limpar()
+    
+    def tem_ordem(self, ordem):
+        """True se o histórico da ordem está completo localmente"""
+        conhecida = self._ids.get(ordem)
+        if conhecida is None:
+            conhecida = self._conexao().execute("SELECT id, completa FROM ordens WHERE ordem = ?", (ordem,)).fetchone()
+            if conhecida is None:
+                return False
+            self._ids[ordem] = conhecida
+        return bool(conhecida[1])
+    
+    def ler(self, NumPontos, Ordem, desde=None, ate=None):
+        """As mesmas linhas (e chaves) que obter_dados_historico obtém do SQL Server"""
+        linhas = []
+        for bloco in self.iterar(Ordem, desde, ate, NumPontos):
+            linhas.extend(bloco)
+        return linhas
+    
+    def iterar(self, Ordem, desde=None, ate=None, NumPontos=-1, tamanho_bloco=1000):
+        """
+        Linhas da ordem (com DataDados posterior a `desde` e até `ate`) em blocos de
+        `tamanho_bloco`, lidas do cursor à medida que são consumidas.
+        """
+        conn = self._conexao()
+        ordem = conn.execute(
+            "SELECT id, artigo, descricao, cadencia, inicio, fim, contagem_total FROM ordens WHERE ordem = ?",
+            (Ordem,),
+        ).fetchone()
+        if ordem is None:
+            return
+        id_ordem, artigo, descricao, cadencia, inicio, fim, contagem_total = ordem
+        inicio = datetime.fromtimestamp(inicio) if inicio is not None else None
+        fim = datetime.fromtimestamp(fim) if fim is not None else None
+        
+        # Estados e hora da amostra descodificados pelo SQLite; cada linha parte de uma
+        # cópia dos campos da ordem, atualizada com os campos da amostra
+        sql = """
+            SELECT t, contagem, media_producao, paragens, quebras, estados & 1, (estados >> 1) & 3,
+                   (estados >> 3) & 1, nominal, media, cadencia,
+                   CASE WHEN tempo IS NOT NULL
+                        THEN printf('%02d:%02d:%02d', tempo / 3600, tempo / 60 % 60, tempo % 60) END
+            FROM amostras WHERE ordem_id = ?
+        """
+        params = [id_ordem]
+        if desde is not None:
+            sql += " AND t > ?"
+            params.append(ns_de_data(desde) // NS_POR_SEGUNDO)
+        if ate is not None:
+            sql += " AND t <= ?"
+            params.append(ns_de_data(ate) // NS_POR_SEGUNDO)
+        sql += " ORDER BY t LIMIT ?"
+        params.append(NumPontos)
+        
+        base = {
+            "Ordem": Ordem, "Artigo": artigo, "DescricaoArtigo": descricao, "CadenciaArtigo": cadencia,
+            "Inicio": inicio, "Fim": fim, "ContagemTotal": contagem_total,
+        }
+        chaves = self.CAMPOS_AMOSTRA
+        fromtimestamp = datetime.fromtimestamp
+        cursor = conn.execute(sql, params)
+        try:
+            while True:
+                amostras = cursor.fetchmany(tamanho_bloco)
+                if not amostras:
+                    break
+                bloco = []
+                for amostra in amostras:
+                    linha = base.copy()
+                    linha.update(zip(chaves, amostra))
+                    linha["DataDados"] = fromtimestamp(amostra[0])
+                    linha["DataNs"] = amostra[0] * NS_POR_SEGUNDO
+                    bloco.append(linha)
+                yield bloco
+        finally:
+            cursor.close()
+    
+    def inicio_ordem(self, Ordem):
+        """Início da ordem (YYYY-MM-DD HH:MM:SS) guardado localmente, ou None"""
+        linha = self._conexao().execute("SELECT inicio FROM ordens WHERE ordem = ?", (Ordem,)).fetchone()
+        if linha is None or linha[0] is None:
+            return None
+        return formatar_epoch(linha[0])
+    
+    def _apagar_ordem(self, conn, id_ordem, ordem):
+        conn.execute("DELETE FROM amostras WHERE ordem_id = ?", (id_ordem,))
+        conn.execute("DELETE FROM ordens WHERE id = ?", (id_ordem,))
+        self._ids.pop(ordem, None)
+        self.ordens_apagadas += 1
+    
+    def tamanho_mb(self):
+        conn = self._conexao()
+        paginas = conn.execute("PRAGMA page_count").fetchone()[0] - conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return paginas * conn.execute("PRAGMA page_size").fetchone()[0] / 1e6
+    
+    def limpar(self):
+        """Aplica a retenção: ordens antigas e, acima de max_mb, as mais antigas primeiro"""
+        self._ultima_limpeza = relogio.tempo()
+        conn = self._conexao()
+        with self._escrita:
+            limite = int(relogio.tempo() - self.dias * 86400)
+            for id_ordem, ordem in conn.execute("SELECT id, ordem FROM ordens WHERE ultima < ?", (limite,)).fetchall():
+                self._apagar_ordem(conn, id_ordem, ordem)
+            conn.commit()
+            while self.tamanho_mb() > self.max_mb:
+                # A ordem mais recente (a que está a ser gravada) nunca é apagada
+                linhas = conn.execute("SELECT id, ordem FROM ordens ORDER BY ultima LIMIT 2").fetchall()
+                if len(linhas) < 2:
+                    break
+                self._apagar_ordem(conn, *linhas[0])
+                conn.commit()
+            conn.execute("PRAGMA incremental_vacuum")
+            conn.commit()
+    
+    def estado(self):
+        conn = self._conexao()
+        ordens, completas = conn.execute("SELECT COUNT(*), COALESCE(SUM(completa), 0) FROM ordens").fetchone()
+        return {
+            "Ficheiro": self.ficheiro,
+            "Ordens": ordens,
+            "OrdensCompletas": completas,
+            "Amostras": conn.execute("SELECT COUNT(*) FROM amostras").fetchone()[0],
+            "TamanhoMB": round(self.tamanho_mb(), 2),
+            "RetencaoDias": self.dias,
+            "MaximoMB": self.max_mb,
+            "AmostrasGravadas": self.amostras_gravadas,
+            "OrdensApagadas": self.ordens_apagadas,
+        }
+
+historico_local = (
+    HistoricoLocal(CONFIG["historico_local_ficheiro"], CONFIG["historico_local_dias"], CONFIG["historico_local_max_mb"])
+    if CONFIG["historico_local"] and not MODO_AGREGADOR else None
+)
+
+@log_exceptions
+def obter_dados_historico(NumPontos, Ordem, contador=None, desde=None, ate=None):
+    """
+    Função para conectar à base de dados e obter os dados da tabela historico_contagens.
+    
+    Se `desde` (datetime) for indicado, devolve apenas as linhas com DataDados posterior;
+    se `ate` for indicado, apenas as linhas com DataDados até essa data.
+    """
+    contador = contador or contador_pedido()
+    if historico_local is not None:
+        try:
+            if historico_local.tem_ordem(Ordem):
+                return historico_local.ler(NumPontos, Ordem, desde, ate)
+        except Exception as e:
+            logging.error(f"Erro ao ler o histórico local, a usar o SQL Server: {e}")
+    chave = ("historico", contador.DB_Server, contador.DB_DB, NumPontos, Ordem, desde, ate)
+    try:
+        conn = get_db_connection(contador.DB_Server, contador.DB_User, contador.DB_Password, contador.DB_DB)
+        cursor = conn.cursor(as_dict=True)
+        
+        SQL = f"""
+            SELECT TOP (%s)
+                DataDados, Ordem, Artigo, DescricaoArtigo, CadenciaArtigo, 
+                Inicio, Fim, ContagemAtual, ContagemTotal, MediaProducao, 
+                Paragens, Quebras, EstadoPorta, EstadoContador, EstadoConfiguracao, 
+                Nominal, Media, Cadencia, Tempo
+            FROM krones_historico_contagens
+            WHERE Ordem = %s{" AND DataDados > %s" if desde is not None else ""}{" AND DataDados <= %s" if ate is not None else ""}
+            ORDER BY DataDados ASC
+        """
+        
+        params = (NumPontos, Ordem) + tuple(d for d in (desde, ate) if d is not None)
+        cursor.execute(SQL, params)
+        result = cursor.fetchall()
+        conn.close()
+        
+        cache_leituras_bd.guardar(chave, result)
+        return result
+    except Exception as e:
+        logging.error(f"Erro ao obter dados históricos: {e}")
+        return cache_leituras_bd.obter(chave, e) or []
+
+def historico_ordem_ativa(NumPontos, contador, desde=None, ate=None):
+    """
+    As mesmas linhas que obter_dados_historico devolve para a ordem ativa, lidas das
+    séries em memória; só as amostras anteriores à janela em memória (ordem iniciada
+    antes do arranque do processo, ou amostras já removidas das séries) vêm da BD.
+    
+    Os campos da ordem e os estados são os atuais, em todas as linhas.
+    """
+    estatisticas = contador.estatisticas
+    # DataDados tem resolução de segundos: os limites comparam-se com o segundo de cada
+    # amostra, ou seja, "desde" exclui e "até" inclui o segundo inteiro
+    limite_desde = truncar_segundo(ns_de_data(desde)) if desde is not None else None
+    limite_ate = truncar_segundo(ns_de_data(ate)) if ate is not None else None
+    with estatisticas.lock:
+        instantes = estatisticas.EstatisticaNs
+        primeiro = bisect.bisect_right(instantes, limite_desde + NS_POR_SEGUNDO - 1) if limite_desde is not None else 0
+        ultimo = bisect.bisect_right(instantes, limite_ate + NS_POR_SEGUNDO - 1) if limite_ate is not None else len(instantes)
+        ultimo = max(primeiro, min(ultimo, primeiro + NumPontos))
+        completo_desde = truncar_segundo(estatisticas.completo_desde)
+        series = (
+            instantes[primeiro:ultimo],
+            estatisticas.Paragens[primeiro:ultimo],
+            estatisticas.EstatisticaGFA[primeiro:ultimo],
+            estatisticas.EstatisticaGFAMedia[primeiro:ultimo],
+            estatisticas.EstatisticaCadenciaArtigo[primeiro:ultimo],
+        )
+    
+    # Amostras anteriores à janela em memória: da BD (ou do histórico local)
+    anteriores = []
+    ordem = contador.metadados
+    inicio_ordem = ordem.InicioNs or None
+    if (inicio_ordem is None or inicio_ordem < completo_desde) and (limite_desde is None or limite_desde < completo_desde - NS_POR_SEGUNDO):
+        fim_anteriores = datetime_de_ns(completo_desde - NS_POR_SEGUNDO)
+        if ate is not None and ate < fim_anteriores:
+            fim_anteriores = ate
+        anteriores = obter_dados_historico(NumPontos, ordem.Ordem, contador, desde, fim_anteriores)
+        if len(anteriores) >= NumPontos:
+            return anteriores[:NumPontos]
+    
+    campos = {
+        "Ordem": ordem.Ordem,
+        "Artigo": ordem.ArtigoEmContagem,
+        "DescricaoArtigo": ordem.DescricaoArtigoEmContagem,
+        "CadenciaArtigo": ordem.CadenciaArtigoEmContagem,
+        "Inicio": ordem.TempoInicio or None,
+        "Fim": ordem.TempoFim or None,
+        "ContagemAtual": contador.quente.contagem,
+        "ContagemTotal": ordem.ContagemTotal,
+        "MediaProducao": media_producao(contador),
+        "Quebras": ordem.Quebras,
+        "EstadoPorta": contador.EstadoPorta,
+        "EstadoContador": contador.EstadoContador,
+        "EstadoConfiguracao": int(contador.ContadorConfigurado),
+    }
+    linhas = anteriores
+    for instante, paragem, nominal, media, cadencia in zip(*series):
+        if len(linhas) >= NumPontos:
+            break
+        linha = campos.copy()
+        linha["DataDados"] = datetime_de_ns(truncar_segundo(instante))
+        linha["DataNs"] = instante
+        linha["Tempo"] = formatar_ns(instante, FORMATO_HORA)
+        linha["Paragens"] = paragem
+        linha["Nominal"] = nominal
+        linha["Media"] = media
+        linha["Cadencia"] = cadencia
+        linhas.append(linha)
+    return linhas
+
+# Resolução usada pelo /api/info em função da duração do intervalo pedido
+RESOLUCOES_API = (
+    ("bruto", timedelta(hours=2)),
+    ("minuto", timedelta(days=2)),
+    ("hora", timedelta(days=62)),
+    ("turno", None),
+)
+
+def escolher_resolucao(inicio, fim):
+    """Escolhe a resolução mais fina cujo número de pontos continua razoável para o intervalo"""
+    for resolucao, duracao_maxima in RESOLUCOES_API:
+        if duracao_maxima is None or fim - inicio <= duracao_maxima:
+            return resolucao
+
+def ler_data_pedido(nome):
+    """Lê um parâmetro de data do pedido (YYYY-MM-DD HH:MM:SS ou ISO 8601)"""
+    valor = request.args.get(nome)
+    if not valor:
+        return None
+    try:
+        return datetime.fromisoformat(valor)
+    except ValueError:
+        raise ValueError(f"Data inválida em '{nome}': {valor}")
+
+@log_exceptions
+def obter_rollups(NumPontos, Ordem, resolucao, inicio, fim, contador=None):
+    """Rollups gravados da ordem numa resolução e intervalo"""
+    contador = contador or contador_pedido()
+    try:
+        conn = get_db_connection(contador.DB_Server, contador.DB_User, contador.DB_Password, contador.DB_DB)
+        cursor = conn.cursor(as_dict=True)
+        cursor.execute(
+            """
+            SELECT TOP (%s)
+                Inicio, Turno, Contagem, GFAMin, GFAMax, GFAMedia, TempoParagem, Quebras
+            FROM krones_rollup_contagens
+            WHERE Ordem = %s AND Resolucao = %s AND Inicio >= %s AND Inicio <= %s
+            ORDER BY Inicio ASC
+            """,
+            (NumPontos, Ordem, resolucao[0].upper(), inicio, fim),
+        )
+        result = cursor.fetchall()
+        conn.close()
+        return result
+    except Exception as e:
+        logging.error(f"Erro ao obter rollups: {e}")
+        return []
+
+def api_info_rollups(NumPontos, Ordem, resolucao, inicio, fim, contador):
+    """Resposta do /api/info construída a partir dos rollups, com a mesma forma da resposta normal"""
+    # Incluir o período que já estava em curso no início do intervalo
+    inicio = contador.rollups.inicio_periodo(resolucao, inicio)
+    linhas = obter_rollups(NumPontos, Ordem, resolucao, inicio, fim, contador)
+    
+    # Períodos da ordem ativa ainda só em memória
+    if Ordem == contador.Ordem:
+        gravados = {str(l["Inicio"]) for l in linhas}
+        for linha in contador.rollups.em_memoria(resolucao, Ordem):
+            momento = datetime.strptime(linha["Inicio"], "%Y-%m-%d %H:%M:%S")
+            if inicio <= momento <= fim and linha["Inicio"] not in gravados:
+                linhas.append(linha)
+        linhas = linhas[:NumPontos]
+    
+    # Metadados da ordem a partir do primeiro registo do histórico
+    meta = obter_dados_historico(1, Ordem, contador)
+    meta = meta[0] if meta else {}
+    cadencia = int(meta.get("CadenciaArtigo") or 6000)
+    
+    tempo, nominal, media, paragens = [], [], [], []
+    minimo, maximo, tempo_paragem, contagens = [], [], [], []
+    soma_ponderada = 0.0
+    total = 0
+    for linha in linhas:
+        inicio_periodo = linha["Inicio"]
+        tempo.append(inicio_periodo.strftime("%Y-%m-%d %H:%M:%S") if hasattr(inicio_periodo, "strftime") else str(inicio_periodo))
+        gfa = float(linha["GFAMedia"] or 0)
+        contagem = int(linha["Contagem"] or 0)
+        nominal.append(gfa)
+        total += contagem
+        soma_ponderada += gfa * contagem
+        media.append(float(round(soma_ponderada / total, 0)) if total else 0.0)
+        paragens.append("0" if float(linha["TempoParagem"] or 0) > 0 else None)
+        minimo.append(float(linha["GFAMin"] or 0))
+        maximo.append(float(linha["GFAMax"] or 0))
+        tempo_paragem.append(float(linha["TempoParagem"] or 0))
+        contagens.append(contagem)
+    
+    dados = {
+        "DataDados": formatar_ns(relogio.tempo_ns()),
+        "Ordem": Ordem,
+        "Artigo": meta.get("Artigo"),
+        "DescricaoArtigo": meta.get("DescricaoArtigo"),
+        "CadenciaArtigo": cadencia,
+        "Inicio": obter_inicio_oficial_ordem(Ordem, contador),
+        "Fim": None,
+        "ContagemAtual": total,
+        "ContagemTotal": meta.get("ContagemTotal", 0),
+        "MediaProducao": media[-1] if media else 0.0,
+        "EstimativaFecho": "",
+        "Nominal": nominal,
+        "Paragens": paragens,
+        "Quebras": sum(int(l["Quebras"] or 0) for l in linhas),
+        "EstadoPorta": 0,
+        "EstadoContador": 0,
+        "EstadoConfiguracao": 0,
+        "Media": media,
+        "Cadencia": [float(cadencia)] * len(linhas),
+        "Tempo": tempo,
+        "Minimo": minimo,
+        "Maximo": maximo,
+        "TempoParagem": tempo_paragem,
+        "Contagens": contagens,
+        "IdBDOrdemProducao": contador.IdBDOrdemProducao if Ordem == contador.Ordem else None,
+        "Resolucao": resolucao,
+        "Completo": True,
+    }
+    return responder(dados, dados), 200
+
+@bp.route("/api/info", defaults={"NumPontos": 180, "Ordem": None})
+@bp.route("/api/info/<int:NumPontos>/<string:Ordem>")
+@log_exceptions
+def ApiInfo(NumPontos, Ordem):
+    """
+    API para obter informações históricas de uma ordem específica.
+    
+    Com ?desde_ms=<cursor> (o CursorMs devolvido no pedido anterior, epoch em ms do
+    último registo) devolve apenas os registos posteriores; os campos escalares só são
+    incluídos quando há registos novos. O Seq do /status (?since=) é um contador de
+    sequência, não um instante, e é rejeitado.
+    
+    Com ?inicio= (e opcionalmente ?fim=) limita o intervalo de tempo e escolhe a
+    resolução pela duração: registos de 5 s, ou rollups por minuto, hora ou turno
+    (?resolucao= força uma resolução).
+    """
+    if "since" in request.args:
+        return jsonify({"error": "since é o cursor Seq do /status; o /api/info usa ?desde_ms=<CursorMs>"}), 400
+    contador = contador_pedido()
+    desde_ms = request.args.get("desde_ms", type=int)
+    desde = None
+    if desde_ms is not None and 0 < desde_ms <= relogio.tempo() * 1000:
+        desde = datetime.fromtimestamp(desde_ms / 1000)
+    incremental = desde is not None
+    try:
+        inicio_intervalo = ler_data_pedido("inicio")
+        fim_intervalo = ler_data_pedido("fim")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     try:
         # Se a ordem não for fornecida, usar a ordem atual
         if Ordem is None:
@@ -1161,33 +4011,56 @@ def ApiInfo(NumPontos, Ordem):
                 "error": "Nenhuma ordem ativa ou especificada"
             }), 200
         
-        # Obtém os dados da tabela historico_contagens
-        result = obter_dados_historico(NumPontos, Ordem)
+        # Intervalo de tempo pedido e resolução correspondente
+        if inicio_intervalo is not None or fim_intervalo is not None:
+            fim_intervalo = fim_intervalo or relogio.agora()
+            inicio_intervalo = inicio_intervalo or fim_intervalo - RESOLUCOES_API[0][1]
+            resolucao = request.args.get("resolucao") or escolher_resolucao(inicio_intervalo, fim_intervalo)
+            if resolucao in Rollups.RESOLUCOES:
+                return api_info_rollups(NumPontos, Ordem, resolucao, inicio_intervalo, fim_intervalo, contador)
+            if not incremental:
+                # DataDados tem resolução de segundos: "> inicio - 1 s" inclui o próprio início
+                desde = inicio_intervalo - timedelta(seconds=1)
+        
+        # Ordem ativa: séries em memória (e a BD só para as amostras mais antigas);
+        # as outras ordens vêm da tabela historico_contagens
+        ativa = Ordem == contador.Ordem and CONFIG["api_info_memoria"]
+        if ativa:
+            result = historico_ordem_ativa(NumPontos, contador, desde, fim_intervalo)
+        else:
+            result = obter_dados_historico(NumPontos, Ordem, contador, desde, fim_intervalo)
+        
+        if not result and incremental:
+            # Sem registos novos desde o cursor: resposta incremental vazia
+            vazio = {"CursorMs": desde_ms, "Completo": False, "DataDados": formatar_ns(relogio.tempo_ns()),
+                     **{k: [] for k in SERIES_STATUS}}
+            return responder(vazio, vazio), 200
         
         if not result:
+            if g.get("erro_bd"):
+                # BD em falha e nada em cache: responder já, com o estado do disjuntor
+                return jsonify({
+                    "error": f"BD indisponível: {g.erro_bd}",
+                    "Disjuntor": disjuntor_bd(contador.DB_Server, contador.DB_DB).estado(),
+                }), 503
             return jsonify({
                 "error": f"Sem dados históricos para a ordem {Ordem}"
             }), 200
         
-        # Obtém a data/hora de início oficial da ordem diretamente da BD
-        inicio_oficial_str = obter_inicio_oficial_ordem(Ordem)
-        inicio_oficial = None
-        
-        # Converter para objeto datetime para comparação
-        if inicio_oficial_str:
-            try:
-                inicio_oficial = datetime.strptime(inicio_oficial_str, "%Y-%m-%d %H:%M:%S")
-                logging.info(f"Hora de início oficial para ordem {Ordem}: {inicio_oficial_str}")
-                
-                # Extrair apenas a hora, minuto e segundo para comparação direta
-                inicio_hms = inicio_oficial.strftime("%H:%M:%S")
-                logging.info(f"Hora de início formatada para comparação: {inicio_hms}")
-            except ValueError as e:
-                logging.error(f"Erro ao converter hora de início: {e}")
+        # Data/hora de início oficial da ordem: a local se a ordem está ativa, senão da BD.
+        # Os registos anteriores ficam de fora, comparando instantes completos (epoch ns):
+        # uma ordem que atravessa a meia-noite ou a mudança da hora não perde registos
+        if ativa and contador.metadados.InicioNs:
+            inicio_oficial = contador.metadados.InicioNs
+            inicio_oficial_str = formatar_ns(inicio_oficial)
+        else:
+            inicio_oficial_str = obter_inicio_oficial_ordem(Ordem, contador)
+            inicio_oficial = ns_de_data(inicio_oficial_str)
+        logging.debug(f"Hora de início oficial para ordem {Ordem}: {inicio_oficial_str}")
         
         # Dicionário para armazenar os dados consolidados
         dados_consolidados = {
-            "DataDados": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "DataDados": formatar_ns(relogio.tempo_ns()),
             "Ordem": Ordem,
             "Artigo": None,
             "DescricaoArtigo": None,
@@ -1241,6 +4114,7 @@ def ApiInfo(NumPontos, Ordem):
             dados_consolidados["EstadoConfiguracao"] = ultima_linha.get("EstadoConfiguracao", 0)
         
         # Arrays para armazenar os dados filtrados
+        tempos_ns = []
         tempo_filtrado = []
         paragens_filtrado = []
         nominal_filtrado = []
@@ -1248,60 +4122,40 @@ def ApiInfo(NumPontos, Ordem):
         cadencia_filtrado = []
         
         # Processar todos os dados das séries temporais com filtragem
-        for idx, row in enumerate(result):
-            tempo_str = None
+        for row in result:
+            # Instante do registo: o das amostras em memória e do histórico local, ou o DataDados da BD
+            instante = row.get("DataNs") or ns_de_data(row.get("DataDados"))
             
-            # Extrair tempo desta linha
+            # Só registos a partir do início oficial (todos, se não o conhecemos)
+            if inicio_oficial and instante < inicio_oficial:
+                continue
+            
+            tempos_ns.append(instante)
             if obter_valor_seguro(row, "Tempo") is not None:
-                tempo_str = row["Tempo"]
-            elif row.get("DataDados") and hasattr(row["DataDados"], "strftime"):
-                tempo_str = row["DataDados"].strftime("%H:%M:%S")
+                tempo_filtrado.append(row["Tempo"])
             else:
-                tempo_str = "00:00:00"
-            
-            # Verificar se este tempo é posterior ao início oficial por comparação direta de strings
-            incluir_registo = False
+                tempo_filtrado.append(formatar_ns(instante, FORMATO_HORA) or "00:00:00")
             
-            if inicio_oficial and tempo_str:
-                try:
-                    # Comparação direta de strings HH:MM:SS
-                    # Isto funciona porque estamos a comparar formatos iguais
-                    incluir_registo = tempo_str >= inicio_hms
-                    
-                    # Log detalhado para os primeiros registos para diagnóstico
-                    if idx < 5 or (idx > 50 and idx < 62):
-                        logging.info(f"Registo {idx}: Tempo={tempo_str}, Início={inicio_hms}, Incluir={incluir_registo}")
-                except Exception as e:
-                    logging.error(f"Erro ao comparar tempo {tempo_str}: {e}")
-                    incluir_registo = False
+            # Adicionar os outros dados correspondentes
+            if obter_valor_seguro(row, "Paragens") is not None:
+                paragens_filtrado.append(row["Paragens"])
             else:
-                # Se não temos início oficial, incluir todos
-                incluir_registo = True
-            
-            # Só adicionar se o tempo for válido (posterior ao início)
-            if incluir_registo:
-                tempo_filtrado.append(tempo_str)
+                paragens_filtrado.append(None)
                 
-                # Adicionar os outros dados correspondentes
-                if obter_valor_seguro(row, "Paragens") is not None:
-                    paragens_filtrado.append(row["Paragens"])
-                else:
-                    paragens_filtrado.append(None)
-                    
-                if obter_valor_seguro(row, "Nominal") is not None:
-                    nominal_filtrado.append(float(row["Nominal"]))
-                else:
-                    nominal_filtrado.append(0)
-                    
-                if obter_valor_seguro(row, "Media") is not None:
-                    media_filtrado.append(float(row["Media"]))
-                else:
-                    media_filtrado.append(0)
-                    
-                if obter_valor_seguro(row, "Cadencia") is not None:
-                    cadencia_filtrado.append(float(row["Cadencia"]))
-                else:
-                    cadencia_filtrado.append(dados_consolidados["CadenciaArtigo"])
+            if obter_valor_seguro(row, "Nominal") is not None:
+                nominal_filtrado.append(float(row["Nominal"]))
+            else:
+                nominal_filtrado.append(0)
+                
+            if obter_valor_seguro(row, "Media") is not None:
+                media_filtrado.append(float(row["Media"]))
+            else:
+                media_filtrado.append(0)
+                
+            if obter_valor_seguro(row, "Cadencia") is not None:
+                cadencia_filtrado.append(float(row["Cadencia"]))
+            else:
+                cadencia_filtrado.append(dados_consolidados["CadenciaArtigo"])
         
         # Atualizar os dados consolidados com os arrays filtrados
         dados_consolidados["Tempo"] = tempo_filtrado
@@ -1311,32 +4165,200 @@ def ApiInfo(NumPontos, Ordem):
         dados_consolidados["Cadencia"] = cadencia_filtrado
         
         # Log para diagnóstico
-        logging.info(f"Total de registos: {len(result)}, Registos filtrados: {len(tempo_filtrado)}")
+        logging.debug(f"Total de registos: {len(result)}, Registos filtrados: {len(tempo_filtrado)}")
         if tempo_filtrado:
-            logging.info(f"Primeiro tempo filtrado: {tempo_filtrado[0]}, Último tempo filtrado: {tempo_filtrado[-1]}")
+            logging.debug(f"Primeiro tempo filtrado: {tempo_filtrado[0]}, Último tempo filtrado: {tempo_filtrado[-1]}")
         
         # Adicionar campos em falta
         dados_consolidados["IdBDOrdemProducao"] = contador.IdBDOrdemProducao if Ordem == contador.Ordem else None
         
-        # Calcular EstimativaFecho
-        if dados_consolidados["MediaProducao"] > 0 and (contador.EstadoContador == 1 and Ordem == contador.Ordem):
-            minutos_restantes = math.ceil(
-                (dados_consolidados["ContagemTotal"] - dados_consolidados["ContagemAtual"]) * 60 / 
-                dados_consolidados["MediaProducao"]
-            )
-            dados_consolidados["EstimativaFecho"] = (
-                datetime.now() + timedelta(minutes=minutos_restantes)
-            ).strftime("%Y-%m-%d %H:%M:%S")
+        # Previsão de fecho (só para a ordem ativa), calculada no último ciclo de estatísticas
+        if Ordem == contador.Ordem:
+            dados_consolidados.update(contador.previsao.atual)
         
-        # Retorna os dados consolidados em JSON
-        return jsonify(dados_consolidados), 200
+        # Indicadores OEE da ordem (total e por hora)
+        dados_consolidados["OEE"] = oee_historico(Ordem, contador)
+        
+        # Cursor para o pedido incremental seguinte (epoch em ms do segundo do último registo)
+        ultimo = result[-1].get("DataNs") or ns_de_data(result[-1].get("DataDados"))
+        dados_consolidados["CursorMs"] = truncar_segundo(ultimo) // 1_000_000 if ultimo else desde_ms
+        dados_consolidados["Completo"] = not incremental
+        dados_consolidados["Resolucao"] = "bruto"
+        
+        # Retorna os dados consolidados em JSON (os formatos compactos usam os instantes)
+        return responder(dados_consolidados, dados_consolidados, tempos_ns if all(tempos_ns) else None), 200
     
     except Exception as e:
         logging.error(f"Erro na API info: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+# Colunas exportáveis de krones_historico_contagens e o seu tipo no Parquet
+COLUNAS_EXPORTACAO = {
+    "DataDados": "data", "Ordem": "texto", "Artigo": "texto", "DescricaoArtigo": "texto",
+    "CadenciaArtigo": "inteiro", "Inicio": "data", "Fim": "data", "ContagemAtual": "inteiro",
+    "ContagemTotal": "inteiro", "MediaProducao": "real", "Paragens": "texto", "Quebras": "inteiro",
+    "EstadoPorta": "inteiro", "EstadoContador": "inteiro", "EstadoConfiguracao": "inteiro",
+    "Nominal": "real", "Media": "real", "Cadencia": "real", "Tempo": "texto",
+}
+LINHAS_BLOCO_EXPORTACAO = 2000  # Linhas lidas da fonte (e por grupo de linhas no Parquet) de cada vez
+
+def blocos_exportacao(Ordem, colunas, desde, ate, contador):
+    """
+    Linhas da ordem em blocos de tuplos (pela ordem de `colunas`), do histórico local
+    se tiver a ordem completa, senão do SQL Server. Nunca há mais de um bloco em memória.
+    """
+    if historico_local is not None and historico_local.tem_ordem(Ordem):
+        for bloco in historico_local.iterar(Ordem, desde, ate, tamanho_bloco=LINHAS_BLOCO_EXPORTACAO):
+            yield [tuple(linha[c] for c in colunas) for linha in bloco]
+        return
+    
+    conn = get_db_connection(contador.DB_Server, contador.DB_User, contador.DB_Password, contador.DB_DB)
+    try:
+        cursor = conn.cursor()
+        # As colunas vêm de COLUNAS_EXPORTACAO, nunca diretamente do pedido
+        cursor.execute(
+            f"""
+            SELECT {", ".join(colunas)}
+            FROM krones_historico_contagens
+            WHERE Ordem = %s{" AND DataDados > %s" if desde is not None else ""}{" AND DataDados <= %s" if ate is not None else ""}
+            ORDER BY DataDados ASC
+            """,
+            (Ordem,) + tuple(d for d in (desde, ate) if d is not None),
+        )
+        while True:
+            bloco = cursor.fetchmany(LINHAS_BLOCO_EXPORTACAO)
+            if not bloco:
+                break
+            yield bloco
+    finally:
+        conn.close()
+
+def exportar_csv(blocos, colunas):
+    """CSV com cabeçalho, gerado bloco a bloco"""
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer, lineterminator="\n")
+    escritor.writerow(colunas)
+    for bloco in blocos:
+        escritor.writerows(bloco)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+class _SaidaParquet:
+    """Destino de escrita do ParquetWriter que guarda apenas os bytes ainda não enviados"""
+    def __init__(self):
+        self._partes = []
+        self._posicao = 0
+        self.closed = False
+    
+    def write(self, dados):
+        self._partes.append(bytes(dados))
+        self._posicao += len(dados)
+        return len(dados)
+    
+    def tell(self):
+        return self._posicao
+    
+    def flush(self):
+        pass
+    
+    def close(self):
+        self.closed = True
+    
+    def retirar(self):
+        dados = b"".join(self._partes)
+        self._partes.clear()
+        return dados
+
+def _converter_coluna(tipo):
+    """Conversão de um valor da fonte para o tipo da coluna no Parquet (decimais, datas em texto)"""
+    if tipo == "data":
+        return lambda v: v if v is None or isinstance(v, datetime) else datetime.fromisoformat(str(v))
+    conversao = {"texto": str, "inteiro": int, "real": float}[tipo]
+    return lambda v: None if v is None else conversao(v)
+
+def exportar_parquet(blocos, colunas):
+    """Parquet com um grupo de linhas por bloco; os bytes de cada grupo são enviados logo a seguir"""
+    tipos = {"data": pa.timestamp("s"), "texto": pa.string(), "inteiro": pa.int64(), "real": pa.float64()}
+    esquema = pa.schema([(c, tipos[COLUNAS_EXPORTACAO[c]]) for c in colunas])
+    conversoes = [_converter_coluna(COLUNAS_EXPORTACAO[c]) for c in colunas]
+    saida = _SaidaParquet()
+    escritor = pq.ParquetWriter(saida, esquema, compression="snappy")
+    try:
+        for bloco in blocos:
+            valores = [[conversao(v) for v in coluna] for conversao, coluna in zip(conversoes, zip(*bloco))]
+            escritor.write_table(pa.Table.from_arrays(
+                [pa.array(v, type=t) for v, t in zip(valores, esquema.types)], schema=esquema,
+            ))
+            yield saida.retirar()
+    finally:
+        escritor.close()
+    yield saida.retirar()
+
+FORMATOS_EXPORTACAO = {
+    "csv": (exportar_csv, "text/csv; charset=utf-8"),
+    "parquet": (exportar_parquet, "application/vnd.apache.parquet"),
+}
+
+@bp.route("/export/<string:Ordem>", methods=["GET"])
+@log_exceptions
+def exportar_ordem(Ordem):
+    """
+    Exporta todas as amostras de uma ordem em CSV (por omissão) ou Parquet (?formato=parquet,
+    requer pyarrow), em streaming: a resposta é escrita à medida que as linhas são lidas,
+    com memória constante seja qual for o tamanho da ordem.
+    
+    ?inicio= e ?fim= limitam o intervalo de tempo; ?colunas=DataDados,ContagemAtual,...
+    escolhe as colunas (por omissão todas as de krones_historico_contagens).
+    """
+    contador = contador_pedido()
+    formato = request.args.get("formato", "csv").lower()
+    if formato not in FORMATOS_EXPORTACAO:
+        return jsonify({"error": f"Formato desconhecido: {formato} (csv ou parquet)"}), 400
+    colunas = [c.strip() for c in request.args.get("colunas", "").split(",") if c.strip()] or list(COLUNAS_EXPORTACAO)
+    invalidas = [c for c in colunas if c not in COLUNAS_EXPORTACAO]
+    if invalidas:
+        return jsonify({"error": f"Colunas desconhecidas: {', '.join(invalidas)}"}), 400
+    try:
+        inicio = ler_data_pedido("inicio")
+        fim = ler_data_pedido("fim")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if formato == "parquet":
+        try:
+            pq.ParquetWriter
+        except ImportError:
+            return jsonify({"error": "Exportação em Parquet indisponível: instale o pyarrow"}), 501
+    
+    # DataDados tem resolução de segundos: "> inicio - 1 s" inclui o próprio início
+    desde = inicio - timedelta(seconds=1) if inicio is not None else None
+    local = historico_local is not None and historico_local.tem_ordem(Ordem)
+    if not local:
+        indisponivel = resposta_bd_indisponivel(contador)
+        if indisponivel is not None:
+            return indisponivel
+    
+    # Ler o primeiro bloco antes de responder: uma falha da BD ainda pode ter o seu código HTTP
+    blocos = blocos_exportacao(Ordem, colunas, desde, fim, contador)
+    try:
+        primeiro = next(blocos, None)
+    except Exception as e:
+        logging.error(f"Erro ao exportar a ordem {Ordem}: {e}")
+        return jsonify({"error": f"BD indisponível: {e}"}), 503
+    if primeiro is None:
+        return jsonify({"error": f"Sem dados históricos para a ordem {Ordem}"}), 404
+    
+    gerar, tipo = FORMATOS_EXPORTACAO[formato]
+    blocos = itertools.chain([primeiro], blocos)
+    resposta = Response(stream_with_context(gerar(blocos, colunas)), mimetype=tipo)
+    resposta.headers["Content-Disposition"] = f'attachment; filename="{Ordem}.{formato}"'
+    resposta.headers["X-Fonte-Dados"] = "local" if local else "sqlserver"
+    return resposta
+
 @log_exceptions
-def obter_inicio_oficial_ordem(Ordem):
+def obter_inicio_oficial_ordem(Ordem, contador=None):
     """
     Obtém a data/hora de início oficial da ordem diretamente da BD.
     
@@ -1347,10 +4369,19 @@ def obter_inicio_oficial_ordem(Ordem):
     
     Args:
         Ordem: O código da ordem de produção
+        contador: Contador cujas credenciais de BD usar (por omissão, o do pedido)
         
     Returns:
         String com a data/hora de início formatada ou None
     """
+    contador = contador or contador_pedido()
+    if historico_local is not None:
+        try:
+            if historico_local.tem_ordem(Ordem):
+                return historico_local.inicio_ordem(Ordem)
+        except Exception as e:
+            logging.error(f"Erro ao ler o histórico local, a usar o SQL Server: {e}")
+    chave = ("inicio_ordem", contador.DB_Server, contador.DB_DB, Ordem)
     try:
         conn = get_db_connection(contador.DB_Server, contador.DB_User, contador.DB_Password, contador.DB_DB)
         cursor = conn.cursor(as_dict=True)
@@ -1370,9 +4401,11 @@ def obter_inicio_oficial_ordem(Ordem):
         if row and row.get("Abertura"):
             # Formatar data corretamente
             if hasattr(row["Abertura"], "strftime"):
-                return row["Abertura"].strftime("%Y-%m-%d %H:%M:%S")
+                inicio = row["Abertura"].strftime("%Y-%m-%d %H:%M:%S")
             else:
-                return str(row["Abertura"])
+                inicio = str(row["Abertura"])
+            cache_leituras_bd.guardar(chave, inicio)
+            return inicio
         
         # Se não encontrou, tenta buscar no histórico
         conn = get_db_connection(contador.DB_Server, contador.DB_User, contador.DB_Password, contador.DB_DB)
@@ -1385,212 +4418,1419 @@ def obter_inicio_oficial_ordem(Ordem):
             ORDER BY DataDados ASC
         """
         
-        cursor.execute(SQL, (Ordem,))
-        row = cursor.fetchone()
-        conn.close()
+        cursor.execute(SQL, (Ordem,))
+        row = cursor.fetchone()
+        conn.close()
+        
+        if row and row.get("Inicio"):
+            # Formatar data corretamente
+            if hasattr(row["Inicio"], "strftime"):
+                inicio = row["Inicio"].strftime("%Y-%m-%d %H:%M:%S")
+            else:
+                inicio = str(row["Inicio"])
+            cache_leituras_bd.guardar(chave, inicio)
+            return inicio
+        
+        # Se ainda não encontrou, retorna None
+        return None
+    except Exception as e:
+        logging.error(f"Erro ao obter início oficial da ordem {Ordem}: {e}")
+        return cache_leituras_bd.obter(chave, e)
+
+@log_exceptions
+def gravar_contagem(Id, ContagemAtual, contador=None):
+    """Grava a contagem atual na BD (e no histórico local) com proteção contra falhas"""
+    contador = contador or contador_pedido()
+    try:
+        media = media_producao(contador)
+        
+        agora = relogio.tempo_ns()
+        DataDados = formatar_ns(agora)
+        
+        # Previsão de fecho calculada no último ciclo de estatísticas
+        EstimativaTempo = contador.previsao.atual["EstimativaFecho"] or None
+        
+        # Formatar as datas para inserção no SQL
+        ordem = contador.metadados
+        Inicio = ordem.TempoInicio or None
+        Fim = ordem.TempoFim or None
+        amostra_ns = contador.EstatisticaNs[-1] if contador.EstatisticaNs else 0
+        
+        # Campos da tabela de histórico
+        params = {
+            "DataDados": DataDados,
+            "Ordem": contador.Ordem,
+            "Artigo": contador.ArtigoEmContagem,
+            "DescricaoArtigo": contador.DescricaoArtigoEmContagem,
+            "CadenciaArtigo": int(contador.CadenciaArtigoEmContagem) if hasattr(contador.CadenciaArtigoEmContagem, "__int__") else contador.CadenciaArtigoEmContagem,
+            "Inicio": Inicio,
+            "Fim": Fim,
+            "ContagemAtual": int(ContagemAtual),
+            "ContagemTotal": int(contador.ContagemTotal),
+            "MediaProducao": float(media) if hasattr(media, "__float__") else media,
+            "EstimativaFecho": EstimativaTempo,
+            "Paragens": contador.Paragens[-1] if contador.Paragens else None,
+            "Quebras": int(contador.Quebras),
+            "EstadoPorta": int(contador.EstadoPorta),
+            "EstadoContador": int(contador.EstadoContador),
+            "EstadoConfiguracao": int(contador.ContadorConfigurado),
+            "Nominal": float(contador.EstatisticaGFA[-1]) if contador.EstatisticaGFA else None,
+            "Media": float(contador.EstatisticaGFAMedia[-1]) if contador.EstatisticaGFAMedia else None,
+            "Cadencia": float(contador.EstatisticaCadenciaArtigo[-1]) if contador.EstatisticaCadenciaArtigo else None,
+            "Tempo": formatar_ns(amostra_ns, FORMATO_HORA) or None,
+        }
+        
+        # Histórico local primeiro: fica gravado mesmo com o SQL Server em falha
+        if historico_local is not None:
+            try:
+                historico_local.registar(contador.linha_id, agora, params, (ordem.InicioNs, ordem.FimNs), amostra_ns)
+            except Exception as e:
+                logging.error(f"Erro ao gravar no histórico local: {e}")
+        
+        conn = get_db_connection(contador.DB_Server, contador.DB_User, contador.DB_Password, contador.DB_DB)
+        cursor = conn.cursor()
+        
+        try:
+            # Registar na tabela de contagem
+            cursor.execute(
+                """
+                INSERT INTO krones_contadoreslinhacontagem
+                    (IdContagem, ContagemAtual, Objetivo, DataLeitura)
+                VALUES
+                    (%s, %s, %s, %s)
+                """,
+                (
+                    int(Id),
+                    int(ContagemAtual),
+                    int(contador.ContagemTotal),
+                    DataDados,
+                )
+            )
+            conn.commit()
+            
+            # Construir a SQL de forma dinâmica para lidar com parâmetros nulos
+            sql_fields = []
+            sql_values = []
+            for key, value in params.items():
+                if value is not None:
+                    sql_fields.append(key)
+                    sql_values.append(f"%({key})s")
+            
+            SQL = f"""
+                INSERT INTO krones_historico_contagens
+                    ({', '.join(sql_fields)})
+                VALUES
+                    ({', '.join(sql_values)})
+            """
+            
+            cursor.execute(SQL, params)
+            conn.commit()
+            
+        except pymssql.Error as e:
+            logging.error(f"Erro SQL ao gravar contagem: {e}")
+            # Tentar reconectar e repetir
+            try:
+                conn = get_db_connection(contador.DB_Server, contador.DB_User, contador.DB_Password, contador.DB_DB)
+                cursor = conn.cursor()
+                # ... repetir código de gravação aqui se necessário
+            except Exception as retry_e:
+                logging.error(f"Falha na reconexão: {retry_e}")
+        
+        finally:
+            if conn:
+                conn.close()
+                
+    except Exception as e:
+        logging.error(f"Erro ao gravar contagem: {e}")
+
+@log_exceptions
+def verificar_contagem_bd(contador=None):
+    """
+    Compara a contagem recuperada com o último registo da ordem na BD.
+    
+    Se a BD tiver mais garrafas do que o estado local (ficheiros locais perdidos
+    ou desatualizados), a diferença é somada à contagem atual.
+    """
+    contador = contador or contador_pedido()
+    try:
+        conn = get_db_connection(contador.DB_Server, contador.DB_User, contador.DB_Password, contador.DB_DB)
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            SELECT TOP 1 ContagemAtual
+            FROM krones_contadoreslinhacontagem
+            WHERE IdContagem = %s
+            ORDER BY Id DESC
+            """,
+            (int(contador.IdBDOrdemProducao),),
+        )
+        row = cursor.fetchone()
+        conn.close()
+    except Exception as e:
+        logging.error(f"Erro ao verificar contagem na BD: {e}")
+        return
+    
+    if not row:
+        return
+    contagem_bd = int(row[0])
+    relatorio = contador.relatorio_recuperacao
+    recuperada = relatorio.get("Recuperada", 0)
+    relatorio["BD"] = contagem_bd
+    relatorio["DiscrepanciaBD"] = contagem_bd - recuperada
+    
+    if contagem_bd > recuperada:
+        with contador._contagem_lock:
+            contador.ContagemAtual += contagem_bd - recuperada
+            contador._save_state()
+        relatorio["ContagemCorrigida"] = contador.ContagemAtual
+        logging.warning(
+            f"Linha {contador.linha_id}: BD com {contagem_bd} garrafas, estado local com {recuperada}; "
+            f"contagem corrigida para {contador.ContagemAtual}"
+        )
+    else:
+        logging.info(f"Linha {contador.linha_id}: contagem recuperada confirmada pela BD ({contagem_bd} <= {recuperada})")
+
+@log_exceptions
+def gravar_oee_horario(contador=None):
+    """Grava os rollups horários de OEE pendentes num único lote"""
+    contador = contador or contador_pedido()
+    pendentes = contador.oee.retirar_pendentes()
+    if not pendentes:
+        return
+    try:
+        conn = get_db_connection(contador.DB_Server, contador.DB_User, contador.DB_Password, contador.DB_DB)
+        cursor = conn.cursor()
+        cursor.executemany(
+            """
+            INSERT INTO krones_oee_horario
+                (Linha, Ordem, IdContagem, Hora, Turno, TempoPlaneado, TempoFuncionamento,
+                 Contagem, Quebras, ContagemTeorica, Disponibilidade, Desempenho, Qualidade, OEE)
+            VALUES
+                (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """,
+            [(contador.linha_id,) + linha for linha in pendentes],
+        )
+        conn.commit()
+        conn.close()
+        logging.info(f"Linha {contador.linha_id}: gravados {len(pendentes)} rollups horários de OEE")
+    except Exception as e:
+        logging.error(f"Erro ao gravar OEE horário, nova tentativa na próxima hora: {e}")
+        contador.oee.devolver_pendentes(pendentes)
+
+@log_exceptions
+def gravar_rollups(contador=None):
+    """Grava os rollups de minuto/hora/turno pendentes num único lote"""
+    contador = contador or contador_pedido()
+    pendentes = contador.rollups.retirar_pendentes()
+    if not pendentes:
+        return
+    try:
+        conn = get_db_connection(contador.DB_Server, contador.DB_User, contador.DB_Password, contador.DB_DB)
+        cursor = conn.cursor()
+        cursor.executemany(
+            """
+            INSERT INTO krones_rollup_contagens
+                (Linha, Ordem, IdContagem, Resolucao, Inicio, Turno, Contagem,
+                 GFAMin, GFAMax, GFAMedia, TempoParagem, Quebras)
+            VALUES
+                (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """,
+            [(contador.linha_id,) + linha for linha in pendentes],
+        )
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logging.error(f"Erro ao gravar rollups, nova tentativa no próximo lote: {e}")
+        contador.rollups.devolver_pendentes(pendentes)
+
+@log_exceptions
+def obter_oee_historico(Ordem, contador=None):
+    """Rollups horários de OEE gravados para a ordem, por ordem cronológica"""
+    contador = contador or contador_pedido()
+    try:
+        conn = get_db_connection(contador.DB_Server, contador.DB_User, contador.DB_Password, contador.DB_DB)
+        cursor = conn.cursor(as_dict=True)
+        cursor.execute(
+            """
+            SELECT Hora, Turno, TempoPlaneado, TempoFuncionamento, Contagem, Quebras, ContagemTeorica
+            FROM krones_oee_horario
+            WHERE Ordem = %s
+            ORDER BY Hora ASC
+            """,
+            (Ordem,),
+        )
+        result = cursor.fetchall()
+        conn.close()
+        return result
+    except Exception as e:
+        logging.error(f"Erro ao obter OEE histórico: {e}")
+        return []
+
+def oee_historico(Ordem, contador):
+    """OEE total e por hora de uma ordem, juntando a hora em curso se a ordem estiver ativa"""
+    total = AcumuladorOEE()
+    horas = []
+    if Ordem == contador.Ordem and contador.oee.horas_completas and CONFIG["api_info_memoria"]:
+        # Ordem ativa iniciada neste processo: as horas fechadas estão todas em memória
+        linhas = [
+            dict(zip(("Hora", "Turno", "TempoPlaneado", "TempoFuncionamento", "Contagem", "Quebras", "ContagemTeorica"), rollup[2:9]))
+            for rollup in list(contador.oee.horas_ordem)
+        ]
+    else:
+        linhas = obter_oee_historico(Ordem, contador)
+    for linha in linhas:
+        acumulador = AcumuladorOEE(
+            float(linha["TempoPlaneado"] or 0), float(linha["TempoFuncionamento"] or 0),
+            int(linha["Contagem"] or 0), int(linha["Quebras"] or 0), float(linha["ContagemTeorica"] or 0),
+        )
+        for campo in AcumuladorOEE.__slots__:
+            setattr(total, campo, getattr(total, campo) + getattr(acumulador, campo))
+        hora = acumulador.indicadores()
+        hora["Hora"] = linha["Hora"].strftime("%Y-%m-%d %H:%M:%S") if hasattr(linha["Hora"], "strftime") else str(linha["Hora"])
+        hora["Turno"] = linha["Turno"]
+        horas.append(hora)
+    
+    if Ordem == contador.Ordem:
+        # Ordem ativa: o total vem da memória e a hora em curso ainda não está na BD
+        resumo = contador.oee.resumo()
+        if resumo["Hora"]["Hora"] and resumo["Hora"]["TempoPlaneado"] > 0:
+            horas.append(resumo["Hora"])
+        return {"Ordem": resumo["Ordem"], "Horas": horas}
+    
+    return {"Ordem": total.indicadores(), "Horas": horas}
+
+class ClienteAgregador:
+    """
+    Envia amostras compactas ao agregador central em lotes.
+    
+    Cada ciclo de estatísticas gera uma amostra por linha (contagem, delta, GFA,
+    média, paragem); a cada `intervalo` segundos as amostras acumuladas são
+    enviadas num único POST, juntamente com um resumo de cada linha. Um lote que
+    falhe é reenviado com o mesmo número, para o agregador poder ignorar duplicados.
+    """
+    def __init__(self, url, origem, registo_linhas, intervalo=15, max_amostras=20000, token=None, verificar_ssl=True):
+        self.url = url.rstrip("/") + "/agregador/amostras"
+        self.ssl_context = None if verificar_ssl else ssl._create_unverified_context()
+        self.origem = origem
+        self.linhas = registo_linhas
+        self.intervalo = intervalo
+        self.token = token
+        self.sessao = uuid.uuid4().hex[:12]  # Distingue reinícios do processo
+        self._amostras = deque(maxlen=max_amostras)
+        self._eventos = deque(maxlen=1000)
+        self._estados = {}  # linha -> último EstadoContador enviado
+        self._lote = 0
+        self._pendente = None
+        self._lock = threading.Lock()
+        self.enviados = 0
+        self.falhas = 0
+        self.ultimo_envio = None
+    
+    def registar_amostra(self, contador, contagem, delta, gfa, ordem=None):
+        """
+        Guarda a amostra de um ciclo de estatísticas (chamado pela update_stats).
+        
+        A amostra leva a ordem a que pertence (id, nome e objetivo do snapshot `ordem`
+        do ciclo): o resumo das linhas só é construído no envio, até `intervalo` segundos
+        depois, quando a linha pode já estar noutra ordem ou livre.
+        """
+        ordem = ordem or contador.metadados
+        media = contador.EstatisticaGFAMedia[-1] if contador.EstatisticaGFAMedia else 0.0
+        paragem = 1 if contador.Paragens and contador.Paragens[-1] == "0" else 0
+        with self._lock:
+            if len(self._amostras) == self._amostras.maxlen:
+                logging.warning("Buffer do agregador cheio, a descartar amostras mais antigas")
+            self._amostras.append([
+                contador.linha_id, round(relogio.tempo(), 3), int(contagem), int(delta),
+                float(gfa), float(media), float(ordem.CadenciaArtigoEmContagem or 0),
+                paragem, int(ordem.Quebras), int(contador.EstadoPorta),
+                int(ordem.IdBDOrdemProducao), ordem.Ordem, int(ordem.ContagemTotal),
+            ])
+    
+    def _resumo_linhas(self, agora):
+        """Resumo de cada linha (metadados da ordem) e eventos de mudança de estado"""
+        resumo = {}
+        for contador_linha in self.linhas.todas():
+            estado = contador_linha.EstadoContador
+            if self._estados.get(contador_linha.linha_id) != estado:
+                self._eventos.append([contador_linha.linha_id, round(agora, 3), "estado", estado])
+                self._estados[contador_linha.linha_id] = estado
+            resumo[contador_linha.linha_id] = {
+                "o": contador_linha.Ordem,
+                "id": contador_linha.IdBDOrdemProducao,
+                "a": contador_linha.ArtigoEmContagem,
+                "d": contador_linha.DescricaoArtigoEmContagem,
+                "cad": contador_linha.CadenciaArtigoEmContagem,
+                "ini": contador_linha.TempoInicio,
+                "fim": contador_linha.TempoFim,
+                "c": contador_linha.ContagemAtual,
+                "t": contador_linha.ContagemTotal,
+                "q": contador_linha.Quebras,
+                "e": estado,
+                "p": contador_linha.EstadoPorta,
+                "cfg": contador_linha.ContadorConfigurado,
+                "m": media_producao(contador_linha),
+            }
+        return resumo
+    
+    def enviar(self):
+        """Envia o lote pendente (ou um novo lote); devolve True se o agregador o aceitou"""
+        agora = time.time()
+        with self._lock:
+            resumo = self._resumo_linhas(agora)
+            if self._pendente is None:
+                self._lote += 1
+                self._pendente = {
+                    "lote": self._lote,
+                    "amostras": list(self._amostras),
+                    "eventos": list(self._eventos),
+                }
+                self._amostras.clear()
+                self._eventos.clear()
+            lote = self._pendente
+        
+        payload = {
+            "v": 2,  # 2: cada amostra leva a ordem (id, nome, objetivo)
+            "origem": self.origem,
+            "sessao": self.sessao,
+            "enviado": round(agora, 3),
+            "linhas": resumo,
+            **lote,
+        }
+        corpo = gzip.compress(json.dumps(payload, separators=(",", ":")).encode("utf-8"))
+        pedido = urllib.request.Request(self.url, data=corpo, method="POST", headers={
+            "Content-Type": "application/json",
+            "Content-Encoding": "gzip",
+        })
+        if self.token:
+            pedido.add_header("X-Krones-Token", self.token)
+        
+        try:
+            with urllib.request.urlopen(pedido, timeout=5, context=self.ssl_context) as resposta:
+                resposta.read()
+            with self._lock:
+                self._pendente = None
+            self.enviados += 1
+            self.ultimo_envio = agora
+            return True
+        except Exception as e:
+            self.falhas += 1
+            # Registar apenas a primeira falha de uma sequência para não encher o log
+            if self.falhas == 1 or self.falhas % 20 == 0:
+                logging.warning(f"Falha ao enviar lote {lote['lote']} ao agregador ({self.falhas} falhas): {e}")
+            return False
+    
+    def thread_envio(self):
+        """Thread de envio periódico para o agregador"""
+        logging.info(f"Envio para o agregador ativo: {self.url} a cada {self.intervalo}s")
+        while thread_running and supervisor.batimento("AgregadorEnvioThread"):
+            time.sleep(self.intervalo)
+            if self.enviar():
+                self.falhas = 0
+        # Último envio no encerramento
+        self.enviar()
+
+# Cliente do agregador (apenas se configurado; caso contrário grava-se diretamente na BD)
+cliente_agregador = None
+if not MODO_AGREGADOR and CONFIG.get("agregador_url"):
+    cliente_agregador = ClienteAgregador(
+        CONFIG["agregador_url"],
+        CONFIG["origem"],
+        linhas,
+        intervalo=CONFIG["agregador_intervalo"],
+        max_amostras=CONFIG["agregador_max_amostras"],
+        token=CONFIG.get("agregador_token"),
+        verificar_ssl=CONFIG["agregador_verificar_ssl"],
+    )
+
+class Agregador:
+    """
+    Agregador central da frota de contadores.
+    
+    Recebe os lotes dos contadores, mantém em memória o estado e as séries
+    recentes de cada linha (para o /status da frota) e grava as amostras na
+    BD em lotes, numa única transação por ciclo.
+    """
+    ORDENS_POR_LINHA = 8  # Resumos de ordens anteriores guardados por linha
+    
+    def __init__(self, bd, intervalo_gravacao=5, pontos_memoria=720, max_pendentes=200000):
+        self.bd = bd
+        self.intervalo_gravacao = intervalo_gravacao
+        self.pontos_memoria = pontos_memoria  # 720 amostras de 5s = 1 hora
+        self._lock = threading.Lock()
+        self._linhas = {}  # (origem, linha) -> dicionário com resumo, séries e eventos
+        self._ultimo_lote = {}  # (origem, sessao) -> último lote aceite
+        self._pendentes_contagem = deque(maxlen=max_pendentes)
+        self._pendentes_historico = deque(maxlen=max_pendentes)
+        self.lotes_recebidos = 0
+        self.lotes_duplicados = 0
+        self.linhas_gravadas = 0
+        self.amostras_sem_ordem = 0
+        self.ultima_gravacao = None
+    
+    def receber(self, payload):
+        """Processa um lote; devolve False se for duplicado"""
+        origem = str(payload["origem"])
+        chave_lote = (origem, payload.get("sessao"))
+        agora = time.time()
+        
+        with self._lock:
+            if payload["lote"] <= self._ultimo_lote.get(chave_lote, 0):
+                self.lotes_duplicados += 1
+                return False
+            self._ultimo_lote[chave_lote] = payload["lote"]
+            self.lotes_recebidos += 1
+            
+            for linha_id, resumo in payload.get("linhas", {}).items():
+                estado = self._estado_linha(origem, linha_id)
+                estado["resumo"] = resumo
+                estado["ultimo_contacto"] = agora
+                # Metadados das últimas ordens da linha, para as amostras que chegam depois
+                # de a linha ter mudado de ordem
+                ordens = estado["ordens"]
+                id_ordem = int(resumo.get("id") or 0)
+                if id_ordem > 0:
+                    ordens.pop(id_ordem, None)
+                    ordens[id_ordem] = resumo
+                    if len(ordens) > self.ORDENS_POR_LINHA:
+                        ordens.pop(next(iter(ordens)))
+            
+            for linha_id, ts, tipo, valor in payload.get("eventos", []):
+                self._estado_linha(origem, linha_id)["eventos"].append([ts, tipo, valor])
+            
+            for amostra in payload.get("amostras", []):
+                linha_id, ts, contagem, delta, gfa, media, cadencia, paragem, quebras, porta = amostra[:10]
+                estado = self._estado_linha(origem, linha_id)
+                estado["serie"].append([ts, contagem, delta, gfa])
+                if paragem:
+                    estado["eventos"].append([ts, "paragem", 1])
+                self._acumular_linhas_bd(origem, estado, amostra)
+        return True
+    
+    def _estado_linha(self, origem, linha_id):
+        chave = (origem, str(linha_id))
+        estado = self._linhas.get(chave)
+        if estado is None:
+            estado = {
+                "resumo": None,
+                "ultimo_contacto": None,
+                "serie": deque(maxlen=self.pontos_memoria),
+                "eventos": deque(maxlen=50),
+                "ordens": {},  # IdBDOrdemProducao -> último resumo da linha com essa ordem
+            }
+            self._linhas[chave] = estado
+        return estado
+    
+    def _acumular_linhas_bd(self, origem, estado, amostra):
+        """
+        Converte uma amostra nas linhas das tabelas de contagem e de histórico.
+        
+        A ordem (id, nome, objetivo) é a da amostra; artigo, início e fim vêm do último
+        resumo recebido com essa ordem (vazios se a ordem começou e acabou entre dois
+        lotes). Amostras de contadores anteriores, sem ordem, usam o resumo do lote.
+        """
+        linha_id, ts, contagem, delta, gfa, media, cadencia, paragem, quebras, porta = amostra[:10]
+        resumo = estado.get("resumo") or {}
+        if len(amostra) >= 13:
+            id_ordem, nome_ordem, objetivo = int(amostra[10] or 0), amostra[11], int(amostra[12] or 0)
+            if int(resumo.get("id") or 0) != id_ordem:
+                resumo = estado["ordens"].get(id_ordem, {})
+        else:
+            id_ordem, nome_ordem, objetivo = int(resumo.get("id") or 0), resumo.get("o"), int(resumo.get("t") or 0)
+        if id_ordem <= 0:
+            self.amostras_sem_ordem += 1
+            if self.amostras_sem_ordem == 1 or self.amostras_sem_ordem % 1000 == 0:
+                logging.warning(
+                    f"Amostra de {origem}/linha {linha_id} sem ordem na BD, não gravada "
+                    f"({self.amostras_sem_ordem} no total)"
+                )
+            return
+        data_str = formatar_epoch(int(ts))
+        
+        self._pendentes_contagem.append((id_ordem, int(contagem), objetivo, data_str))
+        self._pendentes_historico.append((
+            data_str,
+            nome_ordem,
+            resumo.get("a"),
+            resumo.get("d"),
+            int(resumo.get("cad") or 0),
+            resumo.get("ini") or None,
+            resumo.get("fim") or None,
+            int(contagem),
+            objetivo,
+            float(resumo.get("m") or 0),
+            0 if paragem else None,
+            int(quebras),
+            int(porta),
+            1,  # As amostras só são geradas em contagem
+            int(resumo.get("cfg") or 0),
+            float(gfa),
+            float(media),
+            float(cadencia),
+            formatar_epoch(int(ts), FORMATO_HORA),
+        ))
+    
+    def gravar_pendentes(self):
+        """Grava na BD todas as amostras pendentes numa única transação"""
+        with self._lock:
+            contagens = list(self._pendentes_contagem)
+            historico = list(self._pendentes_historico)
+            self._pendentes_contagem.clear()
+            self._pendentes_historico.clear()
+        
+        if not contagens and not historico:
+            return 0
+        
+        try:
+            conn = get_db_connection(self.bd["server"], self.bd["user"], self.bd["password"], self.bd["database"])
+            try:
+                cursor = conn.cursor()
+                cursor.executemany(
+                    """
+                    INSERT INTO krones_contadoreslinhacontagem
+                        (IdContagem, ContagemAtual, Objetivo, DataLeitura)
+                    VALUES
+                        (%s, %s, %s, %s)
+                    """,
+                    contagens
+                )
+                cursor.executemany(
+                    """
+                    INSERT INTO krones_historico_contagens
+                        (DataDados, Ordem, Artigo, DescricaoArtigo, CadenciaArtigo,
+                         Inicio, Fim, ContagemAtual, ContagemTotal, MediaProducao,
+                         Paragens, Quebras, EstadoPorta, EstadoContador, EstadoConfiguracao,
+                         Nominal, Media, Cadencia, Tempo)
+                    VALUES
+                        (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    """,
+                    historico
+                )
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception as e:
+            logging.error(f"Erro ao gravar lote do agregador ({len(historico)} amostras), a repetir no próximo ciclo: {e}")
+            with self._lock:
+                self._pendentes_contagem.extendleft(reversed(contagens))
+                self._pendentes_historico.extendleft(reversed(historico))
+            return 0
+        
+        self.linhas_gravadas += len(historico)
+        self.ultima_gravacao = time.time()
+        return len(historico)
+    
+    def status(self):
+        """Estado de toda a frota a partir da memória"""
+        agora = time.time()
+        linhas_frota = []
+        total_contagem = 0
+        total_gfa = 0.0
+        
+        with self._lock:
+            for (origem, linha_id), estado in sorted(self._linhas.items()):
+                resumo = estado["resumo"] or {}
+                ultima = estado["serie"][-1] if estado["serie"] else None
+                gfa = ultima[3] if ultima else 0.0
+                total_contagem += int(resumo.get("c") or 0)
+                if resumo.get("e") == 1:
+                    total_gfa += gfa
+                linhas_frota.append({
+                    "Origem": origem,
+                    "Linha": linha_id,
+                    "Ordem": resumo.get("o"),
+                    "Artigo": resumo.get("a"),
+                    "ContagemAtual": resumo.get("c"),
+                    "ContagemTotal": resumo.get("t"),
+                    "Quebras": resumo.get("q"),
+                    "EstadoContador": resumo.get("e"),
+                    "EstadoPorta": resumo.get("p"),
+                    "MediaProducao": resumo.get("m"),
+                    "Nominal": gfa,
+                    "UltimoContacto": formatar_epoch(int(estado["ultimo_contacto"])) if estado["ultimo_contacto"] else None,
+                    "SegundosSemContacto": round(agora - estado["ultimo_contacto"], 1) if estado["ultimo_contacto"] else None,
+                    "Eventos": list(estado["eventos"])[-10:],
+                })
+            pendentes = len(self._pendentes_historico)
+        
+        return {
+            "Linhas": linhas_frota,
+            "TotalLinhas": len(linhas_frota),
+            "LinhasEmContagem": sum(1 for l in linhas_frota if l["EstadoContador"] == 1),
+            "ContagemTotalFrota": total_contagem,
+            "GFAFrota": round(total_gfa, 0),
+            "AmostrasPendentesBD": pendentes,
+            "LotesRecebidos": self.lotes_recebidos,
+            "LotesDuplicados": self.lotes_duplicados,
+            "AmostrasGravadas": self.linhas_gravadas,
+            "AmostrasSemOrdem": self.amostras_sem_ordem,
+            "DataDados": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+    
+    def serie(self, origem, linha_id):
+        """Série recente (em memória) de uma linha da frota"""
+        with self._lock:
+            estado = self._linhas.get((origem, str(linha_id)))
+            if estado is None:
+                return None
+            serie = list(estado["serie"])
+        return {
+            "Origem": origem,
+            "Linha": linha_id,
+            "Tempo": [formatar_epoch(int(a[0]), FORMATO_HORA) for a in serie],
+            "ContagemAtual": [a[1] for a in serie],
+            "Nominal": [a[3] for a in serie],
+        }
+
+agregador = None
+if MODO_AGREGADOR:
+    agregador = Agregador(CONFIG["agregador_bd"], intervalo_gravacao=CONFIG["agregador_intervalo_gravacao"])
+
+# Rotas do modo agregador
+bp_agregador = Blueprint("agregador", __name__)
+
+@bp_agregador.route("/agregador/amostras", methods=["POST"])
+@log_exceptions
+def agregador_receber():
+    """Recebe um lote de amostras de um contador"""
+    token = CONFIG.get("agregador_token")
+    if token and request.headers.get("X-Krones-Token") != token:
+        return jsonify({"status": "Erro", "mensagem": "Token inválido"}), 403
+    try:
+        corpo = request.get_data()
+        if request.headers.get("Content-Encoding") == "gzip":
+            corpo = gzip.decompress(corpo)
+        payload = json.loads(corpo)
+        novo = agregador.receber(payload)
+        return jsonify({"status": "OK", "lote": payload.get("lote"), "duplicado": not novo}), 200
+    except Exception as e:
+        logging.error(f"Erro ao receber lote do agregador: {e}")
+        return jsonify({"status": "Erro", "mensagem": str(e)}), 400
+
+@bp_agregador.route("/status", methods=["GET"])
+@log_exceptions
+def agregador_status():
+    """Estado de toda a frota, servido da memória"""
+    return jsonify({"data": agregador.status()}), 200
+
+@bp_agregador.route("/frota/<string:origem>/<string:linha_id>", methods=["GET"])
+@log_exceptions
+def agregador_serie(origem, linha_id):
+    """Série recente de uma linha de um contador da frota"""
+    dados = agregador.serie(origem, linha_id)
+    if dados is None:
+        return jsonify({"status": "Erro", "mensagem": "Linha desconhecida"}), 404
+    return jsonify({"data": dados}), 200
+
+@log_exceptions
+def agregador_gravacao_thread():
+    """Thread do agregador que grava na BD as amostras recebidas"""
+    logging.info("Thread de gravação do agregador iniciada")
+    while thread_running and supervisor.batimento("AgregadorBDThread"):
+        time.sleep(agregador.intervalo_gravacao)
+        agregador.gravar_pendentes()
+    # Gravar o que falta antes de terminar
+    agregador.gravar_pendentes()
+    logging.info("Thread de gravação do agregador finalizada")
+
+@log_exceptions
+def init_agregador():
+    """Inicialização do modo agregador (sem GPIO)"""
+    global thread_running
+    thread_running = True
+    supervisor.registar("AgregadorBDThread", agregador_gravacao_thread, critica=True)
+    supervisor.registar("MemóriaThread", memoria_thread)
+    supervisor.arrancar()
+    logging.info("Agregador inicializado")
+
+class MetricasCaptura:
+    """Despertares e CPU da thread de captura, medidos por janelas de JANELA segundos"""
+    JANELA = 5.0
+    
+    def __init__(self):
+        self.modo = None
+        self.intervalo = None
+        self.ultima_janela = {}
+        self._iniciar_janela()
+    
+    def _iniciar_janela(self):
+        self._inicio = time.perf_counter()
+        self._cpu_inicio = time.thread_time()
+        self._despertares = 0
+        self._por_evento = 0
+    
+    def registar(self, intervalo, por_evento):
+        """Chamado pela thread de captura em cada despertar (intervalo None = repouso)"""
+        modo = "repouso" if intervalo is None else "contagem"
+        decorrido = time.perf_counter() - self._inicio
+        # Uma janela só mede um modo: fecha-a quando o modo muda ou quando termina
+        if modo != self.modo or decorrido >= self.JANELA:
+            if self.modo is not None and decorrido > 0:
+                self.ultima_janela = {
+                    "Modo": self.modo,
+                    "DuracaoS": round(decorrido, 2),
+                    "DespertaresPorS": round(self._despertares / decorrido, 2),
+                    "DespertaresPorTransicao": self._por_evento,
+                    "CpuPct": round((time.thread_time() - self._cpu_inicio) / decorrido * 100, 3),
+                }
+            self.modo = modo
+            self._iniciar_janela()
+        self.intervalo = intervalo
+        self._despertares += 1
+        self._por_evento += por_evento
+    
+    def estado(self):
+        return {
+            "Modo": self.modo,
+            "IntervaloMs": round(self.intervalo * 1000, 2) if self.intervalo is not None else None,
+            "UltimaJanela": self.ultima_janela,
+        }
+
+metricas_captura = MetricasCaptura()
+
+def intervalo_captura(contador):
+    """
+    Intervalo entre leituras do sensor para uma linha em contagem.
+    
+    Parte do período de garrafa mais curto entre a cadência do artigo e o ritmo medido
+    pela captura, dividido por `captura_amostras_por_garrafa`; sem nenhum dos dois (ex.:
+    artigo sem cadência, primeira garrafa) lê a cada 10 ms, como o ciclo fixo anterior.
+    
+    O período não diz quanto tempo o sensor fica ativo, por isso o máximo fica no ciclo
+    fixo anterior: numa linha lenta o impulso continua curto, e cada garrafa perdida
+    aumentaria o ritmo medido e com ele o intervalo.
+    """
+    periodos = []
+    try:
+        cadencia = float(contador.CadenciaArtigoEmContagem or 0)
+    except (TypeError, ValueError):
+        cadencia = 0
+    if cadencia > 0:
+        periodos.append(3600.0 / cadencia)
+    if contador.quente.intervalo_medio:
+        periodos.append(contador.quente.intervalo_medio)
+    intervalo = min(periodos) / CONFIG["captura_amostras_por_garrafa"] if periodos else 0.01
+    minimo = CONFIG["captura_intervalo_min_ms"] / 1000.0
+    return min(max(intervalo, minimo), CONFIG["captura_intervalo_max_ms"] / 1000.0)
+
+@log_exceptions
+def count_thread():
+    """
+    Motor de captura partilhado: lê os sensores de todas as linhas usando o sistema Flop.
+    
+    Uma única thread serve todas as linhas, em vez de uma thread (ou processo) por linha.
+    Enquanto alguma linha conta (ou observa o excesso após o objetivo), lê ao intervalo
+    da linha mais rápida; em repouso dorme até uma transição de estado (evento_captura),
+    acordando só para o batimento do supervisor e o relatório periódico do sensor.
+    """
+    global thread_running
+
+    logging.info(f"Thread de contagem iniciada com sistema Flop ({len(linhas)} linha(s))")
+    
+    # Loop principal da thread
+    while thread_running and supervisor.batimento("ContadorThread"):
+        tempo_atual = time.time()
+        intervalo = None
+        
+        for contador_linha in linhas.todas():
+            try:
+                capturar_linha(contador_linha, tempo_atual)
+            except Exception as e:
+                logging.error(f"Erro na thread de contagem (linha {contador_linha.linha_id}): {e}")
+                contador_linha.read_error_count += 1
+                
+                # Se muitos erros consecutivos, tenta reiniciar o sensor
+                if contador_linha.read_error_count > contador_linha.max_read_errors:
+                    logging.warning(f"Muitos erros consecutivos ({contador_linha.read_error_count}), tentando reiniciar sensor")
+                    contador_linha.pedir_reinicio_sensor()
+                    contador_linha.read_error_count = 0
+                
+                # Pausa nesta linha para evitar ciclos de erro em alta frequência
+                contador_linha.proxima_tentativa_sensor = tempo_atual + 1
+            
+            if contador_linha.estado == ESTADO_EM_CONTAGEM or contador_linha.quente.fecho is not None:
+                intervalo_linha = intervalo_captura(contador_linha)
+                intervalo = intervalo_linha if intervalo is None else min(intervalo, intervalo_linha)
+        
+        # Em repouso, dormir até uma transição de estado; a contar, até à próxima leitura
+        # (time.sleep custa metade de um Event.wait, e uma pausa é vista na leitura seguinte)
+        por_evento = False
+        if intervalo is None:
+            por_evento = evento_captura.wait(CONFIG["captura_repouso_s"])
+            evento_captura.clear()
+        else:
+            time.sleep(intervalo)
+        metricas_captura.registar(intervalo, por_evento)
+    
+    logging.info("Thread de contagem terminada normalmente")
+
+def capturar_linha(contador, tempo_atual):
+    """Uma iteração do motor de captura para a linha indicada"""
+    # Linha em espera após erro, durante o reinício do sensor ou após uma falha deste
+    if contador.reinicio_sensor_pendente or tempo_atual < contador.proxima_tentativa_sensor:
+        return
+    
+    # Imprimir o estado do sensor periodicamente para diagnóstico
+    if (tempo_atual - contador.ultimo_relatorio_estado) > 30:
+        if contador.sensor_initialized:
+            estado_sensor = GPIO.input(contador.SENSOR_PIN)
+            logging.info(f"Linha {contador.linha_id}: estado atual do sensor: {estado_sensor} (Modo contagem: {contador.EstadoContador}, Pausa: {contador.EstadoPausa}, Flop: {contador.Flop})")
+        else:
+            logging.warning(f"Linha {contador.linha_id}: sensor não está inicializado, impossível ler estado")
+        contador.ultimo_relatorio_estado = tempo_atual
+    
+    # Verificar se está em modo de contagem ativo
+    if contador.estado == ESTADO_EM_CONTAGEM:
+        # Nova ordem iniciada antes do fim da observação do excesso da anterior (e não a
+        # ordem fechada no objetivo, ainda à espera da transição)
+        if contador.quente.fecho is not None and contador.quente.terminar_pendente is None:
+            contador.registar_sobrecontagem()
+        
+        # Ler o estado atual do sensor
+        if contador.sensor_initialized:
+            contador.processar_leitura(GPIO.input(contador.SENSOR_PIN))
+        else:
+            # Tentar reinicializar o sensor se não estiver inicializado (fora desta thread)
+            contador.pedir_reinicio_sensor()
+    
+    # Porta fechada no objetivo: medir as garrafas que ainda passam no sensor
+    elif contador.quente.fecho is not None and contador.sensor_initialized:
+        contador.observar_excesso(GPIO.input(contador.SENSOR_PIN))
+
+class AnelCaptura:
+    """
+    Memória partilhada entre o processo de captura e o processo principal.
+    
+    Contém um cabeçalho (registos escritos, iterações do ciclo de leitura, maior
+    intervalo entre leituras em ns), a contagem acumulada de garrafas de cada linha, o
+    alvo de cada linha e um anel com o instante (perf_counter_ns) e a linha de cada
+    garrafa. O processo de captura escreve tudo menos o limite do alvo, que é escrito
+    pelo processo principal. As contagens acumuladas são a referência, por isso nenhuma
+    garrafa se perde; o anel serve para medir a latência e pode ser ultrapassado se
+    o leitor se atrasar mais de `capacidade` garrafas.
+    
+    O alvo de uma linha é a contagem acumulada em que o processo de captura fecha a porta
+    (0 = sem alvo), seguido do limite em que a fechou pela última vez e da latência
+    desse fecho em ns (desde o início da leitura em que contou a garrafa do objetivo).
+    """
+    CABECALHO = struct.Struct("<QQQ")
+    CONTAGEM = struct.Struct("<Q")
+    LIMITE = struct.Struct("<Q")
+    FECHO = struct.Struct("<Qq")
+    REGISTO = struct.Struct("<qQ")
+    
+    def __init__(self, memoria, linhas, capacidade):
+        self.memoria = memoria
+        self.buf = memoria.buf
+        self.linhas = linhas
+        self.capacidade = capacidade
+        self._contagens = self.CABECALHO.size
+        self._alvos = self._contagens + self.CONTAGEM.size * linhas
+        self._registos = self._alvos + (self.LIMITE.size + self.FECHO.size) * linhas
+    
+    @classmethod
+    def tamanho(cls, linhas, capacidade):
+        return (cls.CABECALHO.size + (cls.CONTAGEM.size + cls.LIMITE.size + cls.FECHO.size) * linhas
+                + cls.REGISTO.size * capacidade)
+    
+    def cabecalho(self):
+        """(escritos, iterações, maior intervalo entre leituras em ns)"""
+        return self.CABECALHO.unpack_from(self.buf, 0)
+    
+    def contagem(self, linha):
+        return self.CONTAGEM.unpack_from(self.buf, self._contagens + self.CONTAGEM.size * linha)[0]
+    
+    def _alvo(self, linha):
+        return self._alvos + (self.LIMITE.size + self.FECHO.size) * linha
+    
+    def limite(self, linha):
+        """Contagem acumulada em que a porta da linha deve fechar (0 = sem alvo)"""
+        return self.LIMITE.unpack_from(self.buf, self._alvo(linha))[0]
+    
+    def definir_limite(self, linha, limite):
+        self.LIMITE.pack_into(self.buf, self._alvo(linha), limite)
+    
+    def fecho(self, linha):
+        """(limite do último fecho da porta pelo processo de captura, latência em ns)"""
+        return self.FECHO.unpack_from(self.buf, self._alvo(linha) + self.LIMITE.size)
+    
+    def marcar_fecho(self, linha, limite, latencia_ns):
+        self.FECHO.pack_into(self.buf, self._alvo(linha) + self.LIMITE.size, limite, latencia_ns)
+    
+    def registo(self, indice):
+        """(instante em ns, linha) do registo com o índice absoluto indicado"""
+        return self.REGISTO.unpack_from(self.buf, self._registos + self.REGISTO.size * (indice % self.capacidade))
+    
+    def publicar(self, escritos, linha, instante_ns, contagem):
+        """Escreve o registo e a contagem da linha; o cabeçalho é atualizado a seguir pelo escritor"""
+        self.REGISTO.pack_into(self.buf, self._registos + self.REGISTO.size * (escritos % self.capacidade), instante_ns, linha)
+        self.CONTAGEM.pack_into(self.buf, self._contagens + self.CONTAGEM.size * linha, contagem)
+    
+    def atualizar_cabecalho(self, escritos, iteracoes, maior_intervalo_ns):
+        self.CABECALHO.pack_into(self.buf, 0, escritos, iteracoes, maior_intervalo_ns)
+
+def processo_captura(anel, pinos, portas, intervalo, cpu, prioridade, aviso_fd):
+    """
+    Ciclo do processo de captura: lê os sensores, aplica o ciclo Flop e publica as garrafas.
+    
+    Fecha também a porta da linha (pino de `portas`) na garrafa que atinge o limite
+    escrito no anel pelo processo principal, na mesma leitura e sem esperar pelo GIL
+    do processo principal. Corre num processo criado por fork (herda os pinos já
+    configurados e a memória partilhada); termina com SIGTERM ou quando o processo
+    principal desaparece.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if cpu is not None:
+        try:
+            os.sched_setaffinity(0, {int(cpu)})
+        except (AttributeError, OSError) as e:
+            logging.warning(f"Captura: não foi possível fixar o processo no núcleo {cpu}: {e}")
+    if prioridade:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(int(prioridade)))
+        except (AttributeError, OSError) as e:
+            logging.warning(f"Captura: SCHED_FIFO indisponível (prioridade {prioridade}): {e}")
+    
+    pai = os.getppid()
+    logging.info(f"Processo de captura iniciado (pid {os.getpid()}, {len(pinos)} linha(s), {intervalo * 1000:g} ms)")
+    
+    # Continuar a partir do que já foi publicado (reinício do processo)
+    escritos, iteracoes, maior = anel.cabecalho()
+    contagens = [anel.contagem(i) for i in range(len(pinos))]
+    fechados = [anel.fecho(i)[0] for i in range(len(pinos))]  # Limite do último fecho de cada porta
+    flops = [False] * len(pinos)
+    anterior = time.perf_counter_ns()
+    proximo = time.perf_counter()
+    
+    while True:
+        agora = time.perf_counter_ns()
+        maior = max(maior, agora - anterior)
+        anterior = agora
+        iteracoes += 1
+        publicou = False
+        try:
+            for indice, pino in enumerate(pinos):
+                if GPIO.input(pino) == 1:
+                    flops[indice] = True
+                elif flops[indice]:
+                    flops[indice] = False
+                    contagens[indice] += 1
+                    anel.publicar(escritos, indice, agora, contagens[indice])
+                    escritos += 1
+                    publicou = True
+                    # Garrafa do objetivo: fechar a porta já, antes de avisar o processo principal
+                    limite = anel.limite(indice)
+                    if limite and contagens[indice] >= limite and fechados[indice] != limite:
+                        GPIO.output(portas[indice], GPIO.LOW)
+                        fechados[indice] = limite
+                        anel.marcar_fecho(indice, limite, time.perf_counter_ns() - agora)
+        except Exception as e:
+            logging.error(f"Captura: erro ao ler sensores: {e}")
+            time.sleep(1)
+        anel.atualizar_cabecalho(escritos, iteracoes, maior)
+        
+        if publicou:
+            try:
+                os.write(aviso_fd, b"\0")
+            except BlockingIOError:
+                pass  # O consumidor já tem avisos por ler
         
-        if row and row.get("Inicio"):
-            # Formatar data corretamente
-            if hasattr(row["Inicio"], "strftime"):
-                return row["Inicio"].strftime("%Y-%m-%d %H:%M:%S")
-            else:
-                return str(row["Inicio"])
+        # Processo principal terminado sem parar a captura
+        if iteracoes % 1000 == 0 and os.getppid() != pai:
+            os._exit(0)
         
-        # Se ainda não encontrou, retorna None
-        return None
-    except Exception as e:
-        logging.error(f"Erro ao obter início oficial da ordem {Ordem}: {e}")
-        return None
+        proximo += intervalo
+        espera = proximo - time.perf_counter()
+        if espera > 0:
+            time.sleep(espera)
+        else:
+            proximo = time.perf_counter()  # Atrasado: não tentar recuperar leituras perdidas
 
-@log_exceptions
-def gravar_contagem(Id, ContagemAtual):
-    """Grava a contagem atual na BD com proteção contra falhas"""
-    try:
-        conn = get_db_connection(contador.DB_Server, contador.DB_User, contador.DB_Password, contador.DB_DB)
-        cursor = conn.cursor()
-        
-        media = media_producao()
-        EstimativaTempo = None
+class CapturaProcesso:
+    """
+    Captura num processo dedicado (opcional, "captura_processo" na configuração).
+    
+    O processo filho lê os sensores de todas as linhas a cada `captura_intervalo_ms`
+    e aplica o ciclo Flop fora do GIL do processo principal (API, estatísticas,
+    escritores de BD), opcionalmente fixo num núcleo e com SCHED_FIFO. No processo
+    principal, a ContadorThread consome o AnelCaptura e aplica as garrafas às linhas,
+    acordada por um pipe sempre que há garrafas novas, e mantém no anel o limite de
+    cada linha em contagem: a porta fecha no objetivo pelo processo de captura.
+    """
+    def __init__(self, registo_linhas, intervalo_ms=1, cpu=None, prioridade=None, capacidade=4096):
+        self.linhas = registo_linhas.todas()
+        self.intervalo = intervalo_ms / 1000.0
+        self.cpu = cpu
+        self.prioridade = prioridade
+        self.capacidade = capacidade
+        self.processo = None
+        self.memoria = None
+        self.anel = None
+        self._leitura = self._escrita = None
+        self.consumidas = [0] * len(self.linhas)  # Contagem acumulada já aplicada, por linha
+        self.limites = [0] * len(self.linhas)  # Último limite escrito no anel, por linha
+        self.lidos = 0
+        self.registos_perdidos = 0
+        self.reinicios = 0
+        self.latencias = deque(maxlen=1000)  # Publicação -> consumo (s)
+    
+    def iniciar(self):
+        """Cria a memória partilhada (na primeira vez) e arranca o processo de captura"""
+        import multiprocessing
+        from multiprocessing import shared_memory
         
-        agora = datetime.now()
-        DataDados = agora.strftime("%Y-%m-%d %H:%M:%S")
+        if self.memoria is None:
+            self.memoria = shared_memory.SharedMemory(
+                create=True, size=AnelCaptura.tamanho(len(self.linhas), self.capacidade)
+            )
+            self.memoria.buf[:] = bytes(self.memoria.size)
+            self.anel = AnelCaptura(self.memoria, len(self.linhas), self.capacidade)
+            self._leitura, self._escrita = os.pipe()
+            os.set_blocking(self._leitura, False)
+            os.set_blocking(self._escrita, False)
+        self.atualizar_limites()
         
-        # Calcular estimativa de tempo
-        if media > 0 and contador.EstadoContador == 1:
+        # fork: o filho herda os pinos configurados e a memória partilhada sem voltar a
+        # importar o main.py
+        contexto = multiprocessing.get_context("fork")
+        self.processo = contexto.Process(
+            target=processo_captura,
+            args=(self.anel, [c.SENSOR_PIN for c in self.linhas], [c.DOOR_PIN for c in self.linhas],
+                  self.intervalo, self.cpu, self.prioridade, self._escrita),
+            name="CapturaProcesso",
+            daemon=True,
+        )
+        self.processo.start()
+    
+    def parar_processo(self, timeout=1.0):
+        """Termina o processo de captura; as garrafas já publicadas ficam por consumir"""
+        if self.processo is not None and self.processo.is_alive():
+            self.processo.terminate()
+            self.processo.join(timeout)
+    
+    def libertar(self):
+        """Liberta a memória partilhada e o pipe (no encerramento)"""
+        self.parar_processo()
+        if self.memoria is not None:
+            self.anel = None
             try:
-                Minutos = math.ceil((contador.ContagemTotal - ContagemAtual) * 60 / media)
-                EstimativaTempo = (agora + timedelta(minutes=Minutos)).strftime("%Y-%m-%d %H:%M:%S")
+                self.memoria.close()
+                self.memoria.unlink()
             except Exception as e:
-                logging.error(f"Erro ao calcular estimativa de tempo: {e}")
-                EstimativaTempo = None
-        
-        # Formatar as datas para inserção no SQL
-        Inicio = contador.TempoInicio if contador.TempoInicio else None
-        Fim = contador.TempoFim if contador.TempoFim else None
+                logging.warning(f"Captura: erro ao libertar a memória partilhada: {e}")
+            for fd in (self._leitura, self._escrita):
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+            self.memoria = None
+    
+    def consumir(self):
+        """Aplica às linhas as garrafas publicadas desde a última leitura"""
+        anel = self.anel
+        escritos = anel.cabecalho()[0]
+        agora = time.perf_counter_ns()
+        if escritos - self.lidos > self.capacidade:
+            self.registos_perdidos += escritos - self.lidos - self.capacidade
+            self.lidos = escritos - self.capacidade
+        for indice in range(self.lidos, escritos):
+            self.latencias.append((agora - anel.registo(indice)[0]) / 1e9)
+        self.lidos = escritos
         
-        try:
-            # Registar na tabela de contagem
-            cursor.execute(
-                """
-                INSERT INTO krones_contadoreslinhacontagem
-                    (IdContagem, ContagemAtual, Objetivo, DataLeitura)
-                VALUES
-                    (%s, %s, %s, %s)
-                """,
-                (
-                    int(Id),
-                    int(ContagemAtual),
-                    int(contador.ContagemTotal),
-                    DataDados,
-                )
-            )
-            conn.commit()
-            
-            # Registar na tabela de histórico
-            params = {
-                "DataDados": DataDados,
-                "Ordem": contador.Ordem,
-                "Artigo": contador.ArtigoEmContagem,
-                "DescricaoArtigo": contador.DescricaoArtigoEmContagem,
-                "CadenciaArtigo": int(contador.CadenciaArtigoEmContagem) if hasattr(contador.CadenciaArtigoEmContagem, "__int__") else contador.CadenciaArtigoEmContagem,
-                "Inicio": Inicio,
-                "Fim": Fim,
-                "ContagemAtual": int(ContagemAtual),
-                "ContagemTotal": int(contador.ContagemTotal),
-                "MediaProducao": float(media) if hasattr(media, "__float__") else media,
-                "EstimativaFecho": EstimativaTempo,
-                "Paragens": contador.Paragens[-1] if contador.Paragens else None,
-                "Quebras": int(contador.Quebras),
-                "EstadoPorta": int(contador.EstadoPorta),
-                "EstadoContador": int(contador.EstadoContador),
-                "EstadoConfiguracao": int(contador.ContadorConfigurado),
-                "Nominal": float(contador.EstatisticaGFA[-1]) if contador.EstatisticaGFA else None,
-                "Media": float(contador.EstatisticaGFAMedia[-1]) if contador.EstatisticaGFAMedia else None,
-                "Cadencia": float(contador.EstatisticaCadenciaArtigo[-1]) if contador.EstatisticaCadenciaArtigo else None,
-                "Tempo": contador.EstatisticaTempo[-1] if contador.EstatisticaTempo else None,
-            }
+        for indice, contador_linha in enumerate(self.linhas):
+            total = anel.contagem(indice)
+            novas = total - self.consumidas[indice]
+            self.consumidas[indice] = total
+            if novas > 0 or contador_linha.quente.fecho is not None:
+                contador_linha.aplicar_garrafas(max(novas, 0))
             
-            # Construir a SQL de forma dinâmica para lidar com parâmetros nulos
-            sql_fields = []
-            sql_values = []
-            for key, value in params.items():
-                if value is not None:
-                    sql_fields.append(key)
-                    sql_values.append(f"%({key})s")
-            
-            SQL = f"""
-                INSERT INTO krones_historico_contagens
-                    ({', '.join(sql_fields)})
-                VALUES
-                    ({', '.join(sql_values)})
-            """
-            
-            cursor.execute(SQL, params)
-            conn.commit()
+            # Fecho no objetivo: latência medida no processo de captura, que fechou a porta
+            fecho = contador_linha.quente.fecho
+            if fecho is not None and "PortaPeloProcesso" not in fecho:
+                limite, latencia = anel.fecho(indice)
+                fecho["PortaPeloProcesso"] = limite != 0 and limite == self.limites[indice]
+                if fecho["PortaPeloProcesso"]:
+                    fecho["LatenciaFechoMs"] = round(latencia / 1e6, 3)
+        self.atualizar_limites()
+    
+    def atualizar_limites(self):
+        """
+        Escreve no anel o limite de cada linha: a contagem acumulada do processo de captura
+        em que a linha atinge o objetivo (objetivo e quebras do snapshot da ordem), ou 0
+        se a linha não está em contagem
+        """
+        for indice, contador_linha in enumerate(self.linhas):
+            quente = contador_linha.quente
+            limite = 0
+            if contador_linha.estado == ESTADO_EM_CONTAGEM and quente.terminar_pendente is None:
+                ordem = contador_linha.metadados
+                restantes = ordem.ContagemTotal + ordem.Quebras - quente.contagem
+                if restantes > 0:
+                    limite = self.consumidas[indice] + restantes
+            if limite != self.limites[indice]:
+                self.limites[indice] = limite
+                self.anel.definir_limite(indice, limite)
+    
+    def thread_consumo(self):
+        """ContadorThread no modo de captura em processo: consome o anel quando é avisada"""
+        logging.info(f"Thread de contagem iniciada com captura em processo ({len(self.linhas)} linha(s))")
+        while thread_running and supervisor.batimento("ContadorThread"):
+            if self.processo is None or not self.processo.is_alive():
+                if self.processo is not None:
+                    logging.error(f"Processo de captura terminou (código {self.processo.exitcode}), a reiniciar")
+                    self.reinicios += 1
+                self.iniciar()
             
-        except pymssql.Error as e:
-            logging.error(f"Erro SQL ao gravar contagem: {e}")
-            # Tentar reconectar e repetir
-            try:
-                conn = get_db_connection(contador.DB_Server, contador.DB_User, contador.DB_Password, contador.DB_DB)
-                cursor = conn.cursor()
-                # ... repetir código de gravação aqui se necessário
-            except Exception as retry_e:
-                logging.error(f"Falha na reconexão: {retry_e}")
+            # Acordar com garrafas novas; mais cedo se há excesso a observar ou limites a
+            # manter atualizados (início, retoma, objetivo alterado) numa linha
+            espera = 0.05 if any(c.quente.fecho is not None or c.estado == ESTADO_EM_CONTAGEM for c in self.linhas) else 1.0
+            prontos, _, _ = select.select([self._leitura], [], [], espera)
+            if prontos:
+                try:
+                    os.read(self._leitura, 4096)
+                except BlockingIOError:
+                    pass
+            self.consumir()
         
-        finally:
-            if conn:
-                conn.close()
-                
-    except Exception as e:
-        logging.error(f"Erro ao gravar contagem: {e}")
+        # Garrafas publicadas até o processo parar (encerramento)
+        if self.anel is not None:
+            self.consumir()
+        logging.info("Thread de contagem terminada normalmente")
+    
+    def estado(self):
+        escritos, iteracoes, maior = self.anel.cabecalho() if self.anel is not None else (0, 0, 0)
+        latencias = sorted(self.latencias)
+        return {
+            "Pid": self.processo.pid if self.processo is not None else None,
+            "Ativo": self.processo is not None and self.processo.is_alive(),
+            "IntervaloMs": self.intervalo * 1000,
+            "Cpu": self.cpu,
+            "PrioridadeFifo": self.prioridade,
+            "Garrafas": escritos,
+            "Iteracoes": iteracoes,
+            "MaiorIntervaloLeituraMs": round(maior / 1e6, 3),
+            "LatenciaConsumoP99Ms": round(latencias[int(len(latencias) * 0.99)] * 1000, 3) if latencias else None,
+            "RegistosPerdidos": self.registos_perdidos,
+            "Reinicios": self.reinicios,
+        }
 
-@log_exceptions
-def count_thread():
-    """Thread para contar eventos do sensor usando o sistema Flop"""
-    global contador, thread_running
+# Captura em processo dedicado (None = ContadorThread lê os sensores diretamente)
+captura_processo = None
 
-    logging.info("Thread de contagem iniciada com sistema Flop")
+class MonitorMemoria:
+    """
+    Memória do processo ao longo de semanas de funcionamento.
     
-    # Variáveis locais para controlo
-    contador_debug = 0
-    ultimo_relatorio_estado = 0
+    Amostras periódicas do RSS e das threads do sistema (/proc/self/status), das threads
+    Python, dos blocos alocados pelo interpretador, do heap seguido pelo tracemalloc (se
+    ativo) e do tamanho do app.log. Cada orçamento ultrapassado gera um alerta (e outro
+    quando o valor volta ao normal). O tracemalloc fica desligado por omissão, porque
+    torna cada alocação mais cara; /memoria/alocacoes liga-o a pedido.
+    """
+    # Orçamento da configuração -> campo da amostra
+    ORCAMENTOS = {"rss_mb": "RssMb", "heap_mb": "HeapMb", "threads": "Threads", "log_mb": "LogMb"}
+    AGRUPAMENTOS = ("lineno", "filename", "traceback")
     
-    # Loop principal da thread
-    while thread_running:
+    def __init__(self, orcamentos, pontos=1440, quadros=10, ficheiro_log=LOG_FICHEIRO):
+        self.orcamentos = dict(orcamentos)
+        self.quadros = quadros
+        self.ficheiro_log = ficheiro_log
+        self.amostras = deque(maxlen=pontos)
+        self._instantes = deque(maxlen=pontos)  # Epoch ns de cada amostra, para a tendência
+        self.alertas = deque(maxlen=100)
+        self._excedidos = set()
+        self._referencia = None  # Snapshot do tracemalloc do pedido de alocações anterior
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _ler_proc():
+        """VmRSS, VmHWM (kB) e Threads de /proc/self/status; vazio fora do Linux"""
+        valores = {}
         try:
-            tempo_atual = time.time()
-            contador_debug += 1
-            
-            # Imprimir o estado do sensor periodicamente para diagnóstico
-            if (tempo_atual - ultimo_relatorio_estado) > 30:
-                if contador.sensor_initialized:
-                    estado_sensor = GPIO.input(contador.SENSOR_PIN)
-                    logging.info(f"Estado atual do sensor: {estado_sensor} (Modo contagem: {contador.EstadoContador}, Pausa: {contador.EstadoPausa}, Flop: {contador.Flop})")
-                else:
-                    logging.warning("Sensor não está inicializado, impossível ler estado")
-                ultimo_relatorio_estado = tempo_atual
-            
-            # Verificar se está em modo de contagem ativo
-            if contador.EstadoContador == 1 and not contador.EstadoPausa:
-                # Ler o estado atual do sensor
-                if contador.sensor_initialized:
-                    estado_entrada = GPIO.input(contador.SENSOR_PIN)
-                    
-                    # Sistema Flop - primeira parte (deteta quando o sensor é ativado)
-                    if estado_entrada == 1 and contador.Flop is False:
-                        # Levantar FLOP - sensor ativado
-                        contador.Flop = True
-                        if contador_debug % 10 == 0:
-                            logging.info("Sensor ativado - Flop levantado")
-                            
-                    # Sistema Flop - segunda parte (deteta quando o sensor volta ao estado normal)
-                    if estado_entrada == 0 and contador.Flop is True:
-                        # Contagem completa - incrementar contador
-                        with contador._contagem_lock:
-                            contador.ContagemAtual += 1
-                            
-                            # Log para diagnóstico
-                            if contador.ContagemAtual % 10 == 0 or contador_debug % 20 == 0:
-                                logging.info(f"Contagem incrementada: {contador.ContagemAtual}")
-                            
-                            # Verificar se atingiu o total
-                            if contador.ContagemAtual >= (contador.ContagemTotal + contador.Quebras):
-                                # Usar threading para não bloquear a contagem
-                                threading.Thread(target=contador._stop_counting_thread).start()
-                            
-                            # Guardar estado a cada 10 contagens
-                            if contador.ContagemAtual % 10 == 0:
-                                contador._save_state()
-                        
-                        # Reset no FLOP - pronto para próxima contagem
-                        contador.Flop = False
-                        if contador_debug % 10 == 0:
-                            logging.info("Sensor desativado - Flop reposto")
-                else:
-                    # Tentar reinicializar o sensor se não estiver inicializado
-                    if contador.reiniciar_sensor():
-                        logging.info("Sensor reinicializado com sucesso durante a thread de contagem")
-                    else:
-                        logging.error("Falha ao reinicializar sensor durante a thread de contagem")
-                        time.sleep(5)  # Esperar antes de tentar novamente
+            with open("/proc/self/status") as f:
+                for linha in f:
+                    chave, _, valor = linha.partition(":")
+                    if chave in ("VmRSS", "VmHWM", "Threads"):
+                        valores[chave] = int(valor.split()[0])
+        except (OSError, ValueError):
+            pass
+        return valores
+    
+    def ler(self):
+        """Leitura atual (MB em MiB), sem a registar"""
+        proc = self._ler_proc()
+        heap = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else None
+        # app.log e as cópias da rotação
+        log = None
+        for i in range(LOG_COPIAS + 1):
+            try:
+                log = (log or 0) + os.path.getsize(f"{self.ficheiro_log}.{i}" if i else self.ficheiro_log)
+            except OSError:
+                pass
+        return {
+            "Data": formatar_ns(relogio.tempo_ns()),
+            "RssMb": round(proc["VmRSS"] / 1024, 2) if "VmRSS" in proc else None,
+            "RssPicoMb": round(proc["VmHWM"] / 1024, 2) if "VmHWM" in proc else None,
+            "HeapMb": round(heap[0] / 1048576, 3) if heap else None,
+            "HeapPicoMb": round(heap[1] / 1048576, 3) if heap else None,
+            "BlocosAlocados": sys.getallocatedblocks(),
+            "Threads": threading.active_count(),
+            "ThreadsSO": proc.get("Threads"),
+            "LogMb": round(log / 1048576, 2) if log is not None else None,
+        }
+    
+    def amostrar(self):
+        """Regista uma leitura, verifica os orçamentos e devolve-a"""
+        amostra = self.ler()
+        with self._lock:
+            self.amostras.append(amostra)
+            self._instantes.append(relogio.tempo_ns())
+            self._verificar(amostra)
+        return amostra
+    
+    def _verificar(self, amostra):
+        """Alerta quando um orçamento é ultrapassado e quando volta a ser cumprido; chamado com o lock"""
+        for orcamento, campo in self.ORCAMENTOS.items():
+            limite = self.orcamentos.get(orcamento) or 0
+            valor = amostra.get(campo)
+            if not limite or valor is None:
+                continue
+            excedido = valor > limite
+            if excedido == (orcamento in self._excedidos):
+                continue
+            if excedido:
+                self._excedidos.add(orcamento)
+                logging.warning(f"Memória: {campo} = {valor} acima do orçamento {orcamento} ({limite})")
+            else:
+                self._excedidos.discard(orcamento)
+                logging.info(f"Memória: {campo} = {valor} de novo dentro do orçamento {orcamento} ({limite})")
+            self.alertas.append({
+                "Data": amostra["Data"], "Orcamento": orcamento, "Valor": valor,
+                "Limite": limite, "Excedido": excedido,
+            })
+    
+    def tendencia(self, campo, ultimas=None):
+        """Variação por hora de um campo (reta de mínimos quadrados) nas últimas amostras; None se não há pontos"""
+        with self._lock:
+            pontos = [(t, a[campo]) for t, a in zip(self._instantes, self.amostras) if a.get(campo) is not None]
+        if ultimas:
+            pontos = pontos[-ultimas:]
+        if len(pontos) < 2 or pontos[-1][0] == pontos[0][0]:
+            return None
+        horas = [(t - pontos[0][0]) / (3600 * NS_POR_SEGUNDO) for t, _ in pontos]
+        return round(float(np.polyfit(horas, [v for _, v in pontos], 1)[0]), 4)
+    
+    def ativar_tracemalloc(self):
+        """Liga o tracemalloc, se ainda não estiver, e guarda o snapshot de referência"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.quadros)
+            logging.info(f"tracemalloc ligado ({self.quadros} quadros por alocação)")
+        with self._lock:
+            self._referencia = self._snapshot()
+    
+    def desativar_tracemalloc(self):
+        with self._lock:
+            self._referencia = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+            logging.info("tracemalloc desligado")
+    
+    @staticmethod
+    def _snapshot():
+        """Snapshot do tracemalloc sem as alocações do próprio tracemalloc e do importlib"""
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ))
+    
+    def alocacoes(self, top=15, agrupar="lineno", comparar=False):
+        """
+        As `top` origens com mais memória alocada ou, com `comparar`, as que mais mudaram
+        desde o pedido anterior. Requer o tracemalloc ativo.
+        """
+        snapshot = self._snapshot()
+        with self._lock:
+            referencia, self._referencia = self._referencia, snapshot
+        if comparar and referencia is not None:
+            estatisticas = snapshot.compare_to(referencia, agrupar)
+        else:
+            comparar = False
+            estatisticas = snapshot.statistics(agrupar)
+        origens = []
+        for estatistica in estatisticas[:top]:
+            quadro = estatistica.traceback[-1]  # O mais recente: quem alocou
+            origem = {
+                "Local": f"{quadro.filename}:{quadro.lineno}",
+                "TamanhoKb": round(estatistica.size / 1024, 1),
+                "Blocos": estatistica.count,
+            }
+            if comparar:
+                origem["DiferencaKb"] = round(estatistica.size_diff / 1024, 1)
+                origem["DiferencaBlocos"] = estatistica.count_diff
+            if agrupar == "traceback":
+                origem["Pilha"] = [f"{q.filename}:{q.lineno}" for q in estatistica.traceback]
+            origens.append(origem)
+        atual, pico = tracemalloc.get_traced_memory()
+        return {
+            "Agrupamento": agrupar,
+            "Comparacao": comparar,
+            "HeapMb": round(atual / 1048576, 3),
+            "HeapPicoMb": round(pico / 1048576, 3),
+            "Origens": origens,
+        }
+    
+    def resumo(self):
+        """Última amostra e orçamentos excedidos (para o /saude)"""
+        with self._lock:
+            atual = self.amostras[-1] if self.amostras else {}
+            return {
+                "RssMb": atual.get("RssMb"),
+                "Threads": atual.get("Threads"),
+                "OrcamentosExcedidos": sorted(self._excedidos),
+            }
+    
+    def estado(self, amostras=0):
+        """Leitura atual, orçamentos, alertas, tendências e as últimas `amostras` amostras"""
+        with self._lock:
+            serie = list(self.amostras)[-amostras:] if amostras > 0 else []
+            alertas = list(self.alertas)
+            excedidos = sorted(self._excedidos)
+            total = len(self.amostras)
+        return {
+            "Atual": self.ler(),
+            "Orcamentos": self.orcamentos,
+            "OrcamentosExcedidos": excedidos,
+            "Alertas": alertas,
+            "TendenciaRssMbPorHora": self.tendencia("RssMb"),
+            "TendenciaHeapMbPorHora": self.tendencia("HeapMb"),
+            "Tracemalloc": tracemalloc.is_tracing(),
+            "AmostrasRegistadas": total,
+            "Amostras": serie,
+        }
+
+# Orçamentos em falta no ficheiro de configuração ficam com o valor por omissão
+monitor_memoria = MonitorMemoria(
+    {**CONFIG_PADRAO["memoria_orcamentos"], **CONFIG["memoria_orcamentos"]},
+    CONFIG["memoria_amostras"], CONFIG["memoria_quadros"],
+)
+if CONFIG["memoria_tracemalloc"]:
+    monitor_memoria.ativar_tracemalloc()
+
+INTERVALO_ESTATISTICAS = 5  # Segundos entre ciclos de estatísticas (uma amostra por ciclo)
+
+def ciclo_estatisticas():
+    """Um ciclo de estatísticas de todas as linhas (a stats_thread chama-o a cada 5 s)"""
+    for contador_linha in linhas.todas():
+        try:
+            # Atualizar estatísticas usando o método da classe contador
+            contador_linha.update_stats()
             
-            # Pequena pausa para não sobrecarregar o CPU
-            time.sleep(0.01)  # 10ms, intervalo ótimo para deteção precisa
-                
         except Exception as e:
-            logging.error(f"Erro na thread de contagem: {e}")
-            contador.read_error_count += 1
-            
-            # Se muitos erros consecutivos, tenta reiniciar o sensor
-            if contador.read_error_count > contador.max_read_errors:
-                logging.warning(f"Muitos erros consecutivos ({contador.read_error_count}), tentando reiniciar sensor")
-                contador.reiniciar_sensor()
-                contador.read_error_count = 0
-                
-            time.sleep(1)  # Pausa para evitar ciclos de erro em alta frequência
-    
-    logging.info("Thread de contagem terminada normalmente")
+            logging.error(f"Erro na thread de estatísticas (linha {contador_linha.linha_id}): {e}")
+            logging.error(traceback.format_exc())
 
 @log_exceptions
 def stats_thread():
@@ -1598,18 +5838,14 @@ def stats_thread():
     global thread_running
     logging.info("Thread de estatísticas iniciada")
     
+    proximo_ciclo = relogio.monotonico()
     try:
-        while thread_running:
-            try:
-                # Atualizar estatísticas usando o método da classe contador
-                contador.update_stats()
-                
-            except Exception as e:
-                logging.error(f"Erro na thread de estatísticas: {e}")
-                logging.error(traceback.format_exc())
+        while thread_running and supervisor.batimento("EstatísticasThread"):
+            ciclo_estatisticas()
             
-            # Aguardar próximo ciclo (5 segundos)
-            time.sleep(5)
+            # Aguardar próximo ciclo (5 segundos), sem acumular atrasos (ou o encerramento)
+            proximo_ciclo += INTERVALO_ESTATISTICAS
+            relogio.esperar(evento_encerrar, max(0, proximo_ciclo - relogio.monotonico()))
     
     except Exception as outer_e:
         logging.error(f"Erro fatal na thread de estatísticas: {outer_e}")
@@ -1617,49 +5853,70 @@ def stats_thread():
     
     logging.info("Thread de estatísticas finalizada")
 
+@log_exceptions
+def memoria_thread():
+    """Thread do monitor de memória: uma amostra a cada `memoria_intervalo` segundos"""
+    logging.info("Thread de memória iniciada")
+    while thread_running and supervisor.batimento("MemóriaThread"):
+        try:
+            monitor_memoria.amostrar()
+        except Exception as e:
+            logging.error(f"Erro ao amostrar a memória: {e}")
+        # Supervisão do processo: relógio real, como o supervisor
+        evento_encerrar.wait(CONFIG["memoria_intervalo"])
+    logging.info("Thread de memória finalizada")
+
+def aplicar_calendario(agora, janela_aplicada=None):
+    """
+    Pausa as linhas em contagem ao entrar numa janela do calendário e retoma as que
+    ela pausou quando termina. Devolve a janela em curso; uma linha retomada à mão
+    dentro da mesma janela (`janela_aplicada`) não volta a ser pausada.
+    """
+    janela = calendario.em_pausa(agora)
+    for contador_linha in linhas.todas():
+        linha_id = contador_linha.linha_id
+        if janela is not None:
+            if janela != janela_aplicada and contador_linha.EstadoContador == 1 and contador_linha.pause_count(origem="calendario"):  # pause_count já fecha a porta
+                contador_linha.pausa_calendario = janela
+                logging.info(f"Linha {linha_id}: contador pausado automaticamente às {janela[0]:%H:%M}h")
+        elif contador_linha.pausa_calendario is not None:
+            # Fim da janela que pausou a linha
+            retomar = contador_linha.pausa_calendario[2]
+            contador_linha.pausa_calendario = None
+            if retomar and contador_linha.EstadoContador == 2 and contador_linha.resume_count(origem="calendario"):
+                logging.info(f"Linha {linha_id}: contagem retomada automaticamente")
+    return janela
+
 @log_exceptions
 def auto_pause_thread():
-    """Thread para pausar automaticamente às 12h e 17h"""
+    """
+    Thread de pausas programadas: dorme até à próxima transição do calendário.
+    
+    A espera é limitada a uma hora para acompanhar acertos do relógio (o Raspberry
+    Pi não tem RTC e o NTP pode corrigir a hora depois do arranque).
+    """
     global thread_running
     logging.info("Thread de pausa automática iniciada")
     
-    # Variáveis para controlar quando a última pausa foi feita
-    ultima_pausa_12h = False
-    ultima_pausa_17h = False
-    
+    janela_aplicada = None
     try:
-        while thread_running:
+        while thread_running and supervisor.batimento("PausaAutomáticaThread"):
             try:
-                agora = datetime.now()
-                hora_atual = agora.hour
-                minuto_atual = agora.minute
-                
-                # Verificar se é hora de pausar (12:00 ou 17:00)
-                if hora_atual == 12 and minuto_atual == 0 and contador.EstadoContador == 1 and not ultima_pausa_12h:
-                    if contador.pause_count():  # pause_count já fecha a porta
-                        logging.info("Contador pausado automaticamente às 12:00h")
-                        ultima_pausa_12h = True
-                elif hora_atual == 17 and minuto_atual == 0 and contador.EstadoContador == 1 and not ultima_pausa_17h:
-                    if contador.pause_count():  # pause_count já fecha a porta
-                        logging.info("Contador pausado automaticamente às 17:00h")
-                        ultima_pausa_17h = True
-                
-                # Limpar as flags quando passar do minuto zero
-                if hora_atual == 12 and minuto_atual > 0:
-                    ultima_pausa_12h = False
-                if hora_atual == 17 and minuto_atual > 0:
-                    ultima_pausa_17h = False
-                
-                # Limpar todas as flags à meia-noite
-                if hora_atual == 0 and minuto_atual == 0:
-                    ultima_pausa_12h = False
-                    ultima_pausa_17h = False
+                agora = relogio.agora()
+                janela_aplicada = aplicar_calendario(agora, janela_aplicada)
                 
+                transicao = calendario.proxima_transicao(agora)
+                if transicao is not None:
+                    logging.info(f"Próxima transição do calendário: {transicao[1]} às {transicao[0]:%Y-%m-%d %H:%M}")
+                    espera = (transicao[0] - relogio.agora()).total_seconds()
+                else:
+                    espera = 3600
             except Exception as e:
                 logging.error(f"Erro na verificação de pausa automática: {e}")
+                espera = 60
             
-            # Verificar a cada 15 segundos para não perder o momento exato
-            time.sleep(15)
+            # Acordar na transição (ou no encerramento)
+            relogio.esperar(evento_encerrar, min(max(espera, 0), 3600))
     
     except Exception as outer_e:
         logging.error(f"Erro fatal na thread de pausa automática: {outer_e}")
@@ -1669,75 +5926,250 @@ def auto_pause_thread():
 
 @log_exceptions
 def init_main():
-    """Inicialização do sistema principal com recuperação de estado e threads"""
-    global contador, thread_running
+    """
+    Inicialização do sistema principal com recuperação de estado e threads.
+    
+    O motor de captura arranca primeiro: o estado de todas as linhas é recuperado
+    dos ficheiros locais, os pinos são configurados e a ContadorThread começa logo
+    a ler os sensores. A ligação à BD é aquecida numa thread à parte e o servidor
+    HTTP sobe em paralelo, sem atrasar a primeira contagem.
+    """
+    global thread_running
     thread_running = True
     
     try:
-        # Limpar qualquer configuração GPIO anterior
-        try:
-            GPIO.cleanup()
-            logging.info("Limpeza inicial de pinos GPIO concluída")
-        except Exception as e:
-            logging.warning(f"Falha na limpeza inicial de pinos: {str(e)}")
-        
-        # Configurar modo GPIO
-        GPIO.setmode(GPIO.BCM)
-        logging.info("Modo GPIO configurado como BCM")
+        # Recuperar o estado de todas as linhas antes de tocar nos pinos, para
+        # configurar a porta já no estado certo
+        for contador_linha in linhas.todas():
+            recuperar_linha(contador_linha)
+        marcar_arranque("estado_recuperado")
         
-        # Verificar se há um estado anterior para recuperar
-        try:
-            contador.recover_state()
-            logging.info("Estado anterior recuperado")
-        except Exception as e:
-            logging.error(f"Erro ao recuperar estado anterior: {str(e)}")
-        
-        # Inicializar sensor com tratamento de erros
-        if contador.inicializar_sensor():
-            logging.info("Sensor inicializado com sucesso")
-        else:
-            logging.error("Falha na inicialização do sensor - continuando com sensor desativado")
+        for contador_linha in linhas.todas():
+            inicializar_linha(contador_linha)
+        marcar_arranque("pinos_configurados")
         
-        # Inicializar porta com tratamento de erros
-        if contador.inicializar_porta():
-            logging.info("Porta inicializada com sucesso")
-            
-            # Definir estado inicial da porta
-            if contador.EstadoPorta == 1:
-                GPIO.output(contador.DOOR_PIN, GPIO.HIGH)
-                logging.info("Porta definida como ABERTA no início")
-            else:
-                GPIO.output(contador.DOOR_PIN, GPIO.LOW)
-                logging.info("Porta definida como FECHADA no início")
+        # A captura arranca primeiro; as restantes threads ficam a cargo do supervisor,
+        # que as reinicia se terminarem ou deixarem de dar sinal de vida
+        global captura_processo
+        if CONFIG["captura_processo"]:
+            captura_processo = CapturaProcesso(
+                linhas, CONFIG["captura_intervalo_ms"], CONFIG["captura_cpu"], CONFIG["captura_prioridade_fifo"],
+            )
+            captura_processo.iniciar()
+            supervisor.registar("ContadorThread", captura_processo.thread_consumo, limite_batimento=5, critica=True)
         else:
-            logging.error("Falha na inicialização da porta")
+            supervisor.registar("ContadorThread", count_thread, limite_batimento=5, critica=True)
+        supervisor.iniciar("ContadorThread")
+        marcar_arranque("captura_iniciada")
         
-        # Iniciar threads com tratamento de exceções
-        threads = [
-            threading.Thread(target=count_thread, daemon=True, name="ContadorThread"),
-            threading.Thread(target=stats_thread, daemon=True, name="EstatísticasThread"),
-            threading.Thread(target=auto_pause_thread, daemon=True, name="PausaAutomáticaThread")
-        ]
+        threading.Thread(target=aquecer_bd, daemon=True, name="AquecimentoBDThread").start()
         
-        for t in threads:
-            try:
-                t.start()
-                logging.info(f"Thread {t.name} iniciada")
-            except Exception as thread_e:
-                logging.error(f"Erro ao iniciar thread {t.name}: {thread_e}")
+        supervisor.registar("EstatísticasThread", stats_thread, limite_batimento=30)
+        supervisor.registar("PausaAutomáticaThread", auto_pause_thread)
+        supervisor.registar("MemóriaThread", memoria_thread)
+        if cliente_agregador is not None:
+            supervisor.registar("AgregadorEnvioThread", cliente_agregador.thread_envio)
+        supervisor.arrancar()
         
-        logging.info("Sistema inicializado com sucesso usando modo polling")
+        logging.info(f"Sistema inicializado com sucesso usando modo polling (arranque: {relatorio_arranque})")
     except Exception as e:
         logging.critical(f"Erro fatal na inicialização: {e}")
         logging.critical(traceback.format_exc())
         raise
 
-@app.route("/configurar-sensor", methods=["GET"])
+def recuperar_linha(contador):
+    """Recupera o estado anterior de uma linha"""
+    try:
+        contador.recover_state()
+        logging.info(f"Linha {contador.linha_id}: estado anterior recuperado")
+    except Exception as e:
+        logging.error(f"Erro ao recuperar estado anterior: {str(e)}")
+
+def inicializar_linha(contador):
+    """Inicializa a porta (no estado recuperado) e o sensor de uma linha"""
+    # Inicializar porta com tratamento de erros
+    if contador.inicializar_porta():
+        logging.info(f"Linha {contador.linha_id}: porta inicializada com sucesso")
+    else:
+        logging.error(f"Linha {contador.linha_id}: falha na inicialização da porta")
+    
+    # Inicializar sensor com tratamento de erros
+    if contador.inicializar_sensor():
+        logging.info(f"Linha {contador.linha_id}: sensor inicializado com sucesso")
+    else:
+        logging.error(f"Linha {contador.linha_id}: falha na inicialização do sensor - continuando com sensor desativado")
+
+def aquecer_bd():
+    """
+    Abre a primeira conexão à BD de cada linha e devolve-a ao pool.
+    
+    Corre em paralelo com a captura; as contagens feitas entretanto ficam no
+    diário e no escritor da linha até a BD responder.
+    """
+    if cliente_agregador is not None:
+        return  # As amostras seguem para o agregador, que tem a sua própria ligação
+    for contador_linha in linhas.todas():
+        try:
+            conn = get_db_connection(contador_linha.DB_Server, contador_linha.DB_User,
+                                     contador_linha.DB_Password, contador_linha.DB_DB, max_retries=1)
+            conn.close()
+        except Exception as e:
+            logging.warning(f"Linha {contador_linha.linha_id}: BD indisponível no arranque: {e}")
+            return
+    marcar_arranque("bd_pronta")
+
+def _tempo_interpretador_ms():
+    """Tempo entre o início do processo e ARRANQUE_T0 (só em Linux), ou None"""
+    try:
+        with open("/proc/self/stat") as f:
+            inicio_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        decorrido = uptime - inicio_ticks / os.sysconf("SC_CLK_TCK")
+        return round(max(0.0, decorrido - (time.perf_counter() - ARRANQUE_T0)) * 1000, 1)
+    except Exception:
+        return None
+
+@app.route("/saude", methods=["GET"])
+@log_exceptions
+def saude():
+    """Saúde das threads de trabalho e escritores de BD (503 se uma thread crítica está a falhar)"""
+    estado = supervisor.estado()
+    if captura_processo is not None:
+        estado["Captura"] = captura_processo.estado()
+    elif not MODO_AGREGADOR:
+        estado["Captura"] = metricas_captura.estado()
+    estado["BD"] = [d.estado() for d in list(disjuntores_bd.values())]
+    estado["Memoria"] = monitor_memoria.resumo()  # Orçamentos excedidos são alertas, não falhas
+    return jsonify({"status": "success", "data": estado}), 200 if estado["Saudavel"] else 503
+
+@app.route("/memoria", methods=["GET"])
+@log_exceptions
+def memoria():
+    """Memória do processo: leitura atual, orçamentos, alertas e tendência (?amostras=N inclui a série)"""
+    amostras = request.args.get("amostras", default=0, type=int)
+    return jsonify({"status": "success", "data": monitor_memoria.estado(amostras)}), 200
+
+@app.route("/memoria/alocacoes", methods=["GET"])
+@log_exceptions
+def memoria_alocacoes():
+    """
+    Origens das alocações Python com mais memória, pelo tracemalloc.
+    
+    Se o tracemalloc está desligado, o pedido liga-o (202): as alocações só são seguidas
+    a partir daí. ?top=N, ?agrupar=lineno|filename|traceback, ?comparar=1 (diferença
+    desde o pedido anterior) e ?parar=1 (desliga o tracemalloc).
+    """
+    if request.args.get("parar", "").lower() in ("1", "true"):
+        monitor_memoria.desativar_tracemalloc()
+        return jsonify({"status": "success", "mensagem": "tracemalloc desligado"}), 200
+    agrupar = request.args.get("agrupar", "lineno")
+    if agrupar not in MonitorMemoria.AGRUPAMENTOS:
+        return jsonify({"status": "Erro", "mensagem": f"Agrupamento inválido: {agrupar}"}), 400
+    if not tracemalloc.is_tracing():
+        monitor_memoria.ativar_tracemalloc()
+        return jsonify({"status": "success", "mensagem": "tracemalloc ligado; as alocações são seguidas a partir de agora"}), 202
+    top = min(max(request.args.get("top", default=15, type=int), 1), 100)
+    comparar = request.args.get("comparar", "").lower() in ("1", "true")
+    return jsonify({"status": "success", "data": monitor_memoria.alocacoes(top, agrupar, comparar)}), 200
+
+@app.route("/bd", methods=["GET"])
+@log_exceptions
+def estado_bd():
+    """Estado dos disjuntores da BD (um por servidor/BD), sem tentar ligar"""
+    disjuntores = [d.estado() for d in list(disjuntores_bd.values())]
+    return jsonify({
+        "status": "success",
+        "data": {
+            "Disponivel": all(d["Posicao"] != DisjuntorBD.ABERTO for d in disjuntores),
+            "Disjuntores": disjuntores,
+        }
+    }), 200
+
+@app.route("/historico-local", methods=["GET"])
+@log_exceptions
+def estado_historico_local():
+    """Ordens, amostras e tamanho do histórico local"""
+    if historico_local is None:
+        return jsonify({"status": "Erro", "mensagem": "Histórico local desativado"}), 404
+    return jsonify({"status": "success", "data": historico_local.estado()}), 200
+
+@app.route("/arranque", methods=["GET"])
+@log_exceptions
+def arranque():
+    """Relatório de arranque: fases (ms desde o início do main.py) e importações tardias"""
+    return jsonify({
+        "status": "success",
+        "data": {
+            "Fases": relatorio_arranque,
+            "Importacoes": importacoes_preguicosas,
+            "InterpretadorMs": _tempo_interpretador_ms(),
+        }
+    }), 200
+
+@app.route("/linhas", methods=["GET"])
+@log_exceptions
+def listar_linhas():
+    """Lista as linhas geridas por este processo e o seu estado resumido"""
+    dados = []
+    for contador_linha in linhas.todas():
+        dados.append({
+            "Linha": contador_linha.linha_id,
+            "SensorPin": contador_linha.SENSOR_PIN,
+            "DoorPin": contador_linha.DOOR_PIN,
+            "Ordem": contador_linha.Ordem,
+            "ContagemAtual": contador_linha.ContagemAtual,
+            "ContagemTotal": contador_linha.ContagemTotal,
+            "EstadoContador": contador_linha.EstadoContador,
+            "EstadoPorta": contador_linha.EstadoPorta,
+            "EscritasPendentes": contador_linha.escritor.pendentes(),
+        })
+    return jsonify({"data": dados}), 200
+
+@bp.route("/recuperacao", methods=["GET"])
+@log_exceptions
+def recuperacao():
+    """Relatório da última recuperação de estado: fontes, contagem escolhida e discrepâncias"""
+    contador = contador_pedido()
+    return jsonify({"data": contador.relatorio_recuperacao}), 200
+
+@bp.route("/aproximacao", methods=["GET"])
+@log_exceptions
+def aproximacao():
+    """Aviso de aproximação ao objetivo, ritmo atual e excesso medido nas últimas ordens"""
+    contador = contador_pedido()
+    quente = contador.quente
+    historico = list(contador.sobrecontagens)
+    excessos = [registo["Excesso"] for registo in historico]
+    dados = {
+        "AvisoAtivo": quente.aviso_ativo,
+        "AvisoPin": contador.AVISO_PIN,
+        "AvisoGarrafas": contador.aproximacao_garrafas,
+        "AvisoSegundos": contador.aproximacao_segundos,
+        "RitmoGarrafasHora": round(3600 / quente.intervalo_medio, 0) if quente.intervalo_medio else 0,
+        "ObservarExcesso": quente.fecho is not None,
+        "ExcessoMedio": round(sum(excessos) / len(excessos), 2) if excessos else None,
+        "ExcessoMaximo": max(excessos) if excessos else None,
+        "Ordens": historico,
+    }
+    return jsonify({"data": dados}), 200
+
+@bp.route("/eventos-ordem", methods=["GET"])
+@log_exceptions
+def eventos_ordem():
+    """Estado do ciclo de vida da ordem e os últimos eventos aplicados"""
+    contador = contador_pedido()
+    with contador._state_lock:
+        dados = {"Estado": contador.estado, "Eventos": list(contador.eventos_ordem)}
+    return jsonify({"data": dados}), 200
+
+@bp.route("/configurar-sensor", methods=["GET"])
 @log_exceptions
 def configurar_sensor():
     """
     Endpoint para configurar parâmetros do sensor para ajudar na depuração
     """
+    contador = contador_pedido()
     invert = request.args.get('inverter', default=None)
     pullup = request.args.get('pullup', default=None)
     
@@ -1768,12 +6200,13 @@ def configurar_sensor():
             }
         }), 200
 
-@app.route("/teste-incremento", methods=["GET"])
+@bp.route("/teste-incremento", methods=["GET"])
 @log_exceptions
 def teste_incremento():
     """
     Incrementa manualmente a contagem para depuração
     """
+    contador = contador_pedido()
     try:
         if contador.EstadoContador == 1 and not contador.EstadoPausa:
             with contador._contagem_lock:
@@ -1798,12 +6231,13 @@ def teste_incremento():
         logging.error(f"Erro ao incrementar contagem: {e}")
         return jsonify({"status": "error", "message": f"Erro ao incrementar contagem: {e}"}), 500
 
-@app.route("/sensor-info", methods=["GET"])
+@bp.route("/sensor-info", methods=["GET"])
 @log_exceptions
 def sensor_info():
     """
     Retorna informações de diagnóstico sobre o sensor
     """
+    contador = contador_pedido()
     try:
         # Ler o estado atual do sensor
         sensor_state = None
@@ -1828,28 +6262,47 @@ def sensor_info():
         logging.error(f"Erro ao obter informações do sensor: {e}")
         return jsonify({"status": "error", "message": f"Erro ao obter informações: {e}"}), 500
 
-if __name__ == "__main__":
+if MODO_AGREGADOR:
+    app.register_blueprint(bp_agregador)
+else:
+    # Registar as rotas do contador: na raiz para a linha por omissão e com prefixo por linha
+    app.register_blueprint(bp)
+    app.register_blueprint(bp, url_prefix="/linha/<linha_id>", name="linha")
+
+def executar():
+    """Arranque do processo: sistema (ou agregador) primeiro, depois o servidor HTTP"""
     try:
-        # Registrar limpeza de GPIO no encerramento
-        atexit.register(GPIO.cleanup)
-        
         # Inicializar sistema
-        init_main()
+        if MODO_AGREGADOR:
+            init_agregador()
+        else:
+            init_main()
+            # Registrar limpeza de GPIO no encerramento
+            atexit.register(GPIO.cleanup)
+        
+        porta_http = CONFIG.get("porta_http")
+        marcar_arranque("servidor_http")
+        sd_notify("READY=1")  # Type=notify: o systemd só considera o serviço ativo a partir daqui
         
         # Configurar contexto SSL para HTTPS
         try:
             context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
             context.load_cert_chain(certfile="CERT.crt", keyfile="CERT.key")
-            app.run(host="0.0.0.0", port=443, ssl_context=context, threaded=True)
+            app.run(host="0.0.0.0", port=porta_http or 443, ssl_context=context, threaded=True)
         except Exception as ssl_error:
             logging.error(f"Erro ao iniciar servidor HTTPS: {ssl_error}")
             # Fallback para HTTP em caso de erro SSL
             logging.warning("Iniciando em modo HTTP (sem SSL) como fallback")
-            app.run(host="0.0.0.0", port=8080, threaded=True)
+            app.run(host="0.0.0.0", port=porta_http or 8080, threaded=True)
     except KeyboardInterrupt:
         logging.info("Servidor encerrado por interrupção do teclado")
-        GPIO.cleanup()
+        if not MODO_AGREGADOR:
+            GPIO.cleanup()
     except Exception as e:
         logging.critical(f"Erro fatal: {e}")
         logging.critical(traceback.format_exc())
-        GPIO.cleanup()
+        if not MODO_AGREGADOR:
+            GPIO.cleanup()
+
+if __name__ == "__main__":
+    executar()
@@ -38,6 +38,10 @@ Description=Krones Contador de Garrafas
 After=network.target
 
 [Service]
+Type=notify
+NotifyAccess=main
+WatchdogSec=30
+TimeoutStopSec=30
 User=pi
 WorkingDirectory=/home/pi/krones
 ExecStart=/home/pi/krones/venv/bin/python /home/pi/krones/main.py
@@ -31,6 +31,11 @@ cp -f main.py $INSTALL_DIR/
 cp -f requirements.txt $INSTALL_DIR/
 cp -f README.md $INSTALL_DIR/
 
+# Copia a configuração apenas se fornecida (senão mantém a existente)
+if [ -f "config.json" ]; then
+  cp -f config.json $INSTALL_DIR/
+fi
+
 # Atualiza certificados apenas se fornecidos
 if [ -f "CERT.crt" ] && [ -f "CERT.key" ]; then
   cp -f CERT.crt $INSTALL_DIR/